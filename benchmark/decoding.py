@@ -0,0 +1,75 @@
+import argparse
+import json
+import timeit
+from datetime import datetime
+from controller import decoders
+from controller.decoders import PayloadDecoder
+
+# Messages of the dummy devices
+PAYLOADS = {
+	"temperature": b'{"temperature": 26.5}',
+	"time": b'{"time": "08:00:00"}',
+	"state": b'{"state": "ON"}',
+}
+
+def legacy_decode(payload: bytes):
+	"""
+	Function to decode a message as the controller did before the
+	decoders: JSON parsing, keys list and the `if` chain of the values.
+	Args:
+		payload (bytes): The payload of the message.
+	Returns:
+		The variable name, and the converted value.
+	"""
+	message = json.loads(payload.decode())
+	keys = list(message.keys())
+	if len(keys) != 1:
+		raise ValueError("Too many keys in the message")
+	key = keys[0]
+	value = message.get(key)
+	if key == 'temperature':
+		return key, float(value)
+	if key == 'time':
+		return key, datetime.strptime(value, '%H:%M:%S').time()
+	if key == 'state':
+		if value != 'ON' and value != 'OFF':
+			raise ValueError("Invalid value for state")
+		return key, value
+	raise ValueError("Invalid key")
+
+def measure(function, payload: bytes, number: int) -> float:
+	"""
+	Function to measure the time of decoding a message.
+	Args:
+		function (Callable): The decoding function.
+		payload (bytes): The payload of the message.
+		number (int): Times that the message is decoded, in each repetition.
+	Returns:
+		float: The best time per message, in microseconds.
+	"""
+	times = timeit.repeat(lambda: function(payload), number=number, repeat=7)
+	return min(times) / number * 1e6
+
+def main():
+	"""
+	Main function of the benchmark.
+	"""
+	params = argparse.ArgumentParser(
+		description="Micro-benchmark of the decoding of the state messages"
+	)
+	params.add_argument(
+		"--number", type=int, default=100000,
+		help="Messages decoded in each repetition (default: %(default)s)"
+	)
+	args = params.parse_args()
+
+	decoder = PayloadDecoder()
+	print(f"Accelerated JSON parser: {'orjson' if decoders.orjson else 'not installed'}")
+	print(f"{'variable':<12} {'before (us)':>12} {'after (us)':>12} {'speedup':>8}")
+	for key, payload in PAYLOADS.items():
+		before = measure(legacy_decode, payload, args.number)
+		after = measure(decoder.decode, payload, args.number)
+		print(f"{key:<12} {before:>12.2f} {after:>12.2f} {before / after:>7.1f}x")
+
+if __name__ == '__main__':
+	main()
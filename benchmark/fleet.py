@@ -0,0 +1,355 @@
+import argparse
+import concurrent.futures
+import itertools
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+from paho.mqtt.client import MQTTMessage
+from controller.IOTController import IOTController, STATE_TOPIC
+from .report import environment, percentile, peak_rss_kb, write_report
+
+# Tables that the controller uses, with the columns of the Django models
+SCHEMA = """
+CREATE TABLE app_device (
+	id varchar(128) NOT NULL PRIMARY KEY,
+	host varchar(128) NOT NULL,
+	port integer unsigned NOT NULL,
+	pid integer NULL
+);
+CREATE TABLE app_rule (
+	id integer NOT NULL PRIMARY KEY AUTOINCREMENT,
+	name varchar(128) NOT NULL,
+	operator varchar(2) NOT NULL,
+	threshold varchar(128) NOT NULL,
+	"trigger" varchar(10) NOT NULL,
+	hysteresis real NOT NULL,
+	priority integer NOT NULL,
+	aggregate varchar(10) NOT NULL DEFAULT '',
+	window real NOT NULL DEFAULT 0,
+	duration real NOT NULL DEFAULT 0,
+	command_payload text NOT NULL,
+	created_at datetime NOT NULL,
+	updated_at datetime NOT NULL,
+	source_device_id varchar(128) NOT NULL REFERENCES app_device (id),
+	target_device_id varchar(128) NOT NULL REFERENCES app_device (id)
+);
+CREATE INDEX app_rule_source_device_id ON app_rule (source_device_id);
+CREATE TABLE app_compoundrule (
+	id integer NOT NULL PRIMARY KEY AUTOINCREMENT,
+	name varchar(128) NOT NULL,
+	"trigger" varchar(10) NOT NULL,
+	priority integer NOT NULL,
+	command_payload text NOT NULL,
+	created_at datetime NOT NULL,
+	updated_at datetime NOT NULL,
+	target_device_id varchar(128) NOT NULL REFERENCES app_device (id)
+);
+CREATE TABLE app_compoundcondition (
+	id integer NOT NULL PRIMARY KEY AUTOINCREMENT,
+	variable varchar(16) NOT NULL,
+	operator varchar(2) NOT NULL,
+	threshold varchar(128) NOT NULL,
+	device_id varchar(128) NOT NULL REFERENCES app_device (id),
+	rule_id integer NOT NULL REFERENCES app_compoundrule (id)
+);
+CREATE TABLE app_log (
+	id integer NOT NULL PRIMARY KEY AUTOINCREMENT,
+	timestamp datetime NOT NULL,
+	device varchar(128) NOT NULL,
+	message text NOT NULL
+);
+"""
+
+# Weight of each operator in the rules
+OPERATOR_MIXES = {
+	"ranges": {">": 1, "<": 1, ">=": 1, "<=": 1},
+	"equality": {"==": 1, "!=": 1},
+	"mixed": {">": 1, "<": 1, ">=": 1, "<=": 1, "==": 1, "!=": 1},
+}
+
+# Temperatures sent by the sensors (the thresholds are uniform in the same range)
+DISTRIBUTIONS = {
+	"uniform": lambda generator, base: generator.uniform(0, 50),
+	"normal": lambda generator, base: generator.gauss(25, 5),
+	"constant": lambda generator, base: base,
+}
+
+def create_database(
+	path: str,
+	devices: int,
+	rules_per_device: int,
+	operators: str,
+	seed: int
+) -> None:
+	"""
+	Function to create a database with a fleet of sensors, each one with
+	its rules, which control a switch.
+	Args:
+		path (str): File of the database.
+		devices (int): Number of sensors (and of switches).
+		rules_per_device (int): Rules of each sensor.
+		operators (str): Name of the operator mix of the rules.
+		seed (int): Seed of the random thresholds and operators.
+	"""
+	generator = random.Random(seed)
+	choices, weights = zip(*OPERATOR_MIXES[operators].items())
+	now = "2025-01-01 00:00:00"
+
+	database = sqlite3.connect(path)
+	database.executescript(SCHEMA)
+	database.executemany(
+		"INSERT INTO app_device (id, host, port, pid) VALUES (?, 'localhost', 1883, NULL)",
+		[(f"{kind}-{i}",) for i in range(devices) for kind in ("sensor", "switch")]
+	)
+	database.executemany(
+		"INSERT INTO app_rule (name, operator, threshold, \"trigger\", hysteresis, priority,"
+		" command_payload, created_at, updated_at, source_device_id, target_device_id)"
+		" VALUES (?, ?, ?, 'level', 0, 0, ?, ?, ?, ?, ?)",
+		[
+			(
+				f"Rule {i}.{j}",
+				generator.choices(choices, weights)[0],
+				str(generator.randrange(0, 101) / 2),
+				'{"cmd":"set","state":"%s"}' % generator.choice(("ON", "OFF")),
+				now,
+				now,
+				f"sensor-{i}",
+				f"switch-{generator.randrange(devices)}",
+			)
+			for i in range(devices)
+			for j in range(rules_per_device)
+		]
+	)
+	database.commit()
+	database.close()
+
+def create_messages(
+	devices: int,
+	distribution: str,
+	number: int,
+	seed: int
+) -> List[MQTTMessage]:
+	"""
+	Function to create the state messages of the sensors, from random devices.
+	Args:
+		devices (int): Number of sensors.
+		distribution (str): Name of the distribution of the values.
+		number (int): Number of messages.
+		seed (int): Seed of the devices and values.
+	Returns:
+		List[MQTTMessage]: The messages, as the MQTT client gives them.
+	"""
+	generator = random.Random(seed)
+	value = DISTRIBUTIONS[distribution]
+	bases = [round(generator.uniform(0, 50), 2) for _ in range(devices)]
+
+	messages = []
+	for _ in range(number):
+		device = generator.randrange(devices)
+		message = MQTTMessage(topic=STATE_TOPIC.format(f"sensor-{device}").encode())
+		message.payload = json.dumps(
+			{"temperature": round(value(generator, bases[device]), 2)}
+		).encode()
+		messages.append(message)
+	return messages
+
+def run_case(case: Dict[str, Any], database: str, messages: int, warmup: int, seed: int) -> Dict[str, Any]:
+	"""
+	Function to run a case of the benchmark: the messages are given to
+	`on_message` of a controller (without broker), as fast as possible.
+	It is run in its own process, so the peak RSS is the one of the case.
+	Args:
+		case (Dict[str, Any]): The devices, rules per device, distribution,
+			operator mix and workers of the case.
+		database (str): File of the seeded database.
+		messages (int): Number of messages measured.
+		warmup (int): Number of messages processed before measuring.
+		seed (int): Seed of the messages.
+	Returns:
+		Dict[str, Any]: The case, with its results.
+	"""
+	batch = create_messages(case["devices"], case["distribution"], warmup + messages, seed)
+
+	controller = IOTController(
+		host="localhost",
+		port=1883,
+		database=database,
+		workers=case["workers"],
+		queue_size=max(1000, warmup + messages)
+	)
+
+	# The commands are only counted
+	published = [0]
+	def publish(topic, payload=None, qos=0, retain=False):
+		published[0] += 1
+	controller.client.publish = publish
+
+	# Time of processing each message
+	latencies = []
+	process_message = controller.process_message
+	def timed_process_message(device_id, payload):
+		start = time.perf_counter()
+		process_message(device_id, payload)
+		latencies.append(time.perf_counter() - start)
+	controller.process_message = timed_process_message
+
+	def feed(batch):
+		for message in batch:
+			controller.on_message(controller.client, None, message)
+		if controller.workers is not None:
+			controller.workers.join()
+
+	controller.start_processing()
+	feed(batch[:warmup])
+	controller.logs.join()
+	latencies.clear()
+	published[0] = 0
+
+	# Until the logs are written (stopping the writer, to not wait for the batch time)
+	start = time.perf_counter()
+	feed(batch[warmup:])
+	controller.logs.stop()
+	elapsed = time.perf_counter() - start
+	dropped = controller.logs.dropped
+	controller.stop()
+
+	latencies.sort()
+	return dict(
+		case,
+		messages=messages,
+		seconds=elapsed,
+		msgs_per_sec=messages / elapsed,
+		p50_us=percentile(latencies, 0.50) * 1e6,
+		p99_us=percentile(latencies, 0.99) * 1e6,
+		max_us=latencies[-1] * 1e6 if latencies else 0.0,
+		commands=published[0],
+		logs_dropped=dropped,
+		peak_rss_kb=peak_rss_kb(),
+	)
+
+def compare(baseline: Dict[str, Any], report: Dict[str, Any]) -> str:
+	"""
+	Function to compare the results with the ones of other run (like other commit).
+	Args:
+		baseline (Dict[str, Any]): The report of the other run.
+		report (Dict[str, Any]): The report of this run.
+	Returns:
+		str: The throughput and p99 of each case in both runs.
+	"""
+	def key(result):
+		return tuple(result[name] for name in ("devices", "rules_per_device", "distribution", "operators", "workers"))
+	old = {key(result): result for result in baseline["results"]}
+
+	lines = [f"{'case':<40} {'msgs/s':<31} {'p99 (us)'}"]
+	for result in report["results"]:
+		case = "/".join(str(value) for value in key(result))
+		before = old.get(key(result))
+		if before is None:
+			lines.append(f"{case:<40} {result['msgs_per_sec']:<31.0f} {result['p99_us']:.1f}")
+			continue
+		lines.append(
+			f"{case:<40}"
+			f" {before['msgs_per_sec']:>8.0f} -> {result['msgs_per_sec']:<8.0f}({result['msgs_per_sec'] / before['msgs_per_sec']:.2f}x)"
+			f" {before['p99_us']:>8.1f} -> {result['p99_us']:<8.1f}"
+		)
+	return "\n".join(lines)
+
+def main():
+	"""
+	Main function of the benchmark.
+	"""
+	params = argparse.ArgumentParser(
+		description="Throughput benchmark of the controller, with synthetic fleets of sensors"
+	)
+	params.add_argument(
+		"--devices", type=int, nargs="+", default=[100, 1000],
+		help="Numbers of sensors of the fleets (default: %(default)s)"
+	)
+	params.add_argument(
+		"--rules", type=int, nargs="+", default=[1, 10],
+		help="Numbers of rules of each sensor (default: %(default)s)"
+	)
+	params.add_argument(
+		"--distributions", nargs="+", choices=DISTRIBUTIONS.keys(), default=["uniform"],
+		help="Distributions of the values sent by the sensors (default: %(default)s)"
+	)
+	params.add_argument(
+		"--operators", nargs="+", choices=OPERATOR_MIXES.keys(), default=["mixed"],
+		help="Operator mixes of the rules (default: %(default)s)"
+	)
+	params.add_argument(
+		"--workers", type=int, nargs="+", default=[0],
+		help="Worker threads of the controller; 0 processes the messages in the caller (default: %(default)s)"
+	)
+	params.add_argument(
+		"--messages", type=int, default=20000,
+		help="Messages measured in each case (default: %(default)s)"
+	)
+	params.add_argument(
+		"--warmup", type=int, default=1000,
+		help="Messages processed before measuring (default: %(default)s)"
+	)
+	params.add_argument(
+		"--seed", type=int, default=2312,
+		help="Seed of the databases and messages (default: %(default)s)"
+	)
+	params.add_argument(
+		"--output", default=None,
+		help="File where the JSON report is written (default: standard output)"
+	)
+	params.add_argument(
+		"--baseline", default=None,
+		help="JSON report of other run, to compare with it (written to the standard error)"
+	)
+	args = params.parse_args()
+
+	if min(args.devices) <= 0 or min(args.rules) < 0 or min(args.workers) < 0:
+		params.error("The devices must be greater than 0, and the rules and workers greater or equal than 0")
+	if args.messages <= 0 or args.warmup < 0:
+		params.error("The messages must be greater than 0, and the warmup greater or equal than 0")
+
+	results = []
+	cases = itertools.product(args.devices, args.rules, args.distributions, args.operators, args.workers)
+	with tempfile.TemporaryDirectory() as directory:
+		for devices, rules, distribution, operators, workers in cases:
+			case = {
+				"devices": devices,
+				"rules_per_device": rules,
+				"distribution": distribution,
+				"operators": operators,
+				"workers": workers,
+			}
+			database = os.path.join(directory, f"fleet-{len(results)}.sqlite3")
+			create_database(database, devices, rules, operators, args.seed)
+
+			# Each case in a new process
+			with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+				result = executor.submit(
+					run_case, case, database, args.messages, args.warmup, args.seed
+				).result()
+			results.append(result)
+			print(
+				f"[ Benchmark ] {devices} devices, {rules} rules, {distribution}, {operators}, {workers} workers:"
+				f" {result['msgs_per_sec']:.0f} msgs/s, p99 {result['p99_us']:.1f}us",
+				file=sys.stderr
+			)
+
+	report = {
+		"benchmark": "fleet",
+		"environment": environment(),
+		"seed": args.seed,
+		"results": results,
+	}
+	write_report(report, args.output)
+
+	if args.baseline is not None:
+		with open(args.baseline) as file:
+			print(compare(json.load(file), report), file=sys.stderr)
+
+if __name__ == '__main__':
+	main()
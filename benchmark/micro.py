@@ -0,0 +1,116 @@
+import argparse
+import os
+import sqlite3
+import tempfile
+import timeit
+from datetime import datetime
+from controller.database_communication import create_connection, add_log, add_logs
+from controller.values import OPERATORS, get_correct_value, compare_values
+from .fleet import SCHEMA
+from .report import environment, write_report
+
+# Values of each variable, as they are in the messages and the thresholds
+VALUES = {
+	"temperature": "26.5",
+	"time": "08:00:00",
+	"state": "ON",
+}
+
+def measure(function, number: int) -> float:
+	"""
+	Function to measure the time of a call.
+	Args:
+		function (Callable): The function, without arguments.
+		number (int): Calls in each repetition.
+	Returns:
+		float: The best time per call, in microseconds.
+	"""
+	times = timeit.repeat(function, number=number, repeat=5)
+	return min(times) / number * 1e6
+
+def measure_values(number: int) -> dict:
+	"""
+	Function to measure the conversion of the values of each variable.
+	Args:
+		number (int): Calls in each repetition.
+	Returns:
+		dict: Microseconds per call, by variable.
+	"""
+	return {
+		key: measure(lambda: get_correct_value(key, value), number)
+		for key, value in VALUES.items()
+	}
+
+def measure_comparisons(number: int) -> dict:
+	"""
+	Function to measure the comparison of two temperatures with each operator.
+	Args:
+		number (int): Calls in each repetition.
+	Returns:
+		dict: Microseconds per call, by operator.
+	"""
+	return {
+		operator: measure(lambda: compare_values(26.5, 25.0, operator), number)
+		for operator in OPERATORS
+	}
+
+def measure_logs(number: int) -> dict:
+	"""
+	Function to measure the insertion of the logs in a database, one
+	by one (a transaction each) and in batches.
+	Args:
+		number (int): Logs inserted in each repetition.
+	Returns:
+		dict: Microseconds per log, by way of inserting them.
+	"""
+	with tempfile.TemporaryDirectory() as directory:
+		path = os.path.join(directory, "logs.sqlite3")
+		database = sqlite3.connect(path)
+		database.executescript(SCHEMA)
+		database.close()
+
+		# Same connection settings as the controller
+		connection = create_connection(path, busy_timeout=5000)
+		batch = [("Rule 'Benchmark' applied", "sensor-0", datetime.now())] * 500
+		results = {
+			"add_log": measure(lambda: add_log(connection, "Rule 'Benchmark' applied", "sensor-0"), number),
+			"add_logs (500)": measure(lambda: add_logs(connection, batch), max(1, number // 500)) / 500,
+		}
+		connection.close()
+	return results
+
+def main():
+	"""
+	Main function of the benchmark.
+	"""
+	params = argparse.ArgumentParser(
+		description="Micro-benchmarks of the values, comparisons and logs of the controller"
+	)
+	params.add_argument(
+		"--number", type=int, default=100000,
+		help="Calls in each repetition (default: %(default)s)"
+	)
+	params.add_argument(
+		"--log-number", type=int, default=2000,
+		help="Logs inserted in each repetition (default: %(default)s)"
+	)
+	params.add_argument(
+		"--output", default=None,
+		help="File where the JSON report is written (default: standard output)"
+	)
+	args = params.parse_args()
+
+	if args.number <= 0 or args.log_number <= 0:
+		params.error("The number of calls and logs must be greater than 0")
+
+	write_report({
+		"benchmark": "micro",
+		"environment": environment(),
+		"unit": "us",
+		"get_correct_value": measure_values(args.number),
+		"compare_values": measure_comparisons(args.number),
+		"logs": measure_logs(args.log_number),
+	}, args.output)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,72 @@
+import json
+import math
+import platform
+import resource
+import subprocess
+import sys
+from typing import Any, Dict, List, Optional
+from controller import decoders
+
+def environment() -> Dict[str, Any]:
+	"""
+	Function to describe where a benchmark has been run, so the results
+	of different commits can be compared.
+	Returns:
+		Dict[str, Any]: The commit, the Python version, the machine, and if
+			the accelerated JSON parser is installed.
+	"""
+	try:
+		commit = subprocess.run(
+			["git", "rev-parse", "--short", "HEAD"],
+			capture_output=True,
+			text=True,
+			check=True
+		).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		commit = None
+	return {
+		"commit": commit,
+		"python": platform.python_version(),
+		"machine": platform.machine(),
+		"orjson": decoders.orjson is not None,
+	}
+
+def percentile(values: List[float], fraction: float) -> float:
+	"""
+	Function to get a percentile of some sorted values.
+	Args:
+		values (List[float]): The values, sorted.
+		fraction (float): The percentile, between 0 and 1.
+	Returns:
+		float: The value of the percentile (nearest rank), or 0 if there are no values.
+	"""
+	if not values:
+		return 0.0
+	index = max(0, min(len(values) - 1, math.ceil(fraction * len(values)) - 1))
+	return values[index]
+
+def peak_rss_kb() -> int:
+	"""
+	Function to get the peak resident memory of the process.
+	Returns:
+		int: The peak RSS, in KiB.
+	"""
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# macOS gives it in bytes
+	if sys.platform == "darwin":
+		peak //= 1024
+	return peak
+
+def write_report(report: Dict[str, Any], output: Optional[str] = None) -> None:
+	"""
+	Function to write the report of a benchmark as JSON.
+	Args:
+		report (Dict[str, Any]): The report.
+		output (str): File where it is written (None: the standard output).
+	"""
+	text = json.dumps(report, indent=2)
+	if output is None:
+		print(text)
+		return
+	with open(output, "w") as file:
+		file.write(text + "\n")
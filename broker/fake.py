@@ -0,0 +1,481 @@
+import functools
+import itertools
+import queue
+import threading
+import traceback
+from typing import Any, Dict, List, Optional, Tuple, Union
+import paho.mqtt.client as mqtt
+from .topics import TopicTree, valid_topic, valid_filter, retained_matches
+
+# Events of the queue of a client
+_CONNECT = "connect"
+_MESSAGE = "message"
+_PUBLISHED = "published"
+_DISCONNECT = "disconnect"
+_STOP = "stop"
+
+class FakeBroker:
+	"""
+	In-process broker for the unit tests: the messages published by its
+	clients (`FakeClient`) are given to the subscribers without sockets,
+	with the same rules as the embedded broker (wildcards, retained
+	messages, QoS 0 and 1).
+
+	Each client receives its messages in the thread of its loop, like
+	the paho client, and `join` waits until all of them have been handled.
+	"""
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._clients: Dict[str, "FakeClient"] = {}
+		self._subscriptions = TopicTree()
+		self.retained: Dict[str, mqtt.MQTTMessage] = {}
+		self._ids = itertools.count(1)
+
+		# Events queued in each client that have not been handled
+		self._pending: Dict["FakeClient", int] = {}
+		self._idle = threading.Condition(self._lock)
+
+		# All the published messages, and the errors of the callbacks
+		self.published: List[mqtt.MQTTMessage] = []
+		self.errors: List[BaseException] = []
+
+	@property
+	def clients(self) -> List[str]:
+		"""
+		Returns the ids of the connected clients.
+		"""
+		with self._lock:
+			return list(self._clients)
+
+	def client(self, client_id: str = "", **kwargs) -> "FakeClient":
+		"""
+		Create a client of the broker.
+		Args:
+			client_id (str): The client id (empty: a new one when it connects).
+		Returns:
+			FakeClient: The client.
+		"""
+		return FakeClient(self, client_id, **kwargs)
+
+	def bind(self, cls: type) -> type:
+		"""
+		Get a subclass of a class with an MQTT client (with the `MQTT_CLIENT`
+		attribute, like the controller and the devices) that uses the
+		clients of this broker.
+		Args:
+			cls (type): The class.
+		Returns:
+			type: The subclass.
+		"""
+		return type(cls.__name__, (cls,), {"MQTT_CLIENT": functools.partial(FakeClient, self)})
+
+	def publish(self, topic: str, payload: Any = None, qos: int = 0, retain: bool = False) -> None:
+		"""
+		Publish a message from the broker.
+		Args:
+			topic (str): The topic.
+			payload (Any): The payload.
+			qos (int): The QoS.
+			retain (bool): If the message is retained.
+		"""
+		self._route(_message(topic, payload, qos, retain))
+
+	def messages(self, topic_filter: str = "#") -> List[mqtt.MQTTMessage]:
+		"""
+		Get the published messages whose topic matches a filter.
+		Args:
+			topic_filter (str): The topic filter.
+		Returns:
+			List[mqtt.MQTTMessage]: The messages, in order.
+		"""
+		tree = TopicTree()
+		tree.subscribe(topic_filter, None, 0)
+		with self._lock:
+			return [message for message in self.published if None in tree.match(message.topic)]
+
+	def join(self, timeout: Optional[float] = None) -> bool:
+		"""
+		Wait until the clients with a loop running have handled all their
+		messages (and the ones published meanwhile).
+		Args:
+			timeout (float): Max seconds to wait.
+		Returns:
+			bool: False if the time has ended.
+		"""
+		def idle():
+			return not any(
+				pending for client, pending in self._pending.items() if client._looping
+			)
+		with self._idle:
+			return self._idle.wait_for(idle, timeout)
+
+	def _queue(self, client: "FakeClient", event: tuple) -> None:
+		"""
+		Queue an event in a client. The caller must hold the lock.
+		"""
+		self._pending[client] = self._pending.get(client, 0) + 1
+		client._inbox.put(event)
+
+	def _done(self, client: "FakeClient") -> None:
+		"""
+		An event of a client has been handled.
+		"""
+		with self._idle:
+			self._pending[client] -= 1
+			self._idle.notify_all()
+
+	def _looping(self, client: "FakeClient", looping: bool) -> None:
+		"""
+		The loop of a client has started or ended.
+		"""
+		with self._idle:
+			client._looping = looping
+			self._idle.notify_all()
+
+	def _connect(self, client: "FakeClient") -> None:
+		"""
+		Connect a client (if there was other with the same id, it is disconnected).
+		"""
+		with self._lock:
+			if not client._client_id:
+				client._client_id = f"fake-{next(self._ids)}"
+			previous = self._clients.get(client._client_id)
+			self._clients[client._client_id] = client
+			client._connected = True
+			self._queue(client, (_CONNECT,))
+		if previous is not None and previous is not client:
+			previous._drop()
+
+	def _disconnect(self, client: "FakeClient") -> None:
+		"""
+		Disconnect a client.
+		"""
+		with self._lock:
+			self._subscriptions.remove(client, client._filters)
+			client._filters = {}
+			client._connected = False
+			if self._clients.get(client._client_id) is client:
+				del self._clients[client._client_id]
+			self._queue(client, (_DISCONNECT,))
+
+	def _subscribe(self, client: "FakeClient", filters: List[Tuple[str, int]]) -> List[int]:
+		"""
+		Subscribe a client to some filters, queueing the retained messages.
+		Returns:
+			List[int]: The granted QoS of each filter (128 if it is not valid).
+		"""
+		granted = []
+		with self._lock:
+			for topic_filter, qos in filters:
+				if not valid_filter(topic_filter):
+					granted.append(128)
+					continue
+				qos = min(qos, 1)
+				granted.append(qos)
+				self._subscriptions.subscribe(topic_filter, client, qos)
+				client._filters[topic_filter] = qos
+				for message in retained_matches(self.retained, topic_filter).values():
+					self._queue(client, (_MESSAGE, _copy(message, min(message.qos, qos), True)))
+		return granted
+
+	def _unsubscribe(self, client: "FakeClient", filters: List[str]) -> None:
+		"""
+		Unsubscribe a client from some filters.
+		"""
+		with self._lock:
+			for topic_filter in filters:
+				self._subscriptions.unsubscribe(topic_filter, client)
+				client._filters.pop(topic_filter, None)
+
+	def _route(self, message: mqtt.MQTTMessage) -> None:
+		"""
+		Queue a message in its subscribers, and keep it if it is retained.
+		"""
+		with self._lock:
+			self.published.append(message)
+			if message.retain:
+				if message.payload:
+					self.retained[message.topic] = message
+				else:
+					self.retained.pop(message.topic, None)
+			for client, qos in self._subscriptions.match(message.topic).items():
+				self._queue(client, (_MESSAGE, _copy(message, min(message.qos, qos), False)))
+
+class FakeClient:
+	"""
+	Client of a `FakeBroker`, with the part of the interface of the paho
+	client that the controller and the devices use (version 1 callbacks).
+	"""
+	def __init__(
+		self,
+		broker: FakeBroker,
+		client_id: str = "",
+		clean_session: Optional[bool] = None,
+		userdata: Any = None,
+		**kwargs
+	):
+		"""
+		Constructor of the FakeClient class.
+		Args:
+			broker (FakeBroker): The broker.
+			client_id (str): The client id (empty: a new one when it connects).
+			userdata (Any): The data given to the callbacks.
+		"""
+		self._broker = broker
+		self._client_id = client_id
+		self._userdata = userdata
+
+		# Callbacks
+		self.on_connect = None
+		self.on_disconnect = None
+		self.on_message = None
+		self.on_publish = None
+		self._callbacks: Dict[str, Any] = {}
+
+		# State, and the events that the loop handles
+		self._connected = False
+		self._filters: Dict[str, int] = {}
+		self._inbox: "queue.Queue[tuple]" = queue.Queue()
+		self._mids = itertools.count(1)
+		self._thread: Optional[threading.Thread] = None
+		self._looping = False
+
+	def user_data_set(self, userdata: Any) -> None:
+		"""
+		Set the data given to the callbacks.
+		"""
+		self._userdata = userdata
+
+	def message_callback_add(self, sub: str, callback) -> None:
+		"""
+		Set the callback of the messages whose topic matches a filter
+		(they are not given to `on_message`).
+		"""
+		self._callbacks[sub] = callback
+
+	def message_callback_remove(self, sub: str) -> None:
+		"""
+		Remove the callback of a filter.
+		"""
+		self._callbacks.pop(sub, None)
+
+	def is_connected(self) -> bool:
+		"""
+		Returns if the client is connected.
+		"""
+		return self._connected
+
+	def connect(self, host: str = "localhost", port: int = 1883, keepalive: int = 60, *args, **kwargs) -> int:
+		"""
+		Connect with the broker (the host and port are not used). The
+		`on_connect` callback is called from the loop.
+		"""
+		self._broker._connect(self)
+		return mqtt.MQTT_ERR_SUCCESS
+
+	def reconnect(self) -> int:
+		"""
+		Connect again with the broker.
+		"""
+		return self.connect()
+
+	def disconnect(self, *args, **kwargs) -> int:
+		"""
+		Disconnect from the broker: the loop (`loop_forever` or the thread
+		of `loop_start`) ends after calling `on_disconnect`.
+		"""
+		if not self._connected:
+			return mqtt.MQTT_ERR_NO_CONN
+		self._broker._disconnect(self)
+		return mqtt.MQTT_ERR_SUCCESS
+
+	def subscribe(
+		self,
+		topic: Union[str, Tuple[str, int], List[Tuple[str, int]]],
+		qos: int = 0,
+		*args,
+		**kwargs
+	) -> Tuple[int, Optional[int]]:
+		"""
+		Subscribe to a filter, a (filter, qos) tuple or a list of them.
+		Returns:
+			Tuple[int, int]: The result, and the message id.
+		"""
+		if not self._connected:
+			return mqtt.MQTT_ERR_NO_CONN, None
+		if isinstance(topic, str):
+			filters = [(topic, qos)]
+		elif isinstance(topic, tuple):
+			filters = [topic]
+		else:
+			filters = list(topic)
+		self._broker._subscribe(self, filters)
+		return mqtt.MQTT_ERR_SUCCESS, next(self._mids)
+
+	def unsubscribe(self, topic: Union[str, List[str]], *args, **kwargs) -> Tuple[int, Optional[int]]:
+		"""
+		Unsubscribe from a filter, or a list of them.
+		Returns:
+			Tuple[int, int]: The result, and the message id.
+		"""
+		if not self._connected:
+			return mqtt.MQTT_ERR_NO_CONN, None
+		self._broker._unsubscribe(self, [topic] if isinstance(topic, str) else list(topic))
+		return mqtt.MQTT_ERR_SUCCESS, next(self._mids)
+
+	def publish(
+		self,
+		topic: str,
+		payload: Any = None,
+		qos: int = 0,
+		retain: bool = False,
+		*args,
+		**kwargs
+	) -> mqtt.MQTTMessageInfo:
+		"""
+		Publish a message. It is queued in the subscribers before returning,
+		and `on_publish` is called from the loop (like when paho receives
+		the acknowledgement).
+		Returns:
+			mqtt.MQTTMessageInfo: The information of the message (already published).
+		"""
+		if not valid_topic(topic):
+			raise ValueError("Invalid topic")
+		info = mqtt.MQTTMessageInfo(next(self._mids))
+		if not self._connected:
+			info.rc = mqtt.MQTT_ERR_NO_CONN
+			return info
+		self._broker._route(_message(topic, payload, qos, retain))
+		info.rc = mqtt.MQTT_ERR_SUCCESS
+		info._set_as_published()
+		with self._broker._lock:
+			self._broker._queue(self, (_PUBLISHED, info.mid))
+		return info
+
+	def loop(self, timeout: float = 1.0, *args, **kwargs) -> int:
+		"""
+		Handle the queued events (waiting up to `timeout` for the first one).
+		"""
+		try:
+			event = self._inbox.get(timeout=timeout)
+		except queue.Empty:
+			return mqtt.MQTT_ERR_SUCCESS
+		while True:
+			if not self._handle(event):
+				break
+			try:
+				event = self._inbox.get_nowait()
+			except queue.Empty:
+				break
+		return mqtt.MQTT_ERR_SUCCESS
+
+	def loop_forever(self, *args, **kwargs) -> int:
+		"""
+		Handle the events, until the client disconnects.
+		"""
+		self._broker._looping(self, True)
+		try:
+			while self._handle(self._inbox.get()):
+				pass
+		finally:
+			self._broker._looping(self, False)
+		return mqtt.MQTT_ERR_SUCCESS
+
+	def loop_start(self) -> int:
+		"""
+		Handle the events in a thread.
+		"""
+		if self._thread is not None:
+			return mqtt.MQTT_ERR_INVAL
+		self._thread = threading.Thread(
+			target=self.loop_forever,
+			name=f"fake-client-{self._client_id}",
+			daemon=True
+		)
+		self._thread.start()
+		return mqtt.MQTT_ERR_SUCCESS
+
+	def loop_stop(self, *args, **kwargs) -> int:
+		"""
+		Stop the thread of `loop_start`.
+		"""
+		if self._thread is None:
+			return mqtt.MQTT_ERR_INVAL
+		if self._thread.is_alive():
+			with self._broker._lock:
+				self._broker._queue(self, (_STOP,))
+			self._thread.join()
+		self._thread = None
+		return mqtt.MQTT_ERR_SUCCESS
+
+	def _drop(self) -> None:
+		"""
+		Disconnected by the broker, because other client has the same id.
+		"""
+		with self._broker._lock:
+			self._broker._subscriptions.remove(self, self._filters)
+			self._filters = {}
+			self._connected = False
+			self._broker._queue(self, (_DISCONNECT,))
+
+	def _handle(self, event: tuple) -> bool:
+		"""
+		Handle an event, calling its callback.
+		Returns:
+			bool: False if the loop must end.
+		"""
+		try:
+			kind = event[0]
+			if kind == _CONNECT:
+				if self.on_connect is not None:
+					self.on_connect(self, self._userdata, {"session present": 0}, 0)
+			elif kind == _MESSAGE:
+				callbacks = [
+					callback for sub, callback in list(self._callbacks.items())
+					if mqtt.topic_matches_sub(sub, event[1].topic)
+				]
+				for callback in callbacks:
+					callback(self, self._userdata, event[1])
+				if not callbacks and self.on_message is not None:
+					self.on_message(self, self._userdata, event[1])
+			elif kind == _PUBLISHED:
+				if self.on_publish is not None:
+					self.on_publish(self, self._userdata, event[1])
+			elif kind == _DISCONNECT:
+				if self.on_disconnect is not None:
+					self.on_disconnect(self, self._userdata, 0)
+				return False
+			else:
+				return False
+		except Exception as e:
+			self._broker.errors.append(e)
+			traceback.print_exc()
+		finally:
+			self._broker._done(self)
+		return True
+
+def _message(topic: str, payload: Any, qos: int, retain: bool) -> mqtt.MQTTMessage:
+	"""
+	Function to create a message, with the payload as bytes (like paho).
+	"""
+	if payload is None:
+		payload = b""
+	elif isinstance(payload, str):
+		payload = payload.encode()
+	elif isinstance(payload, (int, float)):
+		payload = str(payload).encode()
+	message = mqtt.MQTTMessage(topic=topic.encode())
+	message.payload = bytes(payload)
+	message.qos = qos
+	message.retain = retain
+	return message
+
+def _copy(message: mqtt.MQTTMessage, qos: int, retain: bool) -> mqtt.MQTTMessage:
+	"""
+	Function to copy a message for a subscriber.
+	"""
+	copy = mqtt.MQTTMessage(topic=message._topic)
+	copy.payload = message.payload
+	copy.qos = qos
+	copy.retain = retain
+	return copy
@@ -0,0 +1,158 @@
+import struct
+from typing import BinaryIO, Optional, Tuple
+
+# Packet types (high nibble of the first byte)
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+# Return codes of CONNACK
+ACCEPTED = 0
+UNACCEPTABLE_PROTOCOL = 1
+IDENTIFIER_REJECTED = 2
+
+# Return code of SUBACK for a rejected filter
+SUBSCRIPTION_FAILURE = 0x80
+
+# Max remaining length of a packet (4 bytes of variable length)
+MAX_LENGTH = 268435455
+
+class ProtocolError(Exception):
+	"""
+	The client has sent a packet that is not valid: the connection is closed.
+	"""
+
+def read_packet(stream: BinaryIO) -> Optional[Tuple[int, int, bytes]]:
+	"""
+	Function to read a packet.
+	Args:
+		stream (BinaryIO): The stream of the connection.
+	Returns:
+		Tuple[int, int, bytes]: The type, the flags and the body of the
+			packet, or None if the connection has been closed.
+	Raises:
+		ProtocolError: If the length is not valid.
+	"""
+	header = stream.read(1)
+	if not header:
+		return None
+
+	# Remaining length: 7 bits per byte, the high bit means that there is more
+	length = 0
+	for shift in range(0, 28, 7):
+		byte = stream.read(1)
+		if not byte:
+			return None
+		length |= (byte[0] & 0x7f) << shift
+		if not byte[0] & 0x80:
+			break
+	else:
+		raise ProtocolError("Malformed remaining length")
+
+	body = stream.read(length) if length else b""
+	if len(body) != length:
+		return None
+	return header[0] >> 4, header[0] & 0x0f, body
+
+def encode_packet(packet_type: int, flags: int, body: bytes = b"") -> bytes:
+	"""
+	Function to encode a packet.
+	Args:
+		packet_type (int): The type of the packet.
+		flags (int): The flags of the fixed header.
+		body (bytes): The variable header and the payload.
+	Returns:
+		bytes: The packet.
+	"""
+	length = len(body)
+	if length > MAX_LENGTH:
+		raise ValueError("Packet too big")
+	encoded = bytearray([(packet_type << 4) | flags])
+	while True:
+		byte = length & 0x7f
+		length >>= 7
+		encoded.append(byte | 0x80 if length else byte)
+		if not length:
+			break
+	return bytes(encoded) + body
+
+def encode_string(value: str) -> bytes:
+	"""
+	Function to encode a UTF-8 string, with its length.
+	"""
+	data = value.encode()
+	return struct.pack("!H", len(data)) + data
+
+class Reader:
+	"""
+	Reader of the fields of the body of a packet.
+	"""
+	__slots__ = ('data', 'position')
+
+	def __init__(self, data: bytes):
+		self.data = data
+		self.position = 0
+
+	@property
+	def remaining(self) -> int:
+		"""
+		Returns the number of bytes that have not been read.
+		"""
+		return len(self.data) - self.position
+
+	def byte(self) -> int:
+		"""
+		Read a byte.
+		"""
+		if self.remaining < 1:
+			raise ProtocolError("Packet too short")
+		self.position += 1
+		return self.data[self.position - 1]
+
+	def uint16(self) -> int:
+		"""
+		Read a two bytes integer.
+		"""
+		if self.remaining < 2:
+			raise ProtocolError("Packet too short")
+		value, = struct.unpack_from("!H", self.data, self.position)
+		self.position += 2
+		return value
+
+	def binary(self) -> bytes:
+		"""
+		Read binary data, with its length.
+		"""
+		length = self.uint16()
+		if self.remaining < length:
+			raise ProtocolError("Packet too short")
+		self.position += length
+		return self.data[self.position - length:self.position]
+
+	def string(self) -> str:
+		"""
+		Read a UTF-8 string, with its length.
+		"""
+		try:
+			return self.binary().decode()
+		except UnicodeDecodeError:
+			raise ProtocolError("Invalid UTF-8 string")
+
+	def rest(self) -> bytes:
+		"""
+		Read the bytes that are left.
+		"""
+		value = self.data[self.position:]
+		self.position = len(self.data)
+		return value
@@ -0,0 +1,512 @@
+import argparse
+import socket
+import socketserver
+import struct
+import threading
+import uuid
+from typing import Dict, List, Optional
+from .packets import (
+	CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP,
+	SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT,
+	ACCEPTED, UNACCEPTABLE_PROTOCOL, IDENTIFIER_REJECTED, SUBSCRIPTION_FAILURE,
+	ProtocolError, Reader, read_packet, encode_packet, encode_string
+)
+from .topics import TopicTree, valid_topic, valid_filter, retained_matches
+
+# Protocol names and levels that are accepted (MQTT 3.1.1, and 3.1)
+PROTOCOLS = {("MQTT", 4), ("MQIsdp", 3)}
+
+# Max QoS granted to the subscriptions
+MAX_QOS = 1
+
+class Message:
+	"""
+	Message published in the broker.
+	"""
+	__slots__ = ('topic', 'payload', 'qos', 'retain', '_topic')
+
+	def __init__(self, topic: str, payload: bytes, qos: int = 0, retain: bool = False):
+		self.topic = topic
+		self.payload = payload
+		self.qos = qos
+		self.retain = retain
+		self._topic = encode_string(topic)
+
+	def encode(self, qos: int, packet_id: int, retain: bool = False) -> bytes:
+		"""
+		Encode the PUBLISH packet of the message.
+		Args:
+			qos (int): The QoS of the delivery.
+			packet_id (int): The packet identifier (only used with QoS > 0).
+			retain (bool): If it is sent because it is retained.
+		Returns:
+			bytes: The packet.
+		"""
+		body = self._topic
+		if qos:
+			body += struct.pack("!H", packet_id)
+		return encode_packet(PUBLISH, (qos << 1) | int(retain), body + self.payload)
+
+class Session:
+	"""
+	Connection of a client with the broker. The packets of the client
+	are read by the thread of the connection; the messages sent to the
+	client are written by the thread that publishes them.
+	"""
+	def __init__(self, broker: "MQTTBroker", connection: socket.socket):
+		"""
+		Constructor of the Session class.
+		Args:
+			broker (MQTTBroker): The broker.
+			connection (socket.socket): The connection with the client.
+		"""
+		# Save the params
+		self.broker = broker
+		self.connection = connection
+		self.stream = connection.makefile("rb")
+
+		# State of the client
+		self.client_id: Optional[str] = None
+		self.filters: Dict[str, int] = {}
+		self.will: Optional[Message] = None
+		self._released: set = set()
+
+		# The packets are written by several threads
+		self._send_lock = threading.Lock()
+		self._packet_id = 0
+		self.closed = False
+
+	def run(self) -> None:
+		"""
+		Read the packets of the client, until it disconnects.
+		"""
+		try:
+			packet = read_packet(self.stream)
+			if packet is None or packet[0] != CONNECT or not self._connect(packet[2]):
+				return
+			while True:
+				packet = read_packet(self.stream)
+				if packet is None:
+					break
+				packet_type, flags, body = packet
+				if packet_type == DISCONNECT:
+					self.will = None
+					break
+				handler = self._HANDLERS.get(packet_type)
+				if handler is None:
+					raise ProtocolError(f"Unexpected packet type {packet_type}")
+				handler(self, flags, Reader(body))
+		except (ProtocolError, OSError) as e:
+			if self.broker.debug:
+				print(f"[ Broker ] {self.client_id}: {e}")
+		finally:
+			self.close()
+			self.broker._remove(self)
+
+	def send(self, data: bytes) -> None:
+		"""
+		Write a packet to the client. If it fails, the connection is closed.
+		Args:
+			data (bytes): The packet.
+		"""
+		with self._send_lock:
+			if self.closed:
+				return
+			try:
+				self.connection.sendall(data)
+			except OSError:
+				self.close()
+
+	def deliver(self, message: Message, qos: int, retain: bool = False) -> None:
+		"""
+		Send a message to the client.
+		Args:
+			message (Message): The message.
+			qos (int): The QoS of the delivery.
+			retain (bool): If it is sent because it is retained.
+		"""
+		with self._send_lock:
+			if self.closed:
+				return
+			if qos:
+				self._packet_id = self._packet_id % 0xffff + 1
+			try:
+				self.connection.sendall(message.encode(qos, self._packet_id, retain))
+			except OSError:
+				self.close()
+
+	def close(self) -> None:
+		"""
+		Close the connection (the thread of the session ends).
+		"""
+		if self.closed:
+			return
+		self.closed = True
+		try:
+			self.connection.shutdown(socket.SHUT_RDWR)
+		except OSError:
+			pass
+
+	def _connect(self, body: bytes) -> bool:
+		"""
+		Handle the CONNECT packet.
+		Args:
+			body (bytes): The body of the packet.
+		Returns:
+			bool: True if the client has been accepted.
+		"""
+		reader = Reader(body)
+		protocol = reader.string()
+		level = reader.byte()
+		if (protocol, level) not in PROTOCOLS:
+			self.send(encode_packet(CONNACK, 0, bytes([0, UNACCEPTABLE_PROTOCOL])))
+			return False
+		flags = reader.byte()
+		keepalive = reader.uint16()
+		client_id = reader.string()
+
+		# Last will, and the credentials (any one is accepted)
+		if flags & 0x04:
+			topic = reader.string()
+			payload = reader.binary()
+			if not valid_topic(topic):
+				raise ProtocolError("Invalid will topic")
+			self.will = Message(topic, payload, min((flags >> 3) & 0x03, 2), bool(flags & 0x20))
+		if flags & 0x80:
+			reader.string()
+		if flags & 0x40:
+			reader.binary()
+
+		# The sessions are not kept, so only a clean one can have no id
+		if not client_id:
+			if not flags & 0x02:
+				self.send(encode_packet(CONNACK, 0, bytes([0, IDENTIFIER_REJECTED])))
+				return False
+			client_id = f"auto-{uuid.uuid4().hex}"
+		self.client_id = client_id
+
+		# Close the connection if the client does not send anything in 1.5 times the keep alive
+		self.connection.settimeout(keepalive * 1.5 if keepalive else None)
+
+		self.broker._add(self)
+		self.send(encode_packet(CONNACK, 0, bytes([0, ACCEPTED])))
+		return True
+
+	def _publish(self, flags: int, reader: Reader) -> None:
+		"""
+		Handle a PUBLISH packet.
+		"""
+		qos = (flags >> 1) & 0x03
+		if qos == 3:
+			raise ProtocolError("Invalid QoS")
+		topic = reader.string()
+		if not valid_topic(topic):
+			raise ProtocolError("Invalid topic")
+		packet_id = reader.uint16() if qos else 0
+		message = Message(topic, reader.rest(), qos, bool(flags & 0x01))
+
+		if qos == 0:
+			self.broker.route(message)
+		elif qos == 1:
+			self.broker.route(message)
+			self.send(encode_packet(PUBACK, 0, struct.pack("!H", packet_id)))
+		else:
+			# Only delivered once, until the client releases it
+			if packet_id not in self._released:
+				self._released.add(packet_id)
+				self.broker.route(message)
+			self.send(encode_packet(PUBREC, 0, struct.pack("!H", packet_id)))
+
+	def _pubrel(self, flags: int, reader: Reader) -> None:
+		"""
+		Handle a PUBREL packet (second step of a QoS 2 message of the client).
+		"""
+		packet_id = reader.uint16()
+		self._released.discard(packet_id)
+		self.send(encode_packet(PUBCOMP, 0, struct.pack("!H", packet_id)))
+
+	def _acknowledge(self, flags: int, reader: Reader) -> None:
+		"""
+		Handle the acknowledges of the messages sent to the client
+		(they are not sent again, so nothing is done).
+		"""
+
+	def _subscribe(self, flags: int, reader: Reader) -> None:
+		"""
+		Handle a SUBSCRIBE packet, sending the retained messages of the filters.
+		"""
+		if flags != 0x02:
+			raise ProtocolError("Invalid SUBSCRIBE flags")
+		packet_id = reader.uint16()
+		requests = []
+		while reader.remaining:
+			topic_filter = reader.string()
+			qos = reader.byte()
+			if qos > 2:
+				raise ProtocolError("Invalid QoS")
+			requests.append((topic_filter, qos))
+		if not requests:
+			raise ProtocolError("SUBSCRIBE without filters")
+
+		codes = []
+		retained: List[tuple] = []
+		for topic_filter, qos in requests:
+			if not valid_filter(topic_filter):
+				codes.append(SUBSCRIPTION_FAILURE)
+				continue
+			granted = min(qos, MAX_QOS)
+			codes.append(granted)
+			for message in self.broker._subscribe(self, topic_filter, granted):
+				retained.append((message, min(message.qos, granted)))
+
+		self.send(encode_packet(SUBACK, 0, struct.pack("!H", packet_id) + bytes(codes)))
+		for message, qos in retained:
+			self.deliver(message, qos, retain=True)
+
+	def _unsubscribe(self, flags: int, reader: Reader) -> None:
+		"""
+		Handle an UNSUBSCRIBE packet.
+		"""
+		if flags != 0x02:
+			raise ProtocolError("Invalid UNSUBSCRIBE flags")
+		packet_id = reader.uint16()
+		while reader.remaining:
+			self.broker._unsubscribe(self, reader.string())
+		self.send(encode_packet(UNSUBACK, 0, struct.pack("!H", packet_id)))
+
+	def _ping(self, flags: int, reader: Reader) -> None:
+		"""
+		Handle a PINGREQ packet.
+		"""
+		self.send(encode_packet(PINGRESP, 0))
+
+	_HANDLERS = {
+		PUBLISH: _publish,
+		PUBACK: _acknowledge,
+		PUBREC: _acknowledge,
+		PUBREL: _pubrel,
+		PUBCOMP: _acknowledge,
+		SUBSCRIBE: _subscribe,
+		UNSUBSCRIBE: _unsubscribe,
+		PINGREQ: _ping,
+	}
+
+class _Handler(socketserver.BaseRequestHandler):
+	"""
+	Handler of a connection of the TCP server: runs its session.
+	"""
+	def handle(self) -> None:
+		Session(self.server.broker, self.request).run()
+
+class _Server(socketserver.ThreadingTCPServer):
+	"""
+	TCP server of the broker, with a thread for each connection.
+	"""
+	allow_reuse_address = True
+	daemon_threads = True
+
+class MQTTBroker:
+	"""
+	Small MQTT 3.1.1 broker, to run the controller and the devices
+	without an external one (like in the tests): QoS 0 and 1 (the
+	subscriptions are granted QoS 1 at most), retained messages,
+	wildcards and last will messages.
+
+	The sessions are not persistent (they are always clean), and the
+	QoS 1 messages are not sent again if they are not acknowledged.
+	"""
+	def __init__(self, host: str = "127.0.0.1", port: int = 1883, debug: bool = False):
+		"""
+		Constructor of the MQTTBroker class.
+		Args:
+			host (str): Address where the broker listens.
+			port (int): Port of the broker (0: a free one, see `port`).
+			debug (bool): Debug mode.
+		"""
+		# Save the params
+		self.host = host
+		self.port = port
+		self.debug = debug
+
+		# Connected clients, their subscriptions and the retained messages
+		self._lock = threading.Lock()
+		self._sessions: Dict[str, Session] = {}
+		self._subscriptions = TopicTree()
+		self.retained: Dict[str, Message] = {}
+
+		self._server: Optional[_Server] = None
+		self._thread: Optional[threading.Thread] = None
+
+	def __enter__(self) -> "MQTTBroker":
+		self.start()
+		return self
+
+	def __exit__(self, *exc) -> None:
+		self.stop()
+
+	@property
+	def clients(self) -> List[str]:
+		"""
+		Returns the ids of the connected clients.
+		"""
+		with self._lock:
+			return list(self._sessions)
+
+	def start(self) -> None:
+		"""
+		Start listening, in a thread.
+		"""
+		if self._server is not None:
+			return
+		self._server = _Server((self.host, self.port), _Handler)
+		self._server.broker = self
+		self.port = self._server.server_address[1]
+		self._thread = threading.Thread(
+			target=self._server.serve_forever,
+			kwargs={"poll_interval": 0.1},
+			name="mqtt-broker",
+			daemon=True
+		)
+		self._thread.start()
+
+	def stop(self) -> None:
+		"""
+		Stop listening, and close the connections.
+		"""
+		if self._server is None:
+			return
+		self._server.shutdown()
+		with self._lock:
+			sessions = list(self._sessions.values())
+		for session in sessions:
+			session.close()
+		self._server.server_close()
+		self._thread.join()
+		self._server = None
+		if self.debug:
+			print("[ Broker ] Stopped")
+
+	def publish(self, topic: str, payload: bytes = b"", qos: int = 0, retain: bool = False) -> None:
+		"""
+		Publish a message from the broker.
+		Args:
+			topic (str): The topic.
+			payload (bytes): The payload.
+			qos (int): The QoS.
+			retain (bool): If the message is retained.
+		"""
+		if isinstance(payload, str):
+			payload = payload.encode()
+		self.route(Message(topic, payload, qos, retain))
+
+	def route(self, message: Message) -> None:
+		"""
+		Send a message to the subscribers of its topic, and keep it if it
+		is retained (a retained message without payload removes it).
+		Args:
+			message (Message): The message.
+		"""
+		with self._lock:
+			if message.retain:
+				if message.payload:
+					self.retained[message.topic] = message
+				else:
+					self.retained.pop(message.topic, None)
+			subscribers = self._subscriptions.match(message.topic)
+		for session, qos in subscribers.items():
+			session.deliver(message, min(message.qos, qos))
+
+	def _add(self, session: Session) -> None:
+		"""
+		Add a connected client. If there was other with the same id, it
+		is disconnected.
+		"""
+		with self._lock:
+			previous = self._sessions.get(session.client_id)
+			self._sessions[session.client_id] = session
+		if previous is not None:
+			previous.close()
+		if self.debug:
+			print(f"[ Broker ] {session.client_id} connected")
+
+	def _remove(self, session: Session) -> None:
+		"""
+		Remove a disconnected client, publishing its last will if it has not
+		disconnected cleanly.
+		"""
+		with self._lock:
+			self._subscriptions.remove(session, session.filters)
+			session.filters = {}
+			if self._sessions.get(session.client_id) is session:
+				del self._sessions[session.client_id]
+		if session.will is not None:
+			self.route(session.will)
+			session.will = None
+		if self.debug and session.client_id is not None:
+			print(f"[ Broker ] {session.client_id} disconnected")
+
+	def _subscribe(self, session: Session, topic_filter: str, qos: int) -> List[Message]:
+		"""
+		Subscribe a client to a filter.
+		Returns:
+			List[Message]: The retained messages that match the filter.
+		"""
+		with self._lock:
+			if session.closed:
+				return []
+			self._subscriptions.subscribe(topic_filter, session, qos)
+			session.filters[topic_filter] = qos
+			return list(retained_matches(self.retained, topic_filter).values())
+
+	def _unsubscribe(self, session: Session, topic_filter: str) -> None:
+		"""
+		Unsubscribe a client from a filter.
+		"""
+		with self._lock:
+			self._subscriptions.unsubscribe(topic_filter, session)
+			session.filters.pop(topic_filter, None)
+
+def parse_params() -> argparse.Namespace:
+	"""
+	Parse the parameters of the script.
+	Returns:
+		argparse.Namespace: The parsed parameters.
+	"""
+	params = argparse.ArgumentParser(
+		description="Embedded MQTT broker"
+	)
+	params.add_argument(
+		"--host", default="127.0.0.1",
+		help="Address where the broker listens (default: %(default)s)"
+	)
+	params.add_argument(
+		"--port", type=int, default=1883,
+		help="Port of the broker (default: %(default)s)"
+	)
+	params.add_argument(
+		"--debug", type=bool, default=False,
+		help="Debug mode (default: %(default)s)"
+	)
+	parsed = params.parse_args()
+
+	if not 0 <= parsed.port <= 65535:
+		params.error("The port must be between 0 and 65535")
+	return parsed
+
+def main():
+	"""
+	Main function of the script: run the broker until a SIGINT is received.
+	"""
+	args = parse_params()
+	broker = MQTTBroker(args.host, args.port, debug=args.debug)
+	broker.start()
+	print(f"[ Broker ] Listening on {args.host}:{broker.port}")
+	try:
+		threading.Event().wait()
+	except KeyboardInterrupt:
+		broker.stop()
+		print("[ Broker ] Stopped")
+
+
+if __name__ == '__main__':
+	main()
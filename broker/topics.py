@@ -0,0 +1,170 @@
+from typing import Any, Dict, Iterable, Optional
+
+def valid_topic(topic: str) -> bool:
+	"""
+	Function to check the name of a topic where a message is published.
+	Args:
+		topic (str): The topic name.
+	Returns:
+		bool: False if it is empty, or it has wildcards.
+	"""
+	return bool(topic) and "+" not in topic and "#" not in topic and "\0" not in topic
+
+def valid_filter(topic_filter: str) -> bool:
+	"""
+	Function to check a topic filter of a subscription.
+	Args:
+		topic_filter (str): The topic filter.
+	Returns:
+		bool: False if it is empty, or its wildcards are not whole levels
+			(or '#' is not the last level).
+	"""
+	if not topic_filter or "\0" in topic_filter:
+		return False
+	levels = topic_filter.split("/")
+	for i, level in enumerate(levels):
+		if level == "#":
+			if i != len(levels) - 1:
+				return False
+		elif "#" in level or ("+" in level and level != "+"):
+			return False
+	return True
+
+class _Node:
+	"""
+	Level of the topic tree, with the subscriptions that end in it.
+	"""
+	__slots__ = ('children', 'subscribers')
+
+	def __init__(self):
+		self.children: Dict[str, "_Node"] = {}
+		self.subscribers: Dict[Any, int] = {}
+
+class TopicTree:
+	"""
+	Subscriptions to topic filters (with the '+' and '#' wildcards),
+	in a tree by level, so the subscribers of a topic are found without
+	checking all the filters.
+	"""
+	def __init__(self):
+		self._root = _Node()
+
+	def subscribe(self, topic_filter: str, subscriber: Any, qos: int) -> None:
+		"""
+		Add (or replace) the subscription of a subscriber to a filter.
+		Args:
+			topic_filter (str): The topic filter.
+			subscriber (Any): The subscriber.
+			qos (int): The granted QoS.
+		"""
+		node = self._root
+		for level in topic_filter.split("/"):
+			child = node.children.get(level)
+			if child is None:
+				child = node.children[level] = _Node()
+			node = child
+		node.subscribers[subscriber] = qos
+
+	def unsubscribe(self, topic_filter: str, subscriber: Any) -> bool:
+		"""
+		Remove the subscription of a subscriber to a filter.
+		Args:
+			topic_filter (str): The topic filter.
+			subscriber (Any): The subscriber.
+		Returns:
+			bool: False if it was not subscribed.
+		"""
+		path = [self._root]
+		levels = topic_filter.split("/")
+		for level in levels:
+			node = path[-1].children.get(level)
+			if node is None:
+				return False
+			path.append(node)
+		if path[-1].subscribers.pop(subscriber, None) is None:
+			return False
+
+		# Remove the levels that are no longer used
+		for level, parent, node in zip(reversed(levels), reversed(path[:-1]), reversed(path[1:])):
+			if node.children or node.subscribers:
+				break
+			del parent.children[level]
+		return True
+
+	def remove(self, subscriber: Any, topic_filters: Iterable[str]) -> None:
+		"""
+		Remove the subscriptions of a subscriber.
+		Args:
+			subscriber (Any): The subscriber.
+			topic_filters (Iterable[str]): Its topic filters.
+		"""
+		for topic_filter in list(topic_filters):
+			self.unsubscribe(topic_filter, subscriber)
+
+	def match(self, topic: str) -> Dict[Any, int]:
+		"""
+		Get the subscribers of a topic.
+		Args:
+			topic (str): The topic name.
+		Returns:
+			Dict[Any, int]: The max QoS of the filters of each subscriber
+				that match the topic.
+		"""
+		matches: Dict[Any, int] = {}
+		levels = topic.split("/")
+
+		# The wildcards do not match the topics that start with '$'
+		system = topic.startswith("$")
+
+		def visit(node: _Node, i: int) -> None:
+			if i == len(levels):
+				self._add(matches, node.subscribers)
+				# 'a/#' also matches 'a'
+				wildcard = node.children.get("#")
+				if wildcard is not None:
+					self._add(matches, wildcard.subscribers)
+				return
+			wildcards = not (system and i == 0)
+			child = node.children.get(levels[i])
+			if child is not None:
+				visit(child, i + 1)
+			if wildcards:
+				child = node.children.get("+")
+				if child is not None:
+					visit(child, i + 1)
+				child = node.children.get("#")
+				if child is not None:
+					self._add(matches, child.subscribers)
+
+		visit(self._root, 0)
+		return matches
+
+	@staticmethod
+	def _add(matches: Dict[Any, int], subscribers: Dict[Any, int]) -> None:
+		"""
+		Add some subscribers to the matches, keeping the max QoS.
+		"""
+		for subscriber, qos in subscribers.items():
+			if qos > matches.get(subscriber, -1):
+				matches[subscriber] = qos
+
+def retained_matches(retained: Dict[str, Any], topic_filter: str) -> Dict[str, Any]:
+	"""
+	Function to get the retained messages whose topic matches a filter.
+	Args:
+		retained (Dict[str, Any]): The retained messages, by topic.
+		topic_filter (str): The topic filter.
+	Returns:
+		Dict[str, Any]: The matching retained messages, by topic.
+	"""
+	# Exact topic: a single lookup
+	if "+" not in topic_filter and "#" not in topic_filter:
+		message: Optional[Any] = retained.get(topic_filter)
+		return {topic_filter: message} if message is not None else {}
+
+	tree = TopicTree()
+	tree.subscribe(topic_filter, None, 0)
+	return {
+		topic: message for topic, message in retained.items()
+		if None in tree.match(topic)
+	}
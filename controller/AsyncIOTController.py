@@ -0,0 +1,397 @@
+import asyncio
+import signal
+import threading
+from typing import Optional
+import paho.mqtt.client as mqtt
+from .IOTController import IOTController
+from .log_writer import AsyncLogWriter
+from .command_coalescer import AsyncCommandCoalescer
+
+class AsyncIOTController(IOTController):
+	"""
+	Controller that runs on an asyncio event loop, instead of the paho
+	loop thread and the worker threads.
+
+	The MQTT socket is attached to the event loop (paho reads and writes
+	it when the loop says it is ready), and everything else is a task:
+		· The message task, that evaluates the rules of the queued
+		  messages (with the same `process_message` of the controller)
+		  and publishes the commands.
+		· The log task, that writes the logs in batches.
+		· The timers that close the windows of the coalesced commands.
+		· The timers of the rules with a duration, that are run by the
+		  thread of the timer wheel and applied in the loop.
+		· The misc task, that keeps the MQTT connection alive.
+		· The refresh task, that checks the changes of the rules.
+
+	The database is never read from the loop: the changes of the rules
+	(the refresh task, the reloads and the change notices) are checked
+	in the executor, and so are the rules of the devices that are not in
+	memory (LRU mode), before their messages are processed.
+
+	When too many messages are queued, the socket is not read until
+	the message task catches up.
+	"""
+	# Class of the writer of the logs
+	LOG_WRITER = AsyncLogWriter
+
+	# Class of the stage that coalesces the commands
+	COMMAND_COALESCER = AsyncCommandCoalescer
+
+	# The changes of the rules are checked by the refresh task
+	CHECK_RULES_INLINE = False
+
+	def __init__(self, *args, **kwargs):
+		# The messages are processed by the loop, not by worker threads
+		kwargs['workers'] = 0
+		self.queue_size = kwargs.pop('queue_size', 1000)
+		super().__init__(*args, **kwargs)
+
+		# Loop state (set when it runs)
+		self.loop: Optional[asyncio.AbstractEventLoop] = None
+		self.messages: Optional[asyncio.Queue] = None
+		self.tasks = []
+		self.socket = None
+		self.paused = False
+		self.stopping: Optional[asyncio.Event] = None
+
+		# Rules of the device of the message being processed, read in the executor
+		self._message_rules: Optional[tuple] = None
+
+		# Result of the shutdown, for the threads that wait for it in `stop`
+		self.drained: Optional[bool] = None
+		self.stopped = threading.Event()
+
+		# Attach the client socket to the event loop
+		self.client.on_socket_open = self.on_socket_open
+		self.client.on_socket_close = self.on_socket_close
+		self.client.on_socket_register_write = self.on_socket_register_write
+		self.client.on_socket_unregister_write = self.on_socket_unregister_write
+
+	def start(self) -> None:
+		"""
+		Run the controller until it is stopped, or a SIGINT or a SIGTERM
+		is received (a SIGHUP reloads the rules).
+		"""
+		try:
+			asyncio.run(self.run(handle_signals=True))
+		except KeyboardInterrupt:
+			pass
+
+	def stop(self, timeout: Optional[float] = None) -> bool:
+		"""
+		Ask the running loop to stop the controller, and wait until it
+		has stopped. It must be called from other thread (from the loop,
+		set `stopping` or await `shutdown` instead).
+		Args:
+			timeout (float): Max seconds to wait (None: until it stops, the
+				loop drains it with its own timeout).
+		Returns:
+			bool: True if everything has been drained in time (False if it
+				has not stopped in time).
+		"""
+		if self.loop is None or self.stopping is None:
+			return True
+		try:
+			running = asyncio.get_running_loop()
+		except RuntimeError:
+			running = None
+		if running is self.loop:
+			raise RuntimeError("stop() can not wait for the loop from the loop")
+		if not self.stopped.is_set():
+			self.loop.call_soon_threadsafe(self.stopping.set)
+		if not self.stopped.wait(timeout):
+			return False
+		return bool(self.drained)
+
+	async def run(self, timeout: Optional[float] = None, handle_signals: bool = False) -> None:
+		"""
+		Connect to the broker, and process the messages until it is stopped.
+		Args:
+			timeout (float): Max seconds to drain the controller when
+				stopping (None: the drain timeout of the controller).
+			handle_signals (bool): If SIGINT and SIGTERM stop the controller,
+				and SIGHUP reloads the rules (only from the main thread).
+		"""
+		self.start_tasks()
+		signals = {}
+		if handle_signals:
+			signals = {
+				signal.SIGINT: self.stopping.set,
+				signal.SIGTERM: self.stopping.set,
+				signal.SIGHUP: lambda: self.loop.run_in_executor(None, self.reload),
+			}
+			for signum, callback in signals.items():
+				self.loop.add_signal_handler(signum, callback)
+		try:
+			# Connect to the broker (the socket is attached to the loop)
+			self.client.connect(
+				self.mqtt_host,
+				self.mqtt_port,
+			)
+			await self.stopping.wait()
+		finally:
+			for signum in signals:
+				self.loop.remove_signal_handler(signum)
+			await self.shutdown(timeout)
+
+	def start_tasks(self) -> None:
+		"""
+		Start the tasks that process the messages and write the logs.
+		It must be called from the loop.
+		"""
+		self.loop = asyncio.get_running_loop()
+		self.messages = asyncio.Queue()
+		self.stopping = asyncio.Event()
+		self.drained = None
+		self.stopped.clear()
+
+		self.logs.start()
+		self.timers.start()
+		if self.commands is not None:
+			self.commands.start()
+		self.start_metrics_server()
+		self.tasks = [
+			self.loop.create_task(self.message_task()),
+			self.loop.create_task(self.misc_task()),
+			self.loop.create_task(self.refresh_task()),
+		]
+
+	async def shutdown(self, timeout: Optional[float] = None) -> bool:
+		"""
+		Stop the controller gracefully, like the one of threads: stop
+		receiving messages, process the queued ones and send their commands,
+		wait for their acknowledgements, disconnect, write the pending logs
+		and close the database connections.
+		Args:
+			timeout (float): Max seconds of the whole drain (None: the
+				drain timeout of the controller).
+		Returns:
+			bool: True if everything has been drained in time.
+		"""
+		if timeout is None:
+			timeout = self.drain_timeout
+		deadline = self.loop.time() + timeout
+		def remaining():
+			return max(0.0, deadline - self.loop.time())
+		drained = True
+
+		# Stop receiving messages (and do not reconnect)
+		self.stopping.set()
+		self._stopping.set()
+		self.stop_intake()
+
+		# Process the queued messages
+		try:
+			await asyncio.wait_for(self.messages.join(), remaining())
+		except asyncio.TimeoutError:
+			drained = False
+			if self.debug:
+				print("[ Controller ] Not all the queued messages could be processed")
+
+		# Stop the timers of the durations (the rules whose duration has not ended are not applied)
+		await self.loop.run_in_executor(None, self.timers.stop, remaining())
+
+		# Send the coalesced commands
+		if self.commands is not None:
+			self.commands.stop()
+			if self.debug:
+				print(f"[ Controller ] Commands: {self.commands.stats()}")
+
+		# Wait for the acknowledgements of the commands (read by the loop), and disconnect
+		while self.commands_pending() > 0:
+			if not self.client.is_connected() or remaining() <= 0:
+				drained = False
+				if self.debug:
+					print("[ Controller ] Not all the commands have been acknowledged")
+				break
+			await asyncio.sleep(0.01)
+		self.client.disconnect()
+		if self.socket is not None:
+			self.loop.remove_reader(self.socket)
+			self.loop.remove_writer(self.socket)
+		for task in self.tasks:
+			task.cancel()
+		await asyncio.gather(*self.tasks, return_exceptions=True)
+
+		# Write the pending logs
+		if not await self.logs.stop(remaining()):
+			drained = False
+			if self.debug:
+				print("[ Controller ] Not all the pending logs could be written")
+
+		# Close the database, the metrics server and the profiler
+		self.rules.close()
+		self.compound.close()
+		self.connections.close()
+		if self.metrics_server is not None:
+			self.metrics_server.stop()
+		if self.profiler is not None:
+			self.profiler.close()
+		if self.debug:
+			print("[ Controller ] Stopped")
+		self.drained = drained
+		self.stopped.set()
+		return drained
+
+	def queue_depths(self) -> dict:
+		"""
+		Get the number of items waiting in each queue.
+		Returns:
+			dict: The depth of each queue, by the tuple of its name.
+		"""
+		depths = super().queue_depths()
+		if self.messages is not None:
+			depths[("messages",)] = self.messages.qsize()
+		return depths
+
+	def lookup_rules(self, device_id: str):
+		"""
+		Get the rules of a device, read by the message task before
+		processing its message, so the loop does not read the database.
+		"""
+		if self._message_rules is not None and self._message_rules[0] == device_id:
+			return self._message_rules[1]
+		return super().lookup_rules(device_id)
+
+	def check_changes(self) -> None:
+		"""
+		Check if the rules have changed, and reload them if needed (it
+		reads the database: it is run in the executor).
+		"""
+		self.rules.check_changes()
+		self.compound.check_changes()
+
+	def on_change(self, client, userdata, msg):
+		"""
+		Callback function that is called when a change notice is received.
+		It is applied in the executor, as it reads the database.
+		"""
+		self.loop.run_in_executor(None, super().on_change, client, userdata, msg)
+
+	def on_duration(self, rule, device_id: str) -> None:
+		"""
+		Apply a rule whose duration has ended, in the loop (it is called
+		from the thread of the timers).
+		"""
+		if self.loop is not None and not self.loop.is_closed():
+			self.loop.call_soon_threadsafe(super().on_duration, rule, device_id)
+
+	###########################
+	# NOTE: Socket management #
+	###########################
+
+	def on_socket_open(self, client, userdata, sock) -> None:
+		"""
+		Callback function that is called when the client socket is opened.
+		"""
+		self.socket = sock
+		self.paused = False
+		self.loop.add_reader(sock, client.loop_read)
+
+	def on_socket_close(self, client, userdata, sock) -> None:
+		"""
+		Callback function that is called when the client socket is closed.
+		"""
+		self.loop.remove_reader(sock)
+		self.loop.remove_writer(sock)
+		if sock is self.socket:
+			self.socket = None
+
+	def on_socket_register_write(self, client, userdata, sock) -> None:
+		"""
+		Callback function that is called when the client has data to write.
+		"""
+		self.loop.add_writer(sock, client.loop_write)
+
+	def on_socket_unregister_write(self, client, userdata, sock) -> None:
+		"""
+		Callback function that is called when the client has written everything.
+		"""
+		self.loop.remove_writer(sock)
+
+	##################
+	# NOTE: Messages #
+	##################
+
+	def on_message(self, client, userdata, msg):
+		"""
+		Callback function that is called when a message is received.
+		It only queues the message, to be processed by the message task.
+		Args:
+			client (mqtt.Client): The client instance for this callback.
+			userdata (Any): The private user data as set in Client() or userdata_set().
+			msg (paho.mqtt.message.MQTTMessage): The message that was received.
+		"""
+		if self._stopping.is_set():
+			return
+		device_id = msg.topic.split("/")[-2]
+
+		# Messages of other partitions (received while rebalancing), but
+		# not of the devices checked by the compound rules of this one
+		if self.partition is not None and not self.partition.owns(device_id) \
+				and not self.compound.depends_on(device_id):
+			return
+		self.messages.put_nowait((device_id, msg.payload))
+
+		# Too many messages: stop reading until they are processed
+		if not self.paused and self.socket is not None \
+				and self.messages.qsize() >= self.queue_size:
+			self.paused = True
+			self.loop.remove_reader(self.socket)
+
+	async def message_task(self) -> None:
+		"""
+		Task that evaluates the rules of the queued messages.
+		"""
+		while True:
+			device_id, payload = await self.messages.get()
+			try:
+				# The rules that are not in memory are read in the executor
+				rules = self.rules.cached(device_id)
+				if rules is None:
+					rules = await self.loop.run_in_executor(None, self.rules.get, device_id)
+				self._message_rules = (device_id, rules)
+				self.process_message(device_id, payload)
+			except Exception as e:
+				if self.debug:
+					print(f"[ {device_id} ] Error processing the message: {e}")
+			finally:
+				self._message_rules = None
+				self.messages.task_done()
+
+			# Read again, when half of the queue has been processed
+			if self.paused and self.socket is not None \
+					and self.messages.qsize() <= self.queue_size // 2:
+				self.paused = False
+				self.loop.add_reader(self.socket, self.client.loop_read)
+
+	async def refresh_task(self) -> None:
+		"""
+		Task that checks the changes of the rules, in the executor.
+		"""
+		while True:
+			await asyncio.sleep(max(self.rules_refresh, 0.1))
+			try:
+				await self.loop.run_in_executor(None, self.check_changes)
+			except Exception as e:
+				if self.debug:
+					print(f"[ Controller ] Error checking the changes of the rules: {e}")
+
+	async def misc_task(self) -> None:
+		"""
+		Task that keeps the connection alive, and reconnects if it is lost.
+		"""
+		while True:
+			await asyncio.sleep(1)
+			if self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS \
+					or self.stopping.is_set():
+				continue
+
+			# Connection lost
+			if self.debug:
+				print("[ Controller ] Connection lost, reconnecting...")
+			try:
+				self.client.reconnect()
+			except OSError:
+				pass
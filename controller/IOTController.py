@@ -1,100 +1,259 @@
 from .device import Device
 from .rule import Rule
-from typing import List, Dict, Any
+from typing import Iterable, List, Dict, Any, Optional
 import paho.mqtt.client as mqtt
-import threading
 import json
-from .database_communication import (
-	create_connection,
-	get_rules,
-	add_log
-)
-from datetime import datetime
-
-def get_correct_value(key: str, value: str) -> Any:
-	"""
-	Function to get the correct value of a variable.
-	Args:
-		key (str): The key of the variable.
-		value (str): The value of the variable.
-	Returns:
-		The correct value of the variable.
-	"""
-	# Temperature
-	if key == 'temperature':
-		try:
-			return float(value)
-		except ValueError:
-			raise ValueError("Invalid value for temperature")
+import threading
+import time
+from .database_communication import ConnectionManager, get_devices
+from .log_writer import LogWriter
+from .command_coalescer import CommandCoalescer
+from .worker_pool import WorkerPool
+from .ingress import BLOCK
+from .rule_index import RuleIndex
+from .rule_set import RuleSet
+from .compound_rules import CompoundRuleIndex
+from .triggers import RuleTriggers
+from .windows import WindowStore
+from .timer_wheel import TimerWheel
+from .durations import DurationConditions
+from .circuit_breaker import RuleCircuitBreaker, CLOSED, TRIPPED
+from .partition import HashRing, Partition
+from .compiled_rule import CompiledRule, InvalidThresholdError
+from .decoders import PayloadDecoder, PayloadError
+from .batch_log import BatchLog
+from .metrics import ControllerMetrics, MetricsServer
+from .profiler import MessageProfiler, MessageTrace
+from .values import DEVICE_TYPES
 
-	# Time
-	if key == 'time':
-		try:
-			return datetime.strptime(value, '%H:%M:%S').time()
-		except ValueError:
-			raise ValueError("Invalid value for time")
-
-	# State
-	if key == 'state':
-		if value != 'ON' and value != 'OFF':
-			raise ValueError("Invalid value for state")
-		return value
-
-	raise ValueError("Invalid key")
-
-def compare_values(
-		value1: Any,
-		value2: Any,
-		operator: str
-) -> bool:
-	"""
-	Function to compare two values.
-	Args:
-		value1 (Any): The first value.
-		value2 (Any): The second value.
-		operator (str): The operator to use for the comparison.
-	Returns:
-		The result of the comparison.
-	"""
-	oprs = {
-		'>': lambda x, y: x > y,
-		'<': lambda x, y: x < y,
-		'==': lambda x, y: x == y,
-		'!=': lambda x, y: x != y,
-		'>=': lambda x, y: x >= y,
-		'<=': lambda x, y: x <= y,
-	}
-
-	if operator in oprs:
-		return oprs[operator](value1, value2)
-
-	raise ValueError("Invalid operator")
+STATE_TOPIC = "redes/2312/10/{}/state"
 
+# Topic where the Django project publishes the changes of the rules and devices
+CHANGES_TOPIC = "redes/2312/10/control/changes"
 
 class IOTController:
+	# Class of the writer of the logs
+	LOG_WRITER = LogWriter
+
+	# Class of the stage that coalesces the commands
+	COMMAND_COALESCER = CommandCoalescer
+
+	# Class of the decoder of the messages
+	PAYLOAD_DECODER = PayloadDecoder
+
+	# Class of the profiler of the messages
+	MESSAGE_PROFILER = MessageProfiler
+
+	# If the changes of the rules are checked while processing the messages
+	CHECK_RULES_INLINE = True
+
+	# Class of the MQTT client
+	MQTT_CLIENT = mqtt.Client
+
 	def __init__(
 		self,
 		host: str,
 		port: int,
 		database: str,
-		debug: bool = False
+		debug: bool = False,
+		rules_cache_size: Optional[int] = None,
+		rules_refresh: float = 1.0,
+		busy_timeout: Optional[int] = 5000,
+		mmap_size: Optional[int] = None,
+		log_queue_size: int = 10000,
+		log_batch_size: int = 500,
+		log_flush_interval: float = 0.5,
+		workers: int = 4,
+		queue_size: int = 1000,
+		partition: Optional[Partition] = None,
+		command_window: Optional[float] = None,
+		metrics_port: Optional[int] = None,
+		profile_file: Optional[str] = None,
+		profile_sample: float = 0.01,
+		profile_max_bytes: int = 10 * 1024 * 1024,
+		profile_backups: int = 3,
+		drain_timeout: float = 5.0,
+		window_capacity: int = 256,
+		timer_tick: float = 0.1,
+		breaker_max_fires: Optional[int] = None,
+		breaker_period: float = 10.0,
+		breaker_cooldown: float = 60.0,
+		conflate: bool = False,
+		shed_policy: str = BLOCK
 	):
 		# Save the params
 		self.mqtt_host = host
 		self.mqtt_port = port
 		self.database = database
 		self.debug = debug
+		self.rules_refresh = rules_refresh
+		self.drain_timeout = drain_timeout
 
+		# Devices handled by this controller (None: all of them)
+		self.partition = partition
+		self.subscribed = set()
+		self._subscriptions_lock = threading.Lock()
+		self._rebalancing = False
+		self._stopping = threading.Event()
+		self._partition_thread = None
+
+		# Metrics (and the local server that publishes them, if it has a port)
+		self.metrics = ControllerMetrics()
+		self.metrics_port = metrics_port
+		self.metrics_server: Optional[MetricsServer] = None
+
+		# Wall time of the stages of each message (None: not profiled)
+		self.profiler: Optional[MessageProfiler] = None
+		if profile_file is not None:
+			self.profiler = self.MESSAGE_PROFILER(
+				profile_file,
+				sample_rate=profile_sample,
+				max_bytes=profile_max_bytes,
+				backups=profile_backups
+			)
+
+		# Long-lived database connections, one per thread
+		self.connections = ConnectionManager(
+			database,
+			busy_timeout=busy_timeout,
+			mmap_size=mmap_size
+		)
+
+		# Logs, written in batches in the background
+		self.logs = self.LOG_WRITER(
+			self.connections,
+			max_queue=log_queue_size,
+			batch_size=log_batch_size,
+			flush_interval=log_flush_interval,
+			debug=debug,
+			latency=self.metrics.db_seconds.labels("logs")
+		)
+
+		# Last state of the edge triggered rules (forgotten when they change)
+		self.triggers = RuleTriggers()
+
+		# Windows of the values, for the rules with an aggregate
+		self.windows = WindowStore(capacity=window_capacity)
+
+		# Timers of the rules with a duration, run by a single thread
+		self.timers = TimerWheel(tick=timer_tick, name="controller-timers", debug=debug)
+		self.durations = DurationConditions(
+			self.timers,
+			self.on_duration,
+			lambda device_id: self.rules.get(device_id)
+		)
+
+		# In-memory index of the rules, by source device
+		self.rules = RuleIndex(
+			database,
+			max_devices=rules_cache_size,
+			check_interval=rules_refresh,
+			device_filter=partition.owns if partition is not None else None,
+			latency=self.metrics.db_seconds.labels("rules"),
+			on_reload=self.forget_rules,
+			check_inline=self.CHECK_RULES_INLINE
+		)
+
+		# Compound rules (of several devices), evaluated from the last values
+		self.compound = CompoundRuleIndex(
+			database,
+			check_interval=rules_refresh,
+			device_filter=partition.owns if partition is not None else None,
+			latency=self.metrics.db_seconds.labels("compound_rules"),
+			check_inline=self.CHECK_RULES_INLINE
+		)
+
+		# Decoder of the messages, with the conversion of each variable
+		self.decoder = self.PAYLOAD_DECODER()
+
+		# Rules suppressed when they are applied too often (None: never)
+		self.breaker = None
+		if breaker_max_fires:
+			self.breaker = RuleCircuitBreaker(
+				breaker_max_fires,
+				period=breaker_period,
+				cooldown=breaker_cooldown
+			)
+
+		# Commands to each target, coalesced during a window (None: sent at once)
+		self.commands = None
+		if command_window:
+			self.commands = self.COMMAND_COALESCER(
+				self.apply_rule,
+				window=command_window,
+				debug=debug,
+				coalesced=self.metrics.commands_coalesced
+			)
+
+		# Workers that process the messages (0 to process them in the MQTT thread)
+		self.workers = None
+		if workers > 0:
+			self.workers = WorkerPool(
+				self._process_item,
+				workers=workers,
+				queue_size=queue_size,
+				name="controller-worker",
+				debug=debug,
+				conflate=conflate,
+				shed_policy=shed_policy,
+				on_discard=self.on_discard
+			)
 
 		# Set the client and callbacks
-		self.client = mqtt.Client()
+		self.client = self.MQTT_CLIENT()
 		self.client.on_connect = self.on_connect
 		self.client.on_message = self.on_message
+		self.client.on_publish = self.on_publish
+		self.client.message_callback_add(CHANGES_TOPIC, self.on_change)
+		self.thread = None
+
+		# Depth of the queues, read when the metrics are collected
+		self.metrics.register_queues(self.queue_depths)
+
+	def start_processing(self) -> None:
+		"""
+		Start the threads that process the messages and write the logs.
+		"""
+		self.logs.start()
+		self.timers.start()
+		if self.commands is not None:
+			self.commands.start()
+		if self.workers is not None:
+			self.workers.start()
+		self.start_metrics_server()
+
+	def start_metrics_server(self) -> None:
+		"""
+		Start serving the metrics, if the controller has a metrics port.
+		"""
+		if self.metrics_port is None or self.metrics_server is not None:
+			return
+		self.metrics_server = MetricsServer(self.metrics, self.metrics_port)
+		self.metrics_server.start()
+		if self.debug:
+			print(f"[ Controller ] Metrics on http://127.0.0.1:{self.metrics_server.port}/metrics")
+
+	def queue_depths(self) -> Dict[tuple, int]:
+		"""
+		Get the number of items waiting in each queue.
+		Returns:
+			Dict[tuple, int]: The depth of each queue, by the tuple of its name.
+		"""
+		depths = {("logs",): self.logs.queue_depth}
+		if self.workers is not None:
+			depths[("messages",)] = self.workers.queue_depth
+		if self.commands is not None:
+			depths[("commands",)] = self.commands.queue_depth
+		depths[("timers",)] = len(self.timers)
+		return depths
 
 	def start(self) -> None:
 		"""
 		Connect to the MQTT broker and start the loop.
 		"""
+		# Start processing the messages
+		self.start_processing()
+
 		# Connect to the broker
 		self.client.connect(
 			self.mqtt_host,
@@ -102,11 +261,151 @@ class IOTController:
 		)
 
 		# Execute, in a thread, the loop, so the main one can be still being used
-		thread = threading.Thread(
+		self.thread = threading.Thread(
 			target=self.client.loop_forever,
 			daemon=True
 		)
-		thread.start()
+		self.thread.start()
+
+		# Follow the devices that are created or deleted in the partition
+		if self.partition is not None:
+			self._partition_thread = threading.Thread(
+				target=self._partition_loop,
+				name="partition-refresh",
+				daemon=True
+			)
+			self._partition_thread.start()
+
+	def stop(self, timeout: Optional[float] = None) -> bool:
+		"""
+		Stop the controller gracefully: stop receiving messages, process
+		the queued ones and send their commands (still connected), wait
+		until the broker acknowledges the commands, disconnect, write the
+		pending logs and close the database connections.
+		Args:
+			timeout (float): Max seconds of the whole drain (None: the
+				drain timeout of the controller).
+		Returns:
+			bool: True if everything has been drained in time.
+		"""
+		if timeout is None:
+			timeout = self.drain_timeout
+		deadline = time.monotonic() + timeout
+		def remaining():
+			return max(0.0, deadline - time.monotonic())
+		drained = True
+
+		# Stop receiving messages (the ones already sent by the broker are dropped)
+		self._stopping.set()
+		self.stop_intake()
+
+		# Process the queued messages
+		if self.workers is not None and not self.workers.stop(remaining()):
+			drained = False
+			if self.debug:
+				print("[ Controller ] Not all the queued messages could be processed")
+
+		# Stop the timers of the durations (the rules whose duration has not ended are not applied)
+		self.timers.stop(remaining())
+
+		# Send the coalesced commands
+		if self.commands is not None:
+			self.commands.stop()
+			if self.debug:
+				print(f"[ Controller ] Commands: {self.commands.stats()}")
+
+		# Wait for the acknowledgements of the commands, and disconnect
+		if not self.wait_for_commands(remaining()):
+			drained = False
+			if self.debug:
+				print("[ Controller ] Not all the commands have been acknowledged")
+		self.client.disconnect()
+		if self.thread is not None:
+			self.thread.join(remaining())
+
+		# Write the pending logs
+		if not self.logs.stop(remaining()):
+			drained = False
+			if self.debug:
+				print("[ Controller ] Not all the pending logs could be written")
+
+		# Close the database, the metrics server and the profiler
+		self.rules.close()
+		self.compound.close()
+		self.connections.close()
+		if self.metrics_server is not None:
+			self.metrics_server.stop()
+		if self.profiler is not None:
+			self.profiler.close()
+		if self.debug:
+			print("[ Controller ] Stopped")
+		return drained
+
+	def stop_intake(self) -> None:
+		"""
+		Unsubscribe from the state topics, so the broker stops sending messages.
+		"""
+		if self.partition is None:
+			self.client.unsubscribe(STATE_TOPIC.format("+"))
+			return
+		with self._subscriptions_lock:
+			if self.subscribed:
+				self.client.unsubscribe([
+					STATE_TOPIC.format(device_id) for device_id in self.subscribed
+				])
+			self.subscribed = set()
+
+	def commands_pending(self) -> int:
+		"""
+		Returns the number of published commands that the broker has not acknowledged.
+		"""
+		return int(
+			self.metrics.commands_published.labels().value
+			- self.metrics.commands_acknowledged.labels().value
+		)
+
+	def wait_for_commands(self, timeout: float) -> bool:
+		"""
+		Wait until the broker has acknowledged the published commands.
+		Args:
+			timeout (float): Max seconds to wait.
+		Returns:
+			bool: False if some commands have not been acknowledged (the
+				time has ended, or the client is not connected).
+		"""
+		deadline = time.monotonic() + timeout
+		while self.commands_pending() > 0:
+			if not self.client.is_connected() or time.monotonic() >= deadline:
+				return False
+			time.sleep(0.01)
+		return True
+
+	def forget_rules(self, rules: Dict[int, Any], changed: Optional[Iterable[int]] = None) -> None:
+		"""
+		Forget the state kept for the rules that have been updated,
+		deleted or moved to other partition (called by the rule index
+		when the rules change).
+		Args:
+			rules (Dict[int, Any]): The loaded rules, by id.
+			changed (Iterable[int]): The ids of the rules that can have
+				changed (None: all of them).
+		"""
+		self.triggers.prune(rules, changed)
+		self.windows.prune(rules, changed)
+		self.durations.prune(rules, changed)
+
+	def reload(self) -> None:
+		"""
+		Read again the rules (and the devices of the partition) from the database.
+		"""
+		self.rules.invalidate()
+		self.compound.invalidate()
+		if self.breaker is not None:
+			self.breaker.reset()
+		if self.partition is not None and not self._stopping.is_set():
+			self.update_subscriptions()
+		if self.debug:
+			print("[ Controller ] Rules reloaded")
 
 	def on_connect(self, client, userdata, flags, rc):
 		"""
@@ -120,102 +419,471 @@ class IOTController:
 		# Connect on each device status topic
 		if self.debug:
 			print(f"[ Controller ] Connected to the broker with result code {rc}")
-		self.client.subscribe("redes/2312/10/+/state")
+
+		# Reconnected while stopping: do not receive messages again
+		if self._stopping.is_set():
+			return
+		self.client.subscribe(CHANGES_TOPIC, qos=1)
+		if self.partition is None:
+			self.client.subscribe(STATE_TOPIC.format("+"))
+		else:
+			with self._subscriptions_lock:
+				self.subscribed = set()
+			self.update_subscriptions()
 		if self.debug:
 			print("[ Controller ] Starting...")
 
+	###################
+	# NOTE: Partition #
+	###################
+
+	def update_subscriptions(self) -> None:
+		"""
+		Subscribe to the state topics of the devices of the partition
+		(and of the devices checked by its compound rules), and
+		unsubscribe from the ones that are no longer in it.
+		It does nothing while the partition is being rebalanced, or the
+		controller is stopping.
+		"""
+		if self._rebalancing or self._stopping.is_set():
+			return
+
+		devices = {
+			device_id
+			for device_id in self.connections.run(get_devices)
+			if self.partition.owns(device_id) or self.compound.depends_on(device_id)
+		}
+
+		with self._subscriptions_lock:
+			added = devices - self.subscribed
+			removed = self.subscribed - devices
+			if removed:
+				self.client.unsubscribe([
+					STATE_TOPIC.format(device_id) for device_id in removed
+				])
+			if added:
+				self.client.subscribe([
+					(STATE_TOPIC.format(device_id), 0) for device_id in added
+				])
+			self.subscribed = devices
+
+		if self.debug and (added or removed):
+			print(f"[ Controller ] {self.partition.member}: +{len(added)} -{len(removed)} devices")
+
+	def release_partition(self, members: List[str]) -> None:
+		"""
+		First step of a rebalance: stop receiving the messages of the
+		devices that will be owned by other members, and process the
+		queued ones, so the new owner continues in order.
+		Args:
+			members (List[str]): The members of the new ring.
+		"""
+		self._rebalancing = True
+		self.partition = Partition(HashRing(members), self.partition.member)
+
+		# Unsubscribe from the devices that are lost
+		with self._subscriptions_lock:
+			lost = {
+				device_id for device_id in self.subscribed
+				if not self.partition.owns(device_id)
+			}
+			if lost:
+				self.client.unsubscribe([
+					STATE_TOPIC.format(device_id) for device_id in lost
+				])
+			self.subscribed -= lost
+
+		# Process their queued messages
+		if self.workers is not None:
+			self.workers.join()
+		if self.commands is not None:
+			self.commands.flush_all()
+
+	def acquire_partition(self, members: List[str]) -> None:
+		"""
+		Second step of a rebalance (when all the members have released
+		their devices): load the rules of the new partition and subscribe
+		to its devices.
+		Args:
+			members (List[str]): The members of the new ring.
+		"""
+		self.partition = Partition(HashRing(members), self.partition.member)
+		self.rules.set_device_filter(self.partition.owns)
+		self.compound.set_device_filter(self.partition.owns)
+		self._rebalancing = False
+		self.update_subscriptions()
+
+	def _partition_loop(self) -> None:
+		"""
+		Loop that updates the subscriptions when the devices change.
+		"""
+		while not self._stopping.wait(max(self.rules_refresh, 1.0)):
+			try:
+				self.update_subscriptions()
+			except Exception as e:
+				if self.debug:
+					print(f"[ Controller ] Error updating the subscriptions: {e}")
+
 	def on_message(self, client, userdata, msg):
 		"""
 		Callback function that is called when a message is received.
+		It only queues the message, to be processed by the worker of the device.
 		Args:
 			client (mqtt.Client): The client instance for this callback.
 			userdata (Any): The private user data as set in Client() or userdata_set().
 			msg (paho.mqtt.message.MQTTMessage): The message that was received.
 		"""
-		# Connect with the database
-		database_connection = create_connection(self.database)
+		# Stopping: the messages sent before unsubscribing are dropped
+		if self._stopping.is_set():
+			return
 
-		# Get the device id that sent the message, and the device of the list
+		# Get the device id that sent the message
 		device_id = msg.topic.split("/")[-2]
+
+		# Messages of other partitions (received while rebalancing), but
+		# not of the devices checked by the compound rules of this one
+		if self.partition is not None and not self.partition.owns(device_id) \
+				and not self.compound.depends_on(device_id):
+			return
+
+		# Without workers, the message is processed in this thread
+		if self.workers is None:
+			self.process_message(device_id, msg.payload)
+			return
+		self.workers.submit(device_id, (device_id, msg.payload))
+
+	def on_discard(self, device_id: str, reason: str) -> None:
+		"""
+		Callback function that is called when a queued message is not
+		processed: a newer one of the device has replaced it (conflated),
+		or the queue was full (shed).
+		Args:
+			device_id (str): The device that sent the message.
+			reason (str): Why it has been discarded.
+		"""
+		self.metrics.messages_discarded.labels(device_id, reason).inc()
+		if self.debug:
+			print(f"[ {device_id} ] Message {reason}")
+
+	def on_publish(self, client, userdata, mid):
+		"""
+		Callback function that is called when the broker acknowledges a command.
+		Args:
+			client (mqtt.Client): The client instance for this callback.
+			userdata (Any): The private user data as set in Client() or userdata_set().
+			mid (int): The message id of the command.
+		"""
+		self.metrics.commands_acknowledged.inc()
+
+	def on_change(self, client, userdata, msg):
+		"""
+		Callback function that is called when a change notice is received:
+		the Django project publishes one each time that a rule or a device
+		is saved or deleted, so only the rules of its source device are
+		read again, without waiting for the next check of the database.
+		Args:
+			client (mqtt.Client): The client instance for this callback.
+			userdata (Any): The private user data as set in Client() or userdata_set().
+			msg (paho.mqtt.message.MQTTMessage): The change notice.
+		"""
+		if self._stopping.is_set():
+			return
+		try:
+			notice = json.loads(msg.payload)
+			entity, object_id = notice["entity"], notice["id"]
+			if entity == "rule":
+				self.rules.update_rule(int(object_id))
+			elif entity == "compound":
+				# The compound rules are few: all of them are read again
+				self.compound.invalidate()
+				if self.partition is not None:
+					self.update_subscriptions()
+			elif entity == "device":
+				# The rules of a deleted device have their own notices
+				if self.partition is not None:
+					self.update_subscriptions()
+			else:
+				return
+		except Exception as e:
+			if self.debug:
+				print(f"[ Controller ] Error applying the change notice {msg.payload!r}: {e}")
+			return
+		self.metrics.change_notices.labels(entity).inc()
+		if self.debug:
+			print(f"[ Controller ] Change of {entity} {object_id} applied (version {notice.get('version')})")
+
+	def _process_item(self, item: tuple) -> None:
+		"""
+		Process a message queued in the workers.
+		Args:
+			item (tuple): The device id and the payload of the message.
+		"""
+		self.process_message(*item)
+
+	def process_message(self, device_id: str, payload: bytes) -> None:
+		"""
+		Process a state message of a device: check its rules, and apply them.
+		Args:
+			device_id (str): The device that sent the message.
+			payload (bytes): The payload of the message.
+		"""
+		start = time.perf_counter()
+		trace = None
+		if self.profiler is not None:
+			trace = self.profiler.start(device_id)
+		try:
+			self.evaluate_message(device_id, payload, trace)
+		finally:
+			self.metrics.message_seconds.observe(time.perf_counter() - start)
+			if trace is not None:
+				self.profiler.finish(trace)
+
+	def evaluate_message(
+		self,
+		device_id: str,
+		payload: bytes,
+		trace: Optional[MessageTrace] = None
+	) -> None:
+		"""
+		Decode a state message, and apply the rules whose condition is met
+		by each of its readings (in order). The rules applied and the
+		errors of a message with several readings are logged once.
+		Args:
+			device_id (str): The device that sent the message.
+			payload (bytes): The payload of the message.
+			trace (MessageTrace): Trace where the time of each stage is
+				recorded (None: not profiled).
+		"""
 		if self.debug:
 			print(f"[ {device_id} ] Message received from {device_id}")
 
-		# Get the payload and the topic
+		# Get the readings of the message
 		try:
-			payload = json.loads(msg.payload.decode())
-		except json.JSONDecodeError:
-			add_log(
-				database_connection,
-				"Bad message format",
+			readings = self.decoder.parse_batch(payload)
+		except PayloadError as e:
+			self.metrics.messages.labels("unknown").inc()
+			self.metrics.parse_failures.labels(str(e)).inc()
+			self.logs.log(
+				str(e),
 				device_id
 			)
-		if self.debug:
-			print(f"[ {device_id} ] Payload: ", payload)
-		
-		# Get the variable to check, and convert to the correct value
-		message_keys = list(payload.keys())
-		if len(message_keys) != 1:
-			add_log(
-				database_connection,
-				"Too many keys in the message",
+			if trace is not None:
+				trace.mark("log")
+			return
+		if trace is not None:
+			trace.mark("decode")
+
+		if len(readings) == 1:
+			key, value, timestamp = readings[0]
+			self.evaluate_reading(device_id, key, value, timestamp, trace)
+			return
+
+		# Several readings, evaluated in order and logged at the end
+		batch = BatchLog(len(readings))
+		for key, value, timestamp in readings:
+			self.evaluate_reading(device_id, key, value, timestamp, trace, batch)
+		message = batch.message()
+		if message is not None:
+			self.logs.log(
+				message,
 				device_id
 			)
-			return
+			if trace is not None:
+				trace.mark("log")
 
-		key_to_check = message_keys[0]
-		value = payload.get(key_to_check)
+	def evaluate_reading(
+		self,
+		device_id: str,
+		key: str,
+		value: Any,
+		timestamp: Optional[float] = None,
+		trace: Optional[MessageTrace] = None,
+		batch: Optional[BatchLog] = None
+	) -> None:
+		"""
+		Apply the rules whose condition is met by a reading of a device.
+		Args:
+			device_id (str): The device that sent the reading.
+			key (str): The variable read.
+			value (Any): The value read, not converted yet.
+			timestamp (float): Time of the reading, in seconds since the
+				epoch (None: now), for the windows of the aggregates.
+			trace (MessageTrace): Trace where the time of each stage is
+				recorded (None: not profiled).
+			batch (BatchLog): Where the rules applied and the errors are
+				recorded, if the reading is part of a batch (None: they
+				are logged now).
+		"""
+		# Convert the value
 		try:
-			source_correct_value = get_correct_value(key_to_check, value)
-		except ValueError:
-			add_log(
-				database_connection,
-				"Bad value format",
+			value = self.decoder.convert(key, value)
+		except PayloadError as e:
+			self.metrics.messages.labels("unknown").inc()
+			self.metrics.parse_failures.labels(str(e)).inc()
+			if batch is not None:
+				batch.error(str(e))
+				return
+			self.logs.log(
+				str(e),
 				device_id
 			)
+			if trace is not None:
+				trace.mark("log")
 			return
+		if trace is not None:
+			trace.mark("conversion")
+		self.metrics.messages.labels(DEVICE_TYPES.get(key, "unknown")).inc()
+		if self.debug:
+			print(f"[ {device_id} ] Value: ", key, value)
+
+		# Get the rules of the variable whose condition is met (in order,
+		# until a rule can not be evaluated)
+		device_rules = self.lookup_rules(device_id).of_variable(key)
+		if trace is not None:
+			trace.mark("lookup")
+		matches, error = device_rules.match(key, value)
+		if device_rules.windowed:
+			matches = self.windows.match(device_id, device_rules, key, value, timestamp, matches)
+
+		# The rules with a duration are applied when their timer ends
+		if device_rules.durations:
+			matches = self.durations.update(device_id, device_rules, key, matches)
+
+		# Only the transitions of the edge triggered rules are applied
+		rules = self.triggers.select(
+			device_rules,
+			key,
+			value,
+			matches
+		)
+
+		# Compound rules that check the device (after its own rules)
+		compound = self.compound.update(device_id, key, value)
+		if compound:
+			rules = rules + compound
 
-		# Check the rules, checking if it has to be applied
-		rules = get_rules(device_id, database_connection)
+		# The rules applied too often are suppressed for a while
+		if self.breaker is not None and rules:
+			rules = [rule for rule in rules if self.allow_rule(rule, device_id)]
+		self.metrics.rules_evaluated.inc(len(device_rules))
+		if rules:
+			self.metrics.rules_fired.inc(len(rules))
+		if trace is not None:
+			trace.mark("evaluation")
 		for rule in rules:
 			if self.debug:
-				print(f"[ {device_id} ] Checking rule: ", rule['name'])
-			# Convert the threshold to the correct value
-			try:
-				threshold = get_correct_value(key_to_check, rule['threshold'])
-			except ValueError:
-				add_log(
-					database_connection,
-					"Invalid threshold format",
-				)
-				return
-			
-			# Make the comparation, and check if it is correct
-			try:
-				comparation = compare_values(source_correct_value, threshold, rule['operator'])
-			except ValueError:
+				print(f"[ {device_id} ] Rule matched: ", rule.name)
+
+			# Send the command now, or when the window of the target ends (the
+			# coalescer logs the command that it sends, not the batch, as it
+			# can be replaced by the one of other rule)
+			if self.commands is not None:
+				self.commands.submit(rule, device_id)
+				if trace is not None:
+					trace.mark("publish")
+			else:
+				self.apply_rule(rule, device_id, trace, log=batch is None)
+				if batch is not None:
+					batch.rule_applied(rule.name)
+
+		# A rule with a bad threshold stops the evaluation
+		if isinstance(error, InvalidThresholdError):
+			if batch is not None:
+				batch.error("Invalid threshold format")
 				return
-			
-			if self.debug:
-				print(f"[ {device_id} ] Comparation result: ", comparation)
-			if not comparation:
-				continue
-
-			# Execute the command on the target device (send the command payload)
-			target_device = rule['target_device_id']
-			self.client.publish(
-				f"redes/2312/10/{target_device}/command",
-				rule['command_payload'],
-				qos=1
+			self.logs.log(
+				"Invalid threshold format",
 			)
+			if trace is not None:
+				trace.mark("log")
+
+	def lookup_rules(self, device_id: str) -> RuleSet:
+		"""
+		Get the rules of a device, to evaluate its message.
+		Args:
+			device_id (str): The source device id.
+		Returns:
+			RuleSet: The rules of the device.
+		"""
+		return self.rules.get(device_id)
+
+	def on_duration(self, rule: CompiledRule, device_id: str) -> None:
+		"""
+		Apply a rule whose condition has been met during its whole
+		duration (called from the thread of the timers).
+		Args:
+			rule (CompiledRule): The rule to apply.
+			device_id (str): The source device that has met the condition.
+		"""
+		if self.breaker is not None and not self.allow_rule(rule, device_id):
+			return
+		self.metrics.rules_fired.inc()
+		if self.debug:
+			print(f"[ {device_id} ] Rule matched during {rule.duration}s: ", rule.name)
+		if self.commands is not None:
+			self.commands.submit(rule, device_id)
+		else:
+			self.apply_rule(rule, device_id)
 
-			# Notify django
-			add_log(
-				database_connection,
-				f"Rule '{rule['name']}' applied",
+	def allow_rule(self, rule: Any, device_id: str) -> bool:
+		"""
+		Check the circuit breaker of a rule that is going to be applied. The
+		time that it trips is logged.
+		Args:
+			rule (Any): The rule (or compound rule) to apply.
+			device_id (str): The source device that has met the condition.
+		Returns:
+			bool: True if it can be applied, False if it is suppressed.
+		"""
+		# The ids of the rules and the compound rules are not unique together
+		state = self.breaker.fire((type(rule), rule.id))
+		if state == CLOSED:
+			return True
+		if state == TRIPPED:
+			self.metrics.breaker_trips.inc()
+			self.logs.log(
+				f"Rule '{rule.name}' suppressed for {self.breaker.cooldown:g}s: applied more than "
+				f"{self.breaker.max_fires} times in {self.breaker.period:g}s",
 				device_id
 			)
 			if self.debug:
-				print(f"[ {device_id} ] Rule '{rule['name']}' applied")
+				print(f"[ {device_id} ] Rule '{rule.name}' suppressed")
+		self.metrics.rules_suppressed.inc()
+		return False
+
+	def apply_rule(
+		self,
+		rule: CompiledRule,
+		device_id: str,
+		trace: Optional[MessageTrace] = None,
+		log: bool = True
+	) -> None:
+		"""
+		Send the command of a rule to its target device, and log it.
+		Args:
+			rule (CompiledRule): The rule to apply.
+			device_id (str): The source device that has met the condition.
+			trace (MessageTrace): Trace of the message that applies the rule
+				(None: not profiled, or sent by the command coalescer).
+			log (bool): If it is logged now (not when it is part of a batch).
+		"""
+		# Execute the command on the target device (send the command payload)
+		self.client.publish(
+			rule.command_topic,
+			rule.command_payload,
+			qos=1
+		)
+		self.metrics.commands_published.inc()
+		if trace is not None:
+			trace.mark("publish")
 
-		# Close the database connection
-		database_connection.close()
\ No newline at end of file
+		# Notify django
+		if log:
+			self.logs.log(
+				f"Rule '{rule.name}' applied",
+				device_id
+			)
+			if trace is not None:
+				trace.mark("log")
+		if self.debug:
+			print(f"[ {device_id} ] Rule '{rule.name}' applied")
@@ -1,4 +1,257 @@
+import random
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+# Status codes of the errors that are retried (the server is not available)
+RETRY_STATUS = {502, 503, 504}
+
+class APIError(Exception):
+	"""
+	The api could not be reached, or it has answered with an error.
+	"""
+
+class APIClient:
+	"""
+	Client of the api of the Django project, with a pool of keep-alive
+	connections (so each request does not open a new one), bounded
+	timeouts, retries with jitter and compressed responses.
+
+	The lists are requested with the ETag of the last answer
+	(`If-None-Match`), so when nothing has changed the server answers
+	with a 304 and the last data is returned again.
+	"""
+	def __init__(
+		self,
+		host: str = "localhost",
+		port: int = 8000,
+		connect_timeout: float = 3.0,
+		read_timeout: float = 10.0,
+		retries: int = 3,
+		backoff: float = 0.2,
+		max_backoff: float = 5.0,
+		pool_size: int = 4,
+		debug: bool = False
+	):
+		"""
+		Constructor of the APIClient class.
+		Args:
+			host (str): Host of the Django server (with or without scheme).
+			port (int): Port of the Django server.
+			connect_timeout (float): Max seconds to connect.
+			read_timeout (float): Max seconds to wait for the answer.
+			retries (int): Times that a failed request is retried.
+			backoff (float): Seconds of the first wait before a retry,
+				doubled in each one (a random part of it is waited).
+			max_backoff (float): Max seconds of the wait before a retry.
+			pool_size (int): Max connections kept open.
+			debug (bool): Debug mode.
+		"""
+		if "://" not in host:
+			host = f"http://{host}"
+		self.base_url = f"{host}:{port}/api/v1/"
+		self.timeout = (connect_timeout, read_timeout)
+		self.retries = retries
+		self.backoff = backoff
+		self.max_backoff = max_backoff
+		self.debug = debug
+
+		# Session with a pool of connections (the retries are made here, with jitter)
+		self.session = requests.Session()
+		adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+		self.session.mount("http://", adapter)
+		self.session.mount("https://", adapter)
+		self.session.headers["Accept-Encoding"] = "gzip"
+
+		# ETag and data of the last answer of each list
+		self._cache: Dict[Tuple[str, tuple], Tuple[str, Any]] = {}
+		self._lock = threading.Lock()
+
+		# Requests made, and answered with a 304
+		self.requests = 0
+		self.not_modified = 0
+
+	def __enter__(self) -> "APIClient":
+		return self
+
+	def __exit__(self, *exc_info) -> None:
+		self.close()
+
+	def close(self) -> None:
+		"""
+		Close the connections of the pool.
+		"""
+		self.session.close()
+
+	def get(self, path: str, params: Optional[Dict[str, Any]] = None) -> Any:
+		"""
+		Read a resource of the api, sending the ETag of the last answer.
+		Args:
+			path (str): Path of the resource, from the api root.
+			params (Dict[str, Any]): Params of the query.
+		Returns:
+			Any: The decoded JSON (the last one if it has not changed).
+		Raises:
+			APIError: If it could not be read.
+		"""
+		key = (path, tuple(sorted((params or {}).items())))
+		with self._lock:
+			cached = self._cache.get(key)
+		headers = {"If-None-Match": cached[0]} if cached is not None else {}
+
+		response = self.request("GET", path, params=params, headers=headers)
+		if response.status_code == 304 and cached is not None:
+			self.not_modified += 1
+			return cached[1]
+		data = self._json(response)
+
+		etag = response.headers.get("ETag")
+		if etag is not None:
+			with self._lock:
+				self._cache[key] = (etag, data)
+		return data
+
+	def post(self, path: str, body: Dict[str, Any]) -> Any:
+		"""
+		Create a resource of the api.
+		Args:
+			path (str): Path of the resource, from the api root.
+			body (Dict[str, Any]): The data of the resource.
+		Returns:
+			Any: The decoded JSON of the answer.
+		Raises:
+			APIError: If it could not be created.
+		"""
+		return self._json(self.request("POST", path, json=body))
+
+	def request(self, method: str, path: str, **kwargs) -> requests.Response:
+		"""
+		Make a request, retrying it if the server can not be reached (a
+		POST is only retried if it could not be sent, so it is not
+		duplicated).
+		Args:
+			method (str): HTTP method.
+			path (str): Path of the resource, from the api root.
+			kwargs: Params of `requests.Session.request`.
+		Returns:
+			requests.Response: The answer.
+		Raises:
+			APIError: If there is no answer after the retries.
+		"""
+		idempotent = method in ("GET", "HEAD")
+		for attempt in range(self.retries + 1):
+			last = attempt == self.retries
+			self.requests += 1
+			try:
+				response = self.session.request(
+					method,
+					self.base_url + path,
+					timeout=self.timeout,
+					**kwargs
+				)
+			except (requests.ConnectionError, requests.Timeout) as e:
+				if last or (self._sent(e) and not idempotent):
+					raise APIError(f"{method} {path}: {e}") from e
+				if self.debug:
+					print(f"[ API ] {method} {path} failed ({e}), retrying...")
+			else:
+				if response.status_code not in RETRY_STATUS or not idempotent or last:
+					return response
+				if self.debug:
+					print(f"[ API ] {method} {path} answered {response.status_code}, retrying...")
+			self._wait(attempt)
+
+	def _wait(self, attempt: int) -> None:
+		"""
+		Wait before a retry: a random time up to the backoff of the attempt
+		(so the clients that fail at once do not retry at once).
+		"""
+		time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+
+	@staticmethod
+	def _sent(error: requests.RequestException) -> bool:
+		"""
+		Returns if the request of a failure could have reached the server
+		(it is not known if the connection is lost while waiting the answer).
+		"""
+		if isinstance(error, requests.ConnectTimeout):
+			return False
+		reason = getattr(error.args[0], "reason", None) if error.args else None
+		return not isinstance(reason, NewConnectionError)
+
+	@staticmethod
+	def _json(response: requests.Response) -> Any:
+		"""
+		Decode the JSON of an answer.
+		Raises:
+			APIError: If it is an error.
+		"""
+		if response.status_code >= 400:
+			raise APIError(f"{response.request.method} {response.url}: {response.status_code}")
+		try:
+			return response.json()
+		except ValueError as e:
+			raise APIError(f"{response.request.method} {response.url}: invalid JSON") from e
+
+	#################
+	# NOTE: Api use #
+	#################
+
+	def devices(self) -> list:
+		"""
+		Returns the data of all the devices.
+		"""
+		return self.get("devices/")
+
+	def rules(self) -> list:
+		"""
+		Returns the data of all the rules.
+		"""
+		return self.get("rules/")
+
+	def device_changes(self, since: int) -> dict:
+		"""
+		Returns the devices changed after a version (see `get_device_changes_from_api`).
+		"""
+		return self.get("devices/", {"since": since})
+
+	def rule_changes(self, since: int) -> dict:
+		"""
+		Returns the rules changed after a version (see `get_rule_changes_from_api`).
+		"""
+		return self.get("rules/", {"since": since})
+
+	def add_log(self, message: str, device_id: Optional[str] = None) -> Any:
+		"""
+		Add a log message (see `add_log_message`).
+		"""
+		body = {"message": message}
+		if device_id is not None:
+			body["device"] = device_id
+		return self.post("logs/", body)
+
+# Clients of the functions, by host and port
+_clients: Dict[Tuple[str, int], APIClient] = {}
+_clients_lock = threading.Lock()
+
+def get_client(host: str, port: int) -> APIClient:
+	"""
+	Function to get the shared client of a Django server (created the
+	first time), so its connections are reused.
+	Args:
+		host (str): Host of the Django server.
+		port (int): Port of the Django server.
+	Returns:
+		APIClient: The client.
+	"""
+	with _clients_lock:
+		client = _clients.get((host, port))
+		if client is None:
+			client = _clients[(host, port)] = APIClient(host, port)
+		return client
 
 def get_devices_from_api(
 	host: str,
@@ -9,13 +262,10 @@ def get_devices_from_api(
 	Args:
 		host (str): Host of the Django server.
 		port (int): Port of the Django server.
-	"""	
+	"""
 	try:
-		request = requests.get(
-			f"http://localhost:8000/api/v1/devices/"
-		)
-		return request.json()
-	except Exception:
+		return get_client(host, port).devices()
+	except APIError:
 		return None
 
 def get_rules_from_api(
@@ -27,13 +277,52 @@ def get_rules_from_api(
 	Args:
 		host (str): Host of the Django server.
 		port (int): Port of the Django server.
-	"""	
+	"""
 	try:
-		request = requests.get(
-			f"http://localhost:8000/api/v1/rules/"
-		)
-		return request.json()
-	except Exception:
+		return get_client(host, port).rules()
+	except APIError:
+		return None
+
+def get_device_changes_from_api(
+	host: str,
+	port: int,
+	since: int
+):
+	"""
+	Function to read from the api the devices changed after a version
+	Args:
+		host (str): Host of the Django server.
+		port (int): Port of the Django server.
+		since (int): Last version that the caller has (0 to read all the devices).
+	Returns:
+		dict: The last version, if the results are all the devices ("full"),
+			the changed devices ("results") and the ids of the deleted
+			ones ("deleted"), or None if it could not be read.
+	"""
+	try:
+		return get_client(host, port).device_changes(since)
+	except APIError:
+		return None
+
+def get_rule_changes_from_api(
+	host: str,
+	port: int,
+	since: int
+):
+	"""
+	Function to read from the api the rules changed after a version
+	Args:
+		host (str): Host of the Django server.
+		port (int): Port of the Django server.
+		since (int): Last version that the caller has (0 to read all the rules).
+	Returns:
+		dict: The last version, if the results are all the rules ("full"),
+			the changed rules ("results") and the ids of the deleted
+			ones ("deleted"), or None if it could not be read.
+	"""
+	try:
+		return get_client(host, port).rule_changes(since)
+	except APIError:
 		return None
 
 def add_log_message(
@@ -53,16 +342,7 @@ def add_log_message(
 			the message. This argument can be None, so the
 			log will not have a device associated.
 	"""
-	# Set the body to send
-	body = { "message": message }
-	if device_id is not None:
-		body["device"] = device_id
-
-	print("Sending: ", body)
 	try:
-		request = requests.post(
-			f"{host}:{port}/api/v1/logs/",
-			json=body
-		)
-	except Exception:
-		return None
\ No newline at end of file
+		get_client(host, port).add_log(message, device_id)
+	except APIError:
+		return None
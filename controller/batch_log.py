@@ -0,0 +1,44 @@
+from typing import Dict, Optional
+
+class BatchLog:
+	"""
+	What has happened with the readings of a batched message (the rules
+	applied and the errors), logged once for the whole message instead
+	of once per reading.
+	"""
+	__slots__ = ("readings", "applied", "errors")
+
+	def __init__(self, readings: int):
+		"""
+		Constructor of the BatchLog class.
+		Args:
+			readings (int): Number of readings of the message.
+		"""
+		self.readings = readings
+		self.applied: Dict[str, int] = {}
+		self.errors: Dict[str, int] = {}
+
+	def rule_applied(self, name: str) -> None:
+		"""
+		Record that a rule has been applied by a reading.
+		"""
+		self.applied[name] = self.applied.get(name, 0) + 1
+
+	def error(self, message: str) -> None:
+		"""
+		Record the error of a reading.
+		"""
+		self.errors[message] = self.errors.get(message, 0) + 1
+
+	def message(self) -> Optional[str]:
+		"""
+		Returns the log message of the batch, or None if there is nothing to log.
+		"""
+		parts = []
+		if self.applied:
+			rules = ", ".join(f"'{name}' x{count}" for name, count in self.applied.items())
+			parts.append(f"rules applied {rules}")
+		parts.extend(f"{error} x{count}" for error, count in self.errors.items())
+		if not parts:
+			return None
+		return f"Batch of {self.readings} readings: " + "; ".join(parts)
@@ -0,0 +1,91 @@
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Hashable, Optional
+
+# Results of a fire of a rule
+CLOSED = "closed"
+TRIPPED = "tripped"
+OPEN = "open"
+
+class RuleCircuitBreaker:
+	"""
+	Circuit breaker of the rules: a rule that is applied more than
+	`max_fires` times in `period` seconds (like the rules of a loop,
+	whose commands change the states that apply them again) trips it,
+	and it is suppressed until `cooldown` seconds have passed. Then it
+	is closed again, with its count from zero.
+
+	The times of the last `max_fires + 1` fires of each rule are kept, so
+	each fire costs O(1).
+	"""
+	def __init__(
+		self,
+		max_fires: int,
+		period: float = 10.0,
+		cooldown: float = 60.0,
+		clock: Callable[[], float] = time.monotonic
+	):
+		"""
+		Constructor of the RuleCircuitBreaker class.
+		Args:
+			max_fires (int): Max times that a rule can be applied in the period.
+			period (float): Seconds of the period.
+			cooldown (float): Seconds that a rule is suppressed when it trips.
+			clock (Callable[[], float]): Function that returns the time.
+		"""
+		# Save the params
+		self.max_fires = max_fires
+		self.period = period
+		self.cooldown = cooldown
+		self.clock = clock
+
+		# Times of the last fires of each rule, and end of the cooldown of the open ones
+		self._fires: Dict[Hashable, Deque[float]] = {}
+		self._open: Dict[Hashable, float] = {}
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._open)
+
+	def fire(self, key: Hashable) -> str:
+		"""
+		Record that a rule is going to be applied.
+		Args:
+			key (Hashable): Key of the rule.
+		Returns:
+			str: CLOSED if it can be applied, TRIPPED if it has gone over
+				the max fires with this one (it is not applied, and it is
+				suppressed from now), or OPEN if it is suppressed.
+		"""
+		now = self.clock()
+		with self._lock:
+			until = self._open.get(key)
+			if until is not None:
+				if now < until:
+					return OPEN
+				del self._open[key]
+
+			fires = self._fires.get(key)
+			if fires is None:
+				fires = self._fires[key] = deque(maxlen=self.max_fires + 1)
+			fires.append(now)
+			if len(fires) > self.max_fires and now - fires[0] < self.period:
+				fires.clear()
+				self._open[key] = now + self.cooldown
+				return TRIPPED
+			return CLOSED
+
+	def reset(self, key: Optional[Hashable] = None) -> None:
+		"""
+		Close the breaker of a rule, or of all of them.
+		Args:
+			key (Hashable): Key of the rule (None: all the rules).
+		"""
+		with self._lock:
+			if key is None:
+				self._fires.clear()
+				self._open.clear()
+			else:
+				self._fires.pop(key, None)
+				self._open.pop(key, None)
@@ -0,0 +1,285 @@
+import asyncio
+import heapq
+import threading
+import time
+import traceback
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from .compiled_rule import CompiledRule
+
+class _PendingCommand:
+	"""
+	Command waiting in the window of a target device.
+	"""
+	__slots__ = ('rule', 'device_id', 'commands', 'deadline')
+
+	def __init__(self, rule: CompiledRule, device_id: str):
+		self.rule = rule
+		self.device_id = device_id
+		self.commands = 1
+		self.deadline = 0.0
+
+class CommandCoalescer:
+	"""
+	Stage that collects the commands sent to each target device during
+	a window (from the first one), and only sends one of them: the one
+	of the rule with the highest priority, or the last one if there
+	are several with the same priority.
+
+	It is useful when several rules (like many sensors controlling the
+	same switch) are applied at the same time: only the last state is
+	sent, instead of one command for each rule. The windows are closed
+	by a thread.
+
+	The commands that are not sent are counted by reason: superseded
+	(by a later one of the same or higher priority) or outranked (by
+	the waiting one, of a higher priority).
+	"""
+	def __init__(
+		self,
+		apply: Callable[[CompiledRule, str], None],
+		window: float = 0.01,
+		debug: bool = False,
+		coalesced: Optional[Any] = None
+	):
+		"""
+		Constructor of the CommandCoalescer class.
+		Args:
+			apply (Callable[[CompiledRule, str], None]): Function that sends
+				the command of a rule, applied by a source device.
+			window (float): Seconds that the commands of a target are collected.
+			debug (bool): Debug mode.
+			coalesced (Counter): Metric where the commands that are not
+				sent are counted, by reason.
+		"""
+		# Save the params
+		self.apply = apply
+		self.window = window
+		self.debug = debug
+		self.coalesced_metric = coalesced
+
+		# Pending command by target, and the end of their windows
+		self._lock = threading.Lock()
+		self._pending: Dict[str, _PendingCommand] = {}
+		self._deadlines: List[Tuple[float, str]] = []
+
+		# Thread that closes the windows
+		self._condition = threading.Condition(self._lock)
+		self._thread: Optional[threading.Thread] = None
+		self._stopped = False
+
+		# Counters
+		self.submitted = 0
+		self.published = 0
+		self.superseded = 0
+		self.outranked = 0
+
+	@property
+	def queue_depth(self) -> int:
+		"""
+		Returns the number of targets with a command waiting to be sent.
+		"""
+		return len(self._pending)
+
+	@property
+	def coalesced(self) -> int:
+		"""
+		Returns the number of commands that have not been sent, because
+		other command was sent instead.
+		"""
+		with self._lock:
+			pending = sum(command.commands for command in self._pending.values())
+		return self.submitted - self.published - pending
+
+	def stats(self) -> Dict[str, int]:
+		"""
+		Returns the counters of the coalescer.
+		"""
+		return {
+			'pending': self.queue_depth,
+			'submitted': self.submitted,
+			'published': self.published,
+			'coalesced': self.coalesced,
+			'superseded': self.superseded,
+			'outranked': self.outranked,
+		}
+
+	def start(self) -> None:
+		"""
+		Start the thread that closes the windows.
+		"""
+		if self._thread is not None:
+			return
+		self._thread = threading.Thread(
+			target=self._run,
+			name="command-coalescer",
+			daemon=True
+		)
+		self._thread.start()
+
+	def submit(self, rule: CompiledRule, device_id: str) -> None:
+		"""
+		Add the command of a rule to the window of its target.
+		Args:
+			rule (CompiledRule): The rule that has been applied.
+			device_id (str): The source device.
+		"""
+		target = rule.target_device_id
+		with self._lock:
+			self.submitted += 1
+			if not self._stopped:
+				pending = self._pending.get(target)
+
+				# First command of the target: open the window
+				if pending is None:
+					self._pending[target] = _PendingCommand(rule, device_id)
+					self._schedule(target)
+					return
+
+				# Keep the last one of the highest priority
+				pending.commands += 1
+				if rule.priority >= pending.rule.priority:
+					pending.rule = rule
+					pending.device_id = device_id
+					self.superseded += 1
+					self._count("superseded")
+				else:
+					self.outranked += 1
+					self._count("outranked")
+				return
+			self.published += 1
+
+		# Stopped: send it now
+		self._apply(_PendingCommand(rule, device_id))
+
+	def flush(self, target: str) -> None:
+		"""
+		Close the window of a target, sending its command.
+		Args:
+			target (str): The target device id.
+		"""
+		with self._lock:
+			pending = self._pending.pop(target, None)
+			if pending is None:
+				return
+			self.published += 1
+		self._apply(pending)
+
+	def flush_all(self) -> None:
+		"""
+		Close all the windows, sending their commands.
+		"""
+		with self._lock:
+			targets = list(self._pending)
+		for target in targets:
+			self.flush(target)
+
+	def stop(self) -> None:
+		"""
+		Stop the thread, sending the pending commands.
+		"""
+		with self._condition:
+			self._stopped = True
+			self._condition.notify()
+		if self._thread is not None:
+			self._thread.join()
+		self.flush_all()
+
+	def _schedule(self, target: str) -> None:
+		"""
+		Close the window of a target when it ends. The caller must hold the lock.
+		Args:
+			target (str): The target device id.
+		"""
+		deadline = time.monotonic() + self.window
+		self._pending[target].deadline = deadline
+		heapq.heappush(self._deadlines, (deadline, target))
+		self._condition.notify()
+
+	def _count(self, reason: str) -> None:
+		"""
+		Count a command that is not sent in the metrics, if any.
+		"""
+		if self.coalesced_metric is not None:
+			self.coalesced_metric.labels(reason).inc()
+
+	def _apply(self, pending: _PendingCommand) -> None:
+		"""
+		Send a command, without stopping the coalescer if it fails.
+		"""
+		try:
+			self.apply(pending.rule, pending.device_id)
+		except Exception as e:
+			if self.debug:
+				print(f"[ Controller ] Error sending the command of '{pending.rule.name}': {e}")
+				traceback.print_exc()
+
+	def _run(self) -> None:
+		"""
+		Loop of the thread: close the windows when they end.
+		"""
+		while True:
+			with self._condition:
+				# Wait for the first window to end
+				while not self._stopped:
+					if self._deadlines:
+						remaining = self._deadlines[0][0] - time.monotonic()
+						if remaining <= 0:
+							break
+						self._condition.wait(remaining)
+					else:
+						self._condition.wait()
+				if self._stopped:
+					return
+				deadline, target = heapq.heappop(self._deadlines)
+
+				# The window has already been closed (and maybe other one opened)
+				pending = self._pending.get(target)
+				if pending is None or pending.deadline != deadline:
+					continue
+			self.flush(target)
+
+class AsyncCommandCoalescer(CommandCoalescer):
+	"""
+	Command coalescer for the asyncio engine: the windows are closed by
+	the event loop, so the commands are sent from it. `submit` must be
+	called from the loop.
+	"""
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+	def start(self) -> None:
+		"""
+		Attach the coalescer to the running loop.
+		"""
+		self._loop = asyncio.get_running_loop()
+
+	def stop(self) -> None:
+		"""
+		Send the pending commands.
+		"""
+		self._stopped = True
+		self.flush_all()
+
+	def _schedule(self, target: str) -> None:
+		"""
+		Close the window of a target when it ends.
+		Args:
+			target (str): The target device id.
+		"""
+		deadline = self._loop.time() + self.window
+		self._pending[target].deadline = deadline
+		self._loop.call_at(deadline, self._expire, target, deadline)
+
+	def _expire(self, target: str, deadline: float) -> None:
+		"""
+		Close the window of a target, if it is the one of the deadline
+		(it can have been closed before, and other one opened).
+		Args:
+			target (str): The target device id.
+			deadline (float): The end of the window.
+		"""
+		pending = self._pending.get(target)
+		if pending is None or pending.deadline != deadline:
+			return
+		self.flush(target)
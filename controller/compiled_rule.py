@@ -0,0 +1,274 @@
+from typing import Any, Dict, FrozenSet, Mapping, Optional, Tuple
+from .values import (
+	OPERATORS,
+	CONVERTERS,
+	DISCRETE_VARIABLES,
+	get_correct_value,
+	to_temperature
+)
+from .database_communication import RULE_COLUMNS, rule_checksum
+
+COMMAND_TOPIC = "redes/2312/10/{}/command"
+
+# Triggers of the rules (when they are applied)
+LEVEL = 'level'
+RISING = 'rising'
+FALLING = 'falling'
+HYSTERESIS = 'hysteresis'
+EDGE_TRIGGERS = frozenset((RISING, FALLING, HYSTERESIS))
+
+# Aggregates of the values of a window, compared instead of the last value
+AVG = 'avg'
+MIN = 'min'
+MAX = 'max'
+COUNT = 'count'
+DERIVATIVE = 'derivative'
+
+# Aggregates whose threshold is a number, whatever the variable
+NUMBER_AGGREGATES = frozenset((COUNT, DERIVATIVE))
+
+# Columns of the rules added after the first version, with the value of
+# the rows without them
+OPTIONAL_COLUMNS = {
+	'trigger': LEVEL,
+	'hysteresis': 0,
+	'priority': 0,
+	'aggregate': '',
+	'window': 0,
+	'duration': 0,
+}
+
+# Marker of a threshold that can not be converted
+_INVALID = object()
+
+def rule_version(row: Mapping[str, Any]) -> Tuple[Any, int]:
+	"""
+	Function to get the version of a rule: its last update and the
+	checksum of its columns (they can be changed without updating it).
+	Args:
+		row (Mapping[str, Any]): The rule, as read from the database.
+	Returns:
+		Tuple[Any, int]: The version.
+	"""
+	columns = set(row.keys())
+	return (row['updated_at'], rule_checksum(*(
+		row[name] if name in columns else OPTIONAL_COLUMNS[name]
+		for name in RULE_COLUMNS
+	)))
+
+class InvalidThresholdError(ValueError):
+	"""
+	The threshold of the rule can not be converted to the message variable.
+	"""
+
+class InvalidOperatorError(ValueError):
+	"""
+	The operator of the rule is not valid.
+	"""
+
+class CompiledRule:
+	"""
+	Rule (row of `app_rule`) prepared to be evaluated on each message.
+
+	It is built once per rule version (`rule_version`), and keeps:
+		· The operator function, resolved from `OPERATORS`.
+		· The threshold converted to the type of each message variable
+		  (converted the first time that the variable is seen).
+		· The command topic and the encoded payload, ready to publish.
+		· The result for each value of the discrete variables, like
+		  the switch state.
+		· The threshold where a hysteresis trigger is released.
+
+	A rule with an aggregate (`aggregate` and `window`) is compared with
+	an aggregate of the values of the window, kept by the `WindowStore`,
+	instead of the value of the message. A rule with a `duration` is
+	applied when its condition has been met for that time, by the
+	`DurationConditions` of the controller.
+	"""
+	__slots__ = (
+		'id',
+		'name',
+		'source_device_id',
+		'operator',
+		'threshold',
+		'target_device_id',
+		'trigger',
+		'hysteresis',
+		'priority',
+		'aggregate',
+		'window',
+		'duration',
+		'command_topic',
+		'command_payload',
+		'version',
+		'compare',
+		'_thresholds',
+		'_outcomes',
+		'_releases',
+		'_variables',
+	)
+
+	def __init__(self, row: Mapping[str, Any]):
+		"""
+		Constructor of the CompiledRule class.
+		Args:
+			row (Mapping[str, Any]): The rule, as read from the database
+				(a sqlite3.Row or a dict, where the optional columns can
+				be missing).
+		"""
+		columns = set(row.keys())
+		optional = {
+			name: row[name] if name in columns else default
+			for name, default in OPTIONAL_COLUMNS.items()
+		}
+		self.id = row['id']
+		self.name = row['name']
+		self.source_device_id = row['source_device_id']
+		self.operator = row['operator']
+		self.threshold = row['threshold']
+		self.target_device_id = row['target_device_id']
+		self.trigger = optional['trigger']
+		self.hysteresis = optional['hysteresis']
+		self.priority = optional['priority']
+		self.aggregate = optional['aggregate'] or None
+		self.window = optional['window']
+		self.duration = optional['duration']
+		self.version = rule_version(row)
+
+		# Command, ready to be sent
+		self.command_topic = COMMAND_TOPIC.format(self.target_device_id)
+		self.command_payload = row['command_payload'].encode()
+
+		# Operator function (None if it is not valid)
+		self.compare = OPERATORS.get(self.operator)
+
+		# Converted thresholds (by variable) and memoized results
+		self._thresholds: Dict[str, Any] = {}
+		self._outcomes: Dict[Any, bool] = {}
+		self._releases: Dict[str, Any] = {}
+
+		# Variables whose values the threshold can be compared with (set when used)
+		self._variables: Optional[FrozenSet[str]] = None
+
+	def __repr__(self):
+		return f"CompiledRule({self.name}, {self.source_device_id}, {self.operator}, {self.threshold})"
+
+	def get_threshold(self, key: str) -> Any:
+		"""
+		Get the threshold converted to the type of the variable.
+		Args:
+			key (str): The variable of the message.
+		Returns:
+			The converted threshold.
+		Raises:
+			InvalidThresholdError: If the threshold can not be converted.
+		"""
+		try:
+			threshold = self._thresholds[key]
+		except KeyError:
+			try:
+				if self.aggregate in NUMBER_AGGREGATES:
+					threshold = to_temperature(self.threshold)
+				else:
+					threshold = get_correct_value(key, self.threshold)
+			except ValueError:
+				threshold = _INVALID
+			self._thresholds[key] = threshold
+
+		if threshold is _INVALID:
+			raise InvalidThresholdError("Invalid threshold format")
+		return threshold
+
+	def applies(self, key: str) -> bool:
+		"""
+		Check if the rule is of a variable: its threshold can be converted
+		to it (a message with several variables is only checked against
+		the rules of each one). A rule whose threshold can not be converted
+		to any known variable is of all of them, so its error is reported.
+		Args:
+			key (str): The variable of the message.
+		Returns:
+			bool: True if the rule has to be checked with the variable.
+		"""
+		variables = self._variables
+		if variables is None:
+			variables = set()
+			for variable in CONVERTERS:
+				try:
+					self.get_threshold(variable)
+				except InvalidThresholdError:
+					continue
+				variables.add(variable)
+			variables = self._variables = frozenset(variables)
+		return not variables or key in variables or key not in CONVERTERS
+
+	def check(self, key: str) -> None:
+		"""
+		Check that the rule can be evaluated for a variable.
+		Args:
+			key (str): The variable of the message.
+		Raises:
+			InvalidThresholdError: If the threshold is not valid.
+			InvalidOperatorError: If the operator is not valid.
+		"""
+		self.get_threshold(key)
+		if self.compare is None:
+			raise InvalidOperatorError("Invalid operator")
+
+	def evaluate(self, key: str, value: Any) -> bool:
+		"""
+		Check if the rule condition is met for a value.
+		Args:
+			key (str): The variable of the message.
+			value (Any): The converted value of the variable.
+		Returns:
+			bool: The result of the comparison.
+		Raises:
+			InvalidThresholdError: If the threshold is not valid.
+			InvalidOperatorError: If the operator is not valid.
+		"""
+		# Discrete variables: the result is always the same for a value
+		discrete = key in DISCRETE_VARIABLES
+		if discrete:
+			outcome = self._outcomes.get(value)
+			if outcome is not None:
+				return outcome
+
+		threshold = self.get_threshold(key)
+		if self.compare is None:
+			raise InvalidOperatorError("Invalid operator")
+		outcome = self.compare(value, threshold)
+
+		if discrete:
+			self._outcomes[value] = outcome
+		return outcome
+
+	def release(self, key: str, value: Any) -> bool:
+		"""
+		Check if an active hysteresis trigger is released by a value:
+		the value has gone back over the threshold, by the hysteresis
+		band (only for the variables with numeric values).
+		Args:
+			key (str): The variable of the message.
+			value (Any): The converted value of the variable.
+		Returns:
+			bool: True if the trigger is released.
+		Raises:
+			InvalidThresholdError: If the threshold is not valid.
+			InvalidOperatorError: If the operator is not valid.
+		"""
+		threshold = self._releases.get(key, _INVALID)
+		if threshold is _INVALID:
+			threshold = self.get_threshold(key)
+			try:
+				if self.operator in ('>', '>='):
+					threshold = threshold - self.hysteresis
+				elif self.operator in ('<', '<='):
+					threshold = threshold + self.hysteresis
+			except TypeError:
+				pass
+			self._releases[key] = threshold
+
+		if self.compare is None:
+			raise InvalidOperatorError("Invalid operator")
+		return not self.compare(value, threshold)
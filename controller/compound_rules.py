@@ -0,0 +1,440 @@
+import threading
+import time
+from typing import Any, Callable, Dict, FrozenSet, List, Mapping, Optional, Sequence, Tuple
+from .compiled_rule import COMMAND_TOPIC, RISING, FALLING
+from .values import OPERATORS, get_correct_value
+from .database_communication import (
+	create_connection,
+	get_all_compound_rules,
+	get_all_compound_conditions,
+	create_change_counters,
+	get_change_counter,
+	get_data_version
+)
+
+# Marker of a threshold that can not be converted, and of a value not received
+_INVALID = object()
+_MISSING = object()
+
+class CompoundCondition:
+	"""
+	Condition of a compound rule (row of `app_compoundcondition`), with
+	the threshold converted to the type of the variable of its device.
+	A condition whose threshold or operator is not valid is never met.
+	"""
+	__slots__ = (
+		'device_id',
+		'variable',
+		'operator',
+		'threshold',
+		'compare',
+	)
+
+	def __init__(self, row: Mapping[str, Any]):
+		"""
+		Constructor of the CompoundCondition class.
+		Args:
+			row (Mapping[str, Any]): The condition, as read from the database.
+		"""
+		self.device_id = row['device_id']
+		self.variable = row['variable']
+		self.operator = row['operator']
+		self.compare = OPERATORS.get(self.operator)
+		try:
+			self.threshold = get_correct_value(self.variable, row['threshold'])
+		except ValueError:
+			self.threshold = _INVALID
+
+	def __repr__(self):
+		return f"CompoundCondition({self.device_id}, {self.variable}, {self.operator}, {self.threshold})"
+
+	def evaluate(self, value: Any) -> bool:
+		"""
+		Check if the condition is met for a value of its device.
+		Args:
+			value (Any): The converted value of the variable.
+		Returns:
+			bool: The result of the comparison (False if it is not valid).
+		"""
+		if self.compare is None or self.threshold is _INVALID:
+			return False
+		try:
+			return self.compare(value, self.threshold)
+		except TypeError:
+			return False
+
+class CompiledCompoundRule:
+	"""
+	Compound rule (row of `app_compoundrule`, with its conditions)
+	prepared to be evaluated incrementally: the result of each condition
+	is kept, with the number of the ones that are not met, so a value
+	only evaluates the conditions of its device.
+
+	It has the same attributes as a `CompiledRule` to be applied (name,
+	target, priority and command), so it is sent in the same way.
+	"""
+	__slots__ = (
+		'id',
+		'name',
+		'trigger',
+		'priority',
+		'target_device_id',
+		'command_topic',
+		'command_payload',
+		'version',
+		'conditions',
+		'_met',
+		'_unmet',
+		'_active',
+	)
+
+	def __init__(self, row: Mapping[str, Any], conditions: Sequence[Mapping[str, Any]]):
+		"""
+		Constructor of the CompiledCompoundRule class.
+		Args:
+			row (Mapping[str, Any]): The rule, as read from the database.
+			conditions (Sequence[Mapping[str, Any]]): Its conditions, as
+				read from the database.
+		"""
+		self.id = row['id']
+		self.name = row['name']
+		self.trigger = row['trigger']
+		self.priority = row['priority']
+		self.target_device_id = row['target_device_id']
+		self.conditions = tuple(CompoundCondition(condition) for condition in conditions)
+
+		# Also changes if the rule or its conditions are changed without updating it
+		self.version = (
+			row['updated_at'],
+			(self.name, self.trigger, self.priority, self.target_device_id, row['command_payload']),
+			tuple(
+				(condition['device_id'], condition['variable'], condition['operator'], condition['threshold'])
+				for condition in conditions
+			)
+		)
+
+		# Command, ready to be sent
+		self.command_topic = COMMAND_TOPIC.format(self.target_device_id)
+		self.command_payload = row['command_payload'].encode()
+
+		# Result of each condition (not met until a value is received)
+		self._met = [False] * len(self.conditions)
+		self._unmet = len(self.conditions)
+		self._active = False
+
+	def __repr__(self):
+		return f"CompiledCompoundRule({self.name}, {self.conditions})"
+
+	@property
+	def met(self) -> bool:
+		"""
+		Returns if all the conditions are met.
+		"""
+		return self._unmet == 0
+
+	def set(self, position: int, met: bool) -> None:
+		"""
+		Save the result of a condition.
+		Args:
+			position (int): Position of the condition.
+			met (bool): If it is met.
+		"""
+		if self._met[position] != met:
+			self._met[position] = met
+			self._unmet += -1 if met else 1
+
+	def transition(self) -> bool:
+		"""
+		Save the state of the rule after a value, and check if it has to
+		be applied:
+			· Level: each time that the conditions are met.
+			· Rising: when the conditions start to be met.
+			· Falling: when the conditions stop being met.
+		Returns:
+			bool: True if the rule has to be applied.
+		"""
+		previous = self._active
+		self._active = active = self._unmet == 0
+		if self.trigger == RISING:
+			return active and not previous
+		if self.trigger == FALLING:
+			return previous and not active
+		return active
+
+	def reset(self) -> None:
+		"""
+		Take the current result of the conditions as the state of the
+		rule, without applying it (when it is loaded).
+		"""
+		self._active = self._unmet == 0
+
+class CompoundRuleIndex:
+	"""
+	In-memory index of the compound rules, evaluated incrementally:
+		· A table with the last value of each variable that the rules
+		  check, by device.
+		· A dependency index: the rules (and the positions of their
+		  conditions) that check each variable of each device, so a value
+		  only evaluates the rules that depend on it, and a device that
+		  no rule checks costs a dict lookup.
+	Nothing is read from the database on each message.
+
+	The rules are loaded once, and read again when they change: like
+	in the `RuleIndex`, the SQLite data version is checked at most once
+	every `check_interval` seconds, and only if it has changed, the
+	change counter of the tables is read (kept by triggers, so the rules
+	and conditions changed with raw SQL are also read again). The rules whose version has not
+	changed keep their state, and the new ones are evaluated with the
+	last values (they are not applied until the next value).
+
+	If `device_filter` is set, only the rules whose target device is
+	accepted by it are evaluated (the partition of the controller
+	process), so each rule is evaluated by one process.
+
+	The values of different devices are processed by different threads,
+	so the rules are evaluated holding a lock. The database is read
+	holding other lock, so the evaluation does not wait for the reads
+	(only for the swap of the new rules). With `check_inline` False, the
+	changes are not checked by `update`, but only when `check_changes`
+	is called (by a background task).
+	"""
+	def __init__(
+		self,
+		database: str,
+		check_interval: float = 1.0,
+		device_filter: Optional[Callable[[str], bool]] = None,
+		latency: Optional[Any] = None,
+		check_inline: bool = True
+	):
+		"""
+		Constructor of the CompoundRuleIndex class.
+		Args:
+			database (str): Path to the database file.
+			check_interval (float): Min seconds between two checks
+				of the database changes.
+			device_filter (Callable[[str], bool]): Function that returns
+				if the rules of a target device have to be evaluated.
+			latency (Histogram): Metric where the time of each read of
+				the database is observed.
+			check_inline (bool): If `update` checks the changes (False:
+				only `check_changes` does).
+		"""
+		# Save the params
+		self.database = database
+		self.check_interval = check_interval
+		self.device_filter = device_filter
+		self.latency = latency
+		self.check_inline = check_inline
+
+		# Lock of the evaluation, and own connection, shared by all the
+		# threads through its lock (also held while reloading)
+		self._lock = threading.Lock()
+		self._connection_lock = threading.Lock()
+		self._connection = create_connection(
+			database,
+			check_same_thread=False
+		)
+		create_change_counters(self._connection)
+
+		# Compiled rules by id, rules by device and variable, and last values
+		self._compiled: Dict[int, CompiledCompoundRule] = {}
+		self._dependencies: Dict[str, Dict[str, List[Tuple[CompiledCompoundRule, Tuple[int, ...]]]]] = {}
+		self._values: Dict[Tuple[str, str], Any] = {}
+
+		# State used to detect the changes
+		self._data_version = None
+		self._fingerprint = None
+		self._next_check = 0.0
+
+		# Load the rules
+		with self._connection_lock:
+			self._refresh()
+			self._next_check = time.monotonic() + check_interval
+
+	def __len__(self):
+		return len(self._compiled)
+
+	@property
+	def devices(self) -> FrozenSet[str]:
+		"""
+		Returns the devices checked by the rules.
+		"""
+		return frozenset(self._dependencies)
+
+	def depends_on(self, device_id: str) -> bool:
+		"""
+		Check if a rule checks the values of a device.
+		Args:
+			device_id (str): The device id.
+		Returns:
+			bool: True if its values are needed.
+		"""
+		return device_id in self._dependencies
+
+	def update(self, device_id: str, key: str, value: Any) -> List[CompiledCompoundRule]:
+		"""
+		Save a value of a device, and evaluate the rules that depend on it.
+		Args:
+			device_id (str): The device that sent the value.
+			key (str): The variable of the message.
+			value (Any): The converted value of the variable.
+		Returns:
+			List[CompiledCompoundRule]: The rules to apply, in order.
+		"""
+		# Reload the rules if they have changed
+		if self.check_inline and time.monotonic() >= self._next_check:
+			self._check_changes()
+
+		# Device that no rule checks
+		if device_id not in self._dependencies:
+			return []
+
+		with self._lock:
+			dependents = self._dependencies.get(device_id, {}).get(key)
+			if dependents is None:
+				return []
+			self._values[(device_id, key)] = value
+
+			selected = []
+			for rule, positions in dependents:
+				for position in positions:
+					rule.set(position, rule.conditions[position].evaluate(value))
+				if rule.transition():
+					selected.append(rule)
+			return selected
+
+	def check_changes(self) -> None:
+		"""
+		Check now if the rules have changed, and reload them if needed.
+		"""
+		self._check_changes(force=True)
+
+	def invalidate(self) -> None:
+		"""
+		Force the rules to be read again from the database.
+		"""
+		with self._connection_lock:
+			self._fingerprint = None
+			self._refresh()
+
+	def set_device_filter(self, device_filter: Optional[Callable[[str], bool]]) -> None:
+		"""
+		Change the target devices whose rules are evaluated, and reload them.
+		Args:
+			device_filter (Callable[[str], bool]): Function that returns
+				if the rules of a target device have to be evaluated.
+		"""
+		with self._connection_lock:
+			self.device_filter = device_filter
+			self._fingerprint = None
+			self._refresh()
+
+	def close(self) -> None:
+		"""
+		Close the connection with the database.
+		"""
+		with self._connection_lock:
+			self._connection.close()
+
+	def _check_changes(self, force: bool = False) -> None:
+		"""
+		Check if the rules have changed, and reload them if needed.
+		Args:
+			force (bool): If the check interval is ignored.
+		"""
+		with self._connection_lock:
+			# Other thread could have made the check
+			now = time.monotonic()
+			if now < self._next_check and not force:
+				return
+			self._next_check = now + self.check_interval
+
+			start = time.perf_counter()
+			try:
+				# Nothing has been committed by other connections
+				data_version = get_data_version(self._connection)
+				if data_version == self._data_version:
+					return
+				self._data_version = data_version
+
+				# Something has changed, but maybe not the rules
+				self._refresh()
+			finally:
+				if self.latency is not None:
+					self.latency.observe(time.perf_counter() - start)
+
+	def _refresh(self) -> None:
+		"""
+		Reload the rules if the tables fingerprint has changed, and build
+		the dependency index again.
+		The caller must hold the lock of the connection.
+		"""
+		if self._data_version is None:
+			self._data_version = get_data_version(self._connection)
+
+		fingerprint = get_change_counter(self._connection, 'compound_rules')
+		if fingerprint == self._fingerprint:
+			return
+		self._fingerprint = fingerprint
+
+		conditions = {}
+		for row in get_all_compound_conditions(self._connection):
+			conditions.setdefault(row['rule_id'], []).append(row)
+		rows = get_all_compound_rules(self._connection)
+		with self._lock:
+			self._build(rows, conditions)
+
+	def _build(self, rows: List[Any], conditions: Dict[int, List[Any]]) -> None:
+		"""
+		Compile the rules read from the database, and build the
+		dependency index again.
+		The caller must hold the lock.
+		Args:
+			rows (List[Any]): The compound rules.
+			conditions (Dict[int, List[Any]]): Their conditions, by rule id.
+		"""
+
+		# Compile the new and updated rules (a rule without conditions is never met)
+		compiled = {}
+		for row in rows:
+			if self.device_filter is not None \
+					and not self.device_filter(row['target_device_id']):
+				continue
+			rule_conditions = conditions.get(row['id'])
+			if not rule_conditions:
+				continue
+			rule = CompiledCompoundRule(row, rule_conditions)
+			previous = self._compiled.get(rule.id)
+			if previous is not None and previous.version == rule.version:
+				rule = previous
+			else:
+				for position, condition in enumerate(rule.conditions):
+					value = self._values.get((condition.device_id, condition.variable), _MISSING)
+					if value is not _MISSING:
+						rule.set(position, condition.evaluate(value))
+				rule.reset()
+			compiled[rule.id] = rule
+
+		# Rules that check each variable of each device, with the positions of the conditions
+		positions: Dict[str, Dict[str, Dict[CompiledCompoundRule, List[int]]]] = {}
+		for rule in compiled.values():
+			for position, condition in enumerate(rule.conditions):
+				positions.setdefault(condition.device_id, {}) \
+					.setdefault(condition.variable, {}) \
+					.setdefault(rule, []).append(position)
+		dependencies = {
+			device_id: {
+				variable: [(rule, tuple(rule_positions)) for rule, rule_positions in rules.items()]
+				for variable, rules in variables.items()
+			}
+			for device_id, variables in positions.items()
+		}
+
+		# Forget the values that no rule checks
+		self._values = {
+			(device_id, variable): value
+			for (device_id, variable), value in self._values.items()
+			if variable in dependencies.get(device_id, ())
+		}
+		self._compiled = compiled
+		self._dependencies = dependencies
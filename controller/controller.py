@@ -1,10 +1,20 @@
 import sys
+import signal
 import argparse
 from typing import Union, Tuple, List
 from .device import Device
 from .rule import Rule
 from .IOTController import IOTController
+from .AsyncIOTController import AsyncIOTController
+from .launcher import Launcher
 from .database_communication import check_database
+from .ingress import SHED_POLICIES, BLOCK
+
+# Available controller engines
+ENGINES = {
+	"threads": IOTController,
+	"asyncio": AsyncIOTController,
+}
 
 def parse_params() -> argparse.Namespace:
 	"""
@@ -30,12 +40,181 @@ def parse_params() -> argparse.Namespace:
 		"-db", "--database", default="iot-manager/db.sqlite3",
 		help="IOT Database (default: %(default)s)"
 	)
+	params.add_argument(
+		"--engine", choices=ENGINES.keys(), default="threads",
+		help="Engine of the controller: paho loop thread and worker threads, or asyncio event loop (default: %(default)s)"
+	)
+	params.add_argument(
+		"--rules-cache-size", type=int, default=None,
+		help="Max devices whose rules are kept in memory; if not set, all the rules are preloaded (default: %(default)s)"
+	)
+	params.add_argument(
+		"--rules-refresh", type=float, default=1.0,
+		help="Min seconds between checks for rule changes (default: %(default)s)"
+	)
+	params.add_argument(
+		"--busy-timeout", type=int, default=5000,
+		help="Milliseconds to wait when the database is locked (default: %(default)s)"
+	)
+	params.add_argument(
+		"--mmap-size", type=int, default=None,
+		help="Max bytes of the database mapped in memory (default: %(default)s)"
+	)
+	params.add_argument(
+		"--log-queue-size", type=int, default=10000,
+		help="Max logs waiting to be written; the new ones are dropped when it is full (default: %(default)s)"
+	)
+	params.add_argument(
+		"--log-batch-size", type=int, default=500,
+		help="Max logs written in a single transaction (default: %(default)s)"
+	)
+	params.add_argument(
+		"--log-flush-interval", type=float, default=0.5,
+		help="Max seconds that a log waits to be written (default: %(default)s)"
+	)
+	params.add_argument(
+		"--workers", type=int, default=4,
+		help="Threads that process the messages, sharded by device; 0 processes them in the MQTT thread (default: %(default)s)"
+	)
+	params.add_argument(
+		"--queue-size", type=int, default=1000,
+		help="Max messages waiting in the queue of each worker (default: %(default)s)"
+	)
+	params.add_argument(
+		"--command-window", type=float, default=None,
+		help="Seconds that the commands to each device are collected, to only send the one of the highest priority (or the last one); if not set, they are sent at once (default: %(default)s)"
+	)
+	params.add_argument(
+		"--window-capacity", type=int, default=256,
+		help="Max values kept in the window of each device for the rules with an aggregate; the oldest ones are dropped when it is full (default: %(default)s)"
+	)
+	params.add_argument(
+		"--timer-tick", type=float, default=0.1,
+		help="Seconds of each tick of the timers of the rules with a duration, their resolution (default: %(default)s)"
+	)
+	params.add_argument(
+		"--breaker-max-fires", type=int, default=None,
+		help="Max times that a rule can be applied in the breaker period; a rule applied more times is suppressed during the breaker cooldown; if not set, the rules are never suppressed (default: %(default)s)"
+	)
+	params.add_argument(
+		"--breaker-period", type=float, default=10.0,
+		help="Seconds in which the applications of each rule are counted (default: %(default)s)"
+	)
+	params.add_argument(
+		"--breaker-cooldown", type=float, default=60.0,
+		help="Seconds that a rule applied too often is suppressed (default: %(default)s)"
+	)
+	params.add_argument(
+		"--conflate", action="store_true",
+		help="Keep only the newest queued message of each device: after a burst, the older ones are not processed"
+	)
+	params.add_argument(
+		"--shed-policy", choices=SHED_POLICIES, default=BLOCK,
+		help="What is done with a message when the queue of its worker is full: wait for room, or drop the new or the oldest message (default: %(default)s)"
+	)
+	params.add_argument(
+		"--metrics-port", type=int, default=None,
+		help="Port of the local HTTP endpoint of the metrics (Prometheus format); if not set, it is not started (default: %(default)s)"
+	)
+	params.add_argument(
+		"--metrics-file", default="controller-metrics.prom",
+		help="File where the metrics are written when a SIGUSR1 is received (default: %(default)s)"
+	)
+	params.add_argument(
+		"--profile", metavar="FILE", default=None,
+		help="Profile mode: the time of each stage of the messages is written to this rotating file, summarised with `python -m controller.profiler FILE` (default: %(default)s)"
+	)
+	params.add_argument(
+		"--profile-sample", type=float, default=0.01,
+		help="Fraction of the messages also profiled with cProfile, in profile mode (default: %(default)s)"
+	)
+	params.add_argument(
+		"--profile-max-bytes", type=int, default=10 * 1024 * 1024,
+		help="Size of the profile file when it is rotated (default: %(default)s)"
+	)
+	params.add_argument(
+		"--profile-backups", type=int, default=3,
+		help="Rotated profile files that are kept (default: %(default)s)"
+	)
+	params.add_argument(
+		"--drain-timeout", type=float, default=5.0,
+		help="Max seconds to process the queued messages, and send the pending commands and logs, when stopping (default: %(default)s)"
+	)
+	params.add_argument(
+		"--processes", type=int, default=1,
+		help="Controller processes, each one owning a partition of the devices (default: %(default)s)"
+	)
 	params.add_argument(
 		"--debug", type=bool, default=False,
 		help="Debug mode (default: %(default)s)"
 	)
 	parsed = params.parse_args()
 
+	# Added constraints
+	if parsed.rules_cache_size is not None and parsed.rules_cache_size <= 0:
+		params.error("The rules cache size must be greater than 0")
+
+	if parsed.rules_refresh < 0:
+		params.error("The rules refresh must be greater or equal than 0")
+
+	if parsed.busy_timeout < 0:
+		params.error("The busy timeout must be greater or equal than 0")
+
+	if parsed.mmap_size is not None and parsed.mmap_size < 0:
+		params.error("The mmap size must be greater or equal than 0")
+
+	if parsed.log_queue_size <= 0 or parsed.log_batch_size <= 0:
+		params.error("The log queue and batch sizes must be greater than 0")
+
+	if parsed.log_flush_interval < 0:
+		params.error("The log flush interval must be greater or equal than 0")
+
+	if parsed.workers < 0:
+		params.error("The number of workers must be greater or equal than 0")
+
+	if parsed.queue_size <= 0:
+		params.error("The queue size must be greater than 0")
+
+	if parsed.command_window is not None and parsed.command_window < 0:
+		params.error("The command window must be greater or equal than 0")
+
+	if parsed.window_capacity <= 0:
+		params.error("The window capacity must be greater than 0")
+
+	if parsed.timer_tick <= 0:
+		params.error("The timer tick must be greater than 0")
+
+	if parsed.breaker_max_fires is not None and parsed.breaker_max_fires <= 0:
+		params.error("The breaker max fires must be greater than 0")
+
+	if parsed.breaker_period <= 0 or parsed.breaker_cooldown <= 0:
+		params.error("The breaker period and cooldown must be greater than 0")
+
+	if (parsed.conflate or parsed.shed_policy != BLOCK) \
+			and (parsed.engine == "asyncio" or parsed.workers == 0):
+		params.error("The conflation and the shedding policy need the worker threads (threads engine, with workers)")
+
+	if parsed.drain_timeout < 0:
+		params.error("The drain timeout must be greater or equal than 0")
+
+	if parsed.processes <= 0:
+		params.error("The number of processes must be greater than 0")
+
+	if parsed.metrics_port is not None and not 0 <= parsed.metrics_port <= 65535:
+		params.error("The metrics port must be between 0 and 65535")
+
+	if not 0 <= parsed.profile_sample <= 1:
+		params.error("The profile sample must be between 0 and 1")
+
+	if parsed.profile_max_bytes <= 0 or parsed.profile_backups < 0:
+		params.error("The profile max bytes must be greater than 0, and the backups greater or equal than 0")
+
+	if parsed.processes > 1 and parsed.metrics_port is not None:
+		params.error("The metrics endpoint can only be used with one process")
+
+	if parsed.processes > 1 and parsed.engine != "threads":
+		params.error("Several processes can only be used with the threads engine")
+
 	# Return the params
 	return parsed
 
@@ -51,21 +230,82 @@ def main():
 		print(f"[ Controller ] Database {args.database} not found.")
 		sys.exit(1)
 
-	# Create the controller, and run it
-	controller = IOTController(
+	# Params of the controller
+	options = dict(
 		host=args.host,
 		port=args.port,
 		database=args.database,
-		debug=args.debug
+		debug=args.debug,
+		rules_cache_size=args.rules_cache_size,
+		rules_refresh=args.rules_refresh,
+		busy_timeout=args.busy_timeout,
+		mmap_size=args.mmap_size,
+		log_queue_size=args.log_queue_size,
+		log_batch_size=args.log_batch_size,
+		log_flush_interval=args.log_flush_interval,
+		workers=args.workers,
+		queue_size=args.queue_size,
+		command_window=args.command_window,
+		metrics_port=args.metrics_port,
+		profile_file=args.profile,
+		profile_sample=args.profile_sample,
+		profile_max_bytes=args.profile_max_bytes,
+		profile_backups=args.profile_backups,
+		drain_timeout=args.drain_timeout,
+		window_capacity=args.window_capacity,
+		timer_tick=args.timer_tick,
+		breaker_max_fires=args.breaker_max_fires,
+		breaker_period=args.breaker_period,
+		breaker_cooldown=args.breaker_cooldown,
+		conflate=args.conflate,
+		shed_policy=args.shed_policy
 	)
+
+	# Several processes, each one with a partition of the devices
+	if args.processes > 1:
+		launcher = Launcher(
+			args.processes,
+			options,
+			debug=args.debug,
+			metrics_file=args.metrics_file
+		)
+		launcher.run()
+		print("[ Controller ] Stopped")
+		return
+
+	# Create the controller, and run it
+	controller = ENGINES[args.engine](**options)
+
+	# The asyncio engine runs in this thread, until a SIGINT or a SIGTERM is received
+	if args.engine == "asyncio":
+		signal.signal(
+			signal.SIGUSR1,
+			lambda signum, frame: controller.metrics.dump(args.metrics_file)
+		)
+		controller.start()
+		print("[ Controller ] Stopped")
+		return
+
+	# The signals are blocked before starting the threads (so they are
+	# inherited blocked), and this thread waits for them
+	signals = {signal.SIGINT, signal.SIGTERM, signal.SIGHUP, signal.SIGUSR1}
+	signal.pthread_sigmask(signal.SIG_BLOCK, signals)
 	controller.start()
 
-	# Loop until a SIGINT is received
-	try:
-		while True:
-			pass
-	except KeyboardInterrupt:
-		print("[ Controller ] Stopping...")
+	while True:
+		signum = signal.sigwait(signals)
+		if signum == signal.SIGHUP:
+			controller.reload()
+		elif signum == signal.SIGUSR1:
+			controller.metrics.dump(args.metrics_file)
+		else:
+			break
+
+	# Drain the messages, commands and logs before ending
+	print("[ Controller ] Stopping...")
+	if not controller.stop():
+		print("[ Controller ] Not everything could be drained in time")
+	print("[ Controller ] Stopped")
 
 
 if __name__ == '__main__':
@@ -1,4 +1,7 @@
 import sqlite3
+import threading
+import zlib
+from typing import Callable, List, Optional, Tuple, Any
 from datetime import datetime
 
 def check_database(database: str) -> bool:
@@ -15,16 +18,28 @@ def check_database(database: str) -> bool:
 	except FileNotFoundError:
 		return False
 
-def create_connection(database: str) -> sqlite3.Connection:
+def create_connection(
+	database: str,
+	check_same_thread: bool = True,
+	busy_timeout: Optional[int] = None,
+	mmap_size: Optional[int] = None
+) -> sqlite3.Connection:
 	"""
 	Function to create a connection to the database
 	Args:
 		database (str): Path to the database file.
+		check_same_thread (bool): If False, the connection can be used
+			from other threads (the caller must serialize the access).
+		busy_timeout (int): Milliseconds to wait for a locked database.
+		mmap_size (int): Max bytes of the database to map in memory.
 	Returns:
 		sqlite3.Connection: Connection object to the database.
 	"""
 	# Connect with the database
-	connection = sqlite3.connect(database)
+	connection = sqlite3.connect(
+		database,
+		check_same_thread=check_same_thread
+	)
 
 	# Change the format of the queries
 	connection.row_factory = sqlite3.Row
@@ -33,9 +48,137 @@ def create_connection(database: str) -> sqlite3.Connection:
 	connection.execute("PRAGMA journal_mode=WAL;")
 	connection.execute("PRAGMA synchronous=NORMAL;")
 
+	# Optional tuning
+	if busy_timeout is not None:
+		connection.execute(f"PRAGMA busy_timeout={int(busy_timeout)};")
+	if mmap_size is not None:
+		connection.execute(f"PRAGMA mmap_size={int(mmap_size)};")
+
 	# Return the connection
 	return connection
 
+class ConnectionManager:
+	"""
+	Long-lived connections to the database, one per thread.
+
+	Each thread opens its connection (and sets the PRAGMAs) the first
+	time it needs it, and reuses it after that. If an operation fails
+	with a database error, the connection is opened again and the
+	operation is retried once.
+	"""
+	def __init__(
+		self,
+		database: str,
+		busy_timeout: Optional[int] = 5000,
+		mmap_size: Optional[int] = None
+	):
+		"""
+		Constructor of the ConnectionManager class.
+		Args:
+			database (str): Path to the database file.
+			busy_timeout (int): Milliseconds to wait for a locked database.
+			mmap_size (int): Max bytes of the database to map in memory.
+		"""
+		self.database = database
+		self.busy_timeout = busy_timeout
+		self.mmap_size = mmap_size
+
+		# Connection of each thread, and all of them to close them
+		self._local = threading.local()
+		self._lock = threading.Lock()
+		self._connections: List[sqlite3.Connection] = []
+		self._closed = False
+
+	def connection(self) -> sqlite3.Connection:
+		"""
+		Get the connection of the current thread, opening it if needed.
+		Returns:
+			sqlite3.Connection: Connection object to the database.
+		"""
+		connection = getattr(self._local, 'connection', None)
+		if connection is not None:
+			return connection
+
+		with self._lock:
+			if self._closed:
+				raise sqlite3.ProgrammingError("The connection manager is closed")
+
+			# It is closed from the thread that stops the controller
+			connection = create_connection(
+				self.database,
+				check_same_thread=False,
+				busy_timeout=self.busy_timeout,
+				mmap_size=self.mmap_size
+			)
+			self._connections.append(connection)
+		self._local.connection = connection
+		return connection
+
+	def reset(self) -> None:
+		"""
+		Close the connection of the current thread, so the next
+		operation opens a new one.
+		"""
+		connection = getattr(self._local, 'connection', None)
+		if connection is None:
+			return
+		self._local.connection = None
+
+		with self._lock:
+			if connection in self._connections:
+				self._connections.remove(connection)
+		try:
+			connection.close()
+		except sqlite3.Error:
+			pass
+
+	def run(self, function: Callable[..., Any], *args, **kwargs) -> Any:
+		"""
+		Execute a database function with the connection of the thread,
+		as `function(connection, *args, **kwargs)`.
+		If it fails, the connection is opened again and it is retried once.
+		Args:
+			function (Callable): The function to execute.
+		Returns:
+			The result of the function.
+		"""
+		try:
+			return function(self.connection(), *args, **kwargs)
+		except sqlite3.IntegrityError:
+			raise
+		except sqlite3.Error:
+			if self._closed:
+				raise
+			self.reset()
+			return function(self.connection(), *args, **kwargs)
+
+	def close(self) -> None:
+		"""
+		Close all the connections. After this, no new connection can be opened.
+		"""
+		with self._lock:
+			self._closed = True
+			connections = self._connections
+			self._connections = []
+
+		for connection in connections:
+			try:
+				connection.close()
+			except sqlite3.Error:
+				pass
+
+def get_devices(database: sqlite3.Connection) -> List[str]:
+	"""
+	Get the ids of all the devices.
+	Args:
+		database (sqlite3.Connection): The connection to the database.
+	Returns:
+		List[str]: The ids of the devices.
+	"""
+	cursor = database.cursor()
+	cursor.execute("SELECT id FROM app_device ORDER BY id")
+	return [row[0] for row in cursor.fetchall()]
+
 def get_rules(source_device: str, database: sqlite3.Connection) -> list:
 	"""
 	Get the rules from the database.
@@ -53,6 +196,157 @@ def get_rules(source_device: str, database: sqlite3.Connection) -> list:
 	rules = cursor.fetchall()
 	return rules
 
+def get_rule(rule_id: int, database: sqlite3.Connection):
+	"""
+	Get a rule from the database.
+	Args:
+		rule_id (int): The rule id.
+		database (sqlite3.Connection): The connection to the database.
+	Returns:
+		sqlite3.Row: The rule, or None if it does not exist.
+	"""
+	cursor = database.cursor()
+	cursor.execute(
+		"SELECT * FROM app_rule WHERE id = ?",
+		(rule_id,)
+	)
+	return cursor.fetchone()
+
+def get_all_rules(database: sqlite3.Connection) -> list:
+	"""
+	Get all the rules from the database.
+	Args:
+		database (sqlite3.Connection): The connection to the database.
+	Returns:
+		list: The list of rules.
+	"""
+	cursor = database.cursor()
+	cursor.execute("SELECT * FROM app_rule ORDER BY id")
+	rules = cursor.fetchall()
+	return rules
+
+# Columns of the rules that the controller uses
+RULE_COLUMNS = (
+	"id", "name", "source_device_id", "aggregate", "window", "operator",
+	"threshold", "trigger", "hysteresis", "duration", "priority",
+	"target_device_id", "command_payload"
+)
+
+def rule_checksum(*values: Any) -> int:
+	"""
+	Function to get the checksum of the columns of a rule (registered
+	in the connection, to be summed in the queries).
+	Args:
+		values (Any): The values of the columns.
+	Returns:
+		int: The checksum.
+	"""
+	return zlib.crc32(repr(values).encode())
+
+# Checksum of each rule, in the queries
+RULE_CHECKSUM = "rule_checksum({})".format(
+	", ".join(f'"{column}"' for column in RULE_COLUMNS)
+)
+
+def get_rule_versions(database: sqlite3.Connection) -> list:
+	"""
+	Get the id, the source device, the aggregate, the last update and
+	the checksum of all the rules.
+	Args:
+		database (sqlite3.Connection): The connection to the database.
+	Returns:
+		list: The list of rows.
+	"""
+	database.create_function("rule_checksum", -1, rule_checksum, deterministic=True)
+	cursor = database.cursor()
+	cursor.execute(
+		"SELECT id, source_device_id, aggregate, \"window\", updated_at, "
+		f"{RULE_CHECKSUM} AS checksum FROM app_rule"
+	)
+	return cursor.fetchall()
+
+def get_data_version(database: sqlite3.Connection) -> int:
+	"""
+	Get the SQLite data version of the connection. It changes each
+	time another connection commits a change in the database.
+	Args:
+		database (sqlite3.Connection): The connection to the database.
+	Returns:
+		int: The data version.
+	"""
+	return database.execute("PRAGMA data_version").fetchone()[0]
+
+# Counters of the changes of the tables of the rules, by name, kept by
+# triggers: they count every insert, update and delete (also the ones
+# of raw SQL, or of `QuerySet.update`), and unlike the data version,
+# they do not change with the writes of other tables (like the logs)
+CHANGE_COUNTERS = {
+	'rules': ('app_rule',),
+	'compound_rules': ('app_compoundrule', 'app_compoundcondition'),
+}
+
+def create_change_counters(database: sqlite3.Connection) -> None:
+	"""
+	Function to create the table of the change counters, and the
+	triggers that update them, if they do not exist.
+	Args:
+		database (sqlite3.Connection): The connection to the database.
+	"""
+	statements = [
+		"CREATE TABLE IF NOT EXISTS controller_changes ("
+		"name TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0)"
+	]
+	for name, tables in CHANGE_COUNTERS.items():
+		statements.append(
+			f"INSERT OR IGNORE INTO controller_changes (name, version) VALUES ('{name}', 0)"
+		)
+		for table in tables:
+			for event in ("INSERT", "UPDATE", "DELETE"):
+				statements.append(
+					f"CREATE TRIGGER IF NOT EXISTS controller_{table}_{event.lower()} "
+					f"AFTER {event} ON {table} BEGIN "
+					f"UPDATE controller_changes SET version = version + 1 WHERE name = '{name}'; "
+					"END"
+				)
+	database.executescript(";\n".join(statements) + ";")
+
+def get_change_counter(database: sqlite3.Connection, name: str) -> int:
+	"""
+	Get the number of changes of the tables of a change counter.
+	Args:
+		database (sqlite3.Connection): The connection to the database.
+		name (str): The name of the counter (see CHANGE_COUNTERS).
+	Returns:
+		int: The number of changes.
+	"""
+	cursor = database.cursor()
+	cursor.execute("SELECT version FROM controller_changes WHERE name = ?", (name,))
+	return cursor.fetchone()[0]
+
+def get_all_compound_rules(database: sqlite3.Connection) -> list:
+	"""
+	Get all the compound rules from the database.
+	Args:
+		database (sqlite3.Connection): The connection to the database.
+	Returns:
+		list: The list of compound rules.
+	"""
+	cursor = database.cursor()
+	cursor.execute("SELECT * FROM app_compoundrule ORDER BY id")
+	return cursor.fetchall()
+
+def get_all_compound_conditions(database: sqlite3.Connection) -> list:
+	"""
+	Get the conditions of all the compound rules from the database.
+	Args:
+		database (sqlite3.Connection): The connection to the database.
+	Returns:
+		list: The list of conditions, by rule.
+	"""
+	cursor = database.cursor()
+	cursor.execute("SELECT * FROM app_compoundcondition ORDER BY rule_id, id")
+	return cursor.fetchall()
+
 def add_log(database: sqlite3.Connection, message: str, device_id: str = None) -> None:
 	"""
 	Add a log to the database.
@@ -67,3 +361,26 @@ def add_log(database: sqlite3.Connection, message: str, device_id: str = None) -
 		(message, device_id, datetime.now(),)
 	)
 	database.commit()
+
+def add_logs(
+	database: sqlite3.Connection,
+	logs: List[Tuple[str, Optional[str], datetime]]
+) -> None:
+	"""
+	Add several logs to the database, in a single transaction.
+	Args:
+		database (sqlite3.Connection): The connection to the database.
+		logs (List[Tuple[str, str, datetime]]): The logs to add, as
+			(message, device id, timestamp).
+	"""
+	# The device can not be NULL, so a log without device would fail the whole batch
+	rows = [
+		(message, device_id if device_id is not None else "", timestamp)
+		for message, device_id, timestamp in logs
+	]
+
+	with database:
+		database.executemany(
+			"INSERT INTO app_log (message, device, timestamp) VALUES (?, ?, ?)",
+			rows
+		)
@@ -0,0 +1,256 @@
+import json
+import re
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from .values import CONVERTERS
+
+# Accelerated JSON parser, if it is installed
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+# Messages with the format of the devices (json.dumps of a single key)
+_PREFIX = b'{"'
+_SEPARATOR = b'": '
+_SUFFIX = b'}'
+
+# JSON number, and the bytes allowed in a plain string (printable ASCII, without escapes)
+_NUMBER = re.compile(rb'-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?')
+_PLAIN = bytes(byte for byte in range(0x20, 0x7f) if byte not in b'"\\')
+
+# Key of the list of readings of a batched message, and of the time of each reading
+READINGS_KEY = "readings"
+TIMESTAMP_KEY = "ts"
+
+class PayloadError(ValueError):
+	"""
+	The payload of a message can not be decoded. The message of the
+	error is the one that is logged.
+	"""
+
+def loads(payload: bytes) -> Any:
+	"""
+	Function to parse a JSON payload, with the accelerated parser if
+	it is installed. When it fails, the standard parser is used, so the
+	result is always the same (it accepts NaN and big integers).
+	Args:
+		payload (bytes): The payload of the message.
+	Returns:
+		Any: The parsed payload.
+	Raises:
+		json.JSONDecodeError: If it is not valid JSON.
+		UnicodeDecodeError: If it is not valid UTF-8.
+	"""
+	if orjson is not None:
+		try:
+			return orjson.loads(payload)
+		except orjson.JSONDecodeError:
+			pass
+	return json.loads(payload.decode())
+
+class PayloadDecoder:
+	"""
+	Decoder of the state messages: gets the variable of the message
+	and its value, converted with the function registered for the
+	variable name.
+
+	If the accelerated JSON parser (orjson) is installed, it parses all
+	the messages. If not, the messages with the format of the devices
+	are parsed straight from the bytes, and only the others are parsed
+	with the standard parser. All the ways give the same result.
+
+	A message can also have several readings (`parse_batch`): several
+	variables, or a list of timestamped readings.
+	"""
+	def __init__(
+		self,
+		converters: Optional[Dict[str, Callable[[Any], Any]]] = None,
+		max_readings: int = 1000
+	):
+		"""
+		Constructor of the PayloadDecoder class.
+		Args:
+			converters (Dict[str, Callable]): Function that converts the
+				values of each variable. By default, the ones of
+				`values.CONVERTERS`, also used for the rule thresholds.
+			max_readings (int): Max readings of a batched message.
+		"""
+		self.max_readings = max_readings
+		self._converters: Dict[str, Callable[[Any], Any]] = (
+			CONVERTERS if converters is None else dict(converters)
+		)
+
+		# Known variable names, as they are in the payloads
+		self._keys: Dict[bytes, str] = {
+			key.encode(): key for key in self._converters
+		}
+
+	def register(self, key: str, convert: Callable[[Any], Any]) -> None:
+		"""
+		Register the conversion of the values of a variable (with the
+		default converters, it is also used for the rule thresholds).
+		Args:
+			key (str): The variable name.
+			convert (Callable[[Any], Any]): Function that converts the
+				value of the message, raising ValueError if it is not valid.
+		"""
+		self._converters[key] = convert
+		self._keys[key.encode()] = key
+
+	def decode(self, payload: bytes) -> Tuple[str, Any]:
+		"""
+		Decode the payload of a message.
+		Args:
+			payload (bytes): The payload of the message.
+		Returns:
+			Tuple[str, Any]: The variable name, and the converted value.
+		Raises:
+			PayloadError: If the message is not valid.
+		"""
+		key, value = self.parse(payload)
+		return key, self.convert(key, value)
+
+	def parse(self, payload: bytes) -> Tuple[str, Any]:
+		"""
+		Parse the payload of a message, without converting the value.
+		Args:
+			payload (bytes): The payload of the message.
+		Returns:
+			Tuple[str, Any]: The variable name, and the value of the message.
+		Raises:
+			PayloadError: If the message is not valid.
+		"""
+		# Fast path: the messages of the devices, parsed from the bytes
+		if orjson is None:
+			result = self._parse_fast(payload)
+			if result is not None:
+				return result
+
+		# Any other message
+		message = self._load(payload)
+		if len(message) != 1:
+			raise PayloadError("Too many keys in the message")
+
+		return next(iter(message.items()))
+
+	def parse_batch(self, payload: bytes) -> List[Tuple[str, Any, Optional[float]]]:
+		"""
+		Parse the payload of a message with one or several readings,
+		without converting the values. The message can be:
+			· A single variable: {"temperature": 26}
+			· Several variables, read at once: {"temperature": 26, "state": "ON"}
+			· A list of readings, each one with one or several variables,
+			  and optionally its time ("ts", seconds since the epoch):
+			  {"readings": [{"ts": 1700000000.5, "temperature": 26}, ...]}
+		Args:
+			payload (bytes): The payload of the message.
+		Returns:
+			List[Tuple[str, Any, float]]: The variable name, the value and
+				the time (None if it is not given) of each reading, in order.
+		Raises:
+			PayloadError: If the message is not valid.
+		"""
+		# Fast path: the messages of the devices, parsed from the bytes
+		if orjson is None:
+			result = self._parse_fast(payload)
+			if result is not None:
+				return [(result[0], result[1], None)]
+
+		message = self._load(payload)
+		if READINGS_KEY not in message:
+			if not message:
+				raise PayloadError("Bad message format")
+			if len(message) > self.max_readings:
+				raise PayloadError("Too many readings in the message")
+			return [(key, value, None) for key, value in message.items()]
+
+		# List of readings
+		batch = message[READINGS_KEY]
+		if len(message) != 1 or not isinstance(batch, list) or not batch:
+			raise PayloadError("Bad message format")
+		readings = []
+		for reading in batch:
+			if not isinstance(reading, dict):
+				raise PayloadError("Bad message format")
+			timestamp = reading.get(TIMESTAMP_KEY)
+			if timestamp is not None and \
+					(isinstance(timestamp, bool) or not isinstance(timestamp, (int, float))):
+				raise PayloadError("Bad message format")
+			size = len(readings)
+			readings.extend(
+				(key, value, timestamp) for key, value in reading.items()
+				if key != TIMESTAMP_KEY
+			)
+			if len(readings) == size:
+				raise PayloadError("Bad message format")
+			if len(readings) > self.max_readings:
+				raise PayloadError("Too many readings in the message")
+		return readings
+
+	@staticmethod
+	def _load(payload: bytes) -> dict:
+		"""
+		Parse a JSON object.
+		Raises:
+			PayloadError: If it is not a JSON object.
+		"""
+		try:
+			message = loads(payload)
+		except (json.JSONDecodeError, UnicodeDecodeError):
+			raise PayloadError("Bad message format")
+		if not isinstance(message, dict):
+			raise PayloadError("Bad message format")
+		return message
+
+	def _parse_fast(self, payload: bytes) -> Optional[Tuple[str, Any]]:
+		"""
+		Parse the messages with the format of the devices ({"<key>": <value>},
+		with a known key and a number or a plain string), without the JSON parser.
+		Args:
+			payload (bytes): The payload of the message.
+		Returns:
+			Tuple[str, Any]: The variable name and the value, or None if
+				the message has other format.
+		"""
+		if not payload.startswith(_PREFIX) or not payload.endswith(_SUFFIX):
+			return None
+		end = payload.find(_SEPARATOR, 2)
+		if end < 0:
+			return None
+		key = self._keys.get(payload[2:end])
+		if key is None:
+			return None
+
+		# The value: a plain string or a number
+		raw = payload[end + 3:-1]
+		if len(raw) >= 2 and raw[0] == 0x22 and raw[-1] == 0x22:
+			if raw[1:-1].translate(None, _PLAIN):
+				return None
+			value = raw[1:-1].decode('ascii')
+		elif _NUMBER.fullmatch(raw):
+			if b'.' in raw or b'e' in raw or b'E' in raw:
+				value = float(raw)
+			else:
+				value = int(raw)
+		else:
+			return None
+		return key, value
+
+	def convert(self, key: str, value: Any) -> Any:
+		"""
+		Convert the value of a variable.
+		Args:
+			key (str): The variable name.
+			value (Any): The value of the message.
+		Returns:
+			Any: The converted value.
+		Raises:
+			PayloadError: If the variable is unknown, or the value is not valid.
+		"""
+		convert = self._converters.get(key)
+		if convert is None:
+			raise PayloadError("Bad value format")
+		try:
+			return convert(value)
+		except ValueError:
+			raise PayloadError("Bad value format")
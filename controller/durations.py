@@ -0,0 +1,115 @@
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional
+from .compiled_rule import CompiledRule
+from .rule_set import RuleSet
+from .timer_wheel import TimerWheel
+
+class DurationConditions:
+	"""
+	Rules with a duration: they are applied when their condition has
+	been met continuously for `duration` seconds, once, until the
+	condition stops being met and starts again.
+
+	When the condition starts to be met, a timer of the duration is
+	scheduled in the timer wheel, and it is cancelled when a value does
+	not meet it. The values that keep meeting it do not touch the timer.
+	When the timer ends, the rule is applied by `apply` (from the thread
+	of the wheel), if it has not been updated or deleted meanwhile.
+	"""
+	def __init__(
+		self,
+		wheel: TimerWheel,
+		apply: Callable[[CompiledRule, str], None],
+		lookup: Callable[[str], RuleSet]
+	):
+		"""
+		Constructor of the DurationConditions class.
+		Args:
+			wheel (TimerWheel): Wheel where the timers are scheduled.
+			apply (Callable[[CompiledRule, str], None]): Function that
+				applies a rule, with its source device.
+			lookup (Callable[[str], RuleSet]): Function that returns the
+				current rules of a device.
+		"""
+		self.wheel = wheel
+		self.apply = apply
+		self.lookup = lookup
+
+		# Version of the rules whose condition is being met (timer pending, or applied), by rule id
+		self._met: Dict[int, Any] = {}
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._met)
+
+	def prune(self, rules: Mapping[int, Any], changed: Optional[Iterable[int]] = None) -> None:
+		"""
+		Forget the rules that are not loaded, or that have been updated,
+		cancelling their timers.
+		Args:
+			rules (Mapping[int, Any]): The loaded rules (with their version), by id.
+			changed (Iterable[int]): The ids of the rules that can have
+				changed (None: all of them).
+		"""
+		with self._lock:
+			for rule_id in (list(self._met) if changed is None else changed):
+				if rule_id not in self._met:
+					continue
+				rule = rules.get(rule_id)
+				if rule is None or rule.version != self._met[rule_id]:
+					del self._met[rule_id]
+					self.wheel.cancel(rule_id)
+
+	def update(
+		self,
+		device_id: str,
+		rules: RuleSet,
+		key: str,
+		matches: List[CompiledRule]
+	) -> List[CompiledRule]:
+		"""
+		Schedule or cancel the timers of the rules of a device with a
+		duration, after a value.
+		Args:
+			device_id (str): The device that sent the value.
+			rules (RuleSet): The rules of the device.
+			key (str): The variable of the message.
+			matches (List[CompiledRule]): The rules whose condition is met.
+		Returns:
+			List[CompiledRule]: The matches without the rules with a
+				duration (they are applied when their timer ends).
+		"""
+		matched = {rule.id for rule in matches}
+		stop = rules.stop(key)
+		with self._lock:
+			for position, rule in rules.durations:
+				if position >= stop:
+					break
+				if rule.id in matched:
+					if self._met.get(rule.id) != rule.version:
+						self._met[rule.id] = rule.version
+						self.wheel.schedule(rule.id, rule.duration, self._elapsed, rule, device_id)
+				elif rule.id in self._met:
+					del self._met[rule.id]
+					self.wheel.cancel(rule.id)
+		return [rule for rule in matches if not rule.duration]
+
+	def _elapsed(self, rule: CompiledRule, device_id: str) -> None:
+		"""
+		Callback of the timer of a rule: its condition has been met for
+		the whole duration.
+		"""
+		with self._lock:
+			if self._met.get(rule.id) != rule.version:
+				return
+
+		# The rule has not been updated or deleted
+		if not any(
+			current.id == rule.id and current.version == rule.version
+			for current in self.lookup(device_id)
+		):
+			with self._lock:
+				if self._met.get(rule.id) == rule.version:
+					del self._met[rule.id]
+			return
+		self.apply(rule, device_id)
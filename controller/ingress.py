@@ -0,0 +1,169 @@
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Hashable, Optional, Tuple
+
+# What is done with a new item when the queue is full
+BLOCK = "block"
+DROP_NEWEST = "drop-newest"
+DROP_OLDEST = "drop-oldest"
+SHED_POLICIES = (BLOCK, DROP_NEWEST, DROP_OLDEST)
+
+# Reasons why an item is discarded
+CONFLATED = "conflated"
+SHED = "shed"
+
+class IngressQueue:
+	"""
+	Bounded queue of the items of a worker, by key (the device id), with
+	the same `get`, `task_done` and `join` as `queue.Queue`.
+
+	With `conflate`, the queue keeps one item per key: a new item of a
+	key that is already waiting replaces it (in its place in the queue),
+	so only the newest message of each device is processed after a
+	burst. When the queue is full, the shedding policy is applied:
+		· block: `put` waits until there is room (backpressure).
+		· drop-newest: the new item is discarded.
+		· drop-oldest: the oldest item is discarded, to queue the new one.
+	`put` returns the item that has been discarded, if any, so it can be
+	counted by key.
+	"""
+	def __init__(self, maxsize: int, conflate: bool = False, policy: str = BLOCK):
+		"""
+		Constructor of the IngressQueue class.
+		Args:
+			maxsize (int): Max items waiting.
+			conflate (bool): If the items of a key replace the waiting one.
+			policy (str): Shedding policy when it is full (see SHED_POLICIES).
+		"""
+		if policy not in SHED_POLICIES:
+			raise ValueError(f"Unknown shedding policy: {policy}")
+
+		# Save the params
+		self.maxsize = maxsize
+		self.conflate = conflate
+		self.policy = policy
+
+		# Waiting items: by key when they are conflated, or as (key, item)
+		self._items = OrderedDict() if conflate else deque()
+		self._unfinished = 0
+
+		self._lock = threading.Lock()
+		self._not_empty = threading.Condition(self._lock)
+		self._not_full = threading.Condition(self._lock)
+		self._all_done = threading.Condition(self._lock)
+
+	def qsize(self) -> int:
+		"""
+		Returns the number of items waiting.
+		"""
+		return len(self._items)
+
+	def put(
+		self,
+		key: Hashable,
+		item: Any,
+		timeout: Optional[float] = None,
+		shed: bool = True
+	) -> Optional[Tuple[Hashable, str]]:
+		"""
+		Queue an item.
+		Args:
+			key (Hashable): The key of the item.
+			item (Any): The item.
+			timeout (float): Max seconds to wait if it is full, with the
+				block policy.
+			shed (bool): If the item can be conflated or shed (False: it
+				waits for room, like with the block policy).
+		Returns:
+			Tuple[Hashable, str]: The key of the discarded item and the
+				reason (CONFLATED or SHED), or None if none has been.
+		Raises:
+			queue.Full: If the timeout expires.
+		"""
+		with self._not_full:
+			# Newer item of a waiting key
+			if shed and self.conflate and key in self._items:
+				self._items[key] = item
+				return (key, CONFLATED)
+
+			discarded = None
+			if len(self._items) >= self.maxsize:
+				if shed and self.policy == DROP_NEWEST:
+					return (key, SHED)
+				if shed and self.policy == DROP_OLDEST:
+					discarded = (self._pop_oldest(), SHED)
+					self._unfinished -= 1
+				else:
+					self._wait_for_room(timeout)
+
+			if self.conflate:
+				self._items[key] = item
+			else:
+				self._items.append((key, item))
+			self._unfinished += 1
+			self._not_empty.notify()
+			return discarded
+
+	def get(self) -> Any:
+		"""
+		Take the oldest item, waiting until there is one.
+		Returns:
+			Any: The item.
+		"""
+		with self._not_empty:
+			while not self._items:
+				self._not_empty.wait()
+			if self.conflate:
+				_, item = self._items.popitem(last=False)
+			else:
+				_, item = self._items.popleft()
+			self._not_full.notify()
+			return item
+
+	def task_done(self) -> None:
+		"""
+		Mark an item taken with `get` as processed.
+		"""
+		with self._all_done:
+			self._unfinished -= 1
+			if self._unfinished <= 0:
+				self._all_done.notify_all()
+
+	def join(self) -> None:
+		"""
+		Wait until all the queued items have been processed.
+		"""
+		with self._all_done:
+			while self._unfinished > 0:
+				self._all_done.wait()
+
+	def _pop_oldest(self) -> Hashable:
+		"""
+		Remove the oldest item. The caller must hold the lock.
+		Returns:
+			Hashable: Its key.
+		"""
+		if self.conflate:
+			key, _ = self._items.popitem(last=False)
+		else:
+			key, _ = self._items.popleft()
+		return key
+
+	def _wait_for_room(self, timeout: Optional[float]) -> None:
+		"""
+		Wait until the queue is not full. The caller must hold the lock.
+		Raises:
+			queue.Full: If the timeout expires.
+		"""
+		if timeout is None:
+			while len(self._items) >= self.maxsize:
+				self._not_full.wait()
+			return
+		deadline = time.monotonic() + timeout
+		while len(self._items) >= self.maxsize:
+			remaining = deadline - time.monotonic()
+			if remaining <= 0:
+				raise queue.Full
+			self._not_full.wait(remaining)
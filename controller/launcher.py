@@ -0,0 +1,365 @@
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+from typing import Any, Dict, List, Optional, Tuple
+from .IOTController import IOTController
+from .partition import HashRing, Partition
+
+def run_partition(
+	member: str,
+	members: List[str],
+	options: Dict[str, Any],
+	connection: multiprocessing.connection.Connection,
+	metrics_file: Optional[str] = None
+) -> None:
+	"""
+	Main function of a controller process: run a controller that owns
+	a partition of the devices, and follow the commands of the launcher.
+	Args:
+		member (str): Name of the process in the ring.
+		members (List[str]): Names of all the processes in the ring.
+		options (Dict[str, Any]): Params of the controller.
+		connection (Connection): Pipe with the launcher.
+		metrics_file (str): File where the metrics are written on a
+			SIGUSR1 (with the name of the process as suffix).
+	"""
+	# Each process profiles its messages in its own file
+	if options.get("profile_file") is not None:
+		options = dict(options, profile_file=f"{options['profile_file']}.{member}")
+
+	# The launcher is the one that stops the processes (and reloads their rules)
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	signal.signal(signal.SIGTERM, signal.SIG_IGN)
+	signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+	controller = IOTController(
+		partition=Partition(HashRing(members), member),
+		**options
+	)
+	if metrics_file is not None:
+		signal.signal(
+			signal.SIGUSR1,
+			lambda signum, frame: controller.metrics.dump(f"{metrics_file}.{member}")
+		)
+	else:
+		signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+	controller.start()
+	connection.send(("ready", member))
+
+	# Commands of the launcher
+	while True:
+		try:
+			command, members = connection.recv()
+		except (EOFError, OSError):
+			break
+
+		if command == "release":
+			controller.release_partition(members)
+			connection.send(("released", member))
+		elif command == "acquire":
+			controller.acquire_partition(members)
+			connection.send(("acquired", member))
+		elif command == "reload":
+			controller.reload()
+			connection.send(("reloaded", member))
+		elif command == "stop":
+			break
+
+	controller.stop()
+
+class Launcher:
+	"""
+	Launcher of several controller processes, each one owning a
+	partition (consistent hashing of the device ids) of the devices.
+
+	When a process is added, removed or dies, the partitions are
+	rebalanced in two steps, so the messages of a device are never
+	processed by two processes at the same time:
+		1. Release: every process unsubscribes from the devices that
+		   it loses, and processes their queued messages.
+		2. Acquire: when all of them have finished, every process
+		   subscribes to the devices that it gains (the last state is
+		   received again, as it is retained).
+
+	Signals: SIGINT/SIGTERM stop everything, SIGTTIN adds a process,
+	SIGTTOU removes one, SIGHUP makes every process reload its rules and
+	SIGUSR1 makes every process write its metrics.
+	"""
+	def __init__(
+		self,
+		processes: int,
+		options: Dict[str, Any],
+		timeout: float = 10.0,
+		debug: bool = False,
+		metrics_file: Optional[str] = None
+	):
+		"""
+		Constructor of the Launcher class.
+		Args:
+			processes (int): Number of controller processes.
+			options (Dict[str, Any]): Params of each controller.
+			timeout (float): Max seconds to wait for a process answer.
+			debug (bool): Debug mode.
+			metrics_file (str): File where each process writes its metrics
+				on a SIGUSR1 (with the name of the process as suffix).
+		"""
+		self.processes = processes
+		self.options = options
+		self.timeout = timeout
+		self.debug = debug
+		self.metrics_file = metrics_file
+
+		# Processes by member name, with the pipe to talk with them
+		self._context = multiprocessing.get_context("spawn")
+		self._children: Dict[str, Tuple[multiprocessing.Process, Any]] = {}
+		self._counter = 0
+
+		# Actions requested by the signals
+		self._running = False
+		self._scale = 0
+		self._reload = False
+
+	@property
+	def members(self) -> List[str]:
+		"""
+		Returns the names of the running processes.
+		"""
+		return list(self._children)
+
+	def start(self) -> None:
+		"""
+		Start the controller processes.
+		"""
+		members = [self._new_member() for _ in range(self.processes)]
+		for member in members:
+			self._spawn(member, members)
+		for member in members:
+			if not self._expect(member, "ready"):
+				self._children[member][0].kill()
+		self._running = True
+
+	def run(self) -> None:
+		"""
+		Start the processes, and supervise them until a SIGINT or a
+		SIGTERM is received.
+		"""
+		signal.signal(signal.SIGINT, self._on_stop_signal)
+		signal.signal(signal.SIGTERM, self._on_stop_signal)
+		signal.signal(signal.SIGTTIN, lambda signum, frame: self._request_scale(1))
+		signal.signal(signal.SIGTTOU, lambda signum, frame: self._request_scale(-1))
+		signal.signal(signal.SIGHUP, self._on_reload_signal)
+		signal.signal(signal.SIGUSR1, self._on_metrics_signal)
+
+		self.start()
+		while self._running:
+			# Wait for a process to die, or for a signal
+			sentinels = {
+				process.sentinel: member
+				for member, (process, _) in self._children.items()
+			}
+			ready = multiprocessing.connection.wait(list(sentinels), timeout=0.5)
+
+			# Replace the dead processes
+			dead = [sentinels[sentinel] for sentinel in ready]
+			if dead and self._running:
+				if self.debug:
+					print(f"[ Launcher ] Processes died: {', '.join(dead)}")
+				self.remove(dead, graceful=False)
+				for _ in dead:
+					self.add()
+
+			# Scale up or down
+			while self._scale > 0 and self._running:
+				self._scale -= 1
+				self.add()
+			while self._scale < 0 and self._running:
+				self._scale += 1
+				if len(self._children) > 1:
+					self.remove([self.members[-1]])
+
+			# Reload the rules
+			if self._reload and self._running:
+				self._reload = False
+				self.reload()
+
+		self.stop()
+
+	def add(self) -> str:
+		"""
+		Add a process, and rebalance the partitions.
+		Returns:
+			str: The name of the new process.
+		"""
+		member = self._new_member()
+		members = self.members + [member]
+
+		# The current processes release the devices of the new one, that starts with them
+		self._broadcast("release", members)
+		self._spawn(member, members)
+		if not self._expect(member, "ready"):
+			self._children[member][0].kill()
+		self._broadcast("acquire", members, exclude=[member])
+
+		if self.debug:
+			print(f"[ Launcher ] Process added: {member}")
+		return member
+
+	def remove(self, removed: List[str], graceful: bool = True) -> None:
+		"""
+		Remove processes, and rebalance the partitions.
+		Args:
+			removed (List[str]): Names of the processes to remove.
+			graceful (bool): If the processes have to release their
+				devices (False if they are dead).
+		"""
+		members = [member for member in self.members if member not in removed]
+
+		# Release: the removed processes lose all their devices
+		if graceful:
+			self._broadcast("release", members)
+		else:
+			self._broadcast("release", members, exclude=removed)
+		for member in removed:
+			self._terminate(member)
+
+		# Acquire: the others take them
+		self._broadcast("acquire", members)
+		if self.debug:
+			print(f"[ Launcher ] Processes removed: {', '.join(removed)}")
+
+	def reload(self) -> None:
+		"""
+		Make all the processes read again their rules.
+		"""
+		self._broadcast("reload", self.members)
+		if self.debug:
+			print("[ Launcher ] Rules reloaded")
+
+	def stop(self) -> None:
+		"""
+		Stop all the processes.
+		"""
+		self._running = False
+		for member in self.members:
+			self._terminate(member)
+
+	def _new_member(self) -> str:
+		"""
+		Returns a new process name.
+		"""
+		member = f"controller-{self._counter}"
+		self._counter += 1
+		return member
+
+	def _spawn(self, member: str, members: List[str]) -> None:
+		"""
+		Start a controller process.
+		Args:
+			member (str): Name of the process.
+			members (List[str]): Names of all the processes in the ring.
+		"""
+		parent_connection, child_connection = self._context.Pipe()
+		process = self._context.Process(
+			target=run_partition,
+			args=(member, members, self.options, child_connection, self.metrics_file),
+			name=member
+		)
+		process.start()
+		child_connection.close()
+		self._children[member] = (process, parent_connection)
+
+	def _terminate(self, member: str) -> None:
+		"""
+		Stop a process: ask it to end, and kill it if it does not.
+		Args:
+			member (str): Name of the process.
+		"""
+		process, connection = self._children.pop(member)
+		try:
+			connection.send(("stop", None))
+		except (BrokenPipeError, OSError):
+			pass
+		process.join(self.timeout)
+		if process.is_alive():
+			process.kill()
+			process.join()
+		connection.close()
+
+	def _broadcast(
+		self,
+		command: str,
+		members: List[str],
+		exclude: Optional[List[str]] = None
+	) -> None:
+		"""
+		Send a command to the processes, and wait for all the answers.
+		The processes that do not answer are killed (and replaced later,
+		as dead processes).
+		Args:
+			command (str): "release", "acquire" or "reload".
+			members (List[str]): Names of the processes in the new ring.
+			exclude (List[str]): Processes that do not receive the command.
+		"""
+		targets = [
+			member for member in self.members
+			if not exclude or member not in exclude
+		]
+		for member in targets:
+			try:
+				self._children[member][1].send((command, members))
+			except (BrokenPipeError, OSError):
+				pass
+
+		answer = {"release": "released", "acquire": "acquired", "reload": "reloaded"}[command]
+		for member in targets:
+			if not self._expect(member, answer):
+				self._children[member][0].kill()
+
+	def _expect(self, member: str, answer: str) -> bool:
+		"""
+		Wait for an answer of a process.
+		Args:
+			member (str): Name of the process.
+			answer (str): The expected answer.
+		Returns:
+			bool: True if it has answered in time.
+		"""
+		connection = self._children[member][1]
+		try:
+			if connection.poll(self.timeout):
+				return connection.recv() == (answer, member)
+		except (EOFError, OSError):
+			pass
+		if self.debug:
+			print(f"[ Launcher ] {member} did not answer '{answer}'")
+		return False
+
+	def _request_scale(self, delta: int) -> None:
+		"""
+		Signal handler: add or remove a process.
+		"""
+		self._scale += delta
+
+	def _on_metrics_signal(self, signum, frame) -> None:
+		"""
+		Signal handler: ask the processes to write their metrics.
+		"""
+		for process, _ in list(self._children.values()):
+			if process.pid is not None:
+				try:
+					os.kill(process.pid, signal.SIGUSR1)
+				except ProcessLookupError:
+					pass
+
+	def _on_reload_signal(self, signum, frame) -> None:
+		"""
+		Signal handler: reload the rules of the processes (from the main loop).
+		"""
+		self._reload = True
+
+	def _on_stop_signal(self, signum, frame) -> None:
+		"""
+		Signal handler: stop the launcher.
+		"""
+		self._running = False
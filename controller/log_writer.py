@@ -0,0 +1,337 @@
+import asyncio
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, Optional
+from .database_communication import (
+	ConnectionManager,
+	add_logs
+)
+
+# Marker put in the queue to stop the writer
+_STOP = object()
+
+class LogWriter:
+	"""
+	Background writer of the controller logs.
+
+	The logs are put in a bounded queue (if it is full, the log is
+	dropped and counted), and a thread inserts them in batches, with
+	one transaction per batch. A batch is written when it has
+	`batch_size` logs, or `flush_interval` seconds after its first
+	log arrived. When it is stopped, all the queued logs are written.
+	"""
+	def __init__(
+		self,
+		connections: ConnectionManager,
+		max_queue: int = 10000,
+		batch_size: int = 500,
+		flush_interval: float = 0.5,
+		debug: bool = False,
+		latency: Optional[Any] = None
+	):
+		"""
+		Constructor of the LogWriter class.
+		Args:
+			connections (ConnectionManager): Connections to the database.
+			max_queue (int): Max number of logs waiting to be written.
+			batch_size (int): Max number of logs written in a transaction.
+			flush_interval (float): Max seconds that a log waits to be written.
+			debug (bool): Debug mode.
+			latency (Histogram): Metric where the time of each write is observed.
+		"""
+		# Save the params
+		self.connections = connections
+		self.max_queue = max_queue
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+		self.debug = debug
+		self.latency = latency
+
+		# Queue of logs, and the thread that writes them
+		self._queue = queue.Queue(maxsize=max_queue)
+		self._thread: Optional[threading.Thread] = None
+		self._stopped = False
+
+		# Counters
+		self._lock = threading.Lock()
+		self.written = 0
+		self.dropped = 0
+		self.failed = 0
+		self.flushes = 0
+		self.last_flush_latency = 0.0
+		self.max_flush_latency = 0.0
+		self.total_flush_latency = 0.0
+
+	@property
+	def queue_depth(self) -> int:
+		"""
+		Returns the number of logs waiting to be written.
+		"""
+		return self._queue.qsize()
+
+	def stats(self) -> Dict[str, float]:
+		"""
+		Returns the counters of the writer.
+		"""
+		return {
+			'queue_depth': self.queue_depth,
+			'written': self.written,
+			'dropped': self.dropped,
+			'failed': self.failed,
+			'flushes': self.flushes,
+			'last_flush_latency': self.last_flush_latency,
+			'max_flush_latency': self.max_flush_latency,
+			'avg_flush_latency': (
+				self.total_flush_latency / self.flushes if self.flushes else 0.0
+			),
+		}
+
+	def start(self) -> None:
+		"""
+		Start the thread that writes the logs.
+		"""
+		if self._thread is not None:
+			return
+		self._thread = threading.Thread(
+			target=self._run,
+			name="log-writer",
+			daemon=True
+		)
+		self._thread.start()
+
+	def log(self, message: str, device_id: Optional[str] = None) -> bool:
+		"""
+		Queue a log to be written. It never blocks.
+		Args:
+			message (str): The message to log.
+			device_id (str): The device id that generated the log.
+		Returns:
+			bool: False if the log has been dropped.
+		"""
+		if not self._stopped:
+			try:
+				self._queue.put_nowait((message, device_id, datetime.now()))
+				return True
+			except queue.Full:
+				pass
+
+		with self._lock:
+			self.dropped += 1
+		return False
+
+	def join(self) -> None:
+		"""
+		Wait until all the queued logs have been written.
+		"""
+		self._queue.join()
+
+	def stop(self, timeout: Optional[float] = None) -> bool:
+		"""
+		Stop the writer, writing all the queued logs.
+		Args:
+			timeout (float): Max seconds to wait.
+		Returns:
+			bool: True if all the logs have been written.
+		"""
+		self._stopped = True
+		if self._thread is None:
+			return self._queue.empty()
+
+		# Ask the thread to end, after the logs that are in the queue
+		try:
+			self._queue.put(_STOP, timeout=timeout)
+		except queue.Full:
+			return False
+		self._thread.join(timeout)
+		return not self._thread.is_alive()
+
+	def _run(self) -> None:
+		"""
+		Loop of the thread: collect the batches and write them.
+		"""
+		stop = False
+		while not stop:
+			# Wait for the first log of the batch
+			item = self._queue.get()
+			if item is _STOP:
+				self._queue.task_done()
+				break
+			batch = [item]
+
+			# Fill the batch, until it is full or its time ends
+			deadline = time.monotonic() + self.flush_interval
+			while len(batch) < self.batch_size:
+				# When the time ends, only the logs already queued are taken
+				remaining = deadline - time.monotonic()
+				try:
+					if remaining > 0:
+						item = self._queue.get(timeout=remaining)
+					else:
+						item = self._queue.get_nowait()
+				except queue.Empty:
+					break
+				if item is _STOP:
+					self._queue.task_done()
+					stop = True
+					break
+				batch.append(item)
+
+			self._flush(batch)
+
+		# Write what is left (logs queued while stopping)
+		batch = []
+		while True:
+			try:
+				item = self._queue.get_nowait()
+			except queue.Empty:
+				break
+			if item is not _STOP:
+				batch.append(item)
+			else:
+				self._queue.task_done()
+		if batch:
+			self._flush(batch)
+
+	def _flush(self, batch: list) -> None:
+		"""
+		Write a batch of logs, and mark them as done in the queue.
+		Args:
+			batch (list): The logs, as (message, device id, timestamp).
+		"""
+		self._write(batch)
+		for _ in batch:
+			self._queue.task_done()
+
+	def _write(self, batch: list) -> None:
+		"""
+		Write a batch of logs in a transaction, updating the counters.
+		Args:
+			batch (list): The logs, as (message, device id, timestamp).
+		"""
+		start = time.perf_counter()
+		try:
+			self.connections.run(add_logs, batch)
+			self.written += len(batch)
+		except sqlite3.Error as e:
+			self.failed += len(batch)
+			if self.debug:
+				print(f"[ Controller ] Error writing {len(batch)} logs: {e}")
+		latency = time.perf_counter() - start
+
+		# Update the counters
+		self.flushes += 1
+		self.last_flush_latency = latency
+		self.total_flush_latency += latency
+		self.max_flush_latency = max(self.max_flush_latency, latency)
+		if self.latency is not None:
+			self.latency.observe(latency)
+
+class AsyncLogWriter(LogWriter):
+	"""
+	Log writer for the asyncio engine.
+
+	It works as `LogWriter`, but the batches are collected by a task of
+	the event loop, and written by a single database thread, so the
+	loop never waits for SQLite. `log` must be called from the loop.
+	"""
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+
+		# Queue of the event loop, and the task that collects the batches
+		self._queue = asyncio.Queue(maxsize=self.max_queue)
+		self._task: Optional[asyncio.Task] = None
+		self._executor: Optional[ThreadPoolExecutor] = None
+
+	def start(self) -> None:
+		"""
+		Start the task that writes the logs. It must be called from the loop.
+		"""
+		if self._task is not None:
+			return
+		self._executor = ThreadPoolExecutor(
+			max_workers=1,
+			thread_name_prefix="log-writer"
+		)
+		self._task = asyncio.get_running_loop().create_task(self._run())
+
+	def log(self, message: str, device_id: Optional[str] = None) -> bool:
+		"""
+		Queue a log to be written. It never blocks.
+		Args:
+			message (str): The message to log.
+			device_id (str): The device id that generated the log.
+		Returns:
+			bool: False if the log has been dropped.
+		"""
+		if not self._stopped:
+			try:
+				self._queue.put_nowait((message, device_id, datetime.now()))
+				return True
+			except asyncio.QueueFull:
+				pass
+
+		self.dropped += 1
+		return False
+
+	async def join(self) -> None:
+		"""
+		Wait until all the queued logs have been written.
+		"""
+		await self._queue.join()
+
+	async def stop(self, timeout: Optional[float] = None) -> bool:
+		"""
+		Stop the writer, writing all the queued logs.
+		Args:
+			timeout (float): Max seconds to wait.
+		Returns:
+			bool: True if all the logs have been written.
+		"""
+		self._stopped = True
+		if self._task is None:
+			return self._queue.empty()
+
+		# Wait for the logs in the queue, and end the task
+		try:
+			await asyncio.wait_for(self._queue.join(), timeout)
+			written = True
+		except asyncio.TimeoutError:
+			written = False
+		self._task.cancel()
+		try:
+			await self._task
+		except asyncio.CancelledError:
+			pass
+		self._executor.shutdown(wait=written)
+		return written
+
+	async def _run(self) -> None:
+		"""
+		Task that collects the batches and writes them.
+		"""
+		loop = asyncio.get_running_loop()
+		while True:
+			# Wait for the first log of the batch
+			batch = [await self._queue.get()]
+
+			# Fill the batch, until it is full or its time ends
+			deadline = loop.time() + self.flush_interval
+			while len(batch) < self.batch_size:
+				remaining = deadline - loop.time()
+				try:
+					if remaining > 0:
+						item = await asyncio.wait_for(self._queue.get(), remaining)
+					else:
+						item = self._queue.get_nowait()
+				except (asyncio.TimeoutError, asyncio.QueueEmpty):
+					break
+				batch.append(item)
+
+			# Write it out of the loop
+			await loop.run_in_executor(self._executor, self._write, batch)
+			for _ in batch:
+				self._queue.task_done()
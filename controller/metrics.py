@@ -0,0 +1,488 @@
+import bisect
+import math
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import get_ident
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Content type of the Prometheus text format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Default buckets of the latency histograms (seconds)
+LATENCY_BUCKETS = (
+	0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+	0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0
+)
+
+def _format_value(value: float) -> str:
+	"""
+	Function to format a sample value.
+	Args:
+		value (float): The value.
+	Returns:
+		str: The value in the Prometheus text format.
+	"""
+	if math.isinf(value):
+		return "+Inf" if value > 0 else "-Inf"
+	if isinstance(value, float) and value.is_integer():
+		return str(int(value))
+	return repr(value)
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+	"""
+	Function to format the labels of a sample.
+	Args:
+		names (Tuple[str, ...]): The label names.
+		values (Tuple[str, ...]): The label values.
+	Returns:
+		str: The labels, like {name="value"} (empty if there are none).
+	"""
+	if not names:
+		return ""
+	labels = ",".join(
+		'{}="{}"'.format(
+			name,
+			str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+		)
+		for name, value in zip(names, values)
+	)
+	return "{" + labels + "}"
+
+class _CounterChild:
+	"""
+	Value of a counter for some label values.
+
+	Each thread adds to its own cell, so no lock is needed (only the
+	owner thread writes a cell), and the value is the sum of the cells.
+	"""
+	__slots__ = ('_cells',)
+
+	def __init__(self):
+		self._cells: Dict[int, List[float]] = {}
+
+	def inc(self, amount: float = 1) -> None:
+		"""
+		Add to the counter.
+		Args:
+			amount (float): The amount to add.
+		"""
+		cell = self._cells.get(get_ident())
+		if cell is None:
+			cell = self._cells.setdefault(get_ident(), [0])
+		cell[0] += amount
+
+	@property
+	def value(self) -> float:
+		"""
+		Returns the value of the counter.
+		"""
+		return sum(cell[0] for cell in list(self._cells.values()))
+
+class _HistogramChild:
+	"""
+	Observations of a histogram for some label values. As the counters,
+	each thread has its own cell: the count of each bucket, and the sum.
+	"""
+	__slots__ = ('_buckets', '_cells')
+
+	def __init__(self, buckets: Tuple[float, ...]):
+		self._buckets = buckets
+		self._cells: Dict[int, List[float]] = {}
+
+	def observe(self, value: float) -> None:
+		"""
+		Add an observation.
+		Args:
+			value (float): The observed value.
+		"""
+		cell = self._cells.get(get_ident())
+		if cell is None:
+			cell = self._cells.setdefault(get_ident(), [0] * (len(self._buckets) + 2))
+		cell[bisect.bisect_left(self._buckets, value)] += 1
+		cell[-1] += value
+
+	def snapshot(self) -> Tuple[List[float], float]:
+		"""
+		Returns the count of each bucket (the last one is +Inf) and the sum.
+		"""
+		counts = [0] * (len(self._buckets) + 1)
+		total = 0.0
+		for cell in list(self._cells.values()):
+			for index in range(len(counts)):
+				counts[index] += cell[index]
+			total += cell[-1]
+		return counts, total
+
+class Metric:
+	"""
+	Base of the metrics: a family of samples, one for each combination
+	of label values.
+	"""
+	TYPE = ""
+
+	def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+		"""
+		Constructor of the Metric class.
+		Args:
+			name (str): Name of the metric.
+			documentation (str): Help text of the metric.
+			labels (Tuple[str, ...]): Names of the labels.
+		"""
+		self.name = name
+		self.documentation = documentation
+		self.label_names = tuple(labels)
+		self._children: Dict[Tuple[str, ...], Any] = {}
+		self._lock = threading.Lock()
+
+		# Without labels, there is a single child (and its record
+		# function is used directly, to save a call)
+		if not self.label_names:
+			self._default = self.labels()
+			self._bind_default()
+
+	def _bind_default(self) -> None:
+		"""
+		Use the record function of the single child as the one of the metric.
+		"""
+
+	def labels(self, *values: str):
+		"""
+		Get the child of some label values (created the first time).
+		Args:
+			values (str): The label values, in the order of the names.
+		Returns:
+			The child, to record the values.
+		"""
+		child = self._children.get(values)
+		if child is None:
+			if len(values) != len(self.label_names):
+				raise ValueError(f"{self.name} has the labels {self.label_names}")
+			with self._lock:
+				child = self._children.get(values)
+				if child is None:
+					child = self._new_child()
+					self._children[values] = child
+		return child
+
+	def _new_child(self):
+		raise NotImplementedError("Subclasses must implement this method")
+
+	def samples(self) -> List[Tuple[str, Tuple[str, ...], Tuple[str, ...], float]]:
+		"""
+		Returns the samples, as (suffix, label names, label values, value).
+		"""
+		raise NotImplementedError("Subclasses must implement this method")
+
+	def render(self) -> str:
+		"""
+		Returns the metric in the Prometheus text format.
+		"""
+		lines = [
+			f"# HELP {self.name} {self.documentation}",
+			f"# TYPE {self.name} {self.TYPE}",
+		]
+		for suffix, names, values, value in self.samples():
+			lines.append(
+				f"{self.name}{suffix}{_format_labels(names, values)} {_format_value(value)}"
+			)
+		return "\n".join(lines) + "\n"
+
+class Counter(Metric):
+	"""
+	Value that only increases (like the number of messages).
+	"""
+	TYPE = "counter"
+
+	def _new_child(self) -> _CounterChild:
+		return _CounterChild()
+
+	def _bind_default(self) -> None:
+		self.inc = self._default.inc
+
+	def inc(self, amount: float = 1) -> None:
+		"""
+		Add to the counter (only without labels).
+		Args:
+			amount (float): The amount to add.
+		"""
+		self._default.inc(amount)
+
+	def samples(self):
+		return [
+			("", self.label_names, values, child.value)
+			for values, child in list(self._children.items())
+		]
+
+class Histogram(Metric):
+	"""
+	Distribution of observed values (like the latencies), in buckets.
+	"""
+	TYPE = "histogram"
+
+	def __init__(
+		self,
+		name: str,
+		documentation: str,
+		labels: Tuple[str, ...] = (),
+		buckets: Tuple[float, ...] = LATENCY_BUCKETS
+	):
+		"""
+		Constructor of the Histogram class.
+		Args:
+			name (str): Name of the metric.
+			documentation (str): Help text of the metric.
+			labels (Tuple[str, ...]): Names of the labels.
+			buckets (Tuple[float, ...]): Upper bounds of the buckets.
+		"""
+		self.buckets = tuple(sorted(buckets))
+		super().__init__(name, documentation, labels)
+
+	def _new_child(self) -> _HistogramChild:
+		return _HistogramChild(self.buckets)
+
+	def _bind_default(self) -> None:
+		self.observe = self._default.observe
+
+	def observe(self, value: float) -> None:
+		"""
+		Add an observation (only without labels).
+		Args:
+			value (float): The observed value.
+		"""
+		self._default.observe(value)
+
+	def samples(self):
+		samples = []
+		names = self.label_names + ("le",)
+		for values, child in list(self._children.items()):
+			counts, total = child.snapshot()
+			cumulative = 0
+			for bound, count in zip(self.buckets + (math.inf,), counts):
+				cumulative += count
+				samples.append(("_bucket", names, values + (_format_value(bound),), cumulative))
+			samples.append(("_count", self.label_names, values, cumulative))
+			samples.append(("_sum", self.label_names, values, total))
+		return samples
+
+class Gauge(Metric):
+	"""
+	Value that is read when the metrics are collected (like the depth of
+	a queue), from a function.
+	"""
+	TYPE = "gauge"
+
+	def __init__(
+		self,
+		name: str,
+		documentation: str,
+		function: Callable[[], Any],
+		labels: Tuple[str, ...] = ()
+	):
+		"""
+		Constructor of the Gauge class.
+		Args:
+			name (str): Name of the metric.
+			documentation (str): Help text of the metric.
+			function (Callable): Function that returns the value or, with
+				labels, a dict of values by the tuple of label values.
+			labels (Tuple[str, ...]): Names of the labels.
+		"""
+		self.function = function
+		super().__init__(name, documentation, labels)
+
+	def _new_child(self) -> None:
+		return None
+
+	def samples(self):
+		value = self.function()
+		if not self.label_names:
+			return [("", (), (), value)]
+		return [
+			("", self.label_names, values, child_value)
+			for values, child_value in value.items()
+		]
+
+class Registry:
+	"""
+	Group of metrics, that can be rendered in the Prometheus text format.
+	"""
+	def __init__(self):
+		"""
+		Constructor of the Registry class.
+		"""
+		self._metrics: Dict[str, Metric] = {}
+
+	def register(self, metric: Metric) -> Metric:
+		"""
+		Add a metric.
+		Args:
+			metric (Metric): The metric.
+		Returns:
+			Metric: The same metric.
+		"""
+		if metric.name in self._metrics:
+			raise ValueError(f"Metric {metric.name} already registered")
+		self._metrics[metric.name] = metric
+		return metric
+
+	def render(self) -> str:
+		"""
+		Returns all the metrics in the Prometheus text format.
+		"""
+		return "".join(metric.render() for metric in list(self._metrics.values()))
+
+	def dump(self, path: str) -> None:
+		"""
+		Write the metrics to a file (replaced at once, so it is never
+		read half written).
+		Args:
+			path (str): Path of the file.
+		"""
+		temporary = f"{path}.tmp"
+		with open(temporary, "w") as file:
+			file.write(self.render())
+		os.replace(temporary, path)
+
+class MetricsServer:
+	"""
+	Local HTTP server of the metrics (GET /metrics), in a thread.
+	"""
+	def __init__(self, registry: Registry, port: int, host: str = "127.0.0.1"):
+		"""
+		Constructor of the MetricsServer class.
+		Args:
+			registry (Registry): The metrics to serve.
+			port (int): Port of the server (0 to choose a free one).
+			host (str): Address of the server.
+		"""
+		self.registry = registry
+
+		class Handler(BaseHTTPRequestHandler):
+			def do_GET(handler):
+				if handler.path.split("?")[0] != "/metrics":
+					handler.send_error(404)
+					return
+				body = registry.render().encode()
+				handler.send_response(200)
+				handler.send_header("Content-Type", CONTENT_TYPE)
+				handler.send_header("Content-Length", str(len(body)))
+				handler.end_headers()
+				handler.wfile.write(body)
+
+			def log_message(handler, format, *args):
+				pass
+
+		self._server = ThreadingHTTPServer((host, port), Handler)
+		self._server.daemon_threads = True
+		self._thread: Optional[threading.Thread] = None
+
+	@property
+	def port(self) -> int:
+		"""
+		Returns the port where the server listens.
+		"""
+		return self._server.server_address[1]
+
+	def start(self) -> None:
+		"""
+		Start serving the metrics, in a thread.
+		"""
+		self._thread = threading.Thread(
+			target=self._server.serve_forever,
+			name="metrics-server",
+			daemon=True
+		)
+		self._thread.start()
+
+	def stop(self) -> None:
+		"""
+		Stop the server.
+		"""
+		if self._thread is not None:
+			self._server.shutdown()
+			self._thread.join()
+		self._server.server_close()
+
+class ControllerMetrics(Registry):
+	"""
+	Metrics of the controller. Recording a value costs a few hundred
+	nanoseconds, so they are always enabled.
+	"""
+	def __init__(self):
+		"""
+		Constructor of the ControllerMetrics class.
+		"""
+		super().__init__()
+		self.messages = self.register(Counter(
+			"iot_controller_messages_received_total",
+			"Readings received (one per variable of each message), by device type",
+			labels=("type",)
+		))
+		self.messages_discarded = self.register(Counter(
+			"iot_controller_messages_discarded_total",
+			"Queued messages not processed, by device and reason (conflated or shed)",
+			labels=("device", "reason")
+		))
+		self.parse_failures = self.register(Counter(
+			"iot_controller_parse_failures_total",
+			"Messages and readings that could not be decoded, by reason",
+			labels=("reason",)
+		))
+		self.rules_evaluated = self.register(Counter(
+			"iot_controller_rules_evaluated_total",
+			"Rules of the source devices checked for the messages"
+		))
+		self.rules_fired = self.register(Counter(
+			"iot_controller_rules_fired_total",
+			"Rules applied"
+		))
+		self.rules_suppressed = self.register(Counter(
+			"iot_controller_rules_suppressed_total",
+			"Rules not applied because their circuit breaker is open"
+		))
+		self.breaker_trips = self.register(Counter(
+			"iot_controller_breaker_trips_total",
+			"Times that a rule has been applied too often, and suppressed"
+		))
+		self.commands_published = self.register(Counter(
+			"iot_controller_commands_published_total",
+			"Commands published to the target devices"
+		))
+		self.commands_coalesced = self.register(Counter(
+			"iot_controller_commands_coalesced_total",
+			"Commands not sent because other one was sent to the device in their window, by reason (superseded or outranked)",
+			labels=("reason",)
+		))
+		self.commands_acknowledged = self.register(Counter(
+			"iot_controller_commands_acknowledged_total",
+			"Commands acknowledged by the broker"
+		))
+		self.change_notices = self.register(Counter(
+			"iot_controller_change_notices_total",
+			"Change notices of the rules and devices applied, by entity",
+			labels=("entity",)
+		))
+		self.message_seconds = self.register(Histogram(
+			"iot_controller_message_seconds",
+			"Time to process a message"
+		))
+		self.db_seconds = self.register(Histogram(
+			"iot_controller_db_seconds",
+			"Time of the database operations, by operation",
+			labels=("operation",)
+		))
+
+	def register_queues(self, function: Callable[[], Dict[Tuple[str, ...], int]]) -> None:
+		"""
+		Add the gauge of the queue depths.
+		Args:
+			function (Callable): Function that returns the depth of each
+				queue, by the tuple of its name.
+		"""
+		self.register(Gauge(
+			"iot_controller_queue_depth",
+			"Items waiting in each queue",
+			function,
+			labels=("queue",)
+		))
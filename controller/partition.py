@@ -0,0 +1,84 @@
+import bisect
+import hashlib
+from typing import Iterable, List, Tuple
+
+def stable_hash(key: str) -> int:
+	"""
+	Hash of a string that is the same in all the processes (the
+	builtin `hash` changes between processes).
+	Args:
+		key (str): The string to hash.
+	Returns:
+		int: The hash, as a 64 bits integer.
+	"""
+	return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+class HashRing:
+	"""
+	Consistent hash ring of the controller processes (members).
+
+	Each member is placed `replicas` times in the ring, and a device is
+	owned by the first member found after the hash of its id. When a
+	member is added or removed, only the devices of that member move.
+	"""
+	def __init__(self, members: Iterable[str], replicas: int = 100):
+		"""
+		Constructor of the HashRing class.
+		Args:
+			members (Iterable[str]): Names of the members.
+			replicas (int): Points of each member in the ring.
+		"""
+		self.members = tuple(sorted(set(members)))
+		self.replicas = replicas
+
+		# Sorted points of the ring, and the member of each one
+		points: List[Tuple[int, str]] = sorted(
+			(stable_hash(f"{member}#{replica}"), member)
+			for member in self.members
+			for replica in range(replicas)
+		)
+		self._hashes = [point for point, _ in points]
+		self._owners = [member for _, member in points]
+
+	def __repr__(self):
+		return f"HashRing({', '.join(self.members)})"
+
+	def owner(self, key: str) -> str:
+		"""
+		Get the member that owns a key.
+		Args:
+			key (str): The key (device id).
+		Returns:
+			str: The name of the member.
+		"""
+		if not self._hashes:
+			raise ValueError("The ring has no members")
+		index = bisect.bisect(self._hashes, stable_hash(key))
+		return self._owners[index % len(self._owners)]
+
+class Partition:
+	"""
+	Devices owned by a member of the ring.
+	"""
+	def __init__(self, ring: HashRing, member: str):
+		"""
+		Constructor of the Partition class.
+		Args:
+			ring (HashRing): The ring of all the members.
+			member (str): The member that owns the partition.
+		"""
+		self.ring = ring
+		self.member = member
+
+	def __repr__(self):
+		return f"Partition({self.member} of {self.ring})"
+
+	def owns(self, device_id: str) -> bool:
+		"""
+		Check if a device belongs to the partition.
+		Args:
+			device_id (str): The device id.
+		Returns:
+			bool: True if the member owns the device.
+		"""
+		return self.ring.owner(device_id) == self.member
@@ -0,0 +1,304 @@
+import argparse
+import cProfile
+import glob
+import json
+import logging
+import logging.handlers
+import math
+import pstats
+import random
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+# Stages of the processing of a message, in order
+STAGES = ("decode", "conversion", "lookup", "evaluation", "publish", "log")
+
+# Only one cProfile can be active in the process (from Python 3.12 it is
+# global), so the sampling of all the profilers is serialised
+_PROFILING = threading.Lock()
+
+class MessageTrace:
+	"""
+	Wall time of each stage of the processing of a message.
+	"""
+	__slots__ = ('device_id', 'start', 'last', 'stages', 'profile')
+
+	def __init__(self, device_id: str, profile: Optional[cProfile.Profile] = None):
+		self.device_id = device_id
+		self.start = time.perf_counter()
+		self.last = self.start
+		self.stages: Dict[str, float] = {}
+		self.profile = profile
+
+	def mark(self, stage: str) -> None:
+		"""
+		End a stage: the time since the end of the previous one is added to it.
+		Args:
+			stage (str): The stage name.
+		"""
+		now = time.perf_counter()
+		self.stages[stage] = self.stages.get(stage, 0.0) + now - self.last
+		self.last = now
+
+class MessageProfiler:
+	"""
+	Profiler of the messages processed by the controller: records the
+	wall time of each stage of every message, and a cProfile of a
+	fraction of them, as JSON lines in a rotating file. The file is
+	summarised offline with `python -m controller.profiler <file>`.
+
+	Only one message is profiled with cProfile at a time (in the whole
+	process); the others sampled meanwhile only have their stages
+	recorded. The messages sampled while other profiler is active (like
+	`python -m cProfile`) are not profiled either.
+	"""
+	def __init__(
+		self,
+		path: str,
+		sample_rate: float = 0.01,
+		max_bytes: int = 10 * 1024 * 1024,
+		backups: int = 3,
+		top_functions: int = 20
+	):
+		"""
+		Constructor of the MessageProfiler class.
+		Args:
+			path (str): File where the traces are written.
+			sample_rate (float): Fraction of the messages profiled with cProfile.
+			max_bytes (int): Size of the file when it is rotated.
+			backups (int): Rotated files that are kept (path.1, path.2...).
+			top_functions (int): Functions saved of each profile (by cumulative time).
+		"""
+		# Save the params
+		self.path = path
+		self.sample_rate = sample_rate
+		self.top_functions = top_functions
+
+		# Rotating file, with its own logger (not the global ones)
+		self._handler = logging.handlers.RotatingFileHandler(
+			path,
+			maxBytes=max_bytes,
+			backupCount=backups
+		)
+		self._handler.setFormatter(logging.Formatter("%(message)s"))
+		self._logger = logging.Logger(f"controller.profiler.{id(self)}")
+		self._logger.addHandler(self._handler)
+		self._logger.propagate = False
+
+		self._random = random.Random()
+
+		# Counters
+		self.recorded = 0
+		self.profiled = 0
+		self.skipped = 0
+
+	def start(self, device_id: str) -> MessageTrace:
+		"""
+		Start the trace of a message (profiled, if it is sampled).
+		Args:
+			device_id (str): The device that sent the message.
+		Returns:
+			MessageTrace: The trace of the message.
+		"""
+		profile = None
+		if self.sample_rate > 0 and self._random.random() < self.sample_rate:
+			if _PROFILING.acquire(blocking=False):
+				profile = cProfile.Profile()
+				try:
+					profile.enable()
+				except ValueError:
+					# Other profiler is active
+					_PROFILING.release()
+					profile = None
+			if profile is None:
+				self.skipped += 1
+		return MessageTrace(device_id, profile)
+
+	def finish(self, trace: MessageTrace) -> None:
+		"""
+		End the trace of a message, and write it.
+		Args:
+			trace (MessageTrace): The trace of the message.
+		"""
+		total = time.perf_counter() - trace.start
+		record: Dict[str, Any] = {
+			"time": time.time(),
+			"device": trace.device_id,
+			"total": total,
+			"stages": trace.stages,
+		}
+
+		# Functions with more cumulative time in the profile
+		if trace.profile is not None:
+			trace.profile.disable()
+			_PROFILING.release()
+			record["profile"] = self._top_functions(trace.profile)
+			self.profiled += 1
+
+		self._logger.info(json.dumps(record))
+		self.recorded += 1
+
+	def close(self) -> None:
+		"""
+		Close the file.
+		"""
+		self._logger.removeHandler(self._handler)
+		self._handler.close()
+
+	def _top_functions(self, profile: cProfile.Profile) -> List[list]:
+		"""
+		Get the functions of a profile with more cumulative time.
+		Args:
+			profile (cProfile.Profile): The profile of a message.
+		Returns:
+			List[list]: The calls, own time, cumulative time and name of each function.
+		"""
+		stats = pstats.Stats(profile).stats
+		functions = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)
+		return [
+			[calls, own, cumulative, pstats.func_std_string(function)]
+			for function, (_, calls, own, cumulative, _) in functions[:self.top_functions]
+		]
+
+def read_traces(path: str) -> List[Dict[str, Any]]:
+	"""
+	Function to read the traces of a file, and of its rotated files.
+	Args:
+		path (str): The file of the profiler.
+	Returns:
+		List[Dict[str, Any]]: The traces, from the oldest to the newest.
+	"""
+	rotated = [
+		name for name in glob.glob(glob.escape(path) + ".*")
+		if name[len(path) + 1:].isdigit()
+	]
+	rotated.sort(key=lambda name: int(name[len(path) + 1:]), reverse=True)
+
+	traces = []
+	for name in rotated + [path]:
+		with open(name) as file:
+			for line in file:
+				line = line.strip()
+				if not line:
+					continue
+				try:
+					traces.append(json.loads(line))
+				except json.JSONDecodeError:
+					# A line cut when the file was being written
+					continue
+	return traces
+
+def _percentile(values: List[float], fraction: float) -> float:
+	"""
+	Function to get a percentile of some sorted values.
+	Args:
+		values (List[float]): The values, sorted.
+		fraction (float): The percentile, between 0 and 1.
+	Returns:
+		float: The value of the percentile (nearest rank).
+	"""
+	index = max(0, min(len(values) - 1, math.ceil(fraction * len(values)) - 1))
+	return values[index]
+
+def summarize(traces: List[Dict[str, Any]], top: int = 10) -> Dict[str, Any]:
+	"""
+	Function to summarise the traces of the profiler.
+	Args:
+		traces (List[Dict[str, Any]]): The traces.
+		top (int): Number of slowest messages in the report.
+	Returns:
+		Dict[str, Any]: The number of messages, the statistics (count,
+			mean, p50, p99 and max seconds) of the total and of each
+			stage, and the slowest messages.
+	"""
+	times: Dict[str, List[float]] = {"total": []}
+	for trace in traces:
+		times["total"].append(trace["total"])
+		for stage, seconds in trace["stages"].items():
+			times.setdefault(stage, []).append(seconds)
+
+	# Known stages in order, then the others
+	order = ["total"] + [stage for stage in STAGES if stage in times]
+	order += sorted(stage for stage in times if stage not in order)
+
+	stages = {}
+	for stage in order:
+		values = sorted(times[stage])
+		if not values:
+			continue
+		stages[stage] = {
+			"count": len(values),
+			"mean": sum(values) / len(values),
+			"p50": _percentile(values, 0.50),
+			"p99": _percentile(values, 0.99),
+			"max": values[-1],
+		}
+
+	return {
+		"messages": len(traces),
+		"stages": stages,
+		"slowest": sorted(traces, key=lambda trace: trace["total"], reverse=True)[:top],
+	}
+
+def format_summary(summary: Dict[str, Any], functions: int = 5) -> str:
+	"""
+	Function to format the summary of the traces as text.
+	Args:
+		summary (Dict[str, Any]): The summary, from `summarize`.
+		functions (int): Functions shown of each profiled message.
+	Returns:
+		str: The report.
+	"""
+	lines = [f"Messages: {summary['messages']}", ""]
+
+	# Statistics of each stage (in microseconds)
+	lines.append(f"{'stage':<12}{'count':>10}{'mean':>12}{'p50':>12}{'p99':>12}{'max':>12}")
+	for stage, stats in summary["stages"].items():
+		lines.append(
+			f"{stage:<12}{stats['count']:>10}"
+			+ "".join(f"{stats[name] * 1e6:>10.1f}us" for name in ("mean", "p50", "p99", "max"))
+		)
+
+	# Slowest messages, with their stages and profile
+	lines.append("")
+	lines.append(f"Slowest {len(summary['slowest'])} messages:")
+	for trace in summary["slowest"]:
+		moment = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(trace["time"]))
+		stages = ", ".join(
+			f"{stage}={seconds * 1e6:.1f}us" for stage, seconds in trace["stages"].items()
+		)
+		lines.append(f"  {moment} {trace['device']}: {trace['total'] * 1e6:.1f}us ({stages})")
+		for calls, own, cumulative, function in trace.get("profile", [])[:functions]:
+			lines.append(f"      {cumulative * 1e6:>10.1f}us {calls:>6} {function}")
+	return "\n".join(lines)
+
+def main():
+	"""
+	Main function of the script: report of a profiler file.
+	"""
+	params = argparse.ArgumentParser(
+		description="Report of the messages profiled by the IOT Controller"
+	)
+	params.add_argument(
+		"file",
+		help="File of the profiler (its rotated files are also read)"
+	)
+	params.add_argument(
+		"--top", type=int, default=10,
+		help="Number of slowest messages in the report (default: %(default)s)"
+	)
+	params.add_argument(
+		"--functions", type=int, default=5,
+		help="Functions shown of each profiled message (default: %(default)s)"
+	)
+	parsed = params.parse_args()
+
+	if parsed.top < 0 or parsed.functions < 0:
+		params.error("The number of messages and functions must be greater or equal than 0")
+
+	print(format_summary(summarize(read_traces(parsed.file), parsed.top), parsed.functions))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,402 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, NamedTuple, Optional
+from .compiled_rule import CompiledRule, rule_version
+from .rule_set import RuleSet, EMPTY_RULE_SET
+from .database_communication import (
+	create_connection,
+	get_rule,
+	get_rules,
+	get_all_rules,
+	get_rule_versions,
+	get_data_version,
+	create_change_counters,
+	get_change_counter
+)
+
+class LoadedRule(NamedTuple):
+	"""
+	Rule of the index that is not in memory (LRU mode): its version, and
+	what the state kept for it by the controller depends on.
+	"""
+	version: Any
+	source_device_id: str
+	aggregate: Optional[str]
+	window: float
+
+class RuleIndex:
+	"""
+	In-memory index of the compiled rules, keyed by the source device id.
+
+	By default all the rules are loaded once, and they are only read
+	again when the rules table changes. To detect it, the SQLite
+	data version (that changes when another connection commits) is
+	checked at most once every `check_interval` seconds, and only if
+	it has changed, the change counter of the rules table is read (kept
+	by triggers, so the rules updated without changing `updated_at` are
+	also read again, and the writes of the logs do not reload them).
+
+	If `max_devices` is set, the rules are not preloaded: they are read
+	on demand, and only the rules of the `max_devices` most recently
+	used devices are kept (LRU). The devices without rules are saved in
+	a separate negative cache, so they do not evict real entries.
+
+	If `device_filter` is set, only the rules of the devices accepted
+	by it are loaded (the partition of the controller process).
+
+	A single rule can also be read again (`update_rule`, when a change
+	notice is received), which only rebuilds the rules of its devices.
+
+	With `check_inline` False, the changes are not checked by `get`, but
+	only when `check_changes` is called (by a background task, so the
+	readers never read the database to check them).
+
+	If `on_reload` is set, it is called with the loaded rules (by id, a
+	`CompiledRule`, or a `LoadedRule` in LRU mode) and the ids of the
+	rules that can have changed (None: all of them) when they change,
+	so the state kept for them elsewhere can be forgotten when they are
+	updated, deleted or filtered out.
+	"""
+	def __init__(
+		self,
+		database: str,
+		max_devices: Optional[int] = None,
+		check_interval: float = 1.0,
+		device_filter: Optional[Callable[[str], bool]] = None,
+		latency: Optional[Any] = None,
+		on_reload: Optional[Callable[[Dict[int, Any], Optional[Iterable[int]]], None]] = None,
+		check_inline: bool = True
+	):
+		"""
+		Constructor of the RuleIndex class.
+		Args:
+			database (str): Path to the database file.
+			max_devices (int): Max number of devices to keep in memory.
+				If None, all the rules are preloaded.
+			check_interval (float): Min seconds between two checks
+				of the database changes.
+			device_filter (Callable[[str], bool]): Function that returns
+				if the rules of a device have to be loaded.
+			latency (Histogram): Metric where the time of each read of
+				the database (rules of a device, or check of the changes)
+				is observed.
+			on_reload (Callable[[Dict[int, Any], Optional[Iterable[int]]], None]):
+				Function called with the loaded rules, by id, and the ids
+				of the ones that can have changed, when they change.
+			check_inline (bool): If `get` checks the changes (False: only
+				`check_changes` does).
+		"""
+		# Save the params
+		self.database = database
+		self.max_devices = max_devices
+		self.check_interval = check_interval
+		self.device_filter = device_filter
+		self.latency = latency
+		self.on_reload = on_reload
+		self.check_inline = check_inline
+
+		# Own connection, shared by all the threads through the lock
+		self._lock = threading.Lock()
+		self._connection = create_connection(
+			database,
+			check_same_thread=False
+		)
+		create_change_counters(self._connection)
+
+		# Rules by device, and devices without rules (LRU mode)
+		self._rules: Dict[str, RuleSet] = OrderedDict()
+		self._no_rules = set()
+
+		# Compiled rules by id (preloaded mode), reused while not updated
+		self._compiled: Dict[int, CompiledRule] = {}
+
+		# State used to detect the changes
+		self._data_version = None
+		self._fingerprint = None
+		self._next_check = 0.0
+
+		# Load the rules
+		with self._lock:
+			self._refresh()
+			self._next_check = time.monotonic() + check_interval
+
+	@property
+	def preloaded(self) -> bool:
+		"""
+		Returns if all the rules are kept in memory.
+		"""
+		return self.max_devices is None
+
+	def get(self, device_id: str) -> RuleSet:
+		"""
+		Get the rules whose source is the device.
+		Args:
+			device_id (str): The source device id.
+		Returns:
+			RuleSet: The rules of the device (empty if it has none).
+		"""
+		# Reload the rules if they have changed
+		if self.check_inline and time.monotonic() >= self._next_check:
+			self._check_changes()
+
+		# Preloaded: a device that is not in the index has no rules
+		if self.preloaded:
+			return self._rules.get(device_id, EMPTY_RULE_SET)
+
+		with self._lock:
+			# Cached device (or not accepted by the filter)
+			if device_id in self._no_rules:
+				return EMPTY_RULE_SET
+			if self.device_filter is not None and not self.device_filter(device_id):
+				return EMPTY_RULE_SET
+			rules = self._rules.get(device_id)
+			if rules is not None:
+				self._rules.move_to_end(device_id)
+				return rules
+
+			# Read the rules of the device
+			start = time.perf_counter()
+			rules = RuleSet(
+				CompiledRule(row)
+				for row in get_rules(device_id, self._connection)
+			)
+			if self.latency is not None:
+				self.latency.observe(time.perf_counter() - start)
+			if not rules:
+				if len(self._no_rules) >= self.max_devices:
+					self._no_rules.clear()
+				self._no_rules.add(device_id)
+				return rules
+
+			# Save it, removing the least recently used device
+			self._rules[device_id] = rules
+			if len(self._rules) > self.max_devices:
+				self._rules.popitem(last=False)
+			return rules
+
+	def cached(self, device_id: str) -> Optional[RuleSet]:
+		"""
+		Get the rules of a device if they are in memory, without reading
+		the database or waiting for other thread that reads it.
+		Args:
+			device_id (str): The source device id.
+		Returns:
+			RuleSet: The rules of the device, or None if they have to be
+				read with `get`.
+		"""
+		if self.preloaded:
+			return self._rules.get(device_id, EMPTY_RULE_SET)
+		if not self._lock.acquire(blocking=False):
+			return None
+		try:
+			if device_id in self._no_rules:
+				return EMPTY_RULE_SET
+			if self.device_filter is not None and not self.device_filter(device_id):
+				return EMPTY_RULE_SET
+			rules = self._rules.get(device_id)
+			if rules is not None:
+				self._rules.move_to_end(device_id)
+			return rules
+		finally:
+			self._lock.release()
+
+	def check_changes(self) -> None:
+		"""
+		Check now if the rules have changed, and reload them if needed.
+		"""
+		self._check_changes(force=True)
+
+	def invalidate(self) -> None:
+		"""
+		Force the rules to be read again from the database.
+		"""
+		with self._lock:
+			self._fingerprint = None
+			self._refresh()
+
+	def update_rule(self, rule_id: int) -> None:
+		"""
+		Read again a rule that has been created, updated or deleted, and
+		update only the rules of its source device (and of the previous
+		one, if it has changed).
+		Args:
+			rule_id (int): The rule id.
+		"""
+		with self._lock:
+			start = time.perf_counter()
+			row = get_rule(rule_id, self._connection)
+
+			# Devices whose rules change
+			devices = set()
+			if row is not None:
+				devices.add(row['source_device_id'])
+			previous = self._compiled.get(rule_id)
+			if previous is not None:
+				devices.add(previous.source_device_id)
+			elif not self.preloaded:
+				devices.update(
+					device_id for device_id, rules in self._rules.items()
+					if any(rule.id == rule_id for rule in rules)
+				)
+
+			for device_id in devices:
+				# LRU mode: they are read again when they are used
+				if not self.preloaded:
+					self._rules.pop(device_id, None)
+					self._no_rules.discard(device_id)
+				elif self.device_filter is None or self.device_filter(device_id):
+					self._load_device(device_id)
+			if self.latency is not None:
+				self.latency.observe(time.perf_counter() - start)
+
+			# Only the rule has changed
+			if self.on_reload is not None:
+				rules = {}
+				if self.preloaded:
+					if rule_id in self._compiled:
+						rules[rule_id] = self._compiled[rule_id]
+				elif row is not None and (
+					self.device_filter is None or self.device_filter(row['source_device_id'])
+				):
+					rules[rule_id] = self._loaded(row, rule_version(row))
+				self.on_reload(rules, (rule_id,))
+
+	def set_device_filter(self, device_filter: Optional[Callable[[str], bool]]) -> None:
+		"""
+		Change the devices whose rules are loaded, and reload them.
+		Args:
+			device_filter (Callable[[str], bool]): Function that returns
+				if the rules of a device have to be loaded.
+		"""
+		with self._lock:
+			self.device_filter = device_filter
+			self._fingerprint = None
+			self._refresh()
+
+	def close(self) -> None:
+		"""
+		Close the connection with the database.
+		"""
+		with self._lock:
+			self._connection.close()
+
+	def _check_changes(self, force: bool = False) -> None:
+		"""
+		Check if the rules have changed, and reload them if needed.
+		Args:
+			force (bool): If the check interval is ignored.
+		"""
+		with self._lock:
+			# Other thread could have made the check
+			now = time.monotonic()
+			if now < self._next_check and not force:
+				return
+			self._next_check = now + self.check_interval
+
+			start = time.perf_counter()
+			try:
+				# Nothing has been committed by other connections
+				data_version = get_data_version(self._connection)
+				if data_version == self._data_version:
+					return
+				self._data_version = data_version
+
+				# Something has changed, but maybe not the rules
+				self._refresh()
+			finally:
+				if self.latency is not None:
+					self.latency.observe(time.perf_counter() - start)
+
+	def _refresh(self) -> None:
+		"""
+		Reload the rules if the rules table fingerprint has changed.
+		The caller must hold the lock.
+		"""
+		if self._data_version is None:
+			self._data_version = get_data_version(self._connection)
+
+		fingerprint = get_change_counter(self._connection, 'rules')
+		if fingerprint == self._fingerprint:
+			return
+		self._fingerprint = fingerprint
+
+		# LRU mode: forget everything, it will be read on demand
+		if not self.preloaded:
+			self._rules = OrderedDict()
+			self._no_rules = set()
+			self._notify_reload()
+			return
+
+		# Preloaded mode: build the new index and swap it
+		rules = {}
+		compiled = {}
+		for row in get_all_rules(self._connection):
+			if self.device_filter is not None \
+					and not self.device_filter(row['source_device_id']):
+				continue
+			rule = self._compiled.get(row['id'])
+			if rule is None or rule.version != rule_version(row):
+				rule = CompiledRule(row)
+			compiled[rule.id] = rule
+			rules.setdefault(rule.source_device_id, []).append(rule)
+		self._compiled = compiled
+		self._rules = {
+			device_id: RuleSet(device_rules)
+			for device_id, device_rules in rules.items()
+		}
+		self._notify_reload()
+
+	def _notify_reload(self) -> None:
+		"""
+		Call `on_reload` with all the rules of the index (the ones in
+		memory when preloaded, or read from the database).
+		The caller must hold the lock.
+		"""
+		if self.on_reload is None:
+			return
+		if self.preloaded:
+			rules = self._compiled
+		else:
+			rules = {
+				row['id']: self._loaded(row, (row['updated_at'], row['checksum']))
+				for row in get_rule_versions(self._connection)
+				if self.device_filter is None or self.device_filter(row['source_device_id'])
+			}
+		self.on_reload(rules, None)
+
+	@staticmethod
+	def _loaded(row: Any, version: Any) -> LoadedRule:
+		"""
+		Build the `LoadedRule` of a row of a rule.
+		"""
+		return LoadedRule(version, row['source_device_id'], row['aggregate'] or None, row['window'])
+
+	def _load_device(self, device_id: str) -> None:
+		"""
+		Read again the rules of a device (preloaded mode).
+		The caller must hold the lock.
+		Args:
+			device_id (str): The source device id.
+		"""
+		previous = self._rules.get(device_id, ())
+		rules = []
+		for row in sorted(get_rules(device_id, self._connection), key=lambda row: row['id']):
+			rule = self._compiled.get(row['id'])
+			if rule is None or rule.version != rule_version(row) \
+					or rule.source_device_id != device_id:
+				rule = CompiledRule(row)
+			self._compiled[rule.id] = rule
+			rules.append(rule)
+
+		# Forget the rules that are no longer of the device (deleted, or moved)
+		ids = {rule.id for rule in rules}
+		for rule in previous:
+			if rule.id not in ids and self._compiled.get(rule.id) is rule:
+				del self._compiled[rule.id]
+
+		# The readers do not hold the lock: the set of the device is replaced
+		if rules:
+			self._rules[device_id] = RuleSet(rules)
+		else:
+			self._rules.pop(device_id, None)
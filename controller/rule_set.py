@@ -0,0 +1,257 @@
+import bisect
+from typing import Any, Dict, List, Optional, Tuple
+from .compiled_rule import (
+	EDGE_TRIGGERS,
+	CompiledRule,
+	InvalidThresholdError,
+	InvalidOperatorError
+)
+
+# Below this number of rules, they are checked one by one
+INDEX_MIN_RULES = 8
+
+# Operators solved with the sorted thresholds
+ORDERED_OPERATORS = ('>', '>=', '<', '<=')
+
+class _VariableIndex:
+	"""
+	Index of the rules of a device for one variable of the messages.
+
+	Only the rules before the first one that can not be evaluated (bad
+	threshold or operator) are indexed, as the rules after it are never
+	checked. The positions of the rules are kept, to return the matches
+	in the same order as the rules.
+	"""
+	__slots__ = (
+		'error',
+		'thresholds',
+		'positions',
+		'equal',
+		'not_equal',
+		'not_equal_by_threshold',
+		'linear',
+	)
+
+	def __init__(self, rules: Tuple[CompiledRule, ...], key: str):
+		"""
+		Constructor of the _VariableIndex class.
+		Args:
+			rules (Tuple[CompiledRule, ...]): The rules of the device.
+			key (str): The variable of the messages.
+		"""
+		# Error that stops the evaluation (after the indexed rules)
+		self.error: Optional[ValueError] = None
+
+		# Sorted thresholds, and the rule positions, of each ordered operator
+		ordered: Dict[str, List[Tuple[Any, int]]] = {
+			operator: [] for operator in ORDERED_OPERATORS
+		}
+
+		# Rule positions by threshold, of the equality operators
+		self.equal: Dict[Any, List[int]] = {}
+		self.not_equal: List[int] = []
+		self.not_equal_by_threshold: Dict[Any, List[int]] = {}
+
+		# Rules that can not be sorted (NaN threshold), as (position, rule, threshold)
+		self.linear: List[Tuple[int, CompiledRule, Any]] = []
+
+		for position, rule in enumerate(rules):
+			# The same checks, in the same order, as `CompiledRule.evaluate`
+			try:
+				threshold = rule.get_threshold(key)
+			except InvalidThresholdError:
+				self.error = InvalidThresholdError("Invalid threshold format")
+				break
+			if rule.compare is None:
+				self.error = InvalidOperatorError("Invalid operator")
+				break
+
+			# The rules with an aggregate are checked with their window
+			if rule.aggregate is not None:
+				continue
+			if threshold != threshold:
+				self.linear.append((position, rule, threshold))
+			elif rule.operator == '==':
+				self.equal.setdefault(threshold, []).append(position)
+			elif rule.operator == '!=':
+				self.not_equal.append(position)
+				self.not_equal_by_threshold.setdefault(threshold, []).append(position)
+			else:
+				ordered[rule.operator].append((threshold, position))
+
+		self.thresholds: Dict[str, List[Any]] = {}
+		self.positions: Dict[str, List[int]] = {}
+		for operator, items in ordered.items():
+			items.sort(key=lambda item: item[0])
+			self.thresholds[operator] = [threshold for threshold, _ in items]
+			self.positions[operator] = [position for _, position in items]
+
+	def match(self, value: Any) -> List[int]:
+		"""
+		Get the positions of the rules whose condition is met.
+		Args:
+			value (Any): The converted value of the variable (not NaN).
+		Returns:
+			List[int]: The positions, not sorted.
+		"""
+		thresholds = self.thresholds
+		positions = self.positions
+
+		# value > threshold: the thresholds lower than the value
+		matches = positions['>'][:bisect.bisect_left(thresholds['>'], value)]
+		matches += positions['>='][:bisect.bisect_right(thresholds['>='], value)]
+
+		# value < threshold: the thresholds greater than the value
+		matches += positions['<'][bisect.bisect_right(thresholds['<'], value):]
+		matches += positions['<='][bisect.bisect_left(thresholds['<='], value):]
+
+		# Equality: the rules of the threshold, or all but them
+		matches += self.equal.get(value, ())
+		if self.not_equal:
+			excluded = self.not_equal_by_threshold.get(value)
+			if excluded:
+				excluded = set(excluded)
+				matches += [p for p in self.not_equal if p not in excluded]
+			else:
+				matches += self.not_equal
+
+		# Thresholds that can not be sorted
+		for position, rule, threshold in self.linear:
+			if rule.compare(value, threshold):
+				matches.append(position)
+		return matches
+
+class RuleSet(tuple):
+	"""
+	Rules of a source device (a tuple of compiled rules), that finds
+	the rules that match a message without checking all of them.
+
+	For each variable of the messages, the thresholds are indexed the
+	first time that the variable is seen:
+		· `<`, `<=`, `>` and `>=`: sorted thresholds, where a bisect
+		  finds the rules that match.
+		· `==` and `!=`: the rules by threshold, found with a lookup.
+	So a message costs O(log n + matches), instead of O(n). The result
+	is the same as checking the rules one by one, in order.
+
+	The rules of other variables (whose threshold is of other type, see
+	`CompiledRule.applies`) are left out with `of_variable`, so a message
+	with several variables only checks each one with its rules.
+
+	The rules that are not level triggered are also kept apart (with
+	their positions), as their state has to be checked on each message,
+	and so are the rules with an aggregate, that are not matched here
+	but with their windows (`WindowStore.match`), and the rules with a
+	duration, that are applied by their timers (`DurationConditions`).
+	"""
+	def __init__(self, rules=()):
+		super().__init__()
+		self._indexes: Dict[str, _VariableIndex] = {}
+		self._stops: Dict[str, int] = {}
+		self._variables: Dict[str, "RuleSet"] = {}
+
+		# Rules that are not level triggered, as (position, rule)
+		self.edges: Tuple[Tuple[int, CompiledRule], ...] = tuple(
+			(position, rule)
+			for position, rule in enumerate(self)
+			if rule.trigger in EDGE_TRIGGERS and not rule.duration
+		)
+
+		# Rules with an aggregate of a window, as (position, rule)
+		self.windowed: Tuple[Tuple[int, CompiledRule], ...] = tuple(
+			(position, rule)
+			for position, rule in enumerate(self)
+			if rule.aggregate is not None
+		)
+
+		# Rules with a duration, as (position, rule)
+		self.durations: Tuple[Tuple[int, CompiledRule], ...] = tuple(
+			(position, rule)
+			for position, rule in enumerate(self)
+			if rule.duration
+		)
+
+		# Positions of the rules by id (to sort them, with the edge and windowed rules)
+		self.positions: Dict[int, int] = (
+			{rule.id: position for position, rule in enumerate(self)}
+			if self.edges or self.windowed else {}
+		)
+
+	def of_variable(self, key: str) -> "RuleSet":
+		"""
+		Get the rules of a variable, in order.
+		Args:
+			key (str): The variable of the message.
+		Returns:
+			RuleSet: The rules (itself, if all of them are of the variable).
+		"""
+		rules = self._variables.get(key)
+		if rules is None:
+			rules = tuple(rule for rule in self if rule.applies(key))
+			rules = self if len(rules) == len(self) else RuleSet(rules)
+			self._variables[key] = rules
+		return rules
+
+	def match(self, key: str, value: Any) -> Tuple[List[CompiledRule], Optional[ValueError]]:
+		"""
+		Get the rules whose condition is met by a value, in order (the
+		rules with an aggregate are not included).
+		Args:
+			key (str): The variable of the message.
+			value (Any): The converted value of the variable.
+		Returns:
+			Tuple[List[CompiledRule], Optional[ValueError]]: The rules that
+				match, and the error of the first rule that can not be
+				evaluated (the rules after it are not checked), if any.
+		"""
+		# Few rules, or a value that can not be compared in order (NaN)
+		if len(self) < INDEX_MIN_RULES or value != value:
+			return self._match_linear(key, value)
+
+		index = self._indexes.get(key)
+		if index is None:
+			index = _VariableIndex(self, key)
+			self._indexes[key] = index
+
+		positions = index.match(value)
+		positions.sort()
+		return [self[position] for position in positions], index.error
+
+	def stop(self, key: str) -> int:
+		"""
+		Get the position of the first rule that can not be evaluated for
+		a variable (the rules from it are never checked).
+		Args:
+			key (str): The variable of the message.
+		Returns:
+			int: The position, or the number of rules if all are valid.
+		"""
+		stop = self._stops.get(key)
+		if stop is None:
+			stop = len(self)
+			for position, rule in enumerate(self):
+				try:
+					rule.check(key)
+				except ValueError:
+					stop = position
+					break
+			self._stops[key] = stop
+		return stop
+
+	def _match_linear(self, key: str, value: Any) -> Tuple[List[CompiledRule], Optional[ValueError]]:
+		"""
+		Check the rules one by one, as `match`.
+		"""
+		matches = []
+		for rule in self:
+			try:
+				if rule.aggregate is not None:
+					rule.check(key)
+				elif rule.evaluate(key, value):
+					matches.append(rule)
+			except ValueError as e:
+				return matches, e
+		return matches, None
+
+# Rules of the devices without rules
+EMPTY_RULE_SET = RuleSet()
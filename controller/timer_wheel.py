@@ -0,0 +1,166 @@
+import math
+import threading
+import time
+import traceback
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+class TimerWheel:
+	"""
+	Hashed timer wheel: the timers are kept in a ring of `slots` buckets
+	of `tick` seconds, and the bucket of a timer is the tick of its
+	deadline modulo the number of slots (a timer longer than a turn is
+	skipped until its turn). So scheduling and cancelling a timer are
+	O(1), and each tick only checks one bucket, whatever the number of
+	timers.
+
+	All the timers are run by a single thread, that sleeps while there
+	are no timers. A timer is identified by a key: scheduling a key again
+	replaces its timer. The callbacks are called from that thread, so
+	they must be short and thread safe.
+	"""
+	def __init__(
+		self,
+		tick: float = 0.1,
+		slots: int = 1024,
+		name: str = "timer-wheel",
+		debug: bool = False
+	):
+		"""
+		Constructor of the TimerWheel class.
+		Args:
+			tick (float): Seconds of each bucket (the resolution of the timers).
+			slots (int): Number of buckets.
+			name (str): Name of the thread.
+			debug (bool): Debug mode.
+		"""
+		# Save the params
+		self.tick = tick
+		self.slots = slots
+		self.name = name
+		self.debug = debug
+
+		# Timers of each bucket, as key: (deadline tick, callback, args), and bucket of each key
+		self._buckets: List[Dict[Hashable, Tuple[int, Callable[..., Any], tuple]]] = [
+			{} for _ in range(slots)
+		]
+		self._slots: Dict[Hashable, int] = {}
+
+		# Next tick to run
+		self._origin = time.monotonic()
+		self._current = 0
+
+		self._condition = threading.Condition()
+		self._running = False
+		self._thread: Optional[threading.Thread] = None
+
+	def __len__(self):
+		return len(self._slots)
+
+	def __contains__(self, key: Hashable) -> bool:
+		return key in self._slots
+
+	def start(self) -> None:
+		"""
+		Start the thread that runs the timers.
+		"""
+		self._running = True
+		self._thread = threading.Thread(
+			target=self._run,
+			name=self.name,
+			daemon=True
+		)
+		self._thread.start()
+
+	def stop(self, timeout: Optional[float] = None) -> None:
+		"""
+		Stop the thread (the pending timers are not run).
+		Args:
+			timeout (float): Max seconds to wait for the thread.
+		"""
+		with self._condition:
+			self._running = False
+			self._condition.notify()
+		if self._thread is not None:
+			self._thread.join(timeout)
+
+	def schedule(self, key: Hashable, delay: float, callback: Callable[..., Any], *args) -> None:
+		"""
+		Schedule a timer (replacing the one of the key, if any).
+		Args:
+			key (Hashable): Key of the timer.
+			delay (float): Seconds until the callback is called.
+			callback (Callable): Function called with the args.
+		"""
+		with self._condition:
+			# Idle wheel: it continues from now
+			idle = not self._slots
+			if idle:
+				self._current = self._ticks(time.monotonic())
+			deadline = max(self._ticks(time.monotonic() + delay), self._current)
+
+			self._remove(key)
+			slot = deadline % self.slots
+			self._buckets[slot][key] = (deadline, callback, args)
+			self._slots[key] = slot
+			if idle:
+				self._condition.notify()
+
+	def cancel(self, key: Hashable) -> bool:
+		"""
+		Cancel a timer.
+		Args:
+			key (Hashable): Key of the timer.
+		Returns:
+			bool: True if it was pending.
+		"""
+		with self._condition:
+			return self._remove(key)
+
+	def _ticks(self, timestamp: float) -> int:
+		"""
+		Returns the first tick that starts at or after a time.
+		"""
+		return math.ceil((timestamp - self._origin) / self.tick)
+
+	def _remove(self, key: Hashable) -> bool:
+		"""
+		Remove a timer. The caller must hold the lock.
+		"""
+		slot = self._slots.pop(key, None)
+		if slot is None:
+			return False
+		del self._buckets[slot][key]
+		return True
+
+	def _run(self) -> None:
+		"""
+		Loop that runs the bucket of each tick when it starts.
+		"""
+		while True:
+			with self._condition:
+				# Sleep until a timer is scheduled
+				while self._running and not self._slots:
+					self._condition.wait()
+				if not self._running:
+					return
+
+				# Wait for the start of the tick
+				remaining = self._origin + self._current * self.tick - time.monotonic()
+				if remaining > 0:
+					self._condition.wait(remaining)
+					continue
+
+				# Take the timers of the bucket whose turn has come
+				bucket = self._buckets[self._current % self.slots]
+				due = [key for key, timer in bucket.items() if timer[0] <= self._current]
+				timers = [bucket.pop(key) for key in due]
+				for key in due:
+					del self._slots[key]
+				self._current += 1
+
+			for _, callback, args in timers:
+				try:
+					callback(*args)
+				except Exception:
+					if self.debug:
+						traceback.print_exc()
@@ -0,0 +1,116 @@
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple
+from .compiled_rule import (
+	EDGE_TRIGGERS,
+	FALLING,
+	HYSTERESIS,
+	CompiledRule
+)
+from .rule_set import RuleSet
+
+class RuleTriggers:
+	"""
+	Last truth value of the rules that are not level triggered, so they
+	are only applied on the transitions:
+		· Rising: when the condition starts to be met.
+		· Falling: when the condition stops being met.
+		· Hysteresis: when the condition starts to be met, but it is
+		  not applied again until the value goes back over the
+		  threshold by the hysteresis band.
+	The level triggered rules (and the ones with an unknown trigger)
+	are applied on every message that meets the condition, as before.
+
+	The state is kept in memory by rule id, and it is reset when the
+	rule is updated. All the messages of a device are processed by the
+	same thread, so each state is only changed by one thread. The state
+	of the rules that are updated, deleted or no longer loaded is
+	forgotten with `prune`, when the rules are reloaded.
+	"""
+	def __init__(self):
+		"""
+		Constructor of the RuleTriggers class.
+		"""
+		# Version and active state, by rule id
+		self._states: Dict[int, Tuple[Any, bool]] = {}
+
+	def __len__(self):
+		return len(self._states)
+
+	def prune(self, rules: Mapping[int, Any], changed: Optional[Iterable[int]] = None) -> None:
+		"""
+		Forget the state of the rules that are not loaded, or that have
+		been updated.
+		Args:
+			rules (Mapping[int, Any]): The loaded rules (with their version), by id.
+			changed (Iterable[int]): The ids of the rules that can have
+				changed (None: all of them).
+		"""
+		for rule_id in (list(self._states) if changed is None else changed):
+			state = self._states.get(rule_id)
+			rule = rules.get(rule_id)
+			if state is not None and (rule is None or rule.version != state[0]):
+				self._states.pop(rule_id, None)
+
+	def is_active(self, rule: CompiledRule) -> bool:
+		"""
+		Check the saved state of a rule.
+		Args:
+			rule (CompiledRule): The rule.
+		Returns:
+			bool: True if the last state of the rule is active.
+		"""
+		state = self._states.get(rule.id)
+		return state is not None and state[0] == rule.version and state[1]
+
+	def select(
+		self,
+		rules: RuleSet,
+		key: str,
+		value: Any,
+		matches: List[CompiledRule]
+	) -> List[CompiledRule]:
+		"""
+		Get the rules that have to be applied for a message, and update
+		the state of the edge triggered rules.
+		Args:
+			rules (RuleSet): The rules of the device.
+			key (str): The variable of the message.
+			value (Any): The converted value of the variable.
+			matches (List[CompiledRule]): The rules whose condition is met.
+		Returns:
+			List[CompiledRule]: The rules to apply, in order.
+		"""
+		# Only level triggered rules
+		if not rules.edges:
+			return matches
+
+		matched = {rule.id for rule in matches}
+		selected = [
+			(rules.positions[rule.id], rule)
+			for rule in matches
+			if rule.trigger not in EDGE_TRIGGERS
+		]
+
+		# The edge rules that have been evaluated (before the first invalid one)
+		stop = rules.stop(key)
+		for position, rule in rules.edges:
+			if position >= stop:
+				break
+
+			previous = self.is_active(rule)
+			condition = rule.id in matched
+			if rule.trigger == HYSTERESIS:
+				active = condition or (previous and not rule.release(key, value))
+				apply = active and not previous
+			elif rule.trigger == FALLING:
+				active = condition
+				apply = previous and not active
+			else:
+				active = condition
+				apply = active and not previous
+
+			self._states[rule.id] = (rule.version, active)
+			if apply:
+				selected.append((position, rule))
+
+		selected.sort(key=lambda item: item[0])
+		return [rule for _, rule in selected]
@@ -0,0 +1,117 @@
+import operator
+from typing import Any
+from datetime import datetime
+
+# Functions of the operators that a rule can use
+OPERATORS = {
+	'>': operator.gt,
+	'<': operator.lt,
+	'==': operator.eq,
+	'!=': operator.ne,
+	'>=': operator.ge,
+	'<=': operator.le,
+}
+
+# Variables with a small set of possible values
+DISCRETE_VARIABLES = frozenset(('state',))
+
+def to_temperature(value: Any) -> float:
+	"""
+	Function to convert a temperature.
+	Args:
+		value (Any): The value of the message (or the threshold).
+	Returns:
+		float: The temperature.
+	"""
+	try:
+		return float(value)
+	except (TypeError, ValueError):
+		raise ValueError("Invalid value for temperature")
+
+def to_seconds(value: Any) -> int:
+	"""
+	Function to convert a time (HH:MM:SS) to the seconds since midnight,
+	so the times are compared as integers.
+	Args:
+		value (Any): The value of the message (or the threshold).
+	Returns:
+		int: The seconds since midnight.
+	"""
+	if not isinstance(value, str):
+		raise ValueError("Invalid value for time")
+
+	# Fast path: two digits for each field
+	if len(value) == 8 and value[2] == ':' and value[5] == ':':
+		hours, minutes, seconds = value[0:2], value[3:5], value[6:8]
+		if hours.isdigit() and minutes.isdigit() and seconds.isdigit() and value.isascii():
+			hours, minutes, seconds = int(hours), int(minutes), int(seconds)
+			if hours < 24 and minutes < 60 and seconds < 60:
+				return hours * 3600 + minutes * 60 + seconds
+			raise ValueError("Invalid value for time")
+
+	# Other formats accepted by strptime (like 8:00:00)
+	try:
+		parsed = datetime.strptime(value, '%H:%M:%S')
+	except ValueError:
+		raise ValueError("Invalid value for time")
+	return parsed.hour * 3600 + parsed.minute * 60 + parsed.second
+
+def to_state(value: Any) -> str:
+	"""
+	Function to check a switch state.
+	Args:
+		value (Any): The value of the message (or the threshold).
+	Returns:
+		str: The state.
+	"""
+	if value != 'ON' and value != 'OFF':
+		raise ValueError("Invalid value for state")
+	return value
+
+# Function that converts the values of each variable
+CONVERTERS = {
+	'temperature': to_temperature,
+	'time': to_seconds,
+	'state': to_state,
+}
+
+# Type of the devices that send each variable
+DEVICE_TYPES = {
+	'temperature': 'sensor',
+	'time': 'clock',
+	'state': 'switch',
+}
+
+def get_correct_value(key: str, value: str) -> Any:
+	"""
+	Function to get the correct value of a variable.
+	Args:
+		key (str): The key of the variable.
+		value (str): The value of the variable.
+	Returns:
+		The correct value of the variable.
+	"""
+	convert = CONVERTERS.get(key)
+	if convert is None:
+		raise ValueError("Invalid key")
+	return convert(value)
+
+def compare_values(
+		value1: Any,
+		value2: Any,
+		operator: str
+) -> bool:
+	"""
+	Function to compare two values.
+	Args:
+		value1 (Any): The first value.
+		value2 (Any): The second value.
+		operator (str): The operator to use for the comparison.
+	Returns:
+		The result of the comparison.
+	"""
+	function = OPERATORS.get(operator)
+	if function is not None:
+		return function(value1, value2)
+
+	raise ValueError("Invalid operator")
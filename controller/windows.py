@@ -0,0 +1,252 @@
+import math
+import time
+from array import array
+from collections import deque
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple
+from .compiled_rule import AVG, MIN, MAX, COUNT, DERIVATIVE, CompiledRule
+from .rule_set import RuleSet
+
+class SlidingWindow:
+	"""
+	Values of a variable received during the last `length` seconds, in
+	a ring buffer of fixed size (two arrays of doubles, with the times
+	and the values), with the statistics updated on each value, so a
+	value costs O(1) (amortized) whatever the length of the window:
+		· A running sum, for the average. It is computed again from the
+		  buffer after `capacity` removals, so the rounding errors do
+		  not accumulate.
+		· Monotonic deques of the positions of the minimum and maximum
+		  candidates.
+		· The first and last values, for the derivative.
+	When more than `capacity` values are received during the window,
+	the oldest ones are dropped (the statistics are of the last ones).
+	"""
+	__slots__ = (
+		'length',
+		'capacity',
+		'_times',
+		'_values',
+		'_start',
+		'_end',
+		'_sum',
+		'_removed',
+		'_mins',
+		'_maxs',
+	)
+
+	def __init__(self, length: float, capacity: int = 256):
+		"""
+		Constructor of the SlidingWindow class.
+		Args:
+			length (float): Seconds of the window.
+			capacity (int): Max values kept.
+		"""
+		self.length = length
+		self.capacity = capacity
+
+		# Ring buffer (the value n is at n % capacity)
+		self._times = array('d', bytes(8 * capacity))
+		self._values = array('d', bytes(8 * capacity))
+		self._start = 0
+		self._end = 0
+
+		# Running sum, and values removed since it was computed
+		self._sum = 0.0
+		self._removed = 0
+
+		# Positions of the values that can be the min (increasing) or the max (decreasing)
+		self._mins = deque()
+		self._maxs = deque()
+
+	def __len__(self):
+		return self._end - self._start
+
+	def add(self, timestamp: float, value: float) -> None:
+		"""
+		Add a value, removing the ones that are out of the window.
+		Args:
+			timestamp (float): Time of the value, in seconds (a time
+				older than the last one is taken as the last one).
+			value (float): The value.
+		"""
+		capacity = self.capacity
+		values = self._values
+		if self._end > self._start:
+			timestamp = max(timestamp, self._times[(self._end - 1) % capacity])
+
+		# Remove the old values (and the oldest one, if it is full)
+		limit = timestamp - self.length
+		while self._start < self._end and (
+			self._times[self._start % capacity] <= limit
+			or self._end - self._start >= capacity
+		):
+			self._remove()
+
+		index = self._end % capacity
+		self._times[index] = timestamp
+		values[index] = value
+		self._sum += value
+
+		# The candidates that are not better than the new value are never the min or max
+		mins = self._mins
+		while mins and values[mins[-1] % capacity] >= value:
+			mins.pop()
+		mins.append(self._end)
+		maxs = self._maxs
+		while maxs and values[maxs[-1] % capacity] <= value:
+			maxs.pop()
+		maxs.append(self._end)
+		self._end += 1
+
+	def aggregate(self, name: str) -> Optional[float]:
+		"""
+		Get an aggregate of the values of the window.
+		Args:
+			name (str): The aggregate (avg, min, max, count or derivative).
+		Returns:
+			float: The aggregate, or None if it can not be computed (no
+				values, or a derivative without two different times).
+		"""
+		count = self._end - self._start
+		if count == 0:
+			return None
+		capacity = self.capacity
+		if name == COUNT:
+			return count
+		if name == AVG:
+			return self._sum / count
+		if name == MIN:
+			return self._values[self._mins[0] % capacity]
+		if name == MAX:
+			return self._values[self._maxs[0] % capacity]
+		if name == DERIVATIVE:
+			first, last = self._start % capacity, (self._end - 1) % capacity
+			elapsed = self._times[last] - self._times[first]
+			if elapsed <= 0:
+				return None
+			return (self._values[last] - self._values[first]) / elapsed * 60
+		return None
+
+	def _remove(self) -> None:
+		"""
+		Remove the oldest value.
+		"""
+		capacity = self.capacity
+		self._sum -= self._values[self._start % capacity]
+		if self._mins[0] == self._start:
+			self._mins.popleft()
+		if self._maxs[0] == self._start:
+			self._maxs.popleft()
+		self._start += 1
+
+		self._removed += 1
+		if self._removed >= capacity:
+			self._removed = 0
+			self._sum = math.fsum(
+				self._values[position % capacity]
+				for position in range(self._start, self._end)
+			)
+
+class WindowStore:
+	"""
+	Sliding windows of the values of the devices, by device, variable
+	and length (the rules with the same window share it). They are only
+	kept for the devices with rules that have an aggregate.
+
+	All the messages of a device are processed by the same thread, so
+	each window is only changed by one thread.
+	"""
+	def __init__(self, capacity: int = 256):
+		"""
+		Constructor of the WindowStore class.
+		Args:
+			capacity (int): Max values kept in each window.
+		"""
+		self.capacity = capacity
+		self._windows: Dict[Tuple[str, str, float], SlidingWindow] = {}
+
+	def __len__(self):
+		return len(self._windows)
+
+	def prune(self, rules: Mapping[int, Any], changed: Optional[Iterable[int]] = None) -> None:
+		"""
+		Forget the windows that no loaded rule uses (the rules have been
+		deleted, their window has changed or their device is in other
+		partition). They are only pruned with all the rules (a change of
+		some of them is followed by a reload of all).
+		Args:
+			rules (Mapping[int, Any]): The loaded rules (with their source
+				device, aggregate and window), by id.
+			changed (Iterable[int]): The ids of the rules that can have
+				changed (None: all of them).
+		"""
+		if changed is not None:
+			return
+		used = {
+			(rule.source_device_id, rule.window)
+			for rule in rules.values()
+			if rule.aggregate
+		}
+		for window_key in list(self._windows):
+			if (window_key[0], window_key[2]) not in used:
+				self._windows.pop(window_key, None)
+
+	def match(
+		self,
+		device_id: str,
+		rules: RuleSet,
+		key: str,
+		value: Any,
+		timestamp: Optional[float],
+		matches: List[CompiledRule]
+	) -> List[CompiledRule]:
+		"""
+		Add a value to the windows of the rules of its device that have
+		an aggregate, and add the ones whose condition is met to the
+		matches of the other rules.
+		Args:
+			device_id (str): The device that sent the value.
+			rules (RuleSet): The rules of the device.
+			key (str): The variable of the message.
+			value (Any): The converted value of the variable.
+			timestamp (float): Time of the value, in seconds since the
+				epoch (None: now).
+			matches (List[CompiledRule]): The rules without an aggregate
+				whose condition is met, in order.
+		Returns:
+			List[CompiledRule]: All the rules whose condition is met, in order.
+		"""
+		# NaN values are not added (they would break the statistics)
+		if value != value:
+			return matches
+		if timestamp is None:
+			timestamp = time.time()
+
+		# Only the numbers are aggregated (the values of the other variables are only counted)
+		if isinstance(value, bool) or not isinstance(value, (int, float)):
+			value = 0.0
+
+		windowed = []
+		updated = set()
+		stop = rules.stop(key)
+		for position, rule in rules.windowed:
+			if position >= stop:
+				break
+
+			# Each window is updated once per value
+			window_key = (device_id, key, rule.window)
+			window = self._windows.get(window_key)
+			if window is None:
+				window = self._windows[window_key] = SlidingWindow(rule.window, self.capacity)
+			if window_key not in updated:
+				window.add(timestamp, value)
+				updated.add(window_key)
+
+			aggregate = window.aggregate(rule.aggregate)
+			if aggregate is not None and rule.compare(aggregate, rule.get_threshold(key)):
+				windowed.append(rule)
+
+		if not windowed:
+			return matches
+		positions = rules.positions
+		return sorted(matches + windowed, key=lambda rule: positions[rule.id])
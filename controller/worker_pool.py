@@ -0,0 +1,155 @@
+import queue
+import threading
+import time
+import traceback
+import zlib
+from typing import Any, Callable, List, Optional
+from .ingress import IngressQueue, BLOCK
+
+# Marker put in the queues to stop the workers
+_STOP = object()
+
+class WorkerPool:
+	"""
+	Pool of threads that process items sharded by a key.
+
+	Each worker has its own bounded queue, and the items are sent to
+	the worker chosen by the hash of their key: the items with the same
+	key (the device id) are processed in order, by the same thread,
+	while the items with different keys are processed in parallel.
+	When the queue of a worker is full, `submit` waits, unless it has
+	another shedding policy. The queues can also conflate the items of
+	each key (see `IngressQueue`), and the discarded items are reported
+	to `on_discard`, with their key and the reason.
+	"""
+	def __init__(
+		self,
+		handler: Callable[[Any], None],
+		workers: int = 4,
+		queue_size: int = 1000,
+		name: str = "worker",
+		debug: bool = False,
+		conflate: bool = False,
+		shed_policy: str = BLOCK,
+		on_discard: Optional[Callable[[str, str], None]] = None
+	):
+		"""
+		Constructor of the WorkerPool class.
+		Args:
+			handler (Callable): Function that processes an item.
+			workers (int): Number of worker threads.
+			queue_size (int): Max items waiting in the queue of each worker.
+			name (str): Prefix of the name of the threads.
+			debug (bool): Debug mode.
+			conflate (bool): If only the newest waiting item of each key is kept.
+			shed_policy (str): What is done when a queue is full (see SHED_POLICIES).
+			on_discard (Callable[[str, str], None]): Function called with
+				the key and the reason of each discarded item.
+		"""
+		self.handler = handler
+		self.workers = workers
+		self.name = name
+		self.debug = debug
+		self.on_discard = on_discard
+
+		# A queue for each worker
+		self._queues: List[IngressQueue] = [
+			IngressQueue(queue_size, conflate=conflate, policy=shed_policy)
+			for _ in range(workers)
+		]
+		self._threads: List[threading.Thread] = []
+
+	@property
+	def queue_depth(self) -> int:
+		"""
+		Returns the number of items waiting to be processed.
+		"""
+		return sum(current.qsize() for current in self._queues)
+
+	def shard(self, key: str) -> int:
+		"""
+		Get the worker that processes the items of a key.
+		Args:
+			key (str): The key of the item.
+		Returns:
+			int: The index of the worker.
+		"""
+		return zlib.crc32(key.encode()) % self.workers
+
+	def start(self) -> None:
+		"""
+		Start the worker threads.
+		"""
+		if self._threads:
+			return
+		for index, worker_queue in enumerate(self._queues):
+			thread = threading.Thread(
+				target=self._run,
+				args=(worker_queue,),
+				name=f"{self.name}-{index}",
+				daemon=True
+			)
+			thread.start()
+			self._threads.append(thread)
+
+	def submit(self, key: str, item: Any, timeout: Optional[float] = None) -> None:
+		"""
+		Queue an item to be processed by the worker of its key.
+		Args:
+			key (str): The key of the item.
+			item (Any): The item to process.
+			timeout (float): Max seconds to wait if the queue is full.
+		Raises:
+			queue.Full: If the timeout expires.
+		"""
+		discarded = self._queues[self.shard(key)].put(key, item, timeout=timeout)
+		if discarded is not None and self.on_discard is not None:
+			self.on_discard(*discarded)
+
+	def join(self) -> None:
+		"""
+		Wait until all the queued items have been processed.
+		"""
+		for worker_queue in self._queues:
+			worker_queue.join()
+
+	def stop(self, timeout: Optional[float] = None) -> bool:
+		"""
+		Stop the workers, after processing the queued items.
+		Args:
+			timeout (float): Max seconds to wait for all the workers
+				(None: until they end).
+		Returns:
+			bool: True if all the workers have ended.
+		"""
+		deadline = None if timeout is None else time.monotonic() + timeout
+		def remaining():
+			return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+		for worker_queue in self._queues:
+			try:
+				worker_queue.put(_STOP, _STOP, timeout=remaining(), shed=False)
+			except queue.Full:
+				pass
+		for thread in self._threads:
+			thread.join(remaining())
+		return not any(thread.is_alive() for thread in self._threads)
+
+	def _run(self, worker_queue: IngressQueue) -> None:
+		"""
+		Loop of a worker: process the items of its queue.
+		Args:
+			worker_queue (IngressQueue): The queue of the worker.
+		"""
+		while True:
+			item = worker_queue.get()
+			try:
+				if item is _STOP:
+					return
+				self.handler(item)
+			except Exception:
+				# An error in a message must not stop the worker
+				if self.debug:
+					traceback.print_exc()
+			finally:
+				worker_queue.task_done()
@@ -3,6 +3,7 @@ from rest_framework.routers import DefaultRouter
 from .views import (
 	DeviceViewSet,
 	RuleViewSet,
+	CompoundRuleViewSet,
 	LogViewSet,
 )
 
@@ -11,6 +12,7 @@ app_name = 'api'
 router = DefaultRouter()
 router.register(r'devices', DeviceViewSet, basename='device')
 router.register(r'rules', RuleViewSet, basename='rule')
+router.register(r'compound-rules', CompoundRuleViewSet, basename='compound-rule')
 router.register(r'logs', LogViewSet, basename='log')
 
 urlpatterns = [
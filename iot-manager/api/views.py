@@ -1,31 +1,158 @@
+from django.utils.decorators import method_decorator
+from django.views.decorators.gzip import gzip_page
+from django.views.decorators.http import condition
 from rest_framework import viewsets, mixins
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
 from app.models import (
 	Device,
 	Rule,
-	Log
+	CompoundRule,
+	Log,
+	Change
 )
 from app.serializers import (
 	DeviceSerializer,
 	RuleSerializer,
+	CompoundRuleSerializer,
 	LogSerializer
 )
 
+# Header with the change version of the full lists
+VERSION_HEADER = 'X-Change-Version'
+
+def change_condition(kind: str):
+	"""
+	Function to get a decorator of the lists of a model that answers
+	the conditional requests (`If-None-Match` and `If-Modified-Since`)
+	with a 304, without reading or serializing the objects, when the
+	model has not changed.
+	The ETag is the version of the last change of the model, and the
+	version of the delta (`since`), as each delta is a different answer.
+	The deltas are only answered by their ETag (the same date would be
+	valid for all of them).
+	Args:
+		kind (str): Kind of the changes of the model.
+	Returns:
+		The decorator.
+	"""
+	def etag(request, *args, **kwargs):
+		since = request.GET.get('since')
+		if since is not None:
+			# A bad version is answered with an error, without ETag
+			try:
+				since = int(since)
+			except ValueError:
+				return None
+			return f"{kind}-{Change.latest_version(kind)}-since-{since}"
+		return f"{kind}-{Change.latest_version(kind)}"
+
+	def last_modified(request, *args, **kwargs):
+		if 'since' in request.GET:
+			return None
+		change = Change.latest(kind)
+		return change.timestamp if change is not None else None
+
+	return condition(etag_func=etag, last_modified_func=last_modified)
+
+class ChangesMixin:
+	"""
+	List that also returns only the objects changed since a version of
+	the model (`?since=<version>`), with the ids of the deleted ones:
+		{"version": <last version>, "full": <bool>, "results": [...], "deleted": [...]}
+
+	When `full` is true (the version is 0, or newer than the last one,
+	as if the database had been replaced), the results are all the
+	objects, and the client must replace the ones that it has.
+	"""
+	# Kind of the changes of the objects
+	change_kind = None
+
+	def list(self, request, *args, **kwargs):
+		since = request.query_params.get('since')
+		if since is None:
+			version = Change.latest_version(self.change_kind)
+			response = super().list(request, *args, **kwargs)
+			response[VERSION_HEADER] = str(version)
+			return response
+
+		try:
+			since = int(since)
+		except ValueError:
+			since = -1
+		if since < 0:
+			raise ValidationError({'since': 'It must be a version (an integer greater or equal than 0)'})
+
+		# The objects are read after the version, so a change made meanwhile is sent again
+		version = Change.latest_version(self.change_kind)
+		full = since == 0 or since > version
+		deleted = []
+		queryset = self.filter_queryset(self.get_queryset())
+		if not full:
+			changes = Change.objects.filter(
+				kind=self.change_kind,
+				version__gt=since,
+				version__lte=version
+			)
+			changed = []
+			for object_id, is_deleted in changes.values_list('object_id', 'deleted'):
+				(deleted if is_deleted else changed).append(object_id)
+			queryset = queryset.filter(pk__in=changed)
+			deleted = [self.to_pk(object_id) for object_id in deleted]
+
+		return Response({
+			'version': version,
+			'full': full,
+			'results': self.get_serializer(queryset, many=True).data,
+			'deleted': deleted,
+		})
+
+	def to_pk(self, object_id: str):
+		"""
+		Returns the primary key of an object from the one of its change.
+		"""
+		return self.get_queryset().model._meta.pk.to_python(object_id)
+
 # Create your views here.
-class DeviceViewSet(viewsets.ReadOnlyModelViewSet):
+@method_decorator(gzip_page, name='dispatch')
+@method_decorator(change_condition(Change.Kinds.DEVICE), name='list')
+class DeviceViewSet(ChangesMixin, viewsets.ReadOnlyModelViewSet):
 	"""
 	API endpoint that allows devices to be viewed.
 		· GET: /devices: returns all the devices data
+		· GET: /devices?since=<version>: returns the devices changed
+		  after a version, and the deleted ones
 	"""
 	queryset = Device.objects.all()
 	serializer_class = DeviceSerializer
+	change_kind = Change.Kinds.DEVICE
 
-class RuleViewSet(viewsets.ReadOnlyModelViewSet):
+@method_decorator(gzip_page, name='dispatch')
+@method_decorator(change_condition(Change.Kinds.RULE), name='list')
+class RuleViewSet(ChangesMixin, viewsets.ReadOnlyModelViewSet):
 	"""
 	API endpoint that allows rules to be viewed.
 		· GET: /rules: returns all the rules data
+		· GET: /rules?since=<version>: returns the rules changed
+		  after a version, and the deleted ones
 	"""
 	queryset = Rule.objects.all()
 	serializer_class = RuleSerializer
+	change_kind = Change.Kinds.RULE
+
+@method_decorator(gzip_page, name='dispatch')
+@method_decorator(change_condition(Change.Kinds.COMPOUND_RULE), name='list')
+class CompoundRuleViewSet(ChangesMixin, viewsets.ReadOnlyModelViewSet):
+	"""
+	API endpoint that allows compound rules to be viewed.
+		· GET: /compound-rules: returns all the compound rules data,
+		  with their conditions
+		· GET: /compound-rules?since=<version>: returns the compound
+		  rules changed after a version, and the deleted ones
+	"""
+	queryset = CompoundRule.objects.prefetch_related('conditions')
+	serializer_class = CompoundRuleSerializer
+	change_kind = Change.Kinds.COMPOUND_RULE
 
 class LogViewSet(
 	mixins.CreateModelMixin,	# Create the logs
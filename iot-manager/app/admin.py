@@ -4,12 +4,23 @@ from .models import (
 	DummyClock,
 	DummySwitch,
 	Rule,
+	CompoundRule,
+	CompoundCondition,
 	Log
 )
 
+class CompoundConditionInline(admin.TabularInline):
+	"""
+	Conditions, edited with their compound rule.
+	"""
+	model = CompoundCondition
+	extra = 2
+	min_num = 1
+
 # Register your models here.
 admin.site.register(DummySensor)
 admin.site.register(DummyClock)
 admin.site.register(DummySwitch)
 admin.site.register(Rule)
+admin.site.register(CompoundRule, inlines=[CompoundConditionInline])
 admin.site.register(Log)
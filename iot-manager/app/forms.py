@@ -49,23 +49,35 @@ class DummySwitchForm(forms.ModelForm):
 class RuleForm(forms.ModelForm):
     class Meta:
         model = Rule
-        fields = ['name', 'source_device', 'operator', 'threshold', 'target_device', 'command_payload']
+        fields = ['name', 'source_device', 'aggregate', 'window', 'operator', 'threshold', 'trigger', 'hysteresis', 'duration', 'target_device', 'priority', 'command_payload']
         widgets = {
             'name': forms.TextInput(attrs={
                 'class': 'form-control',
                 'placeholder': 'Kitchen temperature manager'
             },),
             'source_device': forms.Select(attrs={'class': 'form-select'}),
+            'aggregate': forms.Select(attrs={'class': 'form-select'}),
+            'window': forms.NumberInput(attrs={'class': 'form-control', 'step': 'any', 'min': 0}),
             'operator': forms.Select(attrs={'class': 'form-select'}),
             'threshold': forms.TextInput(attrs={'class': 'form-control'}),
+            'trigger': forms.Select(attrs={'class': 'form-select'}),
+            'hysteresis': forms.NumberInput(attrs={'class': 'form-control', 'step': 'any', 'min': 0}),
+            'duration': forms.NumberInput(attrs={'class': 'form-control', 'step': 'any', 'min': 0}),
             'target_device': forms.Select(attrs={'class': 'form-select'}),
+            'priority': forms.NumberInput(attrs={'class': 'form-control'}),
             'command_payload': forms.Textarea(attrs={'class': 'form-control', 'rows': 3}),
         }
         help_texts = {
             'name': 'Name of the rule to create',
             'source_device': 'Device that will activate the rule',
+            'aggregate': 'Value to compare: the last one, or an aggregate of the values of the window',
+            'window': 'With an aggregate, seconds of values that are aggregated',
             'operator': 'Comparation to do between the value and the threshold',
             'threshold': 'Value to compare with the actual limit value',
+            'trigger': 'When the command is sent, depending on the comparation result',
+            'hysteresis': 'With the hysteresis trigger, how much the value has to go back over the threshold to send it again',
+            'duration': 'Seconds that the condition has to be met without interruption before the command is sent (0: at once)',
             'target_device': 'Device to which the message will be sent if the condition is met',
+            'priority': 'If several rules send a command to the device at the same time, only the one with the highest priority is sent',
             'command_payload': 'Message to send. Has to have the "cmd" field, e.j. {"cmd":"set","state":"ON"}',
         }
\ No newline at end of file
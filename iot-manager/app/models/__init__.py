@@ -4,5 +4,8 @@ from .dummy_sensor import DummySensor
 from .dummy_switch import DummySwitch
 
 from .rule import Rule
+from .compound_rule import CompoundRule, CompoundCondition
 
-from .log import Log
\ No newline at end of file
+from .log import Log
+
+from .change import Change
\ No newline at end of file
@@ -0,0 +1,91 @@
+from typing import Optional
+from django.db import models, transaction
+
+class Change(models.Model):
+	"""
+	Last change of each device and rule, with a version that always
+	increases, so the clients can ask only for what has changed since
+	the version that they have. The deleted objects are kept as tombstones.
+	"""
+
+	class Kinds(models.TextChoices):
+		"""
+		Models whose changes are recorded.
+		"""
+		DEVICE = 'device', 'Device'
+		RULE = 'rule', 'Rule'
+		COMPOUND_RULE = 'compound', 'Compound rule'
+
+	# Version of the change (never reused, as the key is autoincremented)
+	version = models.BigAutoField(
+		primary_key=True
+	)
+
+	# Model of the changed object
+	kind = models.CharField(
+		max_length=8,
+		choices=Kinds.choices,
+	)
+
+	# Primary key of the changed object
+	object_id = models.CharField(
+		max_length=128,
+	)
+
+	# If the object has been deleted (tombstone)
+	deleted = models.BooleanField(
+		default=False,
+	)
+
+	# Date of the change
+	timestamp = models.DateTimeField(
+		auto_now=True,
+	)
+
+	class Meta:
+		ordering = ['version']
+		constraints = [
+			models.UniqueConstraint(fields=['kind', 'object_id'], name='unique_change_object'),
+		]
+		indexes = [
+			models.Index(fields=['kind', 'version']),
+		]
+
+	def __str__(self):
+		"""
+		Returns a string representation of the change.
+		"""
+		action = "deleted" if self.deleted else "changed"
+		return f"[{self.version}] {self.kind} {self.object_id} {action}"
+
+	@classmethod
+	def record(cls, kind: str, object_id, deleted: bool = False) -> "Change":
+		"""
+		Record the change of an object, with a new version (the previous
+		change of the object is replaced).
+		Args:
+			kind (str): Model of the object.
+			object_id (Any): Primary key of the object.
+			deleted (bool): If the object has been deleted.
+		Returns:
+			Change: The new change.
+		"""
+		with transaction.atomic():
+			cls.objects.filter(kind=kind, object_id=str(object_id)).delete()
+			return cls.objects.create(kind=kind, object_id=str(object_id), deleted=deleted)
+
+	@classmethod
+	def latest(cls, kind: Optional[str] = None) -> Optional["Change"]:
+		"""
+		Returns the last change (of a model, or of all), or None if there are none.
+		"""
+		changes = cls.objects.all() if kind is None else cls.objects.filter(kind=kind)
+		return changes.order_by('-version').first()
+
+	@classmethod
+	def latest_version(cls, kind: Optional[str] = None) -> int:
+		"""
+		Returns the version of the last change (of a model, or of all), 0 if there are none.
+		"""
+		change = cls.latest(kind)
+		return change.version if change is not None else 0
@@ -0,0 +1,160 @@
+from django.db import models
+from .device import Device
+from .rule import Rule, validate_command_payload, validate_no_rule_loop
+from django.core.exceptions import ValidationError
+
+# If <DEVICE 1> <VALUE> <CONDITION> <THRESHOLD> and <DEVICE 2> <VALUE> <CONDITION> <THRESHOLD>...,
+# then send <COMMAND_PAYLOAD> to <TARGET_DEVICE>
+class CompoundRule(models.Model):
+	"""
+	Rule whose condition spans several devices: it is met when all its
+	conditions are met by the last values sent by their devices.
+	"""
+
+	class Triggers(models.TextChoices):
+		"""
+		When the rule is applied, depending on the condition result.
+		"""
+		LEVEL = 'level', 'Each time a value is received and the condition is met'
+		RISING = 'rising', 'When the condition starts to be met'
+		FALLING = 'falling', 'When the condition stops being met'
+
+	# Name of the rule
+	name = models.CharField(
+		max_length=128,
+		null=False, blank=False, unique=True
+	)
+
+	# When the rule is applied
+	trigger = models.CharField(
+		max_length=10,
+		choices=Triggers.choices,
+		default=Triggers.LEVEL,
+	)
+
+	# Priority of the command, when several rules send one to the same device at once
+	priority = models.IntegerField(
+		default=0,
+	)
+
+	# Target device
+	target_device = models.ForeignKey(
+		Device,
+		on_delete=models.CASCADE,
+		related_name='compound_rules_as_target',
+	)
+
+	# Command payload to send
+	command_payload = models.CharField(
+		max_length=1024
+	)
+
+	# Created at and update dates (also updated when a condition changes)
+	created_at = models.DateTimeField(
+		auto_now_add=True,
+	)
+	updated_at = models.DateTimeField(
+		auto_now=True,
+	)
+
+	class Meta:
+		ordering = ['name']
+
+	def __str__(self):
+		"""
+		Returns a string representation of the rule.
+		"""
+		return self.name
+
+	def clean(self):
+		"""
+		Validates the model fields.
+		"""
+		validate_command_payload(self.command_payload)
+		self.check_loops()
+		super().clean()
+
+	def check_loops(self):
+		"""
+		Validates that the command of the rule can not apply it again,
+		through other rules, when its target changes (also checked when
+		it is saved).
+		"""
+		if self.pk is None or self.target_device_id is None:
+			return
+		devices = CompoundCondition.objects.filter(rule_id=self.pk).values_list('device_id', flat=True)
+		for device_id in sorted(set(devices)):
+			validate_no_rule_loop(device_id, self.target_device_id, exclude_compound=self.pk)
+
+class CompoundCondition(models.Model):
+	"""
+	Condition of a compound rule: the last value of a device compared
+	with a threshold.
+	"""
+
+	# Rule of the condition
+	rule = models.ForeignKey(
+		CompoundRule,
+		on_delete=models.CASCADE,
+		related_name='conditions',
+	)
+
+	# Device whose value is checked (its compound rules are deleted with it)
+	device = models.ForeignKey(
+		Device,
+		on_delete=models.CASCADE,
+		related_name='compound_conditions',
+	)
+
+	# Variable of the device messages (set from the device when saved)
+	variable = models.CharField(
+		max_length=16,
+		editable=False,
+	)
+
+	# Operator to check
+	operator = models.CharField(
+		max_length=2,
+		choices=Rule.Operators.choices,
+	)
+
+	# Condition value (to check)
+	threshold = models.CharField(
+		max_length=128,
+	)
+
+	class Meta:
+		ordering = ['id']
+
+	def __str__(self):
+		"""
+		Returns a string representation of the condition.
+		"""
+		return f"{self.device_id} {self.operator} {self.threshold}"
+
+	def clean(self):
+		"""
+		Validates the model fields.
+		"""
+		if self.device_id is not None:
+			try:
+				self.device.variable_name
+			except NotImplementedError:
+				raise ValidationError("the device does not send values")
+		self.check_loops()
+		super().clean()
+
+	def check_loops(self):
+		"""
+		Validates that the command of the rule of the condition can not
+		apply it again, through other rules (also checked when it is saved).
+		"""
+		if self.device_id is not None and self.rule_id is not None:
+			validate_no_rule_loop(self.device_id, self.rule.target_device_id, exclude_condition=self.pk)
+
+	def save(self, *args, **kwargs):
+		"""
+		Saves the condition, with the variable of its device.
+		"""
+		self.variable = self.device.variable_name
+		super().save(*args, **kwargs)
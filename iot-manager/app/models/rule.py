@@ -1,10 +1,105 @@
 from django.db import models
 from .device import Device
 from django.core.exceptions import ValidationError
+from typing import Dict, List, Optional, Set
 import json
 
+# Variables whose values can be aggregated (not only counted)
+NUMERIC_VARIABLES = ('temperature', 'time')
+
+def validate_command_payload(command_payload: str) -> None:
+	"""
+	Function to validate the command payload of a rule.
+	Args:
+		command_payload (str): The payload sent to the target device.
+	Raises:
+		ValidationError: If it is not a json object with a 'cmd' key.
+	"""
+	try:
+		converted_payload = json.loads(command_payload)
+	except json.decoder.JSONDecodeError:
+		raise ValidationError("command_payload has to have a json format")
+
+	if not isinstance(converted_payload, dict) or 'cmd' not in converted_payload:
+		raise ValidationError("command_payload must contain 'cmd' key")
+
+def find_rule_loop(
+	source_id: str,
+	target_id: str,
+	exclude_rule: Optional[int] = None,
+	exclude_compound: Optional[int] = None,
+	exclude_condition: Optional[int] = None
+) -> Optional[List[str]]:
+	"""
+	Function to find the loop that a rule would close in the graph of the
+	rules, where each rule (and each condition of a compound rule) goes
+	from the device that it checks to the device that it commands. In a
+	loop, the commands of the rules change the states that apply them
+	again, without end.
+	Args:
+		source_id (str): The source device of the rule.
+		target_id (str): The target device of the rule.
+		exclude_rule (int): The rule that is being changed (its old
+			devices are not part of the graph).
+		exclude_compound (int): The compound rule that is being changed
+			(the old devices of its conditions are not part of the graph).
+		exclude_condition (int): The compound condition that is being
+			changed.
+	Returns:
+		List[str]: The devices of the loop, from the source to the source
+			again, or None if there is no loop.
+	"""
+	from .compound_rule import CompoundCondition
+
+	# Devices commanded by the rules of each device
+	edges: Dict[str, Set[str]] = {}
+	for source, target in Rule.objects.exclude(pk=exclude_rule).values_list('source_device_id', 'target_device_id'):
+		edges.setdefault(source, set()).add(target)
+	conditions = CompoundCondition.objects.exclude(pk=exclude_condition).exclude(rule_id=exclude_compound)
+	for source, target in conditions.values_list('device_id', 'rule__target_device_id'):
+		edges.setdefault(source, set()).add(target)
+
+	# A path from the target back to the source closes the loop (breadth first, the shortest one)
+	previous: Dict[str, Optional[str]] = {target_id: None}
+	pending = [target_id]
+	while pending and source_id not in previous:
+		following = []
+		for device in pending:
+			for target in sorted(edges.get(device, ())):
+				if target not in previous:
+					previous[target] = device
+					following.append(target)
+		pending = following
+	if source_id not in previous:
+		return None
+
+	path = [source_id]
+	device = source_id
+	while device != target_id:
+		device = previous[device]
+		path.append(device)
+	path.reverse()
+	return [source_id] + path
+
+def validate_no_rule_loop(source_id: str, target_id: str, **exclude) -> None:
+	"""
+	Function to validate that a rule (or a condition of a compound rule)
+	does not close a loop of rules.
+	Args:
+		source_id (str): The device checked by the rule.
+		target_id (str): The device commanded by the rule.
+		exclude: The objects that are being changed (see `find_rule_loop`).
+	Raises:
+		ValidationError: If there is a loop.
+	"""
+	loop = find_rule_loop(source_id, target_id, **exclude)
+	if loop is not None:
+		raise ValidationError(f"the rule creates a loop of commands: {' -> '.join(loop)}")
+
 # If <SOURCE_DEVICE> <VALUE> <CONDITION> <THRESHOLD>,
 # then send <COMMAND_PAYLOAD> to <TARGET_DEVICE>
+# (<VALUE> can also be an aggregate of the values of the last <WINDOW> seconds,
+# and the condition can have to be met for <DURATION> seconds)
 class Rule(models.Model):
 	"""
 	Rule model to define the rules for the devices.
@@ -21,6 +116,27 @@ class Rule(models.Model):
 		GTE = '>=', 'Greater than or equal to'
 		LTE = '<=', 'Less than or equal to'
 
+	class Triggers(models.TextChoices):
+		"""
+		When the rule is applied, depending on the condition result.
+		"""
+		LEVEL = 'level', 'Each time the condition is met'
+		RISING = 'rising', 'When the condition starts to be met'
+		FALLING = 'falling', 'When the condition stops being met'
+		HYSTERESIS = 'hysteresis', 'When the condition starts to be met (with hysteresis)'
+
+	class Aggregates(models.TextChoices):
+		"""
+		Value compared with the threshold: the last one, or an aggregate
+		of the values received during the window.
+		"""
+		NONE = '', 'Last value'
+		AVG = 'avg', 'Average of the window'
+		MIN = 'min', 'Minimum of the window'
+		MAX = 'max', 'Maximum of the window'
+		COUNT = 'count', 'Number of values in the window'
+		DERIVATIVE = 'derivative', 'Rate of change per minute in the window'
+
 	# Name of the rule
 	name = models.CharField(
 		max_length=128,
@@ -34,6 +150,19 @@ class Rule(models.Model):
 		related_name='rules_as_source',
 	)
 
+	# Value to check (the last one, or an aggregate of the window)
+	aggregate = models.CharField(
+		max_length=10,
+		choices=Aggregates.choices,
+		default=Aggregates.NONE,
+		blank=True,
+	)
+
+	# Seconds of the window of the aggregate
+	window = models.FloatField(
+		default=0,
+	)
+
 	# Operator to check
 	operator = models.CharField(
 		max_length=2,
@@ -45,6 +174,28 @@ class Rule(models.Model):
 		max_length=128,
 	)
 
+	# When the rule is applied
+	trigger = models.CharField(
+		max_length=10,
+		choices=Triggers.choices,
+		default=Triggers.LEVEL,
+	)
+
+	# Band that the value has to go back over the threshold (hysteresis trigger)
+	hysteresis = models.FloatField(
+		default=0,
+	)
+
+	# Seconds that the condition has to be met continuously before the rule is applied
+	duration = models.FloatField(
+		default=0,
+	)
+
+	# Priority of the command, when several rules send one to the same device at once
+	priority = models.IntegerField(
+		default=0,
+	)
+
 	# Target device
 	target_device = models.ForeignKey(
 		Device,
@@ -78,12 +229,33 @@ class Rule(models.Model):
 		"""
 		Validates the model fields.
 		"""
-		try:
-			converted_payload = json.loads(self.command_payload)
-		except json.decoder.JSONDecodeError:
-			raise ValidationError("command_payload has to have a json format")
+		validate_command_payload(self.command_payload)
+
+		if self.hysteresis < 0:
+			raise ValidationError("hysteresis can not be negative")
+
+		if self.aggregate:
+			if self.window <= 0:
+				raise ValidationError("window must be greater than 0 with an aggregate")
+			if self.trigger == self.Triggers.HYSTERESIS:
+				raise ValidationError("the hysteresis trigger can not be used with an aggregate")
+			if self.aggregate != self.Aggregates.COUNT and self.source_device_id is not None \
+					and self.source_device.variable_name not in NUMERIC_VARIABLES:
+				raise ValidationError("only the count can be aggregated for this device")
 
-		if 'cmd' not in converted_payload:
-			raise ValidationError("command_payload must contain 'cmd' key")
+		if self.duration < 0:
+			raise ValidationError("duration can not be negative")
+		if self.duration > 0 and self.trigger in (self.Triggers.FALLING, self.Triggers.HYSTERESIS):
+			raise ValidationError("a duration can only be used with the level or rising triggers")
+
+		self.check_loops()
 		super().clean()
+
+	def check_loops(self):
+		"""
+		Validates that the command of the rule can not apply it again,
+		through other rules (also checked when it is saved).
+		"""
+		if self.source_device_id is not None and self.target_device_id is not None:
+			validate_no_rule_loop(self.source_device_id, self.target_device_id, exclude_rule=self.pk)
 	
\ No newline at end of file
@@ -0,0 +1,87 @@
+import json
+import threading
+from typing import Optional
+import paho.mqtt.client as mqtt
+from django.conf import settings
+
+# Topic where the changes are published (the controllers are subscribed to it)
+CHANGES_TOPIC = "redes/2312/10/control/changes"
+
+class ChangeNotifier:
+	"""
+	Publisher of the change notices of the rules and devices, with a
+	client that is kept connected (and reconnects) in the background.
+	The notices published while it is not connected are queued, up to
+	`max_queued` (the controllers also check the database periodically).
+	"""
+	def __init__(self, host: str, port: int, max_queued: int = 1000):
+		"""
+		Constructor of the ChangeNotifier class.
+		Args:
+			host (str): Host of the MQTT broker.
+			port (int): Port of the MQTT broker.
+			max_queued (int): Max notices queued while it is not connected.
+		"""
+		self.host = host
+		self.port = port
+		self.client = mqtt.Client()
+		self.client.max_queued_messages_set(max_queued)
+		self.client.connect_async(host, port)
+		self.client.loop_start()
+
+	def publish(self, change) -> None:
+		"""
+		Publish the notice of a change: its entity, id, version and if
+		it has been deleted.
+		Args:
+			change (Change): The change.
+		"""
+		notice = {
+			"entity": change.kind,
+			"id": change.object_id,
+			"version": change.version,
+			"deleted": change.deleted,
+		}
+		self.client.publish(
+			CHANGES_TOPIC,
+			json.dumps(notice, separators=(",", ":")),
+			qos=1
+		)
+
+	def close(self) -> None:
+		"""
+		Disconnect from the broker.
+		"""
+		self.client.disconnect()
+		self.client.loop_stop()
+
+# Notifier of the broker of the settings (created when it is first used)
+_notifier: Optional[ChangeNotifier] = None
+_notifier_lock = threading.Lock()
+
+def get_notifier() -> Optional[ChangeNotifier]:
+	"""
+	Function to get the notifier of the broker of the settings.
+	Returns:
+		ChangeNotifier: The notifier, or None if there is no broker.
+	"""
+	global _notifier
+	host, port = settings.CHANGES_BROKER_HOST, settings.CHANGES_BROKER_PORT
+	with _notifier_lock:
+		# The broker of the settings has changed (like in the tests)
+		if _notifier is not None and (_notifier.host, _notifier.port) != (host, port):
+			_notifier.close()
+			_notifier = None
+		if _notifier is None and host:
+			_notifier = ChangeNotifier(host, port)
+		return _notifier
+
+def notify_change(change) -> None:
+	"""
+	Function to publish the notice of a change, if there is a broker.
+	Args:
+		change (Change): The change.
+	"""
+	notifier = get_notifier()
+	if notifier is not None:
+		notifier.publish(change)
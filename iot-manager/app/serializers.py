@@ -2,6 +2,8 @@ from rest_framework import serializers
 from .models import (
 	Device,
     Rule,
+    CompoundRule,
+    CompoundCondition,
     Log
 )
 
@@ -91,7 +93,29 @@ class RuleSerializer(serializers.ModelSerializer):
         model = Rule
         fields = [
             'id','name',
-            'source_device','operator','threshold', 'target_device','command_payload'
+            'source_device', 'aggregate', 'window', 'operator','threshold', 'trigger', 'hysteresis',
+            'duration', 'target_device', 'priority', 'command_payload'
+        ]
+
+class CompoundConditionSerializer(serializers.ModelSerializer):
+    """
+    Compound rule condition serializer
+    """
+    class Meta:
+        model = CompoundCondition
+        fields = ['device', 'variable', 'operator', 'threshold']
+
+class CompoundRuleSerializer(serializers.ModelSerializer):
+    """
+    Compound rule serializer, with its conditions
+    """
+    conditions = CompoundConditionSerializer(many=True, read_only=True)
+
+    class Meta:
+        model = CompoundRule
+        fields = [
+            'id', 'name', 'conditions', 'trigger',
+            'target_device', 'priority', 'command_payload'
         ]
 
 class LogSerializer(serializers.ModelSerializer):
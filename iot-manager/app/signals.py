@@ -0,0 +1,83 @@
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from .models import Device, Rule, CompoundRule, CompoundCondition, Change
+from .notifications import notify_change
+
+def _kind(instance):
+	"""
+	Function to get the kind of change of an object.
+	Args:
+		instance (Model): The saved or deleted object.
+	Returns:
+		str: The kind of the change, or None if its changes are not recorded.
+	"""
+	# The devices are saved as their concrete class (DummySensor...)
+	if isinstance(instance, Device):
+		return Change.Kinds.DEVICE
+	if isinstance(instance, Rule):
+		return Change.Kinds.RULE
+	if isinstance(instance, CompoundRule):
+		return Change.Kinds.COMPOUND_RULE
+	return None
+
+def _record(kind, object_id, deleted=False):
+	"""
+	Function to record a change, and notify it to the controllers (when
+	it is committed).
+	"""
+	change = Change.record(kind, object_id, deleted=deleted)
+	transaction.on_commit(lambda: notify_change(change))
+
+@receiver(pre_save, sender=Rule)
+@receiver(pre_save, sender=CompoundRule)
+@receiver(pre_save, sender=CompoundCondition)
+def check_rule_loops(sender, instance, **kwargs):
+	"""
+	Reject the rules and compound conditions that close a loop of rules,
+	however they are saved (not only the validated forms).
+	"""
+	instance.check_loops()
+
+@receiver(post_save)
+def record_save(sender, instance, raw=False, **kwargs):
+	"""
+	Record a new version of the devices and rules that are saved, and
+	notify it to the controllers (when it is committed).
+	"""
+	kind = _kind(instance)
+	if kind is not None and not raw:
+		_record(kind, instance.pk)
+
+@receiver(post_delete)
+def record_delete(sender, instance, **kwargs):
+	"""
+	Record a tombstone of the devices and rules that are deleted (the
+	rules of a deleted device are deleted too, and also recorded), and
+	notify it to the controllers (when it is committed).
+	"""
+	kind = _kind(instance)
+	if kind is not None:
+		_record(kind, instance.pk, deleted=True)
+
+@receiver(post_save, sender=CompoundCondition)
+@receiver(post_delete, sender=CompoundCondition)
+def record_condition(sender, instance, raw=False, **kwargs):
+	"""
+	A change of a condition is a change of its compound rule (if the
+	rule is being deleted, its own tombstone is recorded after this).
+	"""
+	if not raw:
+		CompoundRule.objects.filter(pk=instance.rule_id).update(updated_at=timezone.now())
+		_record(Change.Kinds.COMPOUND_RULE, instance.rule_id)
+
+@receiver(pre_delete)
+def delete_compound_rules(sender, instance, **kwargs):
+	"""
+	Delete the compound rules that check a device that is deleted (they
+	can not be met without it).
+	"""
+	if isinstance(instance, Device):
+		for rule in CompoundRule.objects.filter(conditions__device_id=instance.pk).distinct():
+			rule.delete()
@@ -0,0 +1,7 @@
+import sys
+from pathlib import Path
+
+# The controller package is at the root of the repository
+ROOT_PATH = str(Path(__file__).resolve().parents[3])
+if ROOT_PATH not in sys.path:
+	sys.path.append(ROOT_PATH)
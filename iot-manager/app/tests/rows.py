@@ -0,0 +1,24 @@
+from typing import Any, Dict
+
+def rule_row(**columns: Any) -> Dict[str, Any]:
+	"""
+	Function to build a row of `app_rule`, as read by the controller.
+	The optional columns (trigger, priority...) are only included if
+	they are given, as `CompiledRule` has their defaults.
+	Args:
+		columns (Any): The columns that change from the default row.
+	Returns:
+		Dict[str, Any]: The row.
+	"""
+	row = {
+		'id': 1,
+		'name': f"Rule {columns.get('id', 1)}",
+		'source_device_id': 'sensor',
+		'operator': '>',
+		'threshold': '25',
+		'target_device_id': 'switch',
+		'command_payload': '{"cmd":"set","state":"ON"}',
+		'updated_at': '2025-01-01 00:00:00',
+	}
+	row.update(columns)
+	return row
@@ -0,0 +1,111 @@
+from app.models import DummySwitch, DummySensor, Rule
+from django.test import LiveServerTestCase
+import socket
+from controller.api_communication import APIClient, APIError, get_rules_from_api
+
+class TestAPIClient(LiveServerTestCase):
+	"""
+	Tests of the client of the api, with the Django server.
+	"""
+	def setUp(self):
+		self.switch = DummySwitch.objects.create(id="switch-api", probability=0)
+		self.sensor = DummySensor.objects.create(id="sensor-api")
+		for i in range(5):
+			Rule.objects.create(
+				name=f"Api {i}",
+				source_device=self.sensor,
+				operator=">",
+				threshold=str(20 + i),
+				target_device=self.switch,
+				command_payload='{"cmd":"set","state":"ON"}'
+			)
+		self.api = APIClient(self.server_thread.host, self.server_thread.port)
+		self.addCleanup(self.api.close)
+
+	def test_not_modified_01(self):
+		"""
+		The lists that have not changed are answered with a 304, and the
+		last data is returned again.
+		"""
+		rules = self.api.rules()
+		self.assertEqual(len(rules), 5)
+		self.assertEqual(self.api.rules(), rules)
+		self.assertEqual(self.api.not_modified, 1)
+
+		# A change of other model does not change the ETag of the rules
+		self.switch.probability = 0.5
+		self.switch.save()
+		self.api.rules()
+		self.assertEqual(self.api.not_modified, 2)
+
+		Rule.objects.filter(name="Api 0").first().delete()
+		self.assertEqual(len(self.api.rules()), 4)
+		self.assertEqual(self.api.not_modified, 2)
+
+	def test_changes_02(self):
+		"""
+		The deltas are also answered with a 304 while nothing changes.
+		"""
+		version = self.api.rule_changes(0)["version"]
+		self.assertEqual(self.api.rule_changes(version)["results"], [])
+		self.assertEqual(self.api.rule_changes(version)["results"], [])
+		self.assertEqual(self.api.not_modified, 1)
+
+		rule = Rule.objects.get(name="Api 1")
+		rule.threshold = "50"
+		rule.save()
+		changes = self.api.rule_changes(version)
+		self.assertEqual([rule["threshold"] for rule in changes["results"]], ["50"])
+
+	def test_gzip_03(self):
+		"""
+		The lists are compressed.
+		"""
+		response = self.api.request("GET", "rules/")
+		self.assertEqual(response.headers.get("Content-Encoding"), "gzip")
+		self.assertEqual(len(response.json()), 5)
+
+	def test_errors_04(self):
+		"""
+		The errors of the api, and the failed connections (after the
+		retries), raise an APIError.
+		"""
+		with self.assertRaises(APIError):
+			self.api.rule_changes("abc")
+
+		# A port without server
+		with socket.socket() as sock:
+			sock.bind(("127.0.0.1", 0))
+			port = sock.getsockname()[1]
+		api = APIClient("127.0.0.1", port, retries=2, backoff=0.01)
+		with self.assertRaises(APIError):
+			api.devices()
+		self.assertEqual(api.requests, 3)
+		api.close()
+
+	def test_functions_05(self):
+		"""
+		The functions use the host and port that they are given.
+		"""
+		rules = get_rules_from_api(self.server_thread.host, self.server_thread.port)
+		self.assertEqual(len(rules), 5)
+
+	def test_delta_etags_06(self):
+		"""
+		Each delta has its own ETag, so the one of a delta is not valid
+		for other one.
+		"""
+		version = self.api.rule_changes(0)["version"]
+		rule = Rule.objects.get(name="Api 1")
+		rule.threshold = "50"
+		rule.save()
+
+		response = self.client.get("/api/v1/rules/", {"since": version + 1})
+		etag = response["ETag"]
+		response = self.client.get("/api/v1/rules/", {"since": version}, HTTP_IF_NONE_MATCH=etag)
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual([rule["name"] for rule in response.json()["results"]], ["Api 1"])
+
+		response = self.client.get("/api/v1/rules/", {"since": version}, HTTP_IF_NONE_MATCH=response["ETag"])
+		self.assertEqual(response.status_code, 304)
+		self.assertNotIn("Last-Modified", response)
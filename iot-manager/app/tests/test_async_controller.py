@@ -0,0 +1,193 @@
+from app.models import DummySwitch, DummySensor, DummyClock, Rule, Log
+from django.test import TransactionTestCase
+from django.db import connection
+from paho.mqtt.client import MQTTMessage
+import asyncio
+import threading
+from controller.IOTController import IOTController
+from controller.AsyncIOTController import AsyncIOTController
+from controller.partition import HashRing, Partition
+
+class TestAsyncController(TransactionTestCase):
+	"""
+	Tests of the asyncio engine of the controller, without broker.
+	"""
+	MESSAGES = [
+		("sensor-async", b'{"temperature": 24}'),
+		("sensor-async", b'{"temperature": 26}'),
+		("clock-async", b'{"time": "07:59:59"}'),
+		("clock-async", b'{"time": "08:00:00"}'),
+		("switch-async", b'{"state": "OFF"}'),
+		("switch-async", b'{"state": "ON"}'),
+		("sensor-async", b'bad message'),
+		("sensor-async", b'{"temperature": 27}'),
+	]
+
+	def setUp(self):
+		switch = DummySwitch.objects.create(id="switch-async", probability=0)
+		other = DummySwitch.objects.create(id="switch-async-2", probability=0)
+		sensor = DummySensor.objects.create(id="sensor-async")
+		clock = DummyClock.objects.create(id="clock-async")
+		for name, source, operator, threshold, target in [
+			("Async sensor", sensor, ">", "25", switch),
+			("Async clock", clock, ">=", "08:00:00", switch),
+			("Async switch", switch, "==", "ON", other),
+		]:
+			Rule.objects.create(
+				name=name,
+				source_device=source,
+				operator=operator,
+				threshold=threshold,
+				target_device=target,
+				command_payload='{"cmd":"get"}'
+			)
+
+	def create_controller(self, engine):
+		controller = engine(
+			host="localhost",
+			port=1883,
+			database=connection.settings_dict['NAME'],
+			workers=0
+		)
+		published = []
+		controller.client.publish = lambda topic, payload, qos=0, retain=False: \
+			published.append((topic, payload))
+		return controller, published
+
+	def build_message(self, device_id, payload):
+		message = MQTTMessage(topic=f"redes/2312/10/{device_id}/state".encode())
+		message.payload = payload
+		return message
+
+	def test_same_results_01(self):
+		"""
+		The asyncio engine publishes and logs the same as the threads one.
+		"""
+		# Threads engine
+		controller, expected = self.create_controller(IOTController)
+		controller.start_processing()
+		for device_id, payload in self.MESSAGES:
+			controller.on_message(None, None, self.build_message(device_id, payload))
+		controller.stop()
+		expected_logs = list(Log.objects.order_by('id').values_list('message', 'device'))
+		Log.objects.all().delete()
+
+		# Asyncio engine
+		controller, published = self.create_controller(AsyncIOTController)
+
+		async def scenario():
+			controller.start_tasks()
+			for device_id, payload in self.MESSAGES:
+				controller.on_message(None, None, self.build_message(device_id, payload))
+			await controller.shutdown()
+		asyncio.run(scenario())
+
+		self.assertEqual(len(expected), 4)
+		self.assertEqual(published, expected)
+		self.assertEqual(
+			list(Log.objects.order_by('id').values_list('message', 'device')),
+			expected_logs
+		)
+
+	def test_stop_from_thread_02(self):
+		"""
+		`stop` waits for the loop (in other thread) to drain the controller,
+		and returns if it has been drained.
+		"""
+		controller, published = self.create_controller(AsyncIOTController)
+		started = threading.Event()
+
+		# The broker acknowledges the commands
+		def publish(topic, payload, qos=0, retain=False):
+			published.append((topic, payload))
+			controller.metrics.commands_acknowledged.labels().inc()
+		controller.client.publish = publish
+
+		async def scenario():
+			controller.start_tasks()
+			started.set()
+			for device_id, payload in self.MESSAGES:
+				controller.on_message(None, None, self.build_message(device_id, payload))
+			await controller.stopping.wait()
+			await controller.shutdown()
+		thread = threading.Thread(target=asyncio.run, args=(scenario(),))
+		thread.start()
+		started.wait(5)
+
+		self.assertTrue(controller.stop())
+		self.assertTrue(controller.stopped.is_set())
+		self.assertEqual(len(published), 4)
+		thread.join(5)
+
+	def test_partition_03(self):
+		"""
+		The messages of the devices of other partitions are not processed.
+		"""
+		ring = HashRing(["controller-0", "controller-1"])
+		partition = Partition(ring, ring.owner("sensor-async"))
+		other = Partition(ring, next(m for m in ring.members if m != partition.member))
+		results = {}
+		for name, owner in [("own", partition), ("other", other)]:
+			controller = AsyncIOTController(
+				host="localhost",
+				port=1883,
+				database=connection.settings_dict['NAME'],
+				partition=owner
+			)
+
+			async def scenario():
+				controller.start_tasks()
+				controller.on_message(None, None, self.build_message("sensor-async", b'{"temperature": 26}'))
+				results[name] = controller.messages.qsize()
+				await controller.shutdown()
+			asyncio.run(scenario())
+		self.assertEqual(results, {"own": 1, "other": 0})
+
+	def test_database_off_loop_04(self):
+		"""
+		The rules are read, and their changes checked, out of the loop.
+		"""
+		controller = AsyncIOTController(
+			host="localhost",
+			port=1883,
+			database=connection.settings_dict['NAME'],
+			workers=0,
+			rules_cache_size=8
+		)
+		published = []
+		controller.client.publish = lambda topic, payload, qos=0, retain=False: \
+			published.append((topic, payload))
+
+		# Save the threads that read the rules
+		threads = []
+		get = controller.rules.get
+		def traced(device_id):
+			threads.append(threading.current_thread())
+			return get(device_id)
+		controller.rules.get = traced
+
+		async def scenario():
+			controller.start_tasks()
+			loop_thread = threading.current_thread()
+			controller.on_message(None, None, self.build_message("sensor-async", b'{"temperature": 26}'))
+			await controller.messages.join()
+			sent = len(published)
+
+			# The change is not seen until the changes are checked
+			await controller.loop.run_in_executor(
+				None, lambda: Rule.objects.filter(name="Async sensor").update(threshold="30")
+			)
+			controller.on_message(None, None, self.build_message("sensor-async", b'{"temperature": 27}'))
+			await controller.messages.join()
+			unchecked = len(published) - sent
+			await controller.loop.run_in_executor(None, controller.check_changes)
+			controller.on_message(None, None, self.build_message("sensor-async", b'{"temperature": 28}'))
+			await controller.messages.join()
+			checked = len(published) - sent - unchecked
+			await controller.shutdown()
+			return loop_thread, sent, unchecked, checked
+		loop_thread, sent, unchecked, checked = asyncio.run(scenario())
+
+		self.assertEqual((sent, unchecked, checked), (1, 1, 0))
+		self.assertTrue(threads)
+		self.assertNotIn(loop_thread, threads)
@@ -0,0 +1,57 @@
+from django.test import SimpleTestCase
+import os
+import sqlite3
+import tempfile
+from benchmark.fleet import create_database, create_messages, run_case
+
+class TestFleetBenchmark(SimpleTestCase):
+	"""
+	Tests of the fleet benchmark of the controller.
+	"""
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.database = os.path.join(self.directory.name, "fleet.sqlite3")
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def test_seeded_01(self):
+		"""
+		The databases and messages are the same with the same seed.
+		"""
+		create_database(self.database, 20, 3, "ranges", seed=1)
+		database = sqlite3.connect(self.database)
+		rules = database.execute("SELECT operator, threshold, source_device_id FROM app_rule").fetchall()
+		database.close()
+		self.assertEqual(len(rules), 60)
+		self.assertTrue(all(operator in ('>', '<', '>=', '<=') for operator, _, _ in rules))
+
+		other = os.path.join(self.directory.name, "other.sqlite3")
+		create_database(other, 20, 3, "ranges", seed=1)
+		database = sqlite3.connect(other)
+		self.assertEqual(database.execute("SELECT operator, threshold, source_device_id FROM app_rule").fetchall(), rules)
+		database.close()
+
+		first = create_messages(20, "normal", 50, seed=1)
+		second = create_messages(20, "normal", 50, seed=1)
+		self.assertEqual([m.payload for m in first], [m.payload for m in second])
+
+	def test_run_case_02(self):
+		"""
+		A case processes all the messages, and reports its results.
+		"""
+		create_database(self.database, 10, 2, "mixed", seed=1)
+		case = {
+			"devices": 10,
+			"rules_per_device": 2,
+			"distribution": "uniform",
+			"operators": "mixed",
+			"workers": 2,
+		}
+		result = run_case(case, self.database, messages=300, warmup=50, seed=1)
+		self.assertEqual(result["messages"], 300)
+		self.assertGreater(result["msgs_per_sec"], 0)
+		self.assertLessEqual(result["p50_us"], result["p99_us"])
+		self.assertGreater(result["commands"], 0)
+		self.assertEqual(result["logs_dropped"], 0)
+		self.assertGreater(result["peak_rss_kb"], 0)
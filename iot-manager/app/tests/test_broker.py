@@ -0,0 +1,139 @@
+from django.test import SimpleTestCase
+import socket
+import threading
+from paho.mqtt.client import Client
+from broker.server import MQTTBroker
+from broker.fake import FakeBroker
+from broker.topics import TopicTree, valid_filter
+
+class TestTopicTree(SimpleTestCase):
+	"""
+	Tests of the subscriptions by topic filter.
+	"""
+	def test_wildcards_01(self):
+		"""
+		The filters with wildcards match the topics of their levels.
+		"""
+		tree = TopicTree()
+		tree.subscribe("redes/+/state", "plus", 0)
+		tree.subscribe("redes/#", "hash", 1)
+		tree.subscribe("redes/sensor/state", "exact", 1)
+		tree.subscribe("#", "all", 0)
+
+		self.assertEqual(tree.match("redes/sensor/state"), {"plus": 0, "hash": 1, "exact": 1, "all": 0})
+		self.assertEqual(tree.match("redes/sensor/command"), {"hash": 1, "all": 0})
+		self.assertEqual(tree.match("redes"), {"hash": 1, "all": 0})
+		self.assertEqual(tree.match("$SYS/uptime"), {})
+
+		self.assertTrue(tree.unsubscribe("redes/#", "hash"))
+		self.assertFalse(tree.unsubscribe("redes/#", "hash"))
+		self.assertEqual(tree.match("redes/sensor/command"), {"all": 0})
+
+		self.assertTrue(valid_filter("a/+/#"))
+		self.assertFalse(valid_filter("a/#/b"))
+		self.assertFalse(valid_filter("a/b+"))
+
+class TestMQTTBroker(SimpleTestCase):
+	"""
+	Tests of the embedded MQTT broker, with paho clients.
+	"""
+	def setUp(self):
+		self.broker = MQTTBroker(port=0)
+		self.broker.start()
+		self.addCleanup(self.broker.stop)
+		self.received = []
+		self.event = threading.Event()
+
+	def create_client(self, client_id, subscriptions=None, **kwargs):
+		client = Client(client_id=client_id)
+		if subscriptions:
+			client.on_connect = lambda client, userdata, flags, rc: client.subscribe(subscriptions)
+		client.on_message = self.on_message
+		for name, value in kwargs.items():
+			getattr(client, name)(**value)
+		client.connect("127.0.0.1", self.broker.port)
+		client.loop_start()
+		self.addCleanup(client.loop_stop)
+		self.addCleanup(client.disconnect)
+		return client
+
+	def on_message(self, client, userdata, message):
+		self.received.append((message.topic, message.payload, message.qos, message.retain))
+		self.event.set()
+
+	def wait_messages(self, count):
+		while len(self.received) < count:
+			self.event.clear()
+			if not self.event.wait(2):
+				break
+
+	def test_publish_01(self):
+		"""
+		The subscribers receive the messages of their filters, and the retained ones.
+		"""
+		publisher = self.create_client("publisher")
+		publisher.publish("redes/sensor/state", b"26", qos=1, retain=True).wait_for_publish(2)
+
+		self.create_client("subscriber", [("redes/+/state", 1), ("redes/switch/#", 0)])
+		self.wait_messages(1)
+		publisher.publish("redes/switch/command", b"ON", qos=1)
+		publisher.publish("redes/other", b"ignored", qos=1)
+		publisher.publish("redes/sensor/state", b"27", qos=1)
+		self.wait_messages(3)
+
+		self.assertEqual(self.received, [
+			("redes/sensor/state", b"26", 1, True),
+			("redes/switch/command", b"ON", 0, False),
+			("redes/sensor/state", b"27", 1, False),
+		])
+		self.assertEqual(self.broker.retained["redes/sensor/state"].payload, b"26")
+
+	def test_will_02(self):
+		"""
+		The last will is published when a client is disconnected without DISCONNECT.
+		"""
+		self.create_client("subscriber", [("devices/+/status", 0)])
+		connection = socket.create_connection(("127.0.0.1", self.broker.port))
+
+		# CONNECT of MQTT 3.1.1, clean session, with a will on devices/lost/status
+		will = b"\x00\x13devices/lost/status\x00\x07offline"
+		body = b"\x00\x04MQTT\x04\x06\x00\x3c\x00\x04lost" + will
+		connection.sendall(bytes([0x10, len(body)]) + body)
+		self.assertEqual(connection.recv(4), b"\x20\x02\x00\x00")
+		connection.close()
+
+		self.wait_messages(1)
+		self.assertEqual(self.received, [("devices/lost/status", b"offline", 0, False)])
+
+class TestFakeBroker(SimpleTestCase):
+	"""
+	Tests of the in-process broker.
+	"""
+	def test_clients_01(self):
+		"""
+		The messages are handled in the loop of each client.
+		"""
+		broker = FakeBroker()
+		received = []
+		subscriber = broker.client("subscriber")
+		subscriber.on_connect = lambda client, userdata, flags, rc: client.subscribe("redes/+/state", qos=1)
+		subscriber.on_message = lambda client, userdata, message: received.append(
+			(message.topic, message.payload, message.qos, message.retain)
+		)
+		broker.publish("redes/sensor/state", "25", qos=1, retain=True)
+		subscriber.connect("localhost", 1883)
+		subscriber.loop_start()
+
+		publisher = broker.client()
+		publisher.connect("localhost", 1883)
+		publisher.publish("redes/sensor/state", b"26")
+		self.assertTrue(broker.join(2))
+		self.assertEqual(received, [
+			("redes/sensor/state", b"25", 1, True),
+			("redes/sensor/state", b"26", 0, False),
+		])
+		self.assertEqual(len(broker.messages("redes/sensor/+")), 2)
+
+		subscriber.disconnect()
+		subscriber.loop_stop()
+		self.assertEqual(broker.clients, [publisher._client_id])
@@ -0,0 +1,130 @@
+from app.models import DummySwitch, DummySensor, Rule, Change
+from app.notifications import CHANGES_TOPIC, get_notifier
+from django.test import TransactionTestCase, override_settings
+from paho.mqtt.client import Client
+from broker.server import MQTTBroker
+import json
+import queue
+
+class TestChanges(TransactionTestCase):
+	"""
+	Tests of the change versions of the devices and rules, and of the
+	`?since=` lists of the api.
+	"""
+	def setUp(self):
+		self.switch = DummySwitch.objects.create(id="switch-chg", probability=0)
+		self.sensor = DummySensor.objects.create(id="sensor-chg")
+		self.rule = self.create_rule("Changes 01")
+
+	def create_rule(self, name: str) -> Rule:
+		return Rule.objects.create(
+			name=name,
+			source_device=self.sensor,
+			operator=">",
+			threshold="25",
+			target_device=self.switch,
+			command_payload='{"cmd":"set","state":"ON"}'
+		)
+
+	def changes(self, resource: str, since) -> dict:
+		response = self.client.get(f"/api/v1/{resource}/", {"since": since})
+		self.assertEqual(response.status_code, 200)
+		return response.json()
+
+	def test_versions_01(self):
+		"""
+		Each save records a new version, replacing the previous change of the object.
+		"""
+		version = Change.latest_version()
+		self.rule.threshold = "30"
+		self.rule.save()
+		self.assertGreater(Change.latest_version(), version)
+		self.assertEqual(
+			Change.objects.filter(kind=Change.Kinds.RULE, object_id=str(self.rule.id)).count(),
+			1
+		)
+
+	def test_full_02(self):
+		"""
+		Since the version 0, all the objects are returned.
+		"""
+		changes = self.changes("rules", 0)
+		self.assertTrue(changes["full"])
+		self.assertEqual([rule["name"] for rule in changes["results"]], ["Changes 01"])
+		self.assertEqual(changes["version"], Change.latest_version(Change.Kinds.RULE))
+
+		response = self.client.get("/api/v1/devices/")
+		self.assertEqual(response["X-Change-Version"], str(Change.latest_version(Change.Kinds.DEVICE)))
+		self.assertEqual(len(response.json()), 2)
+
+	def test_delta_03(self):
+		"""
+		Only the objects changed after the version are returned, with the deleted ones.
+		"""
+		version = self.changes("rules", 0)["version"]
+		self.assertEqual(self.changes("rules", version)["results"], [])
+
+		second = self.create_rule("Changes 02")
+		rule_id = self.rule.id
+		self.rule.delete()
+		changes = self.changes("rules", version)
+		self.assertFalse(changes["full"])
+		self.assertEqual([rule["id"] for rule in changes["results"]], [second.id])
+		self.assertEqual(changes["deleted"], [rule_id])
+
+		# Nothing after the last version
+		changes = self.changes("rules", changes["version"])
+		self.assertEqual((changes["results"], changes["deleted"]), ([], []))
+
+	def test_device_deleted_04(self):
+		"""
+		Deleting a device also records the deletion of its rules.
+		"""
+		version = self.changes("devices", 0)["version"]
+		self.sensor.delete()
+		self.assertEqual(self.changes("devices", version)["deleted"], ["sensor-chg"])
+		self.assertEqual(self.changes("rules", version)["deleted"], [self.rule.id])
+
+	def test_invalid_since_05(self):
+		"""
+		A version that is not valid is rejected, and a newer one returns everything.
+		"""
+		response = self.client.get("/api/v1/rules/", {"since": "abc"})
+		self.assertEqual(response.status_code, 400)
+		changes = self.changes("rules", Change.latest_version(Change.Kinds.RULE) + 100)
+		self.assertTrue(changes["full"])
+		self.assertEqual(len(changes["results"]), 1)
+
+	def test_notices_06(self):
+		"""
+		The changes are published on the changes topic.
+		"""
+		broker = MQTTBroker(port=0)
+		broker.start()
+		self.addCleanup(broker.stop)
+
+		notices = queue.Queue()
+		client = Client()
+		client.on_message = lambda client, userdata, message: notices.put(json.loads(message.payload))
+		client.connect("127.0.0.1", broker.port)
+		client.subscribe(CHANGES_TOPIC, qos=1)
+		client.loop_start()
+		self.addCleanup(client.loop_stop)
+		self.addCleanup(client.disconnect)
+
+		with override_settings(CHANGES_BROKER_HOST="127.0.0.1", CHANGES_BROKER_PORT=broker.port):
+			self.addCleanup(get_notifier().close)
+			self.rule.threshold = "30"
+			self.rule.save()
+			notice = notices.get(timeout=5)
+			self.assertEqual(notice, {
+				"entity": "rule",
+				"id": str(self.rule.id),
+				"version": Change.latest_version(Change.Kinds.RULE),
+				"deleted": False,
+			})
+
+			self.sensor.delete()
+			deleted = {(notice["entity"], notice["id"]) for notice in [notices.get(timeout=5) for _ in range(2)] if notice["deleted"]}
+			self.assertIn(("device", "sensor-chg"), deleted)
+			self.assertIn(("rule", str(self.rule.id)), deleted)
@@ -0,0 +1,50 @@
+from django.test import SimpleTestCase
+from controller.circuit_breaker import RuleCircuitBreaker, CLOSED, TRIPPED, OPEN
+
+class TestCircuitBreaker(SimpleTestCase):
+	"""
+	Tests of the circuit breaker of the rules applied too often.
+	"""
+	def setUp(self):
+		self.now = 0.0
+		self.breaker = RuleCircuitBreaker(3, period=10, cooldown=60, clock=lambda: self.now)
+
+	def fire(self, key, times, step):
+		states = []
+		for _ in range(times):
+			states.append(self.breaker.fire(key))
+			self.now += step
+		return states
+
+	def test_trip_01(self):
+		"""
+		A rule applied more than the max times in the period trips once,
+		and it is suppressed until the end of the cooldown.
+		"""
+		self.assertEqual(self.fire("a", 6, 1), [CLOSED, CLOSED, CLOSED, TRIPPED, OPEN, OPEN])
+		self.assertEqual(len(self.breaker), 1)
+
+		# The other rules are not suppressed
+		self.assertEqual(self.fire("b", 2, 1), [CLOSED, CLOSED])
+
+		self.now = 63
+		self.assertEqual(self.fire("a", 5, 1), [CLOSED, CLOSED, CLOSED, TRIPPED, OPEN])
+
+	def test_slow_rate_02(self):
+		"""
+		A rule applied at a lower rate does not trip.
+		"""
+		self.assertEqual(set(self.fire("a", 100, 3.4)), {CLOSED})
+		self.assertEqual(self.fire("a", 2, 0.1), [CLOSED, TRIPPED])
+
+	def test_reset_03(self):
+		"""
+		A reset closes the breakers.
+		"""
+		self.fire("a", 4, 0)
+		self.breaker.reset("a")
+		self.assertEqual(self.fire("a", 1, 0), [CLOSED])
+		self.fire("a", 3, 0)
+		self.breaker.reset()
+		self.assertEqual(len(self.breaker), 0)
+		self.assertEqual(self.fire("a", 1, 0), [CLOSED])
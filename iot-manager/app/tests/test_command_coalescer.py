@@ -0,0 +1,116 @@
+from django.test import SimpleTestCase
+import asyncio
+import time
+from controller.compiled_rule import CompiledRule
+from .rows import rule_row
+from controller.command_coalescer import CommandCoalescer, AsyncCommandCoalescer
+from controller.metrics import Counter
+
+class TestCommandCoalescer(SimpleTestCase):
+	"""
+	Tests of the coalescing of the commands sent to each device.
+	"""
+	def setUp(self):
+		self.applied = []
+
+	def build_rule(self, id, target, priority=0):
+		return CompiledRule(rule_row(
+			id=id,
+			target_device_id=target,
+			priority=priority,
+			command_payload=f'{{"cmd":"set","rule":{id}}}'
+		))
+
+	def apply(self, rule, device_id):
+		self.applied.append((rule.id, device_id))
+
+	def test_priority_01(self):
+		"""
+		Only the last command of the highest priority is sent, for each target.
+		"""
+		coalescer = CommandCoalescer(self.apply, window=0.05)
+		coalescer.start()
+		coalescer.submit(self.build_rule(1, "switch-1", priority=1), "sensor-1")
+		coalescer.submit(self.build_rule(2, "switch-1", priority=0), "sensor-2")
+		coalescer.submit(self.build_rule(3, "switch-1", priority=1), "sensor-3")
+		coalescer.submit(self.build_rule(4, "switch-2"), "sensor-4")
+		self.assertEqual(self.applied, [])
+
+		time.sleep(0.2)
+		self.assertEqual(sorted(self.applied), [(3, "sensor-3"), (4, "sensor-4")])
+		self.assertEqual(coalescer.stats(), {
+			'pending': 0,
+			'submitted': 4,
+			'published': 2,
+			'coalesced': 2,
+			'superseded': 1,
+			'outranked': 1,
+		})
+		coalescer.stop()
+
+	def test_stop_02(self):
+		"""
+		The pending commands are sent when it stops, and the next ones at once.
+		"""
+		coalescer = CommandCoalescer(self.apply, window=10)
+		coalescer.start()
+		coalescer.submit(self.build_rule(1, "switch-1"), "sensor-1")
+		coalescer.submit(self.build_rule(2, "switch-1"), "sensor-2")
+		coalescer.stop()
+		self.assertEqual(self.applied, [(2, "sensor-2")])
+
+		coalescer.submit(self.build_rule(3, "switch-1"), "sensor-3")
+		self.assertEqual(self.applied, [(2, "sensor-2"), (3, "sensor-3")])
+
+	def test_async_03(self):
+		"""
+		The asyncio coalescer closes the windows from the loop.
+		"""
+		coalescer = AsyncCommandCoalescer(self.apply, window=0.05)
+
+		async def scenario():
+			coalescer.start()
+			coalescer.submit(self.build_rule(1, "switch-1"), "sensor-1")
+			coalescer.submit(self.build_rule(2, "switch-1"), "sensor-2")
+			await asyncio.sleep(0.2)
+			coalescer.submit(self.build_rule(3, "switch-1"), "sensor-3")
+			coalescer.stop()
+		asyncio.run(scenario())
+
+		self.assertEqual(self.applied, [(2, "sensor-2"), (3, "sensor-3")])
+		self.assertEqual(coalescer.coalesced, 1)
+
+	def test_async_stale_timer_04(self):
+		"""
+		The timer of a window that has been closed before its end does not
+		close the next window of the target.
+		"""
+		coalescer = AsyncCommandCoalescer(self.apply, window=0.1)
+
+		async def scenario():
+			coalescer.start()
+			coalescer.submit(self.build_rule(1, "switch-1"), "sensor-1")
+			await asyncio.sleep(0.05)
+			coalescer.flush_all()
+			await asyncio.sleep(0.01)
+			coalescer.submit(self.build_rule(2, "switch-1"), "sensor-2")
+			await asyncio.sleep(0.07)
+			self.assertEqual(self.applied, [(1, "sensor-1")])
+			await asyncio.sleep(0.15)
+			self.assertEqual(self.applied, [(1, "sensor-1"), (2, "sensor-2")])
+		asyncio.run(scenario())
+
+	def test_metrics_05(self):
+		"""
+		The commands that are not sent are counted in the metric, by reason.
+		"""
+		metric = Counter("coalesced", "Coalesced", labels=("reason",))
+		coalescer = CommandCoalescer(self.apply, window=10, coalesced=metric)
+		coalescer.submit(self.build_rule(1, "switch-1", priority=1), "sensor-1")
+		coalescer.submit(self.build_rule(2, "switch-1", priority=0), "sensor-2")
+		coalescer.submit(self.build_rule(3, "switch-1", priority=1), "sensor-3")
+		coalescer.submit(self.build_rule(4, "switch-1", priority=1), "sensor-4")
+		coalescer.stop()
+		self.assertEqual(self.applied, [(4, "sensor-4")])
+		self.assertEqual(metric.labels("superseded").value, 2)
+		self.assertEqual(metric.labels("outranked").value, 1)
@@ -0,0 +1,70 @@
+from django.test import SimpleTestCase
+from controller.compiled_rule import (
+	CompiledRule,
+	InvalidThresholdError,
+	InvalidOperatorError
+)
+from controller.values import get_correct_value, compare_values
+from .rows import rule_row
+
+class TestCompiledRule(SimpleTestCase):
+	"""
+	Tests of the compiled rules of the controller.
+	"""
+	def build_rule(self, operator, threshold):
+		return CompiledRule(rule_row(name='Compiled', operator=operator, threshold=threshold))
+
+	def test_command_01(self):
+		"""
+		The command is prepared to be published.
+		"""
+		rule = self.build_rule('>', '20')
+		self.assertEqual(rule.command_topic, "redes/2312/10/switch/command")
+		self.assertEqual(rule.command_payload, b'{"cmd":"set","state":"ON"}')
+
+	def test_same_result_02(self):
+		"""
+		The result is the same as comparing with compare_values.
+		"""
+		cases = [
+			('temperature', ['19.5', '20', '20.5'], '20'),
+			('time', ['07:59:59', '08:00:00', '08:00:01'], '08:00:00'),
+			('state', ['ON', 'OFF', 'ON'], 'ON'),
+		]
+		for key, values, threshold in cases:
+			for operator in ['>', '<', '==', '!=', '>=', '<=']:
+				rule = self.build_rule(operator, threshold)
+				for value in values:
+					value = get_correct_value(key, value)
+					expected = compare_values(
+						value,
+						get_correct_value(key, threshold),
+						operator
+					)
+					self.assertEqual(rule.evaluate(key, value), expected)
+
+	def test_errors_03(self):
+		"""
+		The invalid thresholds and operators raise their errors.
+		"""
+		rule = self.build_rule('>', 'hot')
+		with self.assertRaises(InvalidThresholdError):
+			rule.evaluate('temperature', 20.0)
+		with self.assertRaises(InvalidThresholdError):
+			rule.evaluate('temperature', 20.0)
+
+		rule = self.build_rule('=>', '20')
+		with self.assertRaises(InvalidOperatorError):
+			rule.evaluate('temperature', 20.0)
+
+	def test_optional_columns_04(self):
+		"""
+		The rows without the optional columns get their defaults.
+		"""
+		rule = CompiledRule(rule_row())
+		self.assertEqual(
+			(rule.trigger, rule.hysteresis, rule.priority, rule.aggregate, rule.window, rule.duration),
+			('level', 0, 0, None, 0, 0)
+		)
+		rule = CompiledRule(rule_row(trigger='rising', priority=2, aggregate='avg', window=60))
+		self.assertEqual((rule.trigger, rule.priority, rule.aggregate, rule.window), ('rising', 2, 'avg', 60))
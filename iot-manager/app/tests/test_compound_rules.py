@@ -0,0 +1,141 @@
+from app.models import DummySwitch, DummySensor, DummyClock, CompoundRule, CompoundCondition, Change
+from django.test import TransactionTestCase
+from django.db import connection
+from controller.compound_rules import CompoundRuleIndex
+
+class TestCompoundRules(TransactionTestCase):
+	"""
+	Tests of the compound rules (of several devices), and of their
+	incremental evaluation in the controller.
+	"""
+	def setUp(self):
+		self.database = connection.settings_dict['NAME']
+		self.switch = DummySwitch.objects.create(id="switch-cmp", probability=0)
+		self.target = DummySwitch.objects.create(id="switch-cmp-2", probability=0)
+		self.sensor = DummySensor.objects.create(id="sensor-cmp")
+		self.clock = DummyClock.objects.create(id="clock-cmp")
+		self.rule = self.create_rule("Compound 01", [
+			(self.sensor, ">", "25"),
+			(self.clock, ">=", "08:00:00"),
+			(self.switch, "==", "OFF"),
+		])
+
+	def create_rule(self, name, conditions, trigger="level") -> CompoundRule:
+		rule = CompoundRule.objects.create(
+			name=name,
+			trigger=trigger,
+			target_device=self.target,
+			command_payload='{"cmd":"set","state":"ON"}'
+		)
+		for device, operator, threshold in conditions:
+			CompoundCondition.objects.create(rule=rule, device=device, operator=operator, threshold=threshold)
+		return rule
+
+	def names(self, rules):
+		return [rule.name for rule in rules]
+
+	def test_all_conditions_01(self):
+		"""
+		The rule is applied when the last values of all the devices meet
+		their conditions, and only the rules of the device are evaluated.
+		"""
+		index = CompoundRuleIndex(self.database, check_interval=0)
+		self.addCleanup(index.close)
+		self.assertEqual(index.devices, {"sensor-cmp", "clock-cmp", "switch-cmp"})
+		self.assertEqual(
+			[condition.variable for condition in index._compiled[self.rule.id].conditions],
+			["temperature", "time", "state"]
+		)
+
+		self.assertEqual(index.update("sensor-cmp", "temperature", 26.0), [])
+		self.assertEqual(index.update("clock-cmp", "time", 9 * 3600), [])
+		self.assertEqual(self.names(index.update("switch-cmp", "state", "OFF")), ["Compound 01"])
+		self.assertEqual(self.names(index.update("sensor-cmp", "temperature", 27.0)), ["Compound 01"])
+		self.assertEqual(index.update("sensor-cmp", "temperature", 24.0), [])
+		self.assertEqual(index.update("clock-cmp", "time", 10 * 3600), [])
+
+		# Devices and variables that no rule checks
+		self.assertEqual(index.update("sensor-other", "temperature", 30.0), [])
+		self.assertEqual(index.update("sensor-cmp", "state", "ON"), [])
+
+	def test_triggers_02(self):
+		"""
+		The edge triggered rules are applied on the transitions of the
+		whole condition.
+		"""
+		self.create_rule("Compound rising", [(self.sensor, ">", "25"), (self.sensor, "<", "30")], "rising")
+		self.create_rule("Compound falling", [(self.sensor, ">", "25"), (self.clock, "<", "12:00:00")], "falling")
+		index = CompoundRuleIndex(self.database, check_interval=0)
+		self.addCleanup(index.close)
+
+		index.update("clock-cmp", "time", 9 * 3600)
+		applied = [
+			self.names(index.update("sensor-cmp", "temperature", temperature))
+			for temperature in [26.0, 27.0, 31.0, 28.0, 20.0]
+		]
+		self.assertEqual(applied, [
+			["Compound rising"], [], [], ["Compound rising"], ["Compound falling"],
+		])
+
+	def test_refresh_03(self):
+		"""
+		The changes of the rules and of their conditions are loaded, the
+		not changed rules keep their state, and the new ones are evaluated
+		with the last values.
+		"""
+		index = CompoundRuleIndex(self.database, check_interval=0)
+		self.addCleanup(index.close)
+		compiled = index._compiled[self.rule.id]
+		index.update("sensor-cmp", "temperature", 26.0)
+		index.update("clock-cmp", "time", 9 * 3600)
+
+		self.create_rule("Compound 02", [(self.sensor, ">", "20"), (self.clock, "<", "10:00:00")])
+		self.assertEqual(self.names(index.update("clock-cmp", "time", 9 * 3600 + 1)), ["Compound 02"])
+		self.assertIs(index._compiled[self.rule.id], compiled)
+
+		# A change of a condition is a change of the rule
+		version = Change.latest_version(Change.Kinds.COMPOUND_RULE)
+		condition = self.rule.conditions.get(device=self.switch)
+		condition.threshold = "ON"
+		condition.save()
+		self.assertGreater(Change.latest_version(Change.Kinds.COMPOUND_RULE), version)
+		self.assertEqual(self.names(index.update("switch-cmp", "state", "ON")), ["Compound 01"])
+
+		# Deleting a device deletes the rules that check it
+		self.clock.delete()
+		self.assertFalse(CompoundRule.objects.exists())
+		self.assertEqual(index.update("switch-cmp", "state", "ON"), [])
+		self.assertEqual(index.devices, frozenset())
+
+	def test_api_04(self):
+		"""
+		The compound rules are listed by the api, with their conditions.
+		"""
+		response = self.client.get("/api/v1/compound-rules/")
+		self.assertEqual(response.status_code, 200)
+		rule, = response.json()
+		self.assertEqual(rule["name"], "Compound 01")
+		self.assertEqual(
+			[(condition["device"], condition["variable"]) for condition in rule["conditions"]],
+			[("sensor-cmp", "temperature"), ("clock-cmp", "time"), ("switch-cmp", "state")]
+		)
+
+		changes = self.client.get("/api/v1/compound-rules/", {"since": 0}).json()
+		self.assertEqual(changes["version"], Change.latest_version(Change.Kinds.COMPOUND_RULE))
+
+	def test_refresh_without_update_05(self):
+		"""
+		The rules and conditions changed without updating `updated_at`
+		(QuerySet.update or raw SQL) are also read again.
+		"""
+		index = CompoundRuleIndex(self.database, check_interval=0)
+		self.addCleanup(index.close)
+		index.update("sensor-cmp", "temperature", 26.0)
+		index.update("clock-cmp", "time", 9 * 3600)
+
+		CompoundCondition.objects.filter(rule=self.rule, device=self.switch).update(threshold="ON")
+		self.assertEqual(self.names(index.update("switch-cmp", "state", "ON")), ["Compound 01"])
+
+		with connection.cursor() as cursor:
+			cursor.execute("UPDATE app_compoundrule SET command_payload = %s WHERE id = %s", ['{"cmd":"get"}', self.rule.id])
+		self.assertEqual(index.update("switch-cmp", "state", "ON")[0].command_payload, b'{"cmd":"get"}')
@@ -1,118 +1,274 @@
-from app.models import DummySwitch, DummySensor, Rule
+from app.models import DummySwitch, DummySensor, Rule, Log
 from django.test import TransactionTestCase
 from paho.mqtt.client import Client
-import time
+import importlib
 import json
-import os
-import subprocess
-import signal
+import threading
+import time
 from django.db import connection
+from broker.server import MQTTBroker
+from broker.fake import FakeBroker
+from controller.IOTController import IOTController, CHANGES_TOPIC
+
+# The modules of the devices (their names are not valid identifiers)
+dummy_switch = importlib.import_module("iot.dummy-switch")
+dummy_sensor = importlib.import_module("iot.dummy-sensor")
 
 class TestController(TransactionTestCase):
 	"""
+	End to end tests of the controller and the dummy devices.
 	"""
 	def setUp(self):
-		self.client: Client = Client()
-		self.switch_ok = True
-
-	def no_message(self, client, userdata, message):
-		pass
+		# Create the sensor, switch and rules
+		switch = DummySwitch.objects.create(id="swtc01", probability=0)
+		sensor = DummySensor.objects.create(id="sstc01")
+		for threshold in [10, 11]:
+			Rule.objects.create(
+				name=f"Test {threshold}",
+				source_device=sensor,
+				operator="==",
+				threshold=threshold,
+				target_device=switch,
+				command_payload='{"cmd":"set","state":"ON"}'
+			)
+		self.switch_on = threading.Event()
 
 	def check_switch(self, client, userdata, message):
-		message_payload = json.loads(message.payload.decode('utf-8'))
-		if message_payload.get("state") == "ON":
-			self.switch_ok = True
+		if json.loads(message.payload).get("state") == "ON":
+			self.switch_on.set()
 
-	def test_constroller_01(self):
+	def run_devices(self, switch_class, sensor_class, **connection_params):
 		"""
+		Run the switch (starts OFF) and the sensor (sends 10 and 11) in threads.
 		"""
-		# Connect with broker (mosquitto)
-		self.client.on_message = self.no_message
-		try:
-			self.client.connect("localhost", 1883)
-			self.client.loop_start()
-		except Exception as e:
-			self.fail(f"Failed to connect to broker: {e}")
-
-		# Execute the controller
-		cmd = [
-			"python3", '-m', 'controller.controller',
-			"--host", "localhost", '--database', 'test-db.sqlite3'
+		devices = [
+			switch_class(device_id="swtc01", probability=0, **connection_params),
+			sensor_class(
+				device_id="sstc01",
+				interval=0.01,
+				min_value=10,
+				max_value=11,
+				increment=1,
+				**connection_params
+			),
 		]
-		env = os.environ.copy()
-		env['PYTHONPATH'] = '../'
-		process = subprocess.Popen(
-			cmd,
-			env=env,
+		for device in devices:
+			thread = threading.Thread(target=device.run, daemon=True)
+			thread.start()
+			self.addCleanup(thread.join, 2)
+			self.addCleanup(device.stop)
+
+	def test_controller_01(self):
+		"""
+		The rule of the sensor turns on the switch (embedded broker, over TCP).
+		"""
+		broker = MQTTBroker(port=0)
+		broker.start()
+		self.addCleanup(broker.stop)
+
+		# Follow the state of the switch
+		client = Client()
+		client.on_connect = lambda client, userdata, flags, rc: \
+			client.subscribe("redes/2312/10/swtc01/state")
+		client.on_message = self.check_switch
+		client.connect("127.0.0.1", broker.port)
+		client.loop_start()
+		self.addCleanup(client.loop_stop)
+		self.addCleanup(client.disconnect)
+
+		controller = IOTController(
+			host="127.0.0.1",
+			port=broker.port,
+			database=connection.settings_dict['NAME']
 		)
-		controller_pid = process.pid
-		time.sleep(1)
+		controller.start()
+		self.addCleanup(controller.stop)
 
-		# Create the sensor, switch and rule
-		switch = DummySwitch.objects.create(
-			id="swtc01",
+		self.run_devices(
+			dummy_switch.DummySwitchDevice,
+			dummy_sensor.DummySensorDevice,
+			host="127.0.0.1",
+			port=broker.port
+		)
+		self.assertTrue(self.switch_on.wait(5))
+
+	def test_fake_broker_02(self):
+		"""
+		The rule of the sensor turns on the switch (in-process broker).
+		"""
+		broker = FakeBroker()
+		client = broker.client()
+		client.on_message = self.check_switch
+		client.connect("localhost", 1883)
+		client.subscribe("redes/2312/10/swtc01/state")
+		client.loop_start()
+		self.addCleanup(client.loop_stop)
+		self.addCleanup(client.disconnect)
+
+		controller = broker.bind(IOTController)(
 			host="localhost",
 			port=1883,
-			probability=0
+			database=connection.settings_dict['NAME']
 		)
-		sensor = DummySensor.objects.create(
-			id="sstc01",
+		controller.start()
+		self.addCleanup(controller.stop)
+
+		self.run_devices(
+			broker.bind(dummy_switch.DummySwitchDevice),
+			broker.bind(dummy_sensor.DummySensorDevice),
 			host="localhost",
-			port=1883,
-			min_value=10,
-			max_value=12,
-			interval=1,
-			increment=1
+			port=1883
 		)
-		rule1 = Rule.objects.create(
-			name="Test 10",
-			source_device=sensor,
-			operator="==",
-			threshold=10,
-			target_device=switch,
-			command_payload='{"cmd":"set","state":"ON"}'
+		self.assertTrue(self.switch_on.wait(5))
+		self.assertEqual(broker.errors, [])
+		self.assertEqual(
+			broker.messages("redes/2312/10/swtc01/command")[0].payload,
+			b'{"cmd":"set","state":"ON"}'
 		)
-		rule2 = Rule.objects.create(
-			name="Test 11",
-			source_device=sensor,
-			operator="==",
-			threshold=11,
-			target_device=switch,
+
+class SlowController(IOTController):
+	"""
+	Controller that takes some time to process each message, so there
+	are queued messages when it is stopped.
+	"""
+	def process_message(self, device_id, payload):
+		time.sleep(0.005)
+		super().process_message(device_id, payload)
+
+class TestControllerLifecycle(TransactionTestCase):
+	"""
+	Tests of the drain of the controller when it is stopped, and of the
+	reload of the rules.
+	"""
+	def setUp(self):
+		self.switch = DummySwitch.objects.create(id="swlc01", probability=0)
+		self.sensor = DummySensor.objects.create(id="sslc01")
+		Rule.objects.create(
+			name="Lifecycle 01",
+			source_device=self.sensor,
+			operator=">",
+			threshold="25",
+			target_device=self.switch,
 			command_payload='{"cmd":"set","state":"ON"}'
 		)
-		connection.commit()
-
-		# Execute the devices
-		switch_pid = switch.start_process(['--probability', '0']) # Start => OFF, por lo que deberia cambiar
-		sensor_pid = sensor.start_process(['--min', '10', '--max', '11', '--interval', '1', '--increment', '1'])
-		self.assertNotEquals(switch_pid, None)
-		self.assertNotEquals(sensor_pid, None)
-
-		# Wait until the rule is executed (min one time)
-		time.sleep(2)
-
-		# Check the switch state
-		self.client.subscribe("redes/2312/10/sstc01/state")
-		self.client.on_message = self.check_switch
-		self.client.publish(
-			"redes/2312/10/swtc01/command",
-			json.dumps({
-				"cmd": "get"
-			}),
+		self.broker = FakeBroker()
+
+	def start_controller(self, cls=IOTController, **kwargs) -> IOTController:
+		controller = self.broker.bind(cls)(
+			host="localhost",
+			port=1883,
+			database=connection.settings_dict['NAME'],
+			**kwargs
+		)
+		controller.start()
+		self.broker.join(2)
+		return controller
+
+	def send(self, value: int) -> None:
+		self.broker.publish(
+			"redes/2312/10/sslc01/state",
+			json.dumps({"temperature": value})
+		)
+
+	def test_drain_01(self):
+		"""
+		The queued messages are processed, and their commands published
+		and logged, before disconnecting.
+		"""
+		controller = self.start_controller(SlowController, workers=1)
+		for value in range(26, 76):
+			self.send(value)
+		self.broker.join(2)
+		self.assertGreater(controller.workers.queue_depth, 0)
+
+		self.assertTrue(controller.stop())
+		self.assertEqual(len(self.broker.messages("redes/2312/10/swlc01/command")), 50)
+		self.assertEqual(controller.commands_pending(), 0)
+		self.assertEqual(Log.objects.filter(device="sslc01").count(), 50)
+		self.assertEqual(self.broker.clients, [])
+		self.assertEqual(self.broker.errors, [])
+
+	def test_drain_coalesced_02(self):
+		"""
+		The coalesced commands are sent before disconnecting.
+		"""
+		controller = self.start_controller(command_window=60)
+		self.send(30)
+		self.broker.join(2)
+		controller.workers.join()
+		self.assertEqual(self.broker.messages("redes/2312/10/swlc01/command"), [])
+
+		self.assertTrue(controller.stop())
+		self.assertEqual(len(self.broker.messages("redes/2312/10/swlc01/command")), 1)
+
+	def test_intake_stopped_03(self):
+		"""
+		The messages received while stopping are not processed.
+		"""
+		controller = self.start_controller()
+		controller._stopping.set()
+		controller.stop_intake()
+		self.send(30)
+		self.broker.join(2)
+		controller.stop()
+		self.assertEqual(self.broker.messages("redes/2312/10/swlc01/command"), [])
+
+	def test_reload_04(self):
+		"""
+		The new rules are used after a reload, without waiting for the refresh.
+		"""
+		controller = self.start_controller(rules_refresh=3600)
+		self.addCleanup(controller.stop)
+		Rule.objects.create(
+			name="Lifecycle 02",
+			source_device=self.sensor,
+			operator="<",
+			threshold="10",
+			target_device=self.switch,
+			command_payload='{"cmd":"set","state":"OFF"}'
+		)
+		controller.reload()
+		self.send(5)
+		self.broker.join(2)
+		controller.workers.join()
+		self.assertEqual(
+			[message.payload for message in self.broker.messages("redes/2312/10/swlc01/command")],
+			[b'{"cmd":"set","state":"OFF"}']
+		)
+
+	def test_change_notice_05(self):
+		"""
+		The rules of a change notice are applied at once, without waiting
+		for the check of the database.
+		"""
+		controller = self.start_controller(rules_refresh=3600)
+		self.addCleanup(controller.stop)
+		rule = Rule.objects.create(
+			name="Lifecycle 03",
+			source_device=self.sensor,
+			operator="<",
+			threshold="10",
+			target_device=self.switch,
+			command_payload='{"cmd":"set","state":"OFF"}'
+		)
+		self.broker.publish(CHANGES_TOPIC, json.dumps({"entity": "rule", "id": str(rule.id), "version": 1}), qos=1)
+		self.broker.join(2)
+		self.send(5)
+		self.broker.join(2)
+		controller.workers.join()
+
+		# Deleted
+		rule_id = rule.id
+		rule.delete()
+		self.broker.publish(CHANGES_TOPIC, json.dumps({"entity": "rule", "id": str(rule_id), "version": 2}), qos=1)
+		self.broker.join(2)
+		self.send(5)
+		self.broker.join(2)
+		controller.workers.join()
+
+		self.assertEqual(
+			[message.payload for message in self.broker.messages("redes/2312/10/swlc01/command")],
+			[b'{"cmd":"set","state":"OFF"}']
 		)
-		time.sleep(1)
-
-		# Stop the client loop
-		self.client.loop_stop()
-		switch_stop = switch.stop_process()
-		sensor_stop = sensor.stop_process()
-		self.assertTrue(switch_stop)
-		self.assertTrue(sensor_stop)
-
-		try:
-			os.kill(controller_pid, signal.SIGKILL)
-		except:
-			pass
-
-		# Check if the status changed
-		self.assertTrue(self.switch_ok)
+		self.assertEqual(controller.metrics.change_notices.labels("rule").value, 2)
+		self.assertEqual(self.broker.errors, [])
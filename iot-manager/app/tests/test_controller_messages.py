@@ -0,0 +1,478 @@
+from app.models import DummySwitch, DummySensor, DummyClock, Rule, CompoundRule, CompoundCondition, Log
+from django.test import TransactionTestCase
+from django.db import connection
+from django.core.exceptions import ValidationError
+from paho.mqtt.client import MQTTMessage
+from controller.IOTController import IOTController
+from controller.profiler import read_traces
+import os
+import tempfile
+import threading
+import time
+
+class TestControllerMessages(TransactionTestCase):
+	"""
+	Tests of the message handling of the controller, without broker.
+	"""
+	def setUp(self):
+		self.switch = DummySwitch.objects.create(id="switch-msg", probability=0)
+		self.sensor = DummySensor.objects.create(id="sensor-msg")
+		Rule.objects.create(
+			name="Messages 01",
+			source_device=self.sensor,
+			operator=">",
+			threshold="25",
+			target_device=self.switch,
+			command_payload='{"cmd":"set","state":"ON"}'
+		)
+		self.controller = self.create_controller()
+
+	def tearDown(self):
+		self.controller.stop()
+
+	def create_controller(self, **kwargs) -> IOTController:
+		controller = IOTController(
+			host="localhost",
+			port=1883,
+			database=connection.settings_dict['NAME'],
+			**kwargs
+		)
+		self.published = []
+		controller.client.publish = lambda topic, payload, qos=0, retain=False: \
+			self.published.append((topic, payload))
+		controller.start_processing()
+		return controller
+
+	def send(self, device_id: str, payload: bytes, wait: bool = True) -> None:
+		message = MQTTMessage(topic=f"redes/2312/10/{device_id}/state".encode())
+		message.payload = payload
+		self.controller.on_message(self.controller.client, None, message)
+		if wait and self.controller.workers is not None:
+			self.controller.workers.join()
+
+	def logs(self):
+		self.controller.logs.join()
+		return list(
+			Log.objects.order_by('id').values_list('message', flat=True)
+		)
+
+	def test_rule_applied_01(self):
+		"""
+		The command is published and logged when the rule matches.
+		"""
+		self.send("sensor-msg", b'{"temperature": 24}')
+		self.assertEqual(self.published, [])
+
+		self.send("sensor-msg", b'{"temperature": 26}')
+		self.assertEqual(self.published, [(
+			"redes/2312/10/switch-msg/command",
+			b'{"cmd":"set","state":"ON"}'
+		)])
+		self.assertEqual(self.logs(), ["Rule 'Messages 01' applied"])
+
+	def test_bad_messages_02(self):
+		"""
+		The bad messages are logged and ignored.
+		"""
+		self.send("sensor-msg", b'not json')
+		self.send("sensor-msg", b'{"readings": [{"ts": 1}]}')
+		self.send("sensor-msg", b'{"temperature": "hot"}')
+		self.assertEqual(self.published, [])
+		self.assertEqual(self.logs(), [
+			"Bad message format",
+			"Bad message format",
+			"Bad value format",
+		])
+
+	def test_triggers_03(self):
+		"""
+		The edge triggered rules are only applied on the transitions.
+		"""
+		for trigger in ['rising', 'falling', 'hysteresis']:
+			Rule.objects.create(
+				name=f"Messages {trigger}",
+				source_device=self.sensor,
+				operator=">",
+				threshold="25",
+				trigger=trigger,
+				hysteresis=2,
+				target_device=self.switch,
+				command_payload=f'{{"cmd":"{trigger}"}}'
+			)
+		self.controller.rules.invalidate()
+
+		for temperature in [24, 26, 27, 24.5, 26, 22, 26]:
+			self.send("sensor-msg", f'{{"temperature": {temperature}}}'.encode())
+		self.assertEqual(
+			[payload for _, payload in self.published],
+			[
+				b'{"cmd":"set","state":"ON"}', b'{"cmd":"rising"}', b'{"cmd":"hysteresis"}',	# 26
+				b'{"cmd":"set","state":"ON"}',													# 27
+				b'{"cmd":"falling"}',															# 24.5
+				b'{"cmd":"set","state":"ON"}', b'{"cmd":"rising"}',								# 26
+				b'{"cmd":"falling"}',															# 22
+				b'{"cmd":"set","state":"ON"}', b'{"cmd":"rising"}', b'{"cmd":"hysteresis"}',	# 26
+			]
+		)
+		self.assertEqual(len(self.logs()), 11)
+
+	def test_command_window_04(self):
+		"""
+		The commands to the same device during the window are sent once.
+		"""
+		Rule.objects.create(
+			name="Messages priority",
+			source_device=self.sensor,
+			operator="<",
+			threshold="30",
+			priority=1,
+			target_device=self.switch,
+			command_payload='{"cmd":"set","state":"OFF"}'
+		)
+		self.controller.stop()
+		self.controller = self.create_controller(command_window=10)
+
+		self.send("sensor-msg", b'{"temperature": 26}')
+		self.send("sensor-msg", b'{"temperature": 27}')
+		self.assertEqual(self.published, [])
+
+		self.controller.commands.flush_all()
+		self.assertEqual(self.published, [(
+			"redes/2312/10/switch-msg/command",
+			b'{"cmd":"set","state":"OFF"}'
+		)])
+		self.assertEqual(self.logs(), ["Rule 'Messages priority' applied"])
+		self.assertEqual(self.controller.commands.coalesced, 3)
+
+	def test_metrics_05(self):
+		"""
+		The messages, rules and commands are counted.
+		"""
+		self.send("sensor-msg", b'{"temperature": 24}')
+		self.send("sensor-msg", b'{"temperature": 26}')
+		self.send("sensor-msg", b'not json')
+
+		metrics = self.controller.metrics
+		self.assertEqual(metrics.messages.labels("sensor").value, 2)
+		self.assertEqual(metrics.parse_failures.labels("Bad message format").value, 1)
+		self.assertEqual(metrics.rules_evaluated.labels().value, 2)
+		self.assertEqual(metrics.rules_fired.labels().value, 1)
+		self.assertEqual(metrics.commands_published.labels().value, 1)
+		self.assertIn("iot_controller_message_seconds_count 3\n", metrics.render())
+		self.assertIn('iot_controller_queue_depth{queue="messages"} 0\n', metrics.render())
+
+	def test_profile_06(self):
+		"""
+		In profile mode, the time of the stages of each message is written.
+		"""
+		directory = tempfile.TemporaryDirectory()
+		self.addCleanup(directory.cleanup)
+		path = os.path.join(directory.name, "profile.jsonl")
+		self.controller.stop()
+		self.controller = self.create_controller(profile_file=path, profile_sample=1)
+
+		self.send("sensor-msg", b'{"temperature": 26}')
+		self.send("sensor-msg", b'not json')
+		self.controller.profiler.close()
+
+		applied, bad = read_traces(path)
+		self.assertEqual(applied["device"], "sensor-msg")
+		self.assertEqual(
+			list(applied["stages"]),
+			["decode", "conversion", "lookup", "evaluation", "publish", "log"]
+		)
+		self.assertGreaterEqual(applied["total"], sum(applied["stages"].values()))
+		self.assertTrue(applied["profile"])
+		self.assertEqual(list(bad["stages"]), ["log"])
+
+	def test_batch_07(self):
+		"""
+		The readings of a batched message are evaluated in order, and logged once.
+		"""
+		Rule.objects.create(
+			name="Messages rising",
+			source_device=self.sensor,
+			operator=">",
+			threshold="25",
+			trigger="rising",
+			target_device=self.switch,
+			command_payload='{"cmd":"rising"}'
+		)
+		self.controller.rules.invalidate()
+
+		self.send("sensor-msg", b'{"readings": [' \
+			b'{"ts": 1700000000, "temperature": 26}, {"ts": 1700000001, "temperature": 24},' \
+			b'{"ts": 1700000002, "temperature": "hot"}, {"ts": 1700000003.5, "temperature": 27}]}')
+		self.assertEqual(
+			[payload for _, payload in self.published],
+			[
+				b'{"cmd":"set","state":"ON"}', b'{"cmd":"rising"}',		# 26
+				b'{"cmd":"set","state":"ON"}', b'{"cmd":"rising"}',		# 27
+			]
+		)
+		self.assertEqual(self.logs(), [
+			"Batch of 4 readings: rules applied 'Messages 01' x2, 'Messages rising' x2; Bad value format x1",
+		])
+
+		# Several variables at once
+		self.send("sensor-msg", b'{"temperature": 24, "humidity": 10}')
+		self.assertEqual(len(self.published), 4)
+		self.assertEqual(self.logs()[-1], "Batch of 2 readings: Bad value format x1")
+		self.assertEqual(self.controller.metrics.messages.labels("sensor").value, 4)
+		self.assertEqual(self.controller.metrics.parse_failures.labels("Bad value format").value, 2)
+
+		# Several known variables: each one is only checked with its rules
+		self.send("sensor-msg", b'{"temperature": 26, "state": "ON"}')
+		self.assertEqual(self.logs()[-1], "Batch of 2 readings: rules applied 'Messages 01' x1, 'Messages rising' x1")
+		self.send("sensor-msg", b'{"state": "ON", "temperature": 26}')
+		self.assertEqual(self.logs()[-1], "Batch of 2 readings: rules applied 'Messages 01' x1")
+		self.assertEqual(
+			[payload for _, payload in self.published[4:]],
+			[b'{"cmd":"set","state":"ON"}', b'{"cmd":"rising"}', b'{"cmd":"set","state":"ON"}']
+		)
+
+	def test_compound_08(self):
+		"""
+		The compound rules are evaluated with the values of each device,
+		after the rules of the device.
+		"""
+		clock = DummyClock.objects.create(id="clock-msg")
+		rule = CompoundRule.objects.create(
+			name="Messages compound",
+			target_device=self.switch,
+			command_payload='{"cmd":"compound"}'
+		)
+		CompoundCondition.objects.create(rule=rule, device=self.sensor, operator=">", threshold="25")
+		CompoundCondition.objects.create(rule=rule, device=clock, operator=">=", threshold="08:00:00")
+		self.controller.compound.invalidate()
+
+		self.send("sensor-msg", b'{"temperature": 26}')
+		self.send("clock-msg", b'{"time": "07:59:59"}')
+		self.send("clock-msg", b'{"time": "08:00:00"}')
+		self.send("sensor-msg", b'{"temperature": 27}')
+		self.assertEqual(
+			[payload for _, payload in self.published],
+			[b'{"cmd":"set","state":"ON"}', b'{"cmd":"compound"}', b'{"cmd":"set","state":"ON"}', b'{"cmd":"compound"}']
+		)
+		self.assertEqual(self.logs(), [
+			"Rule 'Messages 01' applied",
+			"Rule 'Messages compound' applied",
+			"Rule 'Messages 01' applied",
+			"Rule 'Messages compound' applied",
+		])
+
+	def test_window_09(self):
+		"""
+		The rules with an aggregate are evaluated with the values of the
+		window, at the times of the readings.
+		"""
+		rule = Rule(
+			name="Messages average",
+			source_device=self.sensor,
+			aggregate="avg",
+			window=60,
+			operator=">",
+			threshold="26",
+			trigger="rising",
+			target_device=self.switch,
+			command_payload='{"cmd":"average"}'
+		)
+		rule.full_clean()
+		rule.save()
+		self.controller.rules.invalidate()
+
+		self.send("sensor-msg", b'{"readings": [{"ts": 1000, "temperature": 24}, {"ts": 1010, "temperature": 27}]}')
+		self.send("sensor-msg", b'{"readings": [{"ts": 1020, "temperature": 28}, {"ts": 1030, "temperature": 30}]}')
+		self.send("sensor-msg", b'{"readings": [{"ts": 1100, "temperature": 20}, {"ts": 1110, "temperature": 34}]}')
+		self.assertEqual(
+			[payload for _, payload in self.published if payload == b'{"cmd":"average"}'],
+			[b'{"cmd":"average"}', b'{"cmd":"average"}']
+		)
+
+		# The aggregates are validated
+		for aggregate, window, trigger in [("avg", 0, "level"), ("max", 10, "hysteresis")]:
+			rule.aggregate, rule.window, rule.trigger = aggregate, window, trigger
+			with self.assertRaises(ValidationError):
+				rule.full_clean()
+
+	def test_duration_10(self):
+		"""
+		The rules with a duration are applied once when their condition
+		has been met during the whole duration, and not when a value
+		breaks it before.
+		"""
+		rule = Rule(
+			name="Messages duration",
+			source_device=self.sensor,
+			operator=">",
+			threshold="30",
+			duration=0.3,
+			target_device=self.switch,
+			command_payload='{"cmd":"duration"}'
+		)
+		rule.full_clean()
+		rule.save()
+		self.controller.rules.invalidate()
+		def commands():
+			return [payload for _, payload in self.published if payload == b'{"cmd":"duration"}']
+
+		# Broken before the end
+		self.send("sensor-msg", b'{"temperature": 31}')
+		self.send("sensor-msg", b'{"temperature": 29}')
+		time.sleep(0.5)
+		self.assertEqual(commands(), [])
+		self.assertEqual(len(self.controller.timers), 0)
+
+		# Met during the whole duration, with more values
+		self.send("sensor-msg", b'{"temperature": 31}')
+		self.send("sensor-msg", b'{"temperature": 32}')
+		self.assertEqual(commands(), [])
+		deadline = time.monotonic() + 5
+		while not commands() and time.monotonic() < deadline:
+			time.sleep(0.02)
+		self.send("sensor-msg", b'{"temperature": 33}')
+		time.sleep(0.5)
+		self.assertEqual(commands(), [b'{"cmd":"duration"}'])
+		self.assertIn("Rule 'Messages duration' applied", self.logs())
+
+		# The durations are validated
+		for duration, trigger in [(-1, "level"), (10, "falling"), (10, "hysteresis")]:
+			rule.duration, rule.trigger = duration, trigger
+			with self.assertRaises(ValidationError):
+				rule.full_clean()
+
+	def test_breaker_11(self):
+		"""
+		A rule applied too often is suppressed, and the trip is logged once.
+		"""
+		self.controller.stop()
+		self.controller = self.create_controller(breaker_max_fires=3, breaker_period=60, breaker_cooldown=60)
+		for temperature in range(26, 32):
+			self.send("sensor-msg", f'{{"temperature": {temperature}}}'.encode())
+		self.assertEqual(len(self.published), 3)
+		self.assertEqual(self.logs(), [
+			"Rule 'Messages 01' applied",
+			"Rule 'Messages 01' applied",
+			"Rule 'Messages 01' applied",
+			"Rule 'Messages 01' suppressed for 60s: applied more than 3 times in 60s",
+		])
+		self.assertEqual(self.controller.metrics.breaker_trips.labels().value, 1)
+		self.assertEqual(self.controller.metrics.rules_suppressed.labels().value, 3)
+
+		# A reload closes it
+		self.controller.reload()
+		self.send("sensor-msg", b'{"temperature": 26}')
+		self.assertEqual(len(self.published), 4)
+
+	def test_conflate_12(self):
+		"""
+		With conflation, only the newest queued message of each device is
+		evaluated, and the discarded messages are counted by device.
+		"""
+		self.controller.stop()
+		self.controller = self.create_controller(workers=1, queue_size=1, conflate=True, shed_policy="drop-newest")
+		gate = threading.Event()
+		handler = self.controller.workers.handler
+		self.controller.workers.handler = lambda item: (gate.wait(5), handler(item))
+
+		# The first message is taken by the worker, that waits
+		self.send("sensor-msg", b'{"temperature": 20}', wait=False)
+		while self.controller.workers.queue_depth:
+			time.sleep(0.01)
+		self.send("sensor-msg", b'{"temperature": 24}', wait=False)
+		self.send("sensor-msg", b'{"temperature": 26}', wait=False)
+		self.send("sensor-other", b'{"temperature": 30}', wait=False)
+		gate.set()
+		self.controller.workers.join()
+
+		self.assertEqual(len(self.published), 1)
+		discarded = self.controller.metrics.messages_discarded
+		self.assertEqual(discarded.labels("sensor-msg", "conflated").value, 1)
+		self.assertEqual(discarded.labels("sensor-other", "shed").value, 1)
+		self.assertIn('reason="conflated"', self.controller.metrics.render())
+
+	def test_batch_window_13(self):
+		"""
+		With a command window, the rules of a batch are logged once, when
+		their command is sent, and not in the summary of the batch.
+		"""
+		Rule.objects.create(
+			name="Messages priority",
+			source_device=self.sensor,
+			operator="<",
+			threshold="30",
+			priority=1,
+			target_device=self.switch,
+			command_payload='{"cmd":"set","state":"OFF"}'
+		)
+		self.controller.stop()
+		self.controller = self.create_controller(command_window=10)
+
+		self.send("sensor-msg", b'{"readings": [{"temperature": 26}, {"temperature": "hot"}, {"temperature": 27}]}')
+		self.controller.commands.flush_all()
+		self.assertEqual([payload for _, payload in self.published], [b'{"cmd":"set","state":"OFF"}'])
+		self.assertEqual(self.logs(), [
+			"Batch of 3 readings: Bad value format x1",
+			"Rule 'Messages priority' applied",
+		])
+
+	def test_triggers_pruned_14(self):
+		"""
+		The state of the edge triggered rules is forgotten when they are
+		updated or deleted.
+		"""
+		rules = [
+			Rule.objects.create(
+				name=f"Messages prune {i}",
+				source_device=self.sensor,
+				operator=">",
+				threshold="25",
+				trigger="rising",
+				target_device=self.switch,
+				command_payload='{"cmd":"rising"}'
+			)
+			for i in range(3)
+		]
+		self.controller.rules.invalidate()
+		self.send("sensor-msg", b'{"temperature": 26}')
+		self.assertEqual(len(self.controller.triggers), 3)
+
+		rules[0].threshold = "20"
+		rules[0].save()
+		rules[1].delete()
+		self.controller.rules.invalidate()
+		self.assertEqual(list(self.controller.triggers._states), [rules[2].id])
+
+	def test_durations_pruned_15(self):
+		"""
+		The rules with a duration that are deleted or moved to other
+		device are forgotten, with their timers.
+		"""
+		rules = [
+			Rule.objects.create(
+				name=f"Messages duration {i}",
+				source_device=self.sensor,
+				operator=">",
+				threshold="30",
+				duration=duration,
+				target_device=self.switch,
+				command_payload='{"cmd":"duration"}'
+			)
+			for i, duration in enumerate([0.05, 60])
+		]
+		self.controller.rules.invalidate()
+		self.send("sensor-msg", b'{"temperature": 31}')
+		deadline = time.monotonic() + 5
+		while len(self.controller.timers) > 1 and time.monotonic() < deadline:
+			time.sleep(0.02)
+		self.assertEqual(len(self.controller.durations), 2)
+		self.assertEqual(len(self.controller.timers), 1)
+
+		# The applied one is moved to other device, and the pending one deleted
+		other = DummySensor.objects.create(id="sensor-msg-2")
+		rules[0].source_device = other
+		rules[0].save()
+		rules[1].delete()
+		self.controller.rules.invalidate()
+		self.assertEqual(len(self.controller.durations), 0)
+		self.assertEqual(len(self.controller.timers), 0)
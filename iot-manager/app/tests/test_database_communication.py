@@ -0,0 +1,60 @@
+from django.test import TransactionTestCase
+from django.db import connection
+import threading
+from controller.database_communication import (
+	ConnectionManager,
+	add_log
+)
+from app.models import Log
+
+class TestConnectionManager(TransactionTestCase):
+	"""
+	Tests of the connections of the controller with the database.
+	"""
+	def setUp(self):
+		self.manager = ConnectionManager(
+			connection.settings_dict['NAME'],
+			busy_timeout=1234,
+			mmap_size=0
+		)
+
+	def tearDown(self):
+		self.manager.close()
+
+	def test_per_thread_01(self):
+		"""
+		Each thread has its own connection, and it is reused.
+		"""
+		main = self.manager.connection()
+		self.assertIs(self.manager.connection(), main)
+		self.assertEqual(
+			main.execute("PRAGMA busy_timeout").fetchone()[0], 1234
+		)
+
+		connections = []
+		thread = threading.Thread(
+			target=lambda: connections.append(self.manager.connection())
+		)
+		thread.start()
+		thread.join()
+		self.assertIsNot(connections[0], main)
+
+	def test_reconnect_02(self):
+		"""
+		A closed connection is opened again when an operation fails.
+		"""
+		self.manager.run(add_log, "Before", "device-01")
+		self.manager.connection().close()
+		self.manager.run(add_log, "After", "device-01")
+		self.assertEqual(Log.objects.filter(device="device-01").count(), 2)
+
+	def test_close_03(self):
+		"""
+		After closing, the connections can not be used.
+		"""
+		current = self.manager.connection()
+		self.manager.close()
+		with self.assertRaises(Exception):
+			current.execute("SELECT 1")
+		with self.assertRaises(Exception):
+			self.manager.run(add_log, "Closed", "device-01")
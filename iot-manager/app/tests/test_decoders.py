@@ -0,0 +1,121 @@
+from django.test import SimpleTestCase
+import json
+from unittest import mock
+from controller import decoders
+from controller.decoders import PayloadDecoder, PayloadError
+from controller.values import get_correct_value, to_seconds
+
+class TestPayloadDecoder(SimpleTestCase):
+	"""
+	Tests of the decoding of the state messages.
+	"""
+	PAYLOADS = [
+		b'{"temperature": 26}', b'{"temperature":26.5}', b' { "temperature" : -0.5e1 } ',
+		b'{"temperature": "26"}', b'{"temperature": NaN}', b'{"temperature": 1e400}',
+		b'{"temperature": 123456789012345678901234567890}', b'{"temperature": true}',
+		b'{"temperature": 01}', b'{"temperature": "hot"}', b'{"temperature": null}',
+		b'{"time": "08:00:00"}', b'{"time": "8:0:0"}', b'{"time": "24:00:00"}',
+		b'{"time": "23:59:60"}', b'{"time": "08:00"}', b'{"time": 8}',
+		b'{"state": "ON"}', b'{"state": "OFF"}', b'{"state": "on"}', b'{"state": "\\u004fN"}',
+		b'{"humidity": 10}', b'{}', b'{"temperature": 26, "state": "ON"}',
+		b'{"temperature": 26, "temperature": 27}', b'[1]', b'26', b'not json',
+		b'\xff\xfe', '{"state": "ÓN"}'.encode(), b'\xef\xbb\xbf{"state": "ON"}',
+	]
+
+	def expected(self, payload):
+		"""
+		The message decoded with json and get_correct_value.
+		"""
+		try:
+			message = json.loads(payload.decode())
+		except (json.JSONDecodeError, UnicodeDecodeError):
+			return "Bad message format"
+		if not isinstance(message, dict):
+			return "Bad message format"
+		if len(message) != 1:
+			return "Too many keys in the message"
+		key, value = next(iter(message.items()))
+		try:
+			return key, get_correct_value(key, value)
+		except ValueError:
+			return "Bad value format"
+
+	def decode(self, decoder, payload):
+		try:
+			return decoder.decode(payload)
+		except PayloadError as e:
+			return str(e)
+
+	def assertSameResult(self, result, expected):
+		if isinstance(expected, tuple) and expected[1] != expected[1]:
+			self.assertEqual(result[0], expected[0])
+			self.assertNotEqual(result[1], result[1])
+		else:
+			self.assertEqual(result, expected)
+			self.assertEqual(type(result[1]) if isinstance(result, tuple) else None,
+				type(expected[1]) if isinstance(expected, tuple) else None)
+
+	def test_same_result_01(self):
+		"""
+		The result is the same as parsing the JSON, with and without the accelerated parser.
+		"""
+		for parser in [decoders.orjson, None]:
+			with mock.patch.object(decoders, 'orjson', parser):
+				decoder = PayloadDecoder()
+				for payload in self.PAYLOADS:
+					with self.subTest(payload=payload, parser=parser):
+						self.assertSameResult(self.decode(decoder, payload), self.expected(payload))
+
+	def test_times_02(self):
+		"""
+		The times are the seconds since midnight.
+		"""
+		self.assertEqual(to_seconds("00:00:00"), 0)
+		self.assertEqual(to_seconds("08:00:01"), 8 * 3600 + 1)
+		self.assertEqual(to_seconds("8:0:1"), 8 * 3600 + 1)
+		self.assertEqual(to_seconds("23:59:59"), 86399)
+		for value in ["24:00:00", "12:60:00", "1a:00:00", "08-00-00", "", None]:
+			with self.assertRaises(ValueError):
+				to_seconds(value)
+
+	def test_register_03(self):
+		"""
+		Other variables can be registered.
+		"""
+		decoder = PayloadDecoder({})
+		self.assertEqual(self.decode(decoder, b'{"humidity": 40}'), "Bad value format")
+		decoder.register('humidity', float)
+		self.assertEqual(decoder.decode(b'{"humidity": 40}'), ('humidity', 40.0))
+		self.assertEqual(self.decode(PayloadDecoder(), b'{"humidity": 40}'), "Bad value format")
+
+	def test_batch_04(self):
+		"""
+		The messages can have several variables, or a list of timestamped readings.
+		"""
+		for parser in [decoders.orjson, None]:
+			with mock.patch.object(decoders, 'orjson', parser):
+				decoder = PayloadDecoder(max_readings=3)
+				self.assertEqual(decoder.parse_batch(b'{"temperature": 26}'), [("temperature", 26, None)])
+				self.assertEqual(
+					decoder.parse_batch(b'{"temperature": 26, "state": "ON"}'),
+					[("temperature", 26, None), ("state", "ON", None)]
+				)
+				self.assertEqual(
+					decoder.parse_batch(b'{"readings": [{"ts": 1.5, "temperature": 26}, {"temperature": 27, "state": "ON"}]}'),
+					[("temperature", 26, 1.5), ("temperature", 27, None), ("state", "ON", None)]
+				)
+				for payload, error in [
+					(b'{}', "Bad message format"),
+					(b'{"readings": []}', "Bad message format"),
+					(b'{"readings": {"temperature": 26}}', "Bad message format"),
+					(b'{"readings": [{"temperature": 26}], "state": "ON"}', "Bad message format"),
+					(b'{"readings": [26]}', "Bad message format"),
+					(b'{"readings": [{"ts": 1}]}', "Bad message format"),
+					(b'{"readings": [{"ts": "now", "temperature": 26}]}', "Bad message format"),
+					(b'{"readings": [{"ts": true, "temperature": 26}]}', "Bad message format"),
+					(b'{"a": 1, "b": 2, "c": 3, "d": 4}', "Too many readings in the message"),
+					(b'{"readings": [{"a": 1, "b": 2}, {"c": 3, "d": 4}]}', "Too many readings in the message"),
+				]:
+					with self.subTest(payload=payload, parser=parser):
+						with self.assertRaisesMessage(PayloadError, error):
+							decoder.parse_batch(payload)
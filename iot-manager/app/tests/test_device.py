@@ -1,100 +1,85 @@
-from app.models import DummySwitch, DummySensor
-from django.test import TestCase
-from paho.mqtt.client import Client
-import time
+from django.test import SimpleTestCase
+import importlib
 import json
+import threading
+from broker.fake import FakeBroker
 
-class TestDevice(TestCase):
+# The modules of the devices (their names are not valid identifiers)
+dummy_switch = importlib.import_module("iot.dummy-switch")
+dummy_sensor = importlib.import_module("iot.dummy-sensor")
+
+class TestDevice(SimpleTestCase):
 	"""
+	Tests of the dummy devices, with the in-process broker.
 	"""
 	def setUp(self):
-		self.message_count = 0
-		self.client: Client = Client()
-		self.client.on_message = self.on_message
+		self.broker = FakeBroker()
+		self.states = []
+		self.client = self.broker.client()
+		self.client.on_message = lambda client, userdata, message: \
+			self.states.append(json.loads(message.payload))
+		self.client.connect("localhost", 1883)
+		self.client.loop_start()
+
+	def tearDown(self):
+		self.client.disconnect()
+		self.client.loop_stop()
+		self.assertEqual(self.broker.errors, [])
 
-	def on_message(self, client, userdata, message):
-		self.message_count += 1
+	def run_device(self, device):
+		thread = threading.Thread(target=device.run, daemon=True)
+		thread.start()
+		self.addCleanup(thread.join, 2)
+		self.addCleanup(device.stop)
 
 	def test_switch_01(self):
 		"""
+		The switch publishes its state, and changes it with the set command.
 		"""
-		# Connect with broker (mosquitto)
-		try:
-			self.client.connect("localhost", 1883)
-			self.client.loop_start()
-		except Exception as e:
-			self.fail(f"Failed to connect to broker: {e}")
-
-		# Create the switch, execute it and change
-		switch = DummySwitch(
-			id="switch-test-01",
+		switch = self.broker.bind(dummy_switch.DummySwitchDevice)(
 			host="localhost",
 			port=1883,
+			device_id="switch-test-01",
 			probability=0
 		)
-		switch_pid = switch.start_process(['--probability', '0', '--debug', 'true'])
-		self.assertNotEquals(switch_pid, None)
-		self.message_count = 0
-
-		# Subscribe to the switch topic and send the message
 		self.client.subscribe("redes/2312/10/switch-test-01/state")
+		self.run_device(switch)
+		self.broker.join(2)
+		self.assertEqual(self.states, [{"state": "OFF"}])
+
+		# Change the state
 		self.client.publish(
-			"switch-test-01/command",
+			"redes/2312/10/switch-test-01/command",
 			json.dumps({
-				"command": "set",
+				"cmd": "set",
 				"state": "ON"
 			}),
 		)
-
-		# Wait for the message to be received
-		time.sleep(2)
-
-		# Stop the client loop
-		self.client.loop_stop()
-		stopped = switch.stop_process()
-		self.assertTrue(stopped)
-
-		# Assert that the message was received
-		self.assertGreater(self.message_count, 0)
+		self.broker.join(2)
+		self.assertEqual(self.states, [{"state": "OFF"}, {"state": "ON"}])
 
 	def test_sensor_02(self):
 		"""
+		The sensor publishes its value every interval, between min and max.
 		"""
-		# Connect with broker (mosquitto)
-		try:
-			self.client.connect("localhost", 1883)
-			self.client.loop_start()
-		except Exception as e:
-			self.fail(f"Failed to connect to broker: {e}")
-
-		# Create the switch, execute it and change
-		sensor = DummySensor(
-			id="sensor-test-02",
+		received = threading.Event()
+		self.client.on_message = lambda client, userdata, message: (
+			self.states.append(json.loads(message.payload)),
+			len(self.states) > 4 and received.set()
+		)
+		sensor = self.broker.bind(dummy_sensor.DummySensorDevice)(
 			host="localhost",
 			port=1883,
-			interval=1,
+			device_id="sensor-test-02",
+			interval=0.001,
 			min_value=0,
-			max_value=10,
+			max_value=2,
 			increment=1
 		)
-		switch_pid = sensor.start_process([
-			'--interval', '1',
-			'--min', '0', '--max', '10',
-			'--increment', '1'
-		])
-		self.assertNotEquals(switch_pid, None)
-		self.message_count = 0
-
-		# Subscribe to the switch topic and send the message
 		self.client.subscribe("redes/2312/10/sensor-test-02/state")
-
-		# Wait for the message to be received
-		time.sleep(5)
-
-		# Stop the client loop
-		self.client.loop_stop()
-		stopped = sensor.stop_process()
-		self.assertTrue(stopped)
-
-		# Assert that the message was received
-		self.assertGreater(self.message_count, 3)
+		self.run_device(sensor)
+		self.assertTrue(received.wait(2))
+		self.assertEqual(
+			[state["temperature"] for state in self.states[:5]],
+			[0, 1, 2, 1, 0]
+		)
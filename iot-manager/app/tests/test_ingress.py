@@ -0,0 +1,65 @@
+from django.test import SimpleTestCase
+import queue
+import threading
+from controller.ingress import IngressQueue, CONFLATED, SHED
+
+class TestIngressQueue(SimpleTestCase):
+	"""
+	Tests of the ingress queues of the workers, with conflation and
+	shedding.
+	"""
+	def drain(self, ingress):
+		items = []
+		while ingress.qsize():
+			items.append(ingress.get())
+			ingress.task_done()
+		return items
+
+	def test_conflate_01(self):
+		"""
+		A new item of a waiting key replaces it, in its place.
+		"""
+		ingress = IngressQueue(10, conflate=True)
+		self.assertIsNone(ingress.put("a", "a1"))
+		self.assertIsNone(ingress.put("b", "b1"))
+		self.assertEqual(ingress.put("a", "a2"), ("a", CONFLATED))
+		self.assertEqual(ingress.qsize(), 2)
+		self.assertEqual(self.drain(ingress), ["a2", "b1"])
+
+		# Once taken, the key is queued again
+		ingress.put("a", "a3")
+		self.assertEqual(ingress.get(), "a3")
+		self.assertIsNone(ingress.put("a", "a4"))
+		ingress.task_done()
+		self.assertEqual(self.drain(ingress), ["a4"])
+		ingress.join()
+
+	def test_shedding_02(self):
+		"""
+		When it is full, the new or the oldest item is discarded, or the
+		put waits.
+		"""
+		ingress = IngressQueue(2, policy="drop-newest")
+		ingress.put("a", 1)
+		ingress.put("a", 2)
+		self.assertEqual(ingress.put("b", 3), ("b", SHED))
+		self.assertEqual(self.drain(ingress), [1, 2])
+
+		ingress = IngressQueue(2, conflate=True, policy="drop-oldest")
+		ingress.put("a", 1)
+		ingress.put("b", 2)
+		self.assertEqual(ingress.put("b", 3), ("b", CONFLATED))
+		self.assertEqual(ingress.put("c", 4), ("a", SHED))
+		self.assertEqual(self.drain(ingress), [3, 4])
+		ingress.join()
+
+		ingress = IngressQueue(1)
+		ingress.put("a", 1)
+		with self.assertRaises(queue.Full):
+			ingress.put("b", 2, timeout=0.05)
+		threading.Timer(0.05, lambda: (ingress.get(), ingress.task_done())).start()
+		self.assertIsNone(ingress.put("b", 3, timeout=5))
+		self.assertEqual(self.drain(ingress), [3])
+
+		with self.assertRaises(ValueError):
+			IngressQueue(1, policy="random")
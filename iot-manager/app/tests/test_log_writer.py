@@ -0,0 +1,57 @@
+from django.test import TransactionTestCase
+from django.db import connection
+from controller.database_communication import ConnectionManager
+from controller.log_writer import LogWriter
+from app.models import Log
+
+class TestLogWriter(TransactionTestCase):
+	"""
+	Tests of the background log writer of the controller.
+	"""
+	def setUp(self):
+		self.connections = ConnectionManager(connection.settings_dict['NAME'])
+
+	def tearDown(self):
+		self.connections.close()
+
+	def test_batches_01(self):
+		"""
+		The logs are written in batches, without losing any.
+		"""
+		writer = LogWriter(self.connections, batch_size=10, flush_interval=0.05)
+		writer.start()
+		for i in range(25):
+			writer.log(f"Log {i}", "device-01")
+		writer.log("Without device")
+		writer.join()
+
+		self.assertEqual(Log.objects.count(), 26)
+		self.assertGreaterEqual(writer.flushes, 3)
+		self.assertEqual(writer.stats()['written'], 26)
+		self.assertTrue(writer.stop(5))
+
+	def test_drain_02(self):
+		"""
+		The queued logs are written when the writer is stopped.
+		"""
+		writer = LogWriter(self.connections, flush_interval=60)
+		writer.start()
+		for i in range(5):
+			writer.log(f"Log {i}", "device-02")
+		self.assertTrue(writer.stop(5))
+		self.assertEqual(Log.objects.filter(device="device-02").count(), 5)
+
+		# After stopping, the logs are dropped
+		self.assertFalse(writer.log("Late", "device-02"))
+		self.assertEqual(writer.dropped, 1)
+
+	def test_full_queue_03(self):
+		"""
+		The logs are dropped (and counted) when the queue is full.
+		"""
+		writer = LogWriter(self.connections, max_queue=2)
+		self.assertTrue(writer.log("Log 1"))
+		self.assertTrue(writer.log("Log 2"))
+		self.assertFalse(writer.log("Log 3"))
+		self.assertEqual(writer.stats()['queue_depth'], 2)
+		self.assertEqual(writer.stats()['dropped'], 1)
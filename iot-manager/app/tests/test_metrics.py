@@ -0,0 +1,84 @@
+from django.test import SimpleTestCase
+import os
+import tempfile
+import threading
+import urllib.request
+from controller.metrics import (
+	Counter,
+	Histogram,
+	Gauge,
+	Registry,
+	MetricsServer
+)
+
+class TestMetrics(SimpleTestCase):
+	"""
+	Tests of the metrics of the controller.
+	"""
+	def setUp(self):
+		self.registry = Registry()
+		self.counter = self.registry.register(Counter(
+			"test_messages_total", "Messages", labels=("type",)
+		))
+		self.histogram = self.registry.register(Histogram(
+			"test_seconds", "Latency", buckets=(0.1, 1.0)
+		))
+		self.registry.register(Gauge(
+			"test_depth", "Depth", lambda: 3
+		))
+
+	def test_threads_01(self):
+		"""
+		The counters do not lose increments between threads.
+		"""
+		def work():
+			child = self.counter.labels("sensor")
+			for _ in range(10000):
+				child.inc()
+		threads = [threading.Thread(target=work) for _ in range(4)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(self.counter.labels("sensor").value, 40000)
+
+	def test_render_02(self):
+		"""
+		The metrics are rendered in the Prometheus text format.
+		"""
+		self.counter.labels("sensor").inc()
+		self.counter.labels("clock").inc(2)
+		for value in [0.05, 0.5, 5]:
+			self.histogram.observe(value)
+
+		text = self.registry.render()
+		self.assertIn("# TYPE test_messages_total counter\n", text)
+		self.assertIn('test_messages_total{type="sensor"} 1\n', text)
+		self.assertIn('test_messages_total{type="clock"} 2\n', text)
+		self.assertIn('test_seconds_bucket{le="0.1"} 1\n', text)
+		self.assertIn('test_seconds_bucket{le="1"} 2\n', text)
+		self.assertIn('test_seconds_bucket{le="+Inf"} 3\n', text)
+		self.assertIn("test_seconds_count 3\n", text)
+		self.assertIn("test_seconds_sum 5.55\n", text)
+		self.assertIn("test_depth 3\n", text)
+
+	def test_outputs_03(self):
+		"""
+		The metrics are served by HTTP, and written to a file.
+		"""
+		self.counter.labels("switch").inc()
+		server = MetricsServer(self.registry, 0)
+		server.start()
+		try:
+			url = f"http://127.0.0.1:{server.port}/metrics"
+			with urllib.request.urlopen(url, timeout=5) as response:
+				self.assertEqual(response.status, 200)
+				self.assertIn('test_messages_total{type="switch"} 1', response.read().decode())
+		finally:
+			server.stop()
+
+		with tempfile.TemporaryDirectory() as directory:
+			path = os.path.join(directory, "metrics.prom")
+			self.registry.dump(path)
+			with open(path) as file:
+				self.assertEqual(file.read(), self.registry.render())
@@ -0,0 +1,122 @@
+from app.models import DummySwitch, DummySensor, Rule
+from django.test import SimpleTestCase, TransactionTestCase
+from django.db import connection
+from paho.mqtt.client import Client
+import json
+import time
+from controller.partition import HashRing, Partition
+from controller.launcher import Launcher
+from broker.server import MQTTBroker
+
+class TestHashRing(SimpleTestCase):
+	"""
+	Tests of the consistent hashing of the devices.
+	"""
+	DEVICES = [f"device-{i}" for i in range(2000)]
+
+	def test_balance_01(self):
+		"""
+		Every member owns a similar part of the devices.
+		"""
+		ring = HashRing(["controller-0", "controller-1", "controller-2"])
+		owners = [ring.owner(device_id) for device_id in self.DEVICES]
+		for member in ring.members:
+			self.assertGreater(owners.count(member), len(self.DEVICES) / 6)
+
+	def test_rebalance_02(self):
+		"""
+		When a member is added, only devices that go to it move.
+		"""
+		before = HashRing(["controller-0", "controller-1", "controller-2"])
+		after = HashRing(["controller-0", "controller-1", "controller-2", "controller-3"])
+		moved = [
+			device_id for device_id in self.DEVICES
+			if before.owner(device_id) != after.owner(device_id)
+		]
+		self.assertTrue(all(after.owner(device_id) == "controller-3" for device_id in moved))
+		self.assertLess(len(moved), len(self.DEVICES) / 2)
+
+	def test_partition_03(self):
+		"""
+		Each device belongs to exactly one partition.
+		"""
+		ring = HashRing(["controller-0", "controller-1"])
+		partitions = [Partition(ring, member) for member in ring.members]
+		for device_id in self.DEVICES[:100]:
+			self.assertEqual(sum(p.owns(device_id) for p in partitions), 1)
+
+class TestLauncher(TransactionTestCase):
+	"""
+	Tests of several controller processes, with the embedded broker.
+	"""
+	SENSORS = 12
+
+	def setUp(self):
+		self.broker = MQTTBroker(port=0)
+		self.broker.start()
+		self.addCleanup(self.broker.stop)
+
+		self.commands = []
+		self.client: Client = Client()
+		self.client.on_message = lambda client, userdata, message: \
+			self.commands.append(json.loads(message.payload)["sensor"])
+
+		switch = DummySwitch.objects.create(id="switch-part", probability=0)
+		for i in range(self.SENSORS):
+			sensor = DummySensor.objects.create(id=f"sensor-part-{i}")
+			Rule.objects.create(
+				name=f"Partition {i}",
+				source_device=sensor,
+				operator=">",
+				threshold="25",
+				target_device=switch,
+				command_payload=json.dumps({"cmd": "get", "sensor": i})
+			)
+
+	def publish_readings(self):
+		for i in range(self.SENSORS):
+			self.client.publish(
+				f"redes/2312/10/sensor-part-{i}/state",
+				json.dumps({"temperature": 26}),
+				qos=1
+			)
+
+	def wait_commands(self, count, timeout=10):
+		end = time.monotonic() + timeout
+		while len(self.commands) < count and time.monotonic() < end:
+			time.sleep(0.05)
+
+	def test_processes_01(self):
+		"""
+		Three processes share the devices, and rebalance when one is added.
+		"""
+		try:
+			self.client.connect("127.0.0.1", self.broker.port)
+			self.client.loop_start()
+		except Exception as e:
+			self.fail(f"Failed to connect to broker: {e}")
+		self.client.subscribe("redes/2312/10/switch-part/command", qos=1)
+
+		launcher = Launcher(3, {
+			"host": "127.0.0.1",
+			"port": self.broker.port,
+			"database": connection.settings_dict['NAME'],
+		})
+		try:
+			launcher.start()
+			time.sleep(0.5)
+			self.publish_readings()
+			self.wait_commands(self.SENSORS)
+			self.assertEqual(sorted(self.commands), list(range(self.SENSORS)))
+
+			# Add a process: every sensor keeps having one owner
+			launcher.add()
+			time.sleep(0.5)
+			self.commands.clear()
+			self.publish_readings()
+			self.wait_commands(self.SENSORS)
+			time.sleep(0.5)
+			self.assertEqual(sorted(self.commands), list(range(self.SENSORS)))
+		finally:
+			launcher.stop()
+			self.client.loop_stop()
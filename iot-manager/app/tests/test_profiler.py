@@ -0,0 +1,82 @@
+from django.test import SimpleTestCase
+import os
+import tempfile
+from controller.profiler import (
+	MessageProfiler,
+	read_traces,
+	summarize,
+	format_summary
+)
+
+class TestProfiler(SimpleTestCase):
+	"""
+	Tests of the profiler of the messages.
+	"""
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.path = os.path.join(self.directory.name, "profile.jsonl")
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def record(self, profiler, device_id, stages):
+		trace = profiler.start(device_id)
+		for stage in stages:
+			trace.mark(stage)
+		profiler.finish(trace)
+
+	def test_rotation_01(self):
+		"""
+		The traces of the rotated files are also read, from the oldest.
+		"""
+		profiler = MessageProfiler(self.path, sample_rate=0, max_bytes=2000, backups=50)
+		for i in range(100):
+			self.record(profiler, f"sensor-{i}", ["decode", "lookup"])
+		profiler.close()
+
+		self.assertTrue(os.path.exists(self.path + ".1"))
+		traces = read_traces(self.path)
+		self.assertEqual([trace["device"] for trace in traces], [f"sensor-{i}" for i in range(100)])
+		self.assertFalse(any("profile" in trace for trace in traces))
+
+	def test_summary_02(self):
+		"""
+		The summary has the statistics of each stage, and the slowest messages.
+		"""
+		traces = [
+			{"time": 0, "device": f"sensor-{i}", "total": i / 1000, "stages": {"lookup": i / 2000, "decode": i / 4000}}
+			for i in range(1, 101)
+		]
+		traces[10]["profile"] = [[1, 0.001, 0.002, "rule_set.py:10(match)"]]
+		summary = summarize(traces, top=3)
+
+		self.assertEqual(summary["messages"], 100)
+		self.assertEqual(list(summary["stages"]), ["total", "decode", "lookup"])
+		self.assertEqual(summary["stages"]["total"]["p50"], 0.05)
+		self.assertEqual(summary["stages"]["total"]["p99"], 0.099)
+		self.assertEqual(summary["stages"]["lookup"]["max"], 0.05)
+		self.assertEqual([trace["device"] for trace in summary["slowest"]], ["sensor-100", "sensor-99", "sensor-98"])
+
+		report = format_summary(summarize(traces, top=100))
+		self.assertIn("Slowest 100 messages:", report)
+		self.assertIn("rule_set.py:10(match)", report)
+
+	def test_one_profile_03(self):
+		"""
+		Only one message is profiled at a time, also by several profilers.
+		"""
+		first = MessageProfiler(self.path, sample_rate=1)
+		second = MessageProfiler(self.path + ".second", sample_rate=1)
+		trace = first.start("sensor-1")
+		self.record(second, "sensor-2", ["decode"])
+		first.finish(trace)
+		self.record(second, "sensor-3", ["decode"])
+		first.close()
+		second.close()
+
+		self.assertEqual((first.profiled, first.skipped), (1, 0))
+		self.assertEqual((second.profiled, second.skipped), (1, 1))
+		self.assertEqual(
+			[(trace["device"], "profile" in trace) for trace in read_traces(self.path + ".second")],
+			[("sensor-2", False), ("sensor-3", True)]
+		)
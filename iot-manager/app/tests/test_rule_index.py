@@ -0,0 +1,176 @@
+from app.models import DummySwitch, DummySensor, Rule, Log
+from django.test import TransactionTestCase
+from django.db import connection
+from controller.rule_index import RuleIndex
+from controller.database_communication import create_connection, get_change_counter
+
+class TestRuleIndex(TransactionTestCase):
+	"""
+	Tests of the in-memory rule index of the controller.
+	"""
+	def setUp(self):
+		self.database = connection.settings_dict['NAME']
+		self.switch = DummySwitch.objects.create(id="switch-idx", probability=0)
+		self.sensor = DummySensor.objects.create(id="sensor-idx")
+		self.other = DummySensor.objects.create(id="sensor-idx-2")
+		self.rule = self.create_rule("Index 01", self.sensor, "20")
+
+	def create_rule(self, name, source, threshold, target=None):
+		return Rule.objects.create(
+			name=name,
+			source_device=source,
+			operator=">",
+			threshold=threshold,
+			target_device=target or self.switch,
+			command_payload='{"cmd":"set","state":"ON"}'
+		)
+
+	def test_preloaded_01(self):
+		"""
+		All the rules are loaded, and the devices without rules have none.
+		"""
+		index = RuleIndex(self.database, check_interval=0)
+		rules = index.get("sensor-idx")
+		self.assertEqual([rule.name for rule in rules], ["Index 01"])
+		self.assertEqual(index.get("sensor-idx-2"), ())
+		self.assertEqual(index.get("unknown"), ())
+		index.close()
+
+	def test_refresh_02(self):
+		"""
+		The index is reloaded when the rules change.
+		"""
+		index = RuleIndex(self.database, check_interval=0)
+		compiled = index.get("sensor-idx")[0]
+		self.create_rule("Index 02", self.other, "25")
+		self.assertEqual(len(index.get("sensor-idx-2")), 1)
+
+		# Not updated rules are not compiled again
+		self.assertIs(index.get("sensor-idx")[0], compiled)
+
+		self.rule.threshold = "22"
+		self.rule.save()
+		self.assertEqual(index.get("sensor-idx")[0].threshold, "22")
+
+		self.rule.delete()
+		self.assertEqual(index.get("sensor-idx"), ())
+		index.close()
+
+	def test_no_refresh_03(self):
+		"""
+		The rules are not read again until the check interval passes.
+		"""
+		index = RuleIndex(self.database, check_interval=3600)
+		self.create_rule("Index 03", self.other, "25")
+		self.assertEqual(index.get("sensor-idx-2"), ())
+
+		index.invalidate()
+		self.assertEqual(len(index.get("sensor-idx-2")), 1)
+		index.close()
+
+	def test_lru_04(self):
+		"""
+		In LRU mode only the last used devices are kept.
+		"""
+		index = RuleIndex(self.database, max_devices=1, check_interval=0)
+		self.create_rule("Index 04", self.other, "25")
+		self.assertEqual(len(index.get("sensor-idx")), 1)
+		self.assertEqual(len(index.get("sensor-idx-2")), 1)
+		self.assertNotIn("sensor-idx", index._rules)
+		self.assertIn("sensor-idx-2", index._rules)
+
+		# Negative cache
+		self.assertEqual(index.get("switch-idx"), ())
+		self.assertIn("switch-idx", index._no_rules)
+		other_switch = DummySwitch.objects.create(id="switch-idx-2", probability=0)
+		self.create_rule("Index 05", self.switch, "ON", other_switch)
+		self.assertEqual(len(index.get("switch-idx")), 1)
+		index.close()
+
+	def test_update_rule_05(self):
+		"""
+		A single rule is read again, without reloading the other devices.
+		"""
+		index = RuleIndex(self.database, check_interval=3600)
+		other = self.create_rule("Index 06", self.other, "25")
+		index.update_rule(other.id)
+		self.assertEqual([rule.name for rule in index.get("sensor-idx-2")], ["Index 06"])
+		compiled = index.get("sensor-idx")[0]
+
+		# Moved to other source device
+		other.source_device = self.sensor
+		other.save()
+		index.update_rule(other.id)
+		self.assertEqual(index.get("sensor-idx-2"), ())
+		self.assertEqual([rule.name for rule in index.get("sensor-idx")], ["Index 01", "Index 06"])
+		self.assertIs(index.get("sensor-idx")[0], compiled)
+
+		other_id = other.id
+		other.delete()
+		index.update_rule(other_id)
+		self.assertEqual([rule.name for rule in index.get("sensor-idx")], ["Index 01"])
+		self.assertNotIn(other_id, index._compiled)
+		index.close()
+
+	def test_update_rule_lru_06(self):
+		"""
+		In LRU mode, the devices of the rule are read again when they are used.
+		"""
+		index = RuleIndex(self.database, max_devices=10, check_interval=3600)
+		self.assertEqual(len(index.get("sensor-idx")), 1)
+		self.assertEqual(index.get("sensor-idx-2"), ())
+		self.rule.source_device = self.other
+		self.rule.save()
+		index.update_rule(self.rule.id)
+		self.assertEqual(index.get("sensor-idx"), ())
+		self.assertEqual([rule.name for rule in index.get("sensor-idx-2")], ["Index 01"])
+		index.close()
+
+	def test_refresh_without_update_07(self):
+		"""
+		The rules changed without updating `updated_at` (QuerySet.update
+		or raw SQL) are also read again.
+		"""
+		reloads = []
+		index = RuleIndex(
+			self.database,
+			check_interval=0,
+			on_reload=lambda rules, changed: reloads.append((dict(rules), changed))
+		)
+		version = index.get("sensor-idx")[0].version
+		Rule.objects.filter(id=self.rule.id).update(threshold="30")
+		self.assertEqual(index.get("sensor-idx")[0].threshold, "30")
+		self.assertNotEqual(reloads[-1][0][self.rule.id].version, version)
+
+		with connection.cursor() as cursor:
+			cursor.execute("UPDATE app_rule SET operator = '<' WHERE id = %s", [self.rule.id])
+		self.assertEqual(index.get("sensor-idx")[0].operator, "<")
+		index.close()
+
+		# In LRU mode, the versions are read from the database, and only
+		# the updated rule is read again for a change notice
+		index = RuleIndex(self.database, max_devices=10, on_reload=lambda rules, changed: reloads.append((rules, changed)))
+		self.assertEqual(reloads[-1][0][self.rule.id].version, index.get("sensor-idx")[0].version)
+		self.assertIsNone(reloads[-1][1])
+		index.update_rule(self.rule.id)
+		self.assertEqual(reloads[-1][1], (self.rule.id,))
+		self.assertEqual(list(reloads[-1][0]), [self.rule.id])
+		index.close()
+
+	def test_own_writes_08(self):
+		"""
+		The change counter of the rules (that reloads them) counts all
+		their changes, but not the writes of other tables (like the logs).
+		"""
+		index = RuleIndex(self.database, check_interval=0)
+		database = create_connection(self.database)
+		counter = get_change_counter(database, 'rules')
+		Log.objects.create(message="Not a rule")
+		self.assertEqual(get_change_counter(database, 'rules'), counter)
+
+		Rule.objects.filter(id=self.rule.id).update(threshold="30")
+		self.rule.delete()
+		self.assertEqual(get_change_counter(database, 'rules'), counter + 2)
+		self.assertEqual(index.get("sensor-idx"), ())
+		database.close()
+		index.close()
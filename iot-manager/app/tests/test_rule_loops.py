@@ -0,0 +1,105 @@
+from app.models import DummySwitch, DummySensor, Rule, CompoundRule, CompoundCondition
+from django.test import TransactionTestCase
+from django.core.exceptions import ValidationError
+
+class TestRuleLoops(TransactionTestCase):
+	"""
+	Tests of the detection of the loops of rules, whose commands apply
+	them again.
+	"""
+	def setUp(self):
+		self.sensor = DummySensor.objects.create(id="sensor-loop")
+		self.switches = [DummySwitch.objects.create(id=f"switch-loop-{i}", probability=0) for i in range(3)]
+
+	def build_rule(self, name, source, target) -> Rule:
+		return Rule(
+			name=name,
+			source_device=source,
+			operator="==",
+			threshold="ON",
+			target_device=target,
+			command_payload='{"cmd":"set","state":"ON"}'
+		)
+
+	def test_loops_01(self):
+		"""
+		A rule that closes a loop is not valid, and the loop is shown.
+		"""
+		first, second, third = self.switches
+		self.build_rule("Loop 01", self.sensor, first).save()
+		self.build_rule("Loop 02", first, second).save()
+		self.build_rule("Loop 03", second, third).full_clean()
+		self.build_rule("Loop 03", second, third).save()
+
+		with self.assertRaisesRegex(ValidationError, "switch-loop-2 -> switch-loop-0 -> switch-loop-1 -> switch-loop-2"):
+			self.build_rule("Loop 04", third, first).full_clean()
+		with self.assertRaisesRegex(ValidationError, "switch-loop-0 -> switch-loop-0"):
+			self.build_rule("Loop 04", first, first).full_clean()
+
+		# Without a path back to the source
+		self.build_rule("Loop 04", self.sensor, third).full_clean()
+
+		# The old devices of a changed rule are not part of the graph
+		rule = Rule.objects.get(name="Loop 02")
+		rule.source_device, rule.target_device = second, first
+		rule.full_clean()
+		rule.source_device, rule.target_device = third, second
+		with self.assertRaises(ValidationError):
+			rule.full_clean()
+		Rule.objects.get(name="Loop 03").delete()
+		rule.full_clean()
+
+	def test_compound_02(self):
+		"""
+		The conditions of the compound rules are part of the graph.
+		"""
+		first, second, _ = self.switches
+		compound = CompoundRule.objects.create(
+			name="Loop compound",
+			target_device=second,
+			command_payload='{"cmd":"set","state":"ON"}'
+		)
+		CompoundCondition.objects.create(rule=compound, device=self.sensor, operator=">", threshold="25")
+		CompoundCondition.objects.create(rule=compound, device=first, operator="==", threshold="ON")
+		with self.assertRaisesRegex(ValidationError, "switch-loop-1 -> switch-loop-0 -> switch-loop-1"):
+			self.build_rule("Loop 01", second, first).full_clean()
+
+	def test_saved_03(self):
+		"""
+		The loops are rejected however the rules are saved, also when a
+		compound rule closes them (with a condition, or a new target).
+		"""
+		first, second, third = self.switches
+		self.build_rule("Loop 01", first, second).save()
+		with self.assertRaises(ValidationError):
+			Rule.objects.create(
+				name="Loop 02",
+				source_device=second,
+				operator="==",
+				threshold="ON",
+				target_device=first,
+				command_payload='{"cmd":"set","state":"ON"}'
+			)
+		self.assertEqual(Rule.objects.count(), 1)
+
+		compound = CompoundRule.objects.create(
+			name="Loop compound",
+			target_device=first,
+			command_payload='{"cmd":"set","state":"ON"}'
+		)
+		CompoundCondition.objects.create(rule=compound, device=self.sensor, operator=">", threshold="25")
+		condition = CompoundCondition(rule=compound, device=second, operator="==", threshold="ON")
+		with self.assertRaisesRegex(ValidationError, "switch-loop-1 -> switch-loop-0 -> switch-loop-1"):
+			condition.full_clean()
+		with self.assertRaises(ValidationError):
+			condition.save()
+		CompoundCondition.objects.create(rule=compound, device=third, operator="==", threshold="ON")
+
+		# The conditions of the rule with its new target
+		compound.target_device = third
+		with self.assertRaisesRegex(ValidationError, "switch-loop-2 -> switch-loop-2"):
+			compound.full_clean()
+		with self.assertRaises(ValidationError):
+			compound.save()
+		compound.target_device = second
+		compound.save()
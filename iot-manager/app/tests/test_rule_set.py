@@ -0,0 +1,105 @@
+from django.test import SimpleTestCase
+import random
+from controller.compiled_rule import (
+	CompiledRule,
+	InvalidThresholdError,
+	InvalidOperatorError
+)
+from controller.rule_set import RuleSet
+from controller.values import get_correct_value, compare_values
+from .rows import rule_row
+
+OPERATORS = ['>', '<', '==', '!=', '>=', '<=']
+
+class TestRuleSet(SimpleTestCase):
+	"""
+	Tests of the indexed rules of a device.
+	"""
+	def build_rules(self, conditions):
+		return RuleSet(
+			CompiledRule(rule_row(id=i, operator=operator, threshold=threshold))
+			for i, (operator, threshold) in enumerate(conditions)
+		)
+
+	def expected(self, rules, key, value):
+		"""
+		The rules checked one by one with compare_values.
+		"""
+		matches = []
+		for rule in rules:
+			try:
+				threshold = get_correct_value(key, rule.threshold)
+			except ValueError:
+				return matches, InvalidThresholdError
+			try:
+				if compare_values(value, threshold, rule.operator):
+					matches.append(rule)
+			except ValueError:
+				return matches, InvalidOperatorError
+		return matches, None
+
+	def check(self, rules, key, values):
+		for value in values:
+			value = get_correct_value(key, value)
+			matches, error = rules.match(key, value)
+			expected, expected_error = self.expected(rules, key, value)
+			self.assertEqual([rule.id for rule in matches], [rule.id for rule in expected])
+			self.assertEqual(type(error) if error else None, expected_error)
+
+	def test_same_result_01(self):
+		"""
+		The matches are the same as comparing with compare_values.
+		"""
+		generator = random.Random(10)
+		thresholds = [str(t / 2) for t in range(0, 80)]
+		for _ in range(20):
+			rules = self.build_rules([
+				(generator.choice(OPERATORS), generator.choice(thresholds))
+				for _ in range(generator.randint(8, 60))
+			])
+			self.check(rules, 'temperature', thresholds + ['-5', '50', '20.25'])
+
+		times = ['07:00:00', '08:00:00', '08:00:01', '12:30:00']
+		rules = self.build_rules([(operator, t) for operator in OPERATORS for t in times])
+		self.check(rules, 'time', times + ['00:00:00', '23:59:59'])
+
+		rules = self.build_rules([(operator, s) for operator in OPERATORS for s in ['ON', 'OFF']])
+		self.check(rules, 'state', ['ON', 'OFF'])
+
+	def test_errors_02(self):
+		"""
+		The rules after one that can not be evaluated are not checked.
+		"""
+		conditions = [('>', '10')] * 5 + [('<', '30')] * 5
+		rules = self.build_rules(conditions[:4] + [('>', 'hot')] + conditions[4:])
+		self.check(rules, 'temperature', ['5', '20', '40'])
+		self.assertEqual(len(rules.match('temperature', 20.0)[0]), 4)
+
+		rules = self.build_rules(conditions[:6] + [('=>', '10')] + conditions[6:])
+		self.check(rules, 'temperature', ['5', '20', '40'])
+
+	def test_nan_03(self):
+		"""
+		NaN values and thresholds give the same result as compare_values.
+		"""
+		rules = self.build_rules([(operator, t) for operator in OPERATORS for t in ['nan', '20']])
+		self.check(rules, 'temperature', ['nan', '10', '20', '30'])
+
+	def test_variables_04(self):
+		"""
+		Each variable is only checked with the rules whose threshold is of
+		its type, and the invalid thresholds are checked with all of them.
+		"""
+		rules = self.build_rules([('>', '25'), ('==', 'ON'), ('>=', '08:00:00'), ('<', '30')])
+		self.assertEqual([rule.id for rule in rules.of_variable('temperature')], [0, 3])
+		self.assertEqual([rule.id for rule in rules.of_variable('state')], [1])
+		self.assertEqual(rules.of_variable('state').match('state', 'ON'), ([rules[1]], None))
+
+		rules = self.build_rules([('>', '25'), ('>', 'hot'), ('<', '30')])
+		matches, error = rules.of_variable('temperature').match('temperature', 26.0)
+		self.assertEqual([rule.id for rule in matches], [0])
+		self.assertIsInstance(error, InvalidThresholdError)
+		self.assertEqual([rule.id for rule in rules.of_variable('state')], [1])
+
+		rules = self.build_rules([('>', '25'), ('<', '30')])
+		self.assertIs(rules.of_variable('temperature'), rules)
@@ -0,0 +1,74 @@
+from django.test import SimpleTestCase
+import time
+from controller.timer_wheel import TimerWheel
+
+class TestTimerWheel(SimpleTestCase):
+	"""
+	Tests of the timer wheel of the rules with a duration.
+	"""
+	def setUp(self):
+		self.fired = []
+		self.wheel = TimerWheel(tick=0.01, slots=8)
+		self.wheel.start()
+		self.addCleanup(self.wheel.stop, 1)
+
+	def fire(self, name):
+		self.fired.append((name, time.monotonic()))
+
+	def wait(self, count, timeout=5):
+		deadline = time.monotonic() + timeout
+		while len(self.fired) < count and time.monotonic() < deadline:
+			time.sleep(0.005)
+		return [name for name, _ in self.fired]
+
+	def test_order_01(self):
+		"""
+		The timers are run in the order of their deadlines, not before
+		them, also the ones longer than a turn of the wheel.
+		"""
+		start = time.monotonic()
+		delays = {"c": 0.25, "a": 0.02, "d": 0.13, "b": 0.05}
+		for name, delay in delays.items():
+			self.wheel.schedule(name, delay, self.fire, name)
+		self.assertEqual(len(self.wheel), 4)
+
+		self.assertEqual(self.wait(4), ["a", "b", "d", "c"])
+		for name, fired in self.fired:
+			self.assertGreaterEqual(fired - start, delays[name] - 0.001)
+		self.assertEqual(len(self.wheel), 0)
+
+	def test_cancel_02(self):
+		"""
+		A cancelled timer is not run, and scheduling a key again replaces
+		its timer.
+		"""
+		self.wheel.schedule("a", 0.05, self.fire, "a")
+		self.wheel.schedule("b", 0.05, self.fire, "b")
+		self.assertTrue(self.wheel.cancel("a"))
+		self.assertFalse(self.wheel.cancel("a"))
+		self.assertNotIn("a", self.wheel)
+
+		self.wheel.schedule("b", 0.15, self.fire, "b2")
+		self.wheel.schedule("c", 0.1, self.fire, "c")
+		self.assertEqual(self.wait(2), ["c", "b2"])
+		time.sleep(0.1)
+		self.assertEqual([name for name, _ in self.fired], ["c", "b2"])
+
+	def test_idle_03(self):
+		"""
+		After being idle, the wheel runs the new timers on time, and an
+		error of a callback does not stop it.
+		"""
+		self.wheel.schedule("error", 0, lambda: 1 / 0)
+		time.sleep(0.2)
+		start = time.monotonic()
+		self.wheel.schedule("a", 0.05, self.fire, "a")
+		self.assertEqual(self.wait(1), ["a"])
+		self.assertLess(self.fired[0][1] - start, 1)
+		self.assertGreaterEqual(self.fired[0][1] - start, 0.049)
+
+		# Stopped: the pending timers are not run
+		self.wheel.schedule("b", 0.05, self.fire, "b")
+		self.wheel.stop(1)
+		time.sleep(0.1)
+		self.assertEqual([name for name, _ in self.fired], ["a"])
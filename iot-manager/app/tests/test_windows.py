@@ -0,0 +1,118 @@
+from django.test import SimpleTestCase
+import random
+from controller.compiled_rule import CompiledRule
+from .rows import rule_row
+from controller.rule_set import RuleSet
+from controller.windows import SlidingWindow, WindowStore
+
+class TestWindows(SimpleTestCase):
+	"""
+	Tests of the sliding windows of the rules with an aggregate.
+	"""
+	def build_rule(self, i, aggregate, window, operator, threshold, trigger='level'):
+		return CompiledRule(rule_row(
+			id=i,
+			name=f'Window {i}',
+			operator=operator,
+			threshold=threshold,
+			trigger=trigger,
+			aggregate=aggregate,
+			window=window
+		))
+
+	def test_same_result_01(self):
+		"""
+		The statistics are the same as computing them from the values of
+		the window.
+		"""
+		generator = random.Random(1)
+		window = SlidingWindow(10, capacity=32)
+		samples = []
+		now = 0.0
+		for _ in range(2000):
+			now += generator.choice([0, 0.1, 0.5, 1, 3, 12])
+			value = generator.choice([generator.uniform(-20, 50), 25.0])
+			window.add(now, value)
+			samples = [(t, v) for t, v in samples if t > now - 10][-31:] + [(now, value)]
+
+			values = [v for _, v in samples]
+			self.assertEqual(window.aggregate('count'), len(values))
+			self.assertAlmostEqual(window.aggregate('avg'), sum(values) / len(values))
+			self.assertEqual(window.aggregate('min'), min(values))
+			self.assertEqual(window.aggregate('max'), max(values))
+			elapsed = samples[-1][0] - samples[0][0]
+			if elapsed > 0:
+				self.assertAlmostEqual(
+					window.aggregate('derivative'),
+					(samples[-1][1] - samples[0][1]) / elapsed * 60
+				)
+			else:
+				self.assertIsNone(window.aggregate('derivative'))
+
+	def test_old_times_02(self):
+		"""
+		A value older than the last one is taken as the last one.
+		"""
+		window = SlidingWindow(5)
+		window.add(100, 1)
+		window.add(90, 3)
+		window.add(104, 5)
+		self.assertEqual(window.aggregate('count'), 3)
+		self.assertEqual(window.aggregate('derivative'), 60)
+		window.add(105, 7)
+		self.assertEqual(window.aggregate('count'), 2)
+		self.assertIsNone(SlidingWindow(5).aggregate('avg'))
+
+	def test_match_03(self):
+		"""
+		The rules with an aggregate are matched with their windows, in
+		order with the other rules, and each window is shared.
+		"""
+		rules = RuleSet([
+			self.build_rule(0, '', 0, '>', '25'),
+			self.build_rule(1, 'avg', 60, '>', '26'),
+			self.build_rule(2, 'max', 60, '>=', '30'),
+			self.build_rule(3, 'derivative', 60, '>', '2'),
+			self.build_rule(4, 'count', 10, '>=', '3'),
+		])
+		self.assertEqual(rules.match('temperature', 31.0)[0], [rules[0]])
+
+		store = WindowStore()
+		def match(timestamp, value):
+			matches, _ = rules.match('temperature', value)
+			return [rule.id for rule in store.match('sensor', rules, 'temperature', value, timestamp, matches)]
+
+		self.assertEqual(match(0, 24.0), [])
+		self.assertEqual(match(20, 31.0), [0, 1, 2, 3])
+		self.assertEqual(match(25, 27.0), [0, 1, 2, 3])
+		self.assertEqual(match(30, float('nan')), [])
+		self.assertEqual(match(70, 26.0), [0, 1, 2])
+		self.assertEqual(match(71, 20.0), [2])
+		self.assertEqual(match(72, 20.0), [2, 4])
+		self.assertEqual(len(store), 2)
+
+		# A rule with a bad threshold stops the evaluation, as the other rules
+		rules = RuleSet([self.build_rule(0, 'avg', 60, '>', 'hot'), self.build_rule(1, 'count', 60, '>', '0')])
+		self.assertEqual(match(80, 26.0), [])
+
+	def test_prune_04(self):
+		"""
+		Only the windows used by the loaded rules are kept.
+		"""
+		rules = RuleSet([self.build_rule(0, 'avg', 60, '>', '26'), self.build_rule(1, 'count', 10, '>=', '3')])
+		store = WindowStore()
+		for device_id in ['sensor', 'sensor-2']:
+			store.match(device_id, rules, 'temperature', 26.0, 0, [])
+		self.assertEqual(len(store), 4)
+
+		# Only reloads of all the rules prune the windows
+		store.prune({}, (0, 1))
+		self.assertEqual(len(store), 4)
+
+		# The second rule is deleted, and the window of the first one changed
+		store.prune({0: self.build_rule(0, 'avg', 30, '>', '26')})
+		self.assertEqual(len(store), 0)
+
+		store.match('sensor', rules, 'temperature', 26.0, 0, [])
+		store.prune({rule.id: rule for rule in rules})
+		self.assertEqual(sorted(store._windows), [('sensor', 'temperature', 10), ('sensor', 'temperature', 60)])
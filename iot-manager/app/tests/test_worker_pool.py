@@ -0,0 +1,100 @@
+from django.test import SimpleTestCase
+import threading
+import time
+from controller.worker_pool import WorkerPool
+
+class TestWorkerPool(SimpleTestCase):
+	"""
+	Tests of the pool of workers that process the messages.
+	"""
+	def test_order_01(self):
+		"""
+		The items of a key are processed in order, by the same thread.
+		"""
+		processed = {}
+		threads = {}
+		lock = threading.Lock()
+
+		def handler(item):
+			key, value = item
+			with lock:
+				processed.setdefault(key, []).append(value)
+				threads.setdefault(key, set()).add(threading.current_thread().name)
+
+		pool = WorkerPool(handler, workers=4, queue_size=10)
+		pool.start()
+		for value in range(200):
+			for key in ["device-a", "device-b", "device-c"]:
+				pool.submit(key, (key, value))
+		pool.join()
+		self.assertTrue(pool.stop(5))
+
+		for key in ["device-a", "device-b", "device-c"]:
+			self.assertEqual(processed[key], list(range(200)))
+			self.assertEqual(len(threads[key]), 1)
+
+	def test_errors_02(self):
+		"""
+		An error in an item does not stop the worker.
+		"""
+		processed = []
+
+		def handler(item):
+			if item is None:
+				raise ValueError("Bad item")
+			processed.append(item)
+
+		pool = WorkerPool(handler, workers=1)
+		pool.start()
+		pool.submit("device", None)
+		pool.submit("device", 1)
+		pool.join()
+		self.assertTrue(pool.stop(5))
+		self.assertEqual(processed, [1])
+
+	def test_conflate_03(self):
+		"""
+		With conflation, only the newest waiting item of each key is
+		processed, and the discarded items are reported.
+		"""
+		processed = []
+		discarded = []
+		gate = threading.Event()
+
+		def handler(item):
+			gate.wait()
+			processed.append(item)
+
+		pool = WorkerPool(
+			handler,
+			workers=1,
+			queue_size=2,
+			conflate=True,
+			shed_policy="drop-newest",
+			on_discard=lambda key, reason: discarded.append((key, reason))
+		)
+		for key, value in [("a", 1), ("a", 2), ("b", 3), ("a", 4), ("c", 5)]:
+			pool.submit(key, value)
+		pool.start()
+		gate.set()
+		pool.join()
+		self.assertTrue(pool.stop(5))
+		self.assertEqual(processed, [4, 3])
+		self.assertEqual(discarded, [("a", "conflated"), ("a", "conflated"), ("c", "shed")])
+
+	def test_stop_timeout_04(self):
+		"""
+		The timeout of `stop` is for all the workers, not for each one.
+		"""
+		gate = threading.Event()
+		pool = WorkerPool(lambda item: gate.wait(), workers=4, queue_size=1, shed_policy="drop-newest")
+		pool.start()
+		for i in range(100):
+			pool.submit(f"device-{i}", i)
+
+		start = time.monotonic()
+		self.assertFalse(pool.stop(0.2))
+		self.assertLess(time.monotonic() - start, 0.6)
+
+		gate.set()
+		self.assertTrue(pool.stop(5))
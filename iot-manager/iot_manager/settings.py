@@ -131,3 +131,9 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# MQTT broker where the changes of the rules and devices are published,
+# so the controllers apply them at once (empty, the default: they are not
+# published, and no client is started)
+CHANGES_BROKER_HOST = os.getenv('CHANGES_BROKER_HOST', '')
+CHANGES_BROKER_PORT = int(os.getenv('CHANGES_BROKER_PORT', '1883'))
@@ -1,3 +1,4 @@
+import threading
 import paho.mqtt.client as mqtt
 from typing import Optional, Callable
 from abc import ABC, abstractmethod
@@ -6,6 +7,9 @@ class IOTDevice(ABC):
 
 	TOPIC_BASENAME = 'redes/2312/10'
 
+	# Class of the MQTT client
+	MQTT_CLIENT = mqtt.Client
+
 	def __init__(
 		self,
 		host: str,
@@ -33,7 +37,10 @@ class IOTDevice(ABC):
 		self.command_topic = f"{self.TOPIC_BASENAME}/{self.device_id}/command"
 
 		# Create the client
-		self.client = mqtt.Client(client_id=self.device_id)
+		self.client = self.MQTT_CLIENT(client_id=self.device_id)
+
+		# Set when the device is stopped (ends the loops of the device)
+		self.stopped = threading.Event()
 
 		# Set the callbacks
 		self.client.on_connect = on_connect
@@ -54,13 +61,20 @@ class IOTDevice(ABC):
 		except Exception as e:
 			return str(e)
 
-		# Start the loop and wait a keyboard interrupt
+		# Start the loop and wait a keyboard interrupt (or until it is stopped)
 		try:
 			self.client.loop_forever()
 		except KeyboardInterrupt:
-			self.client.disconnect()
+			self.stop()
 		return None
 
+	def stop(self) -> None:
+		"""
+		Stop the device: end its loops, and disconnect from the broker.
+		"""
+		self.stopped.set()
+		self.client.disconnect()
+
 	@abstractmethod
 	def on_connect(self, client, userdata, flags, rc) -> None:
 		"""
@@ -3,7 +3,6 @@ import sys
 from typing import Optional
 from datetime import datetime, timedelta
 import threading
-import time
 import json
 
 from .IOTDevice import IOTDevice
@@ -117,11 +116,8 @@ class DummyClockDevice(IOTDevice):
 		# Calculate the time to wait
 		time_to_wait = 1.0 / self.rate
 
-		# Loop where the info is sent
-		while True:
-			# Sleep the calculated time
-			time.sleep(time_to_wait)
-
+		# Loop where the info is sent (until the device is stopped)
+		while not self.stopped.wait(time_to_wait):
 			# Update the time
 			self.current_time += timedelta(seconds=self.increment)
 
@@ -1,7 +1,6 @@
 import argparse
 import sys
 import threading
-import time
 import json
 
 from .IOTDevice import IOTDevice
@@ -106,10 +105,8 @@ class DummySensorDevice(IOTDevice):
 		"""
 		Loop that publishes the state of the sensor.
 		"""
-		while True:
-			# Wait the interval set
-			time.sleep(self.interval)
-
+		# Wait the interval set (until the device is stopped)
+		while not self.stopped.wait(self.interval):
 			# Update the value:
 			# If it is > max value or < min value, the increment is set to the opposite sign
 			next_value = self.value + self.increment